@@ -51,13 +51,15 @@ from .models import (
     SpellingBeePuzzleBase,
     SpellingBeeDefinition,
     SpellingBeeDefinitionBase,
+    OwnTracksPlaceBase,
+    OwnTracksPlace,
 )
 from .nextcloud_connector import MyDiaryNextcloud
 from . import spelling_bee
 from .dictionary_connector import fetch_definition
 from .spotify_connector import normalize_spotify_id
 from .pocket_connector import MyDiaryPocket
-from .core import get_last_timezone
+from .core import get_last_timezone, start_of_day
 
 # a route default, so it has to be resolved at import time rather than lazily
 # like the rest of the owntracks imports. owntracks_track is pure and cheap.
@@ -137,6 +139,14 @@ class DogUpdate(SQLModel):
     notes: Optional[str] = None
 
 
+class OwnTracksPlaceRead(OwnTracksPlaceBase):
+    id: int
+
+
+class OwnTracksPlaceUpdate(SQLModel):
+    name: Optional[str] = None
+
+
 class RecipeRead(RecipeBase):
     id: int
 
@@ -295,10 +305,53 @@ def scheduled_spotify_save_recent_tracks():
 
 
 def scheduled_owntracks_sync():
-    from mydiary.owntracks_connector import MyDiaryOwnTracks
+    with Session(engine) as session:
+        sync_owntracks(session)
 
-    num_saved = MyDiaryOwnTracks().save_locations_to_database()
+
+def sync_owntracks(session: Session, owntracks=None, days_back: int = 7) -> int:
+    """Save new fixes, then bring every day they fell on up to date -- its
+    track, place visits and summary, not just today's: the last run of a day
+    is before midnight, and the recorder can upload a batch days late."""
+    from mydiary.owntracks_cache import processed_day
+    from mydiary.owntracks_connector import MyDiaryOwnTracks
+    from mydiary.owntracks_daypoints import day_columns
+    from mydiary.owntracks_heatmap import MODES, update as update_heatmap
+    from mydiary.owntracks_places import record_stays
+    from mydiary.owntracks_range import days_of
+
+    owntracks = owntracks or MyDiaryOwnTracks()
+    touched: List[datetime] = []
+    num_saved = owntracks.save_locations_to_database(
+        session=session, days_back=days_back, touched=touched
+    )
     logger.info(f"{num_saved} owntracks locations saved")
+    today = _owntracks_day("today", "infer", session)
+    days = [d for d in days_of(touched, session) if d.date() < today.date()]
+    # the fixes are saved; a step failing past here must not cost the others
+    # their run, so each one logs and moves on
+    for dt in days + [today]:
+        try:
+            # fold the new fixes into the day's stays now, so today's track is
+            # ready before anyone asks for it, and its visits count them
+            track, _ = processed_day(dt, session, incremental=dt is today)
+            record_stays(dt.date(), track.stays, session)
+        except Exception:
+            session.rollback()
+            logger.exception(f"failed to update the stays of {dt.date()}")
+        try:
+            # and re-encode its columns, which every other read of the day loads
+            day_columns(dt, session)
+        except Exception:
+            session.rollback()
+            logger.exception(f"failed to encode the fixes of {dt.date()}")
+    for mode in MODES:
+        try:
+            update_heatmap(session, mode)
+        except Exception:
+            session.rollback()
+            logger.exception(f"failed to update the {mode} heatmap")
+    return num_saved
 
 
 scheduler = BackgroundScheduler()
@@ -800,18 +853,7 @@ def _owntracks_day(dt: str, tz: str, session: Session) -> pendulum.DateTime:
     Defaults to the inferred timezone rather than "local": the container runs on
     UTC, and for a map the day boundary decides what is on it.
     """
-    if tz == "infer":
-        try:
-            tz = get_last_timezone(dt, session=session)
-        except (AttributeError, TypeError):
-            # no TimeZoneChange rows recorded yet
-            logger.warning("could not infer timezone; falling back to local")
-            tz = "local"
-    if dt == "today":
-        return pendulum.today(tz=tz)
-    if dt == "yesterday":
-        return pendulum.yesterday(tz=tz)
-    return pendulum.parse(dt, tz=tz)
+    return start_of_day(dt, session, tz=tz)
 
 
 def _track_params(
@@ -834,16 +876,67 @@ def _track_params(
     )
 
 
-@app.get("/owntracks/locations/{dt}", operation_id="owntracksLocationsForDay")
+# a FeatureCollection route's other representations; see owntracks_compact.py
+_COLLECTION_RESPONSES = {
+    200: {
+        "content": {
+            "application/json": {},
+            "application/vnd.mydiary.compact+json": {},
+            "application/msgpack": {},
+        }
+    }
+}
+_FMT_QUERY = Query(
+    None,
+    pattern="^(geojson|compact|msgpack)$",
+    description="geojson, compact (polylines and columns), or msgpack of compact. "
+    "Defaults to what the Accept header asks for, else geojson.",
+)
+
+
+def _collection_response(
+    request: Request, collection: dict, fmt: Optional[str], timezone: str
+) -> Response:
+    """collection in the negotiated format, compressed if the client accepts it."""
+    from .owntracks_compact import (
+        FORMATS,
+        FormatNotAvailable,
+        compress,
+        encode,
+        negotiate,
+    )
+
+    try:
+        fmt = negotiate(fmt, request.headers.get("accept"))
+    except FormatNotAvailable as e:
+        raise HTTPException(status_code=406, detail=str(e))
+    body, encoding = compress(
+        encode(collection, fmt, timezone), request.headers.get("accept-encoding")
+    )
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type=FORMATS[fmt], headers=headers)
+
+
+@app.get(
+    "/owntracks/locations/{dt}",
+    operation_id="owntracksLocationsForDay",
+    responses=_COLLECTION_RESPONSES,
+)
 def owntracks_locations_for_day(
-    dt: str, tz: str = "infer", session: Session = Depends(get_session)
+    dt: str,
+    request: Request,
+    tz: str = "infer",
+    fmt: Optional[str] = _FMT_QUERY,
+    session: Session = Depends(get_session),
 ):
     """The day's raw location fixes, before any smoothing."""
     from .owntracks_connector import MyDiaryOwnTracks
 
     dt_obj = _owntracks_day(dt, tz, session)
     locations = MyDiaryOwnTracks().get_locations_for_day(dt_obj, session=session)
-    return {
+    collection = {
         "type": "FeatureCollection",
         "features": [
             {
@@ -862,11 +955,17 @@ def owntracks_locations_for_day(
             for loc in locations
         ],
     }
+    return _collection_response(request, collection, fmt, dt_obj.timezone_name)
 
 
-@app.get("/owntracks/track/{dt}", operation_id="owntracksTrackForDay")
+@app.get(
+    "/owntracks/track/{dt}",
+    operation_id="owntracksTrackForDay",
+    responses=_COLLECTION_RESPONSES,
+)
 def owntracks_track_for_day(
     dt: str,
+    request: Request,
     tz: str = "infer",
     area_threshold_m: float = AREA_SPLIT_M,
     max_acc: int = 100,
@@ -875,6 +974,8 @@ def owntracks_track_for_day(
     gap_minutes: float = 45.0,
     gap_metres: float = 250.0,
     dwell_max_kmh: float = 1.0,
+    zoom: Optional[float] = Query(None, ge=0, le=24),
+    fmt: Optional[str] = _FMT_QUERY,
     session: Session = Depends(get_session),
 ):
     """The processed day: stays and links, as GeoJSON.
@@ -882,23 +983,109 @@ def owntracks_track_for_day(
     The frontend map draws this, so the interactive view and the rendered image
     always agree -- including how many maps the day is in: every feature carries
     the index of the area it belongs to, and `properties.areas` describes them.
+
+    Pass the zoom the map is at to get links merged and simplified for it --
+    light geometry for a wide view. Leave it out for every link in full.
+
+    `fmt` (or the Accept header) picks a compact form instead: encoded
+    polylines with columnar properties, as JSON or MessagePack.
     """
-    from .owntracks_connector import MyDiaryOwnTracks
-    from .owntracks_track import (
-        build_track,
-        points_from_locations,
-        split_into_areas,
-        track_to_geojson,
-    )
+    from .gazetteer import get_gazetteer
+    from .owntracks_cache import processed_day
+    from .owntracks_track import track_to_geojson
 
     dt_obj = _owntracks_day(dt, tz, session)
     params = _track_params(
         max_acc, stay_radius_m, stay_minutes, gap_minutes, gap_metres, dwell_max_kmh
     )
-    locations = MyDiaryOwnTracks().get_locations_for_day(dt_obj, session=session)
-    points = points_from_locations(locations, timezone=dt_obj.timezone_name)
-    track = build_track(points, params)
-    return track_to_geojson(track, split_into_areas(track, area_threshold_m))
+    track, areas = processed_day(dt_obj, session, params, area_threshold_m)
+    collection = track_to_geojson(track, areas, get_gazetteer(), zoom=zoom)
+    return _collection_response(request, collection, fmt, dt_obj.timezone_name)
+
+
+@app.get(
+    "/owntracks/track",
+    operation_id="owntracksTrackForRange",
+    responses={
+        200: {"content": {"application/x-ndjson": {}, "application/msgpack": {}}},
+        406: {"description": "msgpack was asked for and is not installed"},
+    },
+)
+def owntracks_track_for_range(
+    request: Request,
+    start: date,
+    end: date,
+    tz: str = "infer",
+    area_threshold_m: float = AREA_SPLIT_M,
+    max_acc: int = 100,
+    stay_radius_m: float = 150.0,
+    stay_minutes: float = 20.0,
+    gap_minutes: float = 45.0,
+    gap_metres: float = 250.0,
+    dwell_max_kmh: float = 1.0,
+    zoom: Optional[float] = Query(None, ge=0, le=24),
+    fmt: Optional[str] = _FMT_QUERY,
+    session: Session = Depends(get_session),
+):
+    """Every day from start to end (inclusive), as /owntracks/track/{dt} gives
+    each, streamed one record per day, in date order:
+    `{"date", "timezone", "track"}`.
+
+    `fmt` (or the Accept header) picks the track's form as for one day. GeoJSON
+    and compact records are lines of NDJSON; msgpack records are a sequence of
+    MessagePack documents (406 if msgpack is not installed). Compressed with
+    brotli or gzip as the client accepts, flushed after every day.
+
+    One query finds every day's timezone and one loads every fix; days not
+    already cached are built in parallel. At most a year and a day at a time.
+    """
+    from fastapi.responses import StreamingResponse
+
+    from .gazetteer import get_gazetteer
+    from .owntracks_compact import (
+        STREAM_FORMATS,
+        FormatNotAvailable,
+        compact_collection,
+        compress_stream,
+        encode_record,
+        negotiate,
+    )
+    from .owntracks_range import MAX_RANGE_DAYS, range_tracks
+    from .owntracks_track import track_to_geojson
+
+    if end < start:
+        raise HTTPException(status_code=422, detail="end is before start")
+    if (end - start).days + 1 > MAX_RANGE_DAYS:
+        raise HTTPException(
+            status_code=422, detail=f"at most {MAX_RANGE_DAYS} days at a time"
+        )
+    try:
+        fmt = negotiate(fmt, request.headers.get("accept"))
+    except FormatNotAvailable as e:
+        raise HTTPException(status_code=406, detail=str(e))
+    params = _track_params(
+        max_acc, stay_radius_m, stay_minutes, gap_minutes, gap_metres, dwell_max_kmh
+    )
+    gazetteer = get_gazetteer()
+
+    def lines():
+        days = range_tracks(start, end, session, params, area_threshold_m, tz=tz)
+        for dt, track, areas in days:
+            collection = track_to_geojson(track, areas, gazetteer, zoom=zoom)
+            if fmt != "geojson":
+                collection = compact_collection(collection, dt.timezone_name)
+            record = {
+                "date": dt.to_date_string(),
+                "timezone": dt.timezone_name,
+                "track": collection,
+            }
+            yield encode_record(record, fmt)
+
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    body, encoding = compress_stream(lines(), request.headers.get("accept-encoding"))
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return StreamingResponse(body, media_type=STREAM_FORMATS[fmt], headers=headers)
 
 
 @app.get(
@@ -914,6 +1101,10 @@ def owntracks_day_map_image(
     height: int = 900,
     fmt: str = "JPEG",
     quality: int = 85,
+    supersample: str = "full",
+    max_bytes: Optional[int] = None,
+    min_quality: int = 40,
+    resize_to_fit: bool = False,
     panel: int = 0,
     max_acc: int = 100,
     stay_radius_m: float = 150.0,
@@ -924,7 +1115,9 @@ def owntracks_day_map_image(
     session: Session = Depends(get_session),
 ):
     """The day's map. Panel 0 is the whole day; on a day spent in two or more
-    distinct areas, higher panels are the per-area maps."""
+    distinct areas, higher panels are the per-area maps. max_bytes caps the
+    image's size: quality is lowered as far as min_quality to fit, and with
+    resize_to_fit the image is made smaller if that is not enough."""
     from .map_render import RenderParams
     from .owntracks_maps import render_for_day
 
@@ -932,11 +1125,21 @@ def owntracks_day_map_image(
     params = _track_params(
         max_acc, stay_radius_m, stay_minutes, gap_minutes, gap_metres, dwell_max_kmh
     )
-    render = RenderParams(width=width, height=height, fmt=fmt, quality=quality)
+    render = RenderParams(
+        width=width,
+        height=height,
+        fmt=fmt,
+        quality=quality,
+        supersample=supersample,
+        max_bytes=max_bytes,
+        min_quality=min_quality,
+        resize_to_fit=resize_to_fit,
+    )
     try:
-        media_type = render.media_type
+        render.validate()
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    media_type = render.media_type
     try:
         data, _, content_hash = render_for_day(dt_obj, session, params, render, panel)
     except LookupError as e:
@@ -970,18 +1173,16 @@ def owntracks_areas_for_day(
     Clustering runs on stays only: a road trip's waypoints are each far apart,
     so clustering every point would report a single drive as dozens of areas.
     """
-    from .owntracks_maps import day_track
-    from .owntracks_track import split_into_areas
+    from .owntracks_maps import day_track_and_areas
 
     dt_obj = _owntracks_day(dt, tz, session)
     params = _track_params(
         max_acc, stay_radius_m, stay_minutes, gap_minutes, gap_metres, dwell_max_kmh
     )
     try:
-        track = day_track(dt_obj, session, params)
+        _, areas = day_track_and_areas(dt_obj, session, params, area_threshold_m)
     except LookupError as e:
         raise HTTPException(status_code=404, detail=str(e))
-    areas = split_into_areas(track, area_threshold_m)
     return {
         "num_areas": len(areas),
         # the whole-day overview counts too, so a two-area day is three maps
@@ -1006,12 +1207,116 @@ def owntracks_areas_for_day(
 def owntracks_sync_locations(
     days_back: int = 7, session: Session = Depends(get_session)
 ):
-    from .owntracks_connector import MyDiaryOwnTracks
+    num_added = sync_owntracks(session, days_back=days_back)
+    return {"num_added": num_added}
+
+
+@app.get("/owntracks/places", operation_id="owntracksPlaces")
+def owntracks_places(session: Session = Depends(get_session)):
+    """Every known place, most visited first, with the time spent there."""
+    from .models import OwnTracksPlaceVisit
+
+    rows = session.exec(
+        select(
+            OwnTracksPlace,
+            func.count(OwnTracksPlaceVisit.id),
+            func.coalesce(func.sum(OwnTracksPlaceVisit.minutes), 0.0),
+        )
+        .outerjoin(OwnTracksPlaceVisit)
+        .group_by(OwnTracksPlace.id)
+        .order_by(desc(func.count(OwnTracksPlaceVisit.id)), OwnTracksPlace.id)
+    ).all()
+    return [
+        {
+            **OwnTracksPlaceRead.model_validate(place).model_dump(),
+            "num_visits": num_visits,
+            "minutes": round(minutes),
+        }
+        for place, num_visits, minutes in rows
+    ]
+
+
+@app.patch(
+    "/owntracks/places/{place_id}",
+    operation_id="updateOwnTracksPlace",
+    response_model=OwnTracksPlaceRead,
+)
+def update_owntracks_place(
+    *,
+    session: Session = Depends(get_session),
+    place_id: int,
+    place: OwnTracksPlaceUpdate,
+):
+    """Name a place; the itinerary uses the name from the next map sync on."""
+    db_place = session.get(OwnTracksPlace, place_id)
+    if not db_place:
+        raise HTTPException(status_code=404, detail="Place not found")
+    place_data = place.model_dump(exclude_unset=True)
+    for k, v in place_data.items():
+        setattr(db_place, k, v)
+    session.add(db_place)
+    session.commit()
+    session.refresh(db_place)
+    return db_place
+
+
+@app.get("/owntracks/places/{place_id}/minutes", operation_id="owntracksPlaceMinutes")
+def owntracks_place_minutes(
+    place_id: int,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    session: Session = Depends(get_session),
+):
+    """Time spent at a place, optionally between two diary dates."""
+    from .owntracks_places import minutes_at
 
-    num_added = MyDiaryOwnTracks().save_locations_to_database(
-        session=session, days_back=days_back
+    if session.get(OwnTracksPlace, place_id) is None:
+        raise HTTPException(status_code=404, detail="Place not found")
+    minutes = minutes_at(place_id, session, start, end)
+    return {"place_id": place_id, "minutes": round(minutes)}
+
+
+@app.get("/owntracks/stats", operation_id="owntracksStats")
+def owntracks_stats(
+    by: str = Query("week", pattern="^(week|month|year)$"),
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    places: int = Query(5, ge=0, le=50),
+    session: Session = Depends(get_session),
+):
+    """Distance, stays, time moving and time at places, per week, month or year.
+
+    Adds up the per-day summaries written as days' tracks are built, so a day
+    that has never been built (or backfilled, see
+    scripts/owntracks_backfill_summaries.py) is not counted, and each period
+    lists its stale_days, whose summaries predate some of their fixes.
+    """
+    from .owntracks_stats import period_stats
+
+    periods = period_stats(session, by=by, start=start, end=end, num_places=places)
+    return {"by": by, "periods": periods}
+
+
+@app.get(
+    "/owntracks/heatmap/{mode}/{z}/{x}/{y}.png",
+    operation_id="owntracksHeatmapTile",
+    response_class=Response,
+)
+def owntracks_heatmap_tile(mode: str, z: int, x: int, y: int):
+    """A 256px z/x/y heatmap tile of every fix ("fixes") or of the time spent
+    at each place ("stays"), for a Leaflet overlay. Blank where nothing is."""
+    from .owntracks_heatmap import MAX_ZOOM, MIN_ZOOM, MODES, get_store
+
+    if mode not in MODES:
+        raise HTTPException(status_code=404, detail=f"no heatmap layer {mode!r}")
+    if not MIN_ZOOM <= z <= MAX_ZOOM or not (0 <= x < 2**z and 0 <= y < 2**z):
+        raise HTTPException(status_code=404, detail="tile out of range")
+    return Response(
+        content=get_store(mode).tile_png(z, x, y),
+        media_type="image/png",
+        # the hourly sync can redraw a tile, so not immutable
+        headers={"Cache-Control": "private, max-age=3600"},
     )
-    return {"num_added": num_added}
 
 
 @app.post("/owntracks/map/{dt}/to_note", operation_id="owntracksMapToNote")
@@ -1035,6 +1340,61 @@ def owntracks_map_to_note(
     return {"result": result, "num_maps": num_maps}
 
 
+@app.post("/owntracks/map_jobs", operation_id="owntracksQueueMapRenders")
+def owntracks_queue_map_renders(
+    start: date,
+    end: date,
+    width: int = 1200,
+    height: int = 900,
+    fmt: str = "JPEG",
+    quality: int = 85,
+    supersample: str = "full",
+    max_bytes: Optional[int] = None,
+    min_quality: int = 40,
+    resize_to_fit: bool = False,
+    session: Session = Depends(get_session),
+):
+    """Queue every day's maps from start to end (inclusive) for rendering on
+    the background render service, which is started if it is not running.
+    A later GET /owntracks/map/{dt} or note sync finds them rendered."""
+    from .map_jobs import queue_status, run_in_background, submit
+    from .map_render import RenderParams
+    from .owntracks_range import MAX_RANGE_DAYS
+
+    if end < start:
+        raise HTTPException(status_code=422, detail="end is before start")
+    if (end - start).days + 1 > MAX_RANGE_DAYS:
+        raise HTTPException(
+            status_code=422, detail=f"at most {MAX_RANGE_DAYS} days at a time"
+        )
+    render = RenderParams(
+        width=width,
+        height=height,
+        fmt=fmt,
+        quality=quality,
+        supersample=supersample,
+        max_bytes=max_bytes,
+        min_quality=min_quality,
+        resize_to_fit=resize_to_fit,
+    )
+    try:
+        render.validate()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    days = list(pendulum.interval(start, end).range("days"))
+    num_queued = submit(days, session, render=render)
+    started = run_in_background()
+    return {"num_queued": num_queued, "started": started, **queue_status(session)}
+
+
+@app.get("/owntracks/map_jobs", operation_id="owntracksMapRenderStatus")
+def owntracks_map_render_status(session: Session = Depends(get_session)):
+    """How many render jobs are in each status, and the service's progress."""
+    from .map_jobs import queue_status, service_progress
+
+    return {**queue_status(session), "service": service_progress()}
+
+
 @app.post(
     "/images/upload/{note_id}",
     operation_id="uploadImagesToNote",
@@ -3,7 +3,8 @@
 DESCRIPTION = """core.py"""
 
 import sys, os, time
-from typing import Tuple
+from datetime import date
+from typing import Tuple, Union
 import requests
 import json
 import hashlib
@@ -77,6 +78,31 @@ def get_last_timezone(dt_str: str, session: Session) -> str:
     else:
         return z.tz_after
 
+
+def start_of_day(
+    diary_date: Union[date, str], session: Session, tz: str = "infer"
+) -> pendulum.DateTime:
+    """Start of the day in the day's own timezone.
+
+    diary_date is a date, or a string as the API routes take it: "today",
+    "yesterday" or an ISO date. With tz="infer" the timezone comes from
+    TimeZoneChange, falling back to local while that table is still empty.
+    """
+    dt_str = diary_date if isinstance(diary_date, str) else diary_date.isoformat()
+    if tz == "infer":
+        try:
+            tz = get_last_timezone(dt_str, session=session)
+        except (AttributeError, TypeError):
+            # no TimeZoneChange rows recorded yet
+            logger.warning("could not infer timezone; falling back to local")
+            tz = "local"
+    if dt_str == "today":
+        return pendulum.today(tz=tz)
+    if dt_str == "yesterday":
+        return pendulum.yesterday(tz=tz)
+    return pendulum.parse(dt_str, tz=tz)
+
+
 def get_hash_from_txt(txt: str) -> str:
     hash = hashlib.md5()
     hash.update(txt.encode("utf-8"))
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Offline reverse geocoding: the nearest town to a position.
+
+A stay at an unnamed place is a pair of coordinates, and a day away is a map
+with a time range over it. Naming them needs a reverse geocoder, and the
+nightly batch cannot call a network service per stay. This answers from a
+local gazetteer dump instead: a GeoNames-style TSV (e.g. cities1000.txt from
+download.geonames.org), pointed at by MYDIARY_GAZETTEER.
+
+The TSV is compiled once into a KD-tree laid out in flat arrays -- positions as
+unit vectors, so nearest by chord is nearest on the sphere with no special case
+at the antimeridian or the poles -- and saved as .npy files under the cache
+directory. Loading memory-maps them, so opening the gazetteer costs nothing in
+proportion to its size and the pages a query never touches are never read.
+
+The tree is implicit: the node for a range of the arrays is its middle entry,
+split on axis depth % 3, so there are no child pointers to store."""
+
+import hashlib
+import math
+import os
+import shutil
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+# bump when the compiled layout changes, so old indexes are rebuilt
+INDEX_VERSION = 1
+
+# the same as haversine_m, so distances agree with the rest of the pipeline
+EARTH_RADIUS_M = 6371000.0
+
+# a position farther than this from every town is in the middle of nowhere
+# (or the sea), and naming it after a town 80km away would be wrong
+MAX_DISTANCE_M = 25000.0
+
+# GeoNames columns (of 19): geonameid, name, asciiname, alternatenames,
+# latitude, longitude, feature class, feature code, country code, ...
+_NAME, _LAT, _LON, _FEATURE_CLASS, _COUNTRY = 1, 4, 5, 6, 8
+
+
+@dataclass(frozen=True)
+class Locality:
+    name: str
+    country_code: str
+    lat: float
+    lon: float
+    distance_m: float
+
+    def label(self) -> str:
+        """e.g. 'Ghent, BE'."""
+        if self.country_code:
+            return f"{self.name}, {self.country_code}"
+        return self.name
+
+
+def _unit_vectors(lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    lat = np.radians(lats)
+    lon = np.radians(lons)
+    return np.column_stack(
+        (np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat))
+    )
+
+
+def read_tsv(path: Union[str, Path]) -> Tuple[List[str], List[float], List[float]]:
+    """(labels, lats, lons) of the populated places in a GeoNames-style TSV.
+
+    A label is 'name\\tcountry code'. Rows of another feature class (mountains,
+    lakes, ...) are skipped, as are comments and rows too short to parse.
+    """
+    labels, lats, lons = [], [], []
+    num_bad = 0
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip() or line.startswith("#"):
+                continue
+            cols = line.rstrip("\n").split("\t")
+            try:
+                if cols[_FEATURE_CLASS] not in ("P", ""):
+                    continue
+                lat, lon = float(cols[_LAT]), float(cols[_LON])
+                labels.append(f"{cols[_NAME]}\t{cols[_COUNTRY]}")
+            except (IndexError, ValueError):
+                num_bad += 1
+                continue
+            lats.append(lat)
+            lons.append(lon)
+    if num_bad:
+        logger.warning(f"{path}: skipped {num_bad} unparseable row(s)")
+    return labels, lats, lons
+
+
+def _kdtree_order(points: np.ndarray) -> np.ndarray:
+    """The permutation of points that lays them out as an implicit KD-tree."""
+    order = np.arange(len(points))
+    stack = [(0, len(points), 0)]
+    while stack:
+        lo, hi, axis = stack.pop()
+        if hi - lo < 2:
+            continue
+        idx = order[lo:hi]
+        k = (hi - lo) // 2
+        order[lo:hi] = idx[np.argpartition(points[idx, axis], k)]
+        mid = lo + k
+        nxt = (axis + 1) % 3
+        stack.append((lo, mid, nxt))
+        stack.append((mid + 1, hi, nxt))
+    return order
+
+
+def build_index(tsv_path: Union[str, Path], out_dir: Union[str, Path]) -> int:
+    """Compile a gazetteer TSV into out_dir. Returns the number of places.
+
+    Written to a temporary directory first and renamed into place, so a reader
+    never sees half an index.
+    """
+    labels, lats, lons = read_tsv(tsv_path)
+    points = _unit_vectors(np.asarray(lats, float), np.asarray(lons, float))
+    order = _kdtree_order(points)
+    encoded = [labels[i].encode("utf-8") for i in order]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+
+    out_dir = Path(out_dir)
+    tmp_dir = out_dir.with_name(f"{out_dir.name}.tmp{os.getpid()}")
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    np.save(tmp_dir / "points.npy", np.ascontiguousarray(points[order]))
+    np.save(tmp_dir / "offsets.npy", offsets)
+    np.save(tmp_dir / "labels.npy", np.frombuffer(b"".join(encoded), np.uint8))
+    try:
+        os.replace(tmp_dir, out_dir)
+    except OSError:
+        # another process got there first: theirs is the same index
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    logger.info(f"compiled {len(encoded)} places from {tsv_path}")
+    return len(encoded)
+
+
+class Gazetteer:
+    """A compiled gazetteer, memory-mapped. See build_index and open_tsv."""
+
+    def __init__(self, index_dir: Union[str, Path]):
+        index_dir = Path(index_dir)
+        self.points = np.load(index_dir / "points.npy", mmap_mode="r")
+        self.offsets = np.load(index_dir / "offsets.npy", mmap_mode="r")
+        self.labels = np.load(index_dir / "labels.npy", mmap_mode="r")
+        # indexing a memoryview gives Python floats, several times faster than
+        # numpy scalars for a walk that touches one coordinate at a time
+        self._flat = memoryview(self.points.reshape(-1)).cast("B").cast("d")
+
+    @classmethod
+    def open_tsv(
+        cls, tsv_path: Union[str, Path], cache_dir: Optional[Path] = None
+    ) -> "Gazetteer":
+        """Open a TSV's compiled index, compiling it first if it is not cached.
+
+        The index is keyed on the file's path, size and mtime, so replacing the
+        dump compiles a new one.
+        """
+        # lazily imported: it brings the database with it, and owntracks_track
+        # (pure functions) imports this module
+        from .thumbnail_cache import get_cache_dir
+
+        tsv_path = Path(tsv_path).resolve()
+        stat = tsv_path.stat()
+        key = hashlib.sha256(
+            f"{INDEX_VERSION}|{tsv_path}|{stat.st_size}|{stat.st_mtime_ns}".encode()
+        ).hexdigest()[:16]
+        index_dir = (cache_dir or get_cache_dir("gazetteer")) / key
+        if not (index_dir / "labels.npy").exists():
+            build_index(tsv_path, index_dir)
+        return cls(index_dir)
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def nearest(
+        self, lat: float, lon: float, max_distance_m: float = MAX_DISTANCE_M
+    ) -> Optional[Locality]:
+        """The nearest place within max_distance_m, or None."""
+        if not len(self.points):
+            return None
+        phi, lam = math.radians(lat), math.radians(lon)
+        cos_phi = math.cos(phi)
+        q = (cos_phi * math.cos(lam), cos_phi * math.sin(lam), math.sin(phi))
+        # compare squared chords: monotone in distance along the surface
+        half_angle = min(max_distance_m / (2 * EARTH_RADIUS_M), math.pi / 2)
+        chord = 2 * math.sin(half_angle)
+        best = [chord * chord, -1]
+        self._search(q, 0, len(self.points), 0, best)
+        best_d2, i = best
+        if i < 0:
+            return None
+        x, y, z = self._flat[3 * i : 3 * i + 3]
+        name, _, country = (
+            bytes(self.labels[self.offsets[i] : self.offsets[i + 1]])
+            .decode("utf-8")
+            .partition("\t")
+        )
+        return Locality(
+            name=name,
+            country_code=country,
+            lat=math.degrees(math.asin(max(-1.0, min(1.0, z)))),
+            lon=math.degrees(math.atan2(y, x)),
+            distance_m=2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(best_d2) / 2)),
+        )
+
+    def _search(self, q, lo: int, hi: int, axis: int, best: list) -> None:
+        p = self._flat
+        qx, qy, qz = q
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            b = 3 * mid
+            dx, dy, dz = qx - p[b], qy - p[b + 1], qz - p[b + 2]
+            d2 = dx * dx + dy * dy + dz * dz
+            if d2 < best[0]:
+                best[0], best[1] = d2, mid
+            diff = q[axis] - p[b + axis]
+            nxt = axis + 1 if axis < 2 else 0
+            if diff < 0:
+                self._search(q, lo, mid, nxt, best)
+                lo = mid + 1
+            else:
+                self._search(q, mid + 1, hi, nxt, best)
+                hi = mid
+            # the far side can only help if the splitting plane is within reach
+            if diff * diff >= best[0]:
+                return
+            axis = nxt
+
+    def label(
+        self, lat: float, lon: float, max_distance_m: float = MAX_DISTANCE_M
+    ) -> Optional[str]:
+        locality = self.nearest(lat, lon, max_distance_m)
+        return locality.label() if locality is not None else None
+
+
+@lru_cache(maxsize=1)
+def _open(path: str, size: int, mtime_ns: int) -> Gazetteer:
+    return Gazetteer.open_tsv(path)
+
+
+def get_gazetteer() -> Optional[Gazetteer]:
+    """The gazetteer MYDIARY_GAZETTEER points at, or None if there is none.
+
+    None is the normal case without a dump, and everything that names places
+    falls back to coordinates -- exactly the output from before there was one.
+    """
+    path = os.getenv("MYDIARY_GAZETTEER")
+    if not path:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        logger.warning(f"MYDIARY_GAZETTEER={path} not found; not naming places")
+        return None
+    return _open(path, stat.st_size, stat.st_mtime_ns)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Disk cache of rendered day maps, keyed by their content hash.
+
+A panel's content_hash (owntracks_maps._content_hash) covers the processed
+track, the render parameters and how the panel is framed, so the encoded
+image it names never changes: there is no invalidation, only eviction. The
+browser's ETag saves a re-render for the one tab that holds it; this saves it
+for every other client, and for a Joplin re-upload of a map rendered before.
+
+Files are {hash}.img under {MYDIARY_CACHE_DIR}/maps/. A read touches the
+file's mtime, so the mtime is when it was last used; a write that takes the
+directory past max_bytes (MYDIARY_MAP_CACHE_MB) deletes the least recently
+used down to LOW_WATER of it."""
+
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+
+from . import thumbnail_cache
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+DEFAULT_MAP_CACHE_MB = 256
+# evict down to this fraction of max_bytes, so one eviction covers many writes
+LOW_WATER = 0.9
+
+
+class MapCache:
+    """One directory of encoded maps. Thread-safe; other processes may share
+    the directory, in which case num_bytes is this process's estimate until
+    the next eviction rescans it."""
+
+    def __init__(self, cache_dir: os.PathLike, max_bytes: int) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.num_bytes = sum(f.stat().st_size for f in self.cache_dir.glob("*.img"))
+        self.hits = self.misses = self.evictions = 0
+
+    def _path(self, key: str) -> Path:
+        if not key.isalnum():
+            raise ValueError(f"not a content hash: {key!r}")
+        return self.cache_dir / f"{key}.img"
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+        except FileNotFoundError:  # never stored, or evicted since
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        path = self._path(key)
+        tmp_path = path.with_name(f"{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(data)
+        with self._lock:
+            try:
+                old = path.stat().st_size
+            except FileNotFoundError:
+                old = 0
+            os.replace(tmp_path, path)
+            self.num_bytes += len(data) - old
+            over = self.num_bytes > self.max_bytes
+        if over:
+            self.evict()
+
+    def evict(self, target_bytes: Optional[int] = None) -> int:
+        """Delete least recently used maps until the directory is at most
+        target_bytes (LOW_WATER of max_bytes by default). Returns how many."""
+        if target_bytes is None:
+            target_bytes = int(self.max_bytes * LOW_WATER)
+        with self._lock:
+            files = []
+            for f in self.cache_dir.glob("*.img"):
+                try:
+                    st = f.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, f.name, f, st.st_size))
+            self.num_bytes = sum(size for *_, size in files)
+            num = 0
+            for _, _, f, size in sorted(files):
+                if self.num_bytes <= target_bytes:
+                    break
+                f.unlink(missing_ok=True)
+                self.num_bytes -= size
+                num += 1
+            self.evictions += num
+        if num:
+            logger.debug(f"evicted {num} map(s); cache is {self.num_bytes} bytes")
+        return num
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                num_bytes=self.num_bytes,
+                max_bytes=self.max_bytes,
+            )
+
+
+_caches: Dict[Path, MapCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_map_cache() -> MapCache:
+    """The map cache under the current cache dir, opened once per process. Its
+    cap is MYDIARY_MAP_CACHE_MB, read when it is first opened."""
+    cache_dir = thumbnail_cache.get_cache_dir(subdir="maps")
+    with _caches_lock:
+        cache = _caches.get(cache_dir)
+        if cache is None:
+            mb = float(os.getenv("MYDIARY_MAP_CACHE_MB") or DEFAULT_MAP_CACHE_MB)
+            cache = _caches[cache_dir] = MapCache(cache_dir, int(mb * 1024 * 1024))
+        return cache
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Batch map rendering: a database job queue, worked by a process pool.
+
+sync_day_map_to_note renders a day's panels on the calling thread, so a
+backfill of a few hundred days is tile decoding, LANCZOS and JPEG optimize on
+one core, one day after another. Here rendering is split from uploading:
+
+  * submit queues MapRenderJob rows -- (day, panel, TrackParams, RenderParams)
+  * RenderService renders them on a pool of worker processes into the map
+    cache (map_cache.py), retries a failed job up to max_attempts times, and
+    logs progress as it goes
+  * the sync afterwards finds every panel already rendered, and only uploads
+
+The workers' tile downloads share one rate limit per tile provider, so a pool
+of them is no harder on the tile CDN than one process. The queue is in the
+database, so an interrupted backfill carries on where it stopped. Run one
+service at a time: a starting service takes any job left "running" to be
+from one that died."""
+
+import json
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Executor, Future
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import asdict
+from datetime import date
+from timeit import default_timer as timer
+from typing import Callable, Dict, List, Optional, Sequence
+
+import pendulum
+from sqlmodel import Session, col, func, select
+
+from .db import engine
+from .map_render import LAYERS, RenderParams
+from .map_tiles import RateLimiter, TilesOffline, set_rate_limits
+from .models import MapRenderJob
+from .owntracks_maps import panels_for_day, render_cached
+from .owntracks_range import day_timezones
+from .owntracks_track import TrackParams
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+# leave a core for the web server, or for the sync uploading behind the pool
+RENDER_WORKERS = max(1, (os.cpu_count() or 1) - 1)
+MAX_ATTEMPTS = 3
+# tile downloads a second, per provider, across every worker
+TILE_RATE = 10.0
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+def _params_json(params) -> str:
+    return json.dumps(asdict(params), sort_keys=True)
+
+
+def submit(
+    days: Sequence[date],
+    session: Session,
+    params: Optional[TrackParams] = None,
+    render: Optional[RenderParams] = None,
+    panel: Optional[int] = None,
+) -> int:
+    """Queue a render of each day's map(s) -- every panel, or just panel.
+    Returns how many jobs were queued: a day already queued with the same
+    parameters is not queued twice, and its finished jobs are dropped."""
+    params_json = _params_json(params or TrackParams())
+    render_json = _params_json(render or RenderParams())
+    existing = session.exec(
+        select(MapRenderJob).where(
+            col(MapRenderJob.diary_date).in_(days),
+            MapRenderJob.panel == panel,
+            MapRenderJob.params == params_json,
+            MapRenderJob.render == render_json,
+        )
+    ).all()
+    pending = set()
+    for job in existing:
+        if job.status in (DONE, FAILED):
+            session.delete(job)
+        else:
+            pending.add(job.diary_date)
+    todo = sorted(set(days) - pending)
+    timezones = day_timezones(todo, session)
+    now = pendulum.now("UTC")
+    for diary_date in todo:
+        session.add(
+            MapRenderJob(
+                diary_date=diary_date,
+                timezone=timezones[diary_date],
+                panel=panel,
+                params=params_json,
+                render=render_json,
+                status=QUEUED,
+                created_at=now,
+                updated_at=now,
+            )
+        )
+    session.commit()
+    return len(todo)
+
+
+def queue_status(session: Session) -> Dict[str, int]:
+    """How many jobs are in each status."""
+    counts = dict.fromkeys([QUEUED, RUNNING, DONE, FAILED], 0)
+    rows = session.exec(
+        select(MapRenderJob.status, func.count()).group_by(MapRenderJob.status)
+    )
+    counts.update(dict(rows.all()))
+    return counts
+
+
+def render_job(
+    diary_date: date,
+    timezone: str,
+    panel: Optional[int],
+    params: str,
+    render: str,
+    session: Optional[Session] = None,
+) -> List[str]:
+    """Render one job's panels into the map cache; returns their content
+    hashes. Runs in a worker process, on a session of its own."""
+    close_session = session is None
+    if session is None:
+        session = Session(engine)
+    try:
+        track_params = TrackParams(**json.loads(params))
+        render_params = RenderParams(**json.loads(render))
+        dt = pendulum.parse(diary_date.isoformat(), tz=timezone)
+        _, panels = panels_for_day(dt, session, track_params, render_params)
+        if panel is not None:
+            if not 0 <= panel < len(panels):
+                raise LookupError(f"{diary_date} has no panel {panel}")
+            panels = [panels[panel]]
+        render_cached(panels, track_params, render_params)
+        return [p.content_hash for p in panels]
+    finally:
+        if close_session:
+            session.close()
+
+
+def _retriable(e: BaseException) -> bool:
+    # a missing tile may be there next time; a day with no fixes will not be
+    if isinstance(e, TilesOffline):
+        return True
+    return not isinstance(e, (LookupError, ValueError))
+
+
+def _init_worker(limits: Dict[str, RateLimiter]) -> None:
+    set_rate_limits(limits)
+
+
+class _InlineExecutor(Executor):
+    """Runs each job as it is submitted, on the caller's session: workers=0."""
+
+    def __init__(self, session: Session) -> None:
+        self.session = session
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future: Future = Future()
+        try:
+            future.set_result(fn(*args, session=self.session, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+class RenderService:
+    """Works the queue off with a bounded pool of worker processes.
+
+    workers=0 renders on the calling thread instead, on the caller's session.
+    tile_rate is downloads a second per tile provider, shared by the pool.
+    """
+
+    def __init__(
+        self,
+        workers: int = RENDER_WORKERS,
+        max_attempts: int = MAX_ATTEMPTS,
+        tile_rate: Optional[float] = TILE_RATE,
+    ) -> None:
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.tile_rate = tile_rate
+        self.progress = dict(total=0, done=0, failed=0, retried=0)
+
+    def _executor(self, session: Session) -> Executor:
+        if self.workers <= 0:
+            return _InlineExecutor(session)
+        # spawn, not fork: the server has threads (the scheduler, the
+        # threadpool) that a forked child would inherit mid-whatever
+        ctx = multiprocessing.get_context("spawn")
+        limits = {}
+        if self.tile_rate:
+            limits = {p.name(): RateLimiter(self.tile_rate, ctx) for p in LAYERS}
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=ctx,
+            initializer=_init_worker,
+            initargs=(limits,),
+        )
+
+    def run(
+        self,
+        session: Session,
+        on_progress: Optional[Callable[[Dict[str, int]], None]] = None,
+    ) -> Dict[str, int]:
+        """Render every queued job, and any left running by a service that
+        died. Returns the progress counts: total, done, failed, retried."""
+        for job in session.exec(
+            select(MapRenderJob).where(MapRenderJob.status == RUNNING)
+        ).all():
+            job.status = QUEUED
+            session.add(job)
+        session.commit()
+        pending = deque(
+            session.exec(
+                select(MapRenderJob.id)
+                .where(MapRenderJob.status == QUEUED)
+                .order_by(MapRenderJob.id)
+            ).all()
+        )
+        self.progress = dict(total=len(pending), done=0, failed=0, retried=0)
+        if not pending:
+            return self.progress
+        logger.info(f"rendering {len(pending)} map job(s) on {self.workers} worker(s)")
+
+        start = timer()
+        in_flight: Dict[Future, int] = {}
+        executor = self._executor(session)
+        if self.workers <= 0 and self.tile_rate:
+            set_rate_limits({p.name(): RateLimiter(self.tile_rate) for p in LAYERS})
+        try:
+            while pending or in_flight:
+                # a couple of jobs per worker in flight keeps the pool busy
+                # without claiming the whole queue up front
+                while pending and len(in_flight) < 2 * max(self.workers, 1):
+                    job = session.get(MapRenderJob, pending.popleft())
+                    job.status = RUNNING
+                    job.attempts += 1
+                    job.updated_at = pendulum.now("UTC")
+                    session.add(job)
+                    session.commit()
+                    future = executor.submit(
+                        render_job,
+                        job.diary_date,
+                        job.timezone,
+                        job.panel,
+                        job.params,
+                        job.render,
+                    )
+                    in_flight[future] = job.id
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                broken = False
+                for future in finished:
+                    job_id = in_flight.pop(future)
+                    error = future.exception()
+                    # a worker that died (killed, out of memory) takes the
+                    # pool with it, and fails every job it had in flight
+                    broken = broken or isinstance(error, BrokenProcessPool)
+                    if self._finish(session, job_id, error):
+                        pending.append(job_id)
+                    self._log_progress(start)
+                    if on_progress is not None:
+                        on_progress(dict(self.progress))
+                if broken and not in_flight:
+                    logger.warning("the render pool broke; starting a new one")
+                    executor.shutdown(cancel_futures=True)
+                    executor = self._executor(session)
+        finally:
+            executor.shutdown(cancel_futures=True)
+            if self.workers <= 0:
+                set_rate_limits({})
+        return self.progress
+
+    def _finish(
+        self, session: Session, job_id: int, error: Optional[BaseException]
+    ) -> bool:
+        """Record a job's outcome; True if it goes back on the queue."""
+        job = session.get(MapRenderJob, job_id)
+        job.updated_at = pendulum.now("UTC")
+        retry = False
+        if error is None:
+            job.status = DONE
+            job.error = None
+            self.progress["done"] += 1
+        else:
+            job.error = f"{type(error).__name__}: {error}"
+            retry = _retriable(error) and job.attempts < self.max_attempts
+            job.status = QUEUED if retry else FAILED
+            self.progress["retried" if retry else "failed"] += 1
+            logger.warning(
+                f"map job for {job.diary_date} failed (attempt {job.attempts}"
+                f"{', will retry' if retry else ''}): {job.error}"
+            )
+        session.add(job)
+        session.commit()
+        return retry
+
+    def _log_progress(self, start: float) -> None:
+        p = self.progress
+        finished = p["done"] + p["failed"]
+        if finished and (finished % 10 == 0 or finished == p["total"]):
+            elapsed = timer() - start
+            remaining = elapsed / finished * (p["total"] - finished)
+            logger.info(
+                f"{finished}/{p['total']} map job(s) finished ({p['failed']} "
+                f"failed) in {elapsed:.0f}s; about {remaining:.0f}s to go"
+            )
+
+
+_service: Optional[RenderService] = None
+_service_thread: Optional[threading.Thread] = None
+_service_lock = threading.Lock()
+
+
+def run_in_background(workers: int = RENDER_WORKERS) -> bool:
+    """Work the queue off on a thread of this process, unless that is already
+    happening. Returns whether a service was started."""
+    global _service, _service_thread
+
+    def _run(service: RenderService) -> None:
+        with Session(engine) as session:
+            service.run(session)
+
+    with _service_lock:
+        if _service_thread is not None and _service_thread.is_alive():
+            return False
+        _service = RenderService(workers=workers)
+        _service_thread = threading.Thread(
+            target=_run, args=(_service,), name="map-render-service", daemon=True
+        )
+        _service_thread.start()
+        return True
+
+
+def service_progress() -> Optional[Dict[str, int]]:
+    """The background service's progress, or None if it has not run."""
+    with _service_lock:
+        if _service is None:
+            return None
+        running = _service_thread is not None and _service_thread.is_alive()
+        return dict(_service.progress, running=running)
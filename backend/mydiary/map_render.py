@@ -16,14 +16,18 @@ PIL.ImageDraw has none of its own."""
 import io
 import math
 from dataclasses import dataclass
-from typing import List, Optional, Sequence, Tuple
+from typing import Dict, List, Optional, Sequence, Tuple
 
+import numpy as np
 import s2sphere
 import staticmaps
 from PIL import Image, ImageDraw, ImageFont
+from staticmaps.pillow_renderer import PillowRenderer
 from staticmaps.tile_provider import TileProvider
 
 from . import thumbnail_cache
+from .map_tiles import TileFetcher, TilesOffline, get_tile, get_tile_cache
+from .map_tiles import mercator, prefetch, tiles_for
 from .owntracks_track import (
     PERIOD_LABELS,
     DayTrack,
@@ -69,6 +73,15 @@ FORMATS = {
     "WEBP": ("webp", "image/webp"),
 }
 _FORMAT_ALIASES = {"JPG": "JPEG"}
+SUPERSAMPLE_MODES = ("full", "overlay")
+# the formats whose size a quality setting controls
+LOSSY_FORMATS = ("JPEG", "WEBP")
+# encodes one image may take to meet RenderParams.max_bytes
+MAX_ENCODES = 8
+# a shrink aims this far under the budget, so one resize is usually enough
+RESIZE_MARGIN = 0.95
+# and never below this fraction of the requested size
+MIN_RESIZE = 0.5
 
 
 @dataclass(frozen=True)
@@ -82,24 +95,63 @@ class RenderParams:
 
     quality is ignored for PNG. Same cache_key() shape as TrackParams, so the
     two compose into one content hash.
+
+    supersample is what is composited at SUPERSAMPLE x: "full" is the whole
+    map, basemap included, downscaled once at the end; "overlay" composites
+    the basemap and street labels over the visible crop only (at output size
+    when there is no crop) and draws the track and its labels at 2x. Half the
+    time and two thirds the memory, within a pixel or so of "full"
+    (scripts/owntracks_benchmark_map_render.py).
+
+    max_bytes turns quality into a ceiling: a busy city day that would come
+    out at several times a quiet day's size is re-encoded at the highest
+    quality down to min_quality that fits (encode_map), and with
+    resize_to_fit, made smaller if even min_quality does not. The search is
+    deterministic, so the budget and its bounds are all the hash needs.
+
+    validate() checks the fields that can be out of range; rendering does it
+    first, and a route taking them from a query calls it to answer with a 400.
     """
 
     width: int = 1200
     height: int = 900
     fmt: str = "JPEG"
     quality: int = 85
+    supersample: str = "full"
+    max_bytes: Optional[int] = None
+    min_quality: int = 40
+    resize_to_fit: bool = False
+
+    def validate(self) -> None:
+        """Raise ValueError if the format, supersample mode or size budget is
+        not one this can render."""
+        if self.format not in FORMATS:
+            raise ValueError(
+                f"unsupported image format {self.fmt!r}; "
+                f"expected one of {', '.join(sorted(FORMATS))}"
+            )
+        if self.supersample not in SUPERSAMPLE_MODES:
+            raise ValueError(
+                f"unsupported supersample mode {self.supersample!r}; "
+                f"expected one of {', '.join(SUPERSAMPLE_MODES)}"
+            )
+        if self.max_bytes is None:
+            return
+        if self.max_bytes <= 0:
+            raise ValueError(f"max_bytes must be positive, not {self.max_bytes}")
+        if not 1 <= self.min_quality <= self.quality <= 100:
+            raise ValueError(
+                f"expected 1 <= min_quality <= quality <= 100, not "
+                f"{self.min_quality} and {self.quality}"
+            )
+        if self.format not in LOSSY_FORMATS and not self.resize_to_fit:
+            raise ValueError(f"a {self.format} size budget needs resize_to_fit")
 
     @property
     def format(self) -> str:
         """The Pillow format name, normalised (jpg -> JPEG)."""
         fmt = self.fmt.upper()
-        fmt = _FORMAT_ALIASES.get(fmt, fmt)
-        if fmt not in FORMATS:
-            raise ValueError(
-                f"unsupported image format {self.fmt!r}; "
-                f"expected one of {', '.join(sorted(FORMATS))}"
-            )
-        return fmt
+        return _FORMAT_ALIASES.get(fmt, fmt)
 
     @property
     def ext(self) -> str:
@@ -109,10 +161,21 @@ class RenderParams:
     def media_type(self) -> str:
         return FORMATS[self.format][1]
 
+    @property
+    def overlay_only(self) -> bool:
+        return self.supersample == "overlay"
+
     def cache_key(self) -> str:
         # normalised fmt, so "jpg" and "JPEG" are not two different keys and
         # do not each trigger a re-render and a fresh Joplin resource
         fields = dict(self.__dict__, fmt=self.format)
+        # left out at its default, so every map hashed before the field
+        # existed still hashes the same
+        if fields["supersample"] == "full":
+            del fields["supersample"]
+        if fields["max_bytes"] is None:
+            for k in ("max_bytes", "min_quality", "resize_to_fit"):
+                del fields[k]
         return "|".join(f"{k}={v}" for k, v in sorted(fields.items()))
 
 
@@ -142,6 +205,9 @@ class RetinaTileProvider(TileProvider):
 # quiet enough to sit under a track; the default OSM style is not
 BASEMAP_PROVIDER = RetinaTileProvider("carto-light-nolabels-2x", "light_nolabels")
 LABELS_PROVIDER = RetinaTileProvider("carto-light-onlylabels-2x", "light_only_labels")
+# both layers share the fitted center, zoom and tile size, so every map needs
+# the same tiles from each
+LAYERS = [BASEMAP_PROVIDER, LABELS_PROVIDER]
 
 
 def _hex_to_rgb(value: str) -> Tuple[int, int, int]:
@@ -175,6 +241,8 @@ class TrackOverlay(staticmaps.Object):
         self.track = track
         self.scale = scale
         self.frame = frame if frame is not None else track
+        # (of the frame?, zoom) -> tile coordinates, in _track_lat_lon order
+        self._tile_xy: Dict[Tuple[bool, int], Tuple[np.ndarray, np.ndarray]] = {}
 
     def bounds(self) -> s2sphere.LatLngRect:
         return bounds_for(self.frame)
@@ -184,33 +252,61 @@ class TrackOverlay(staticmaps.Object):
         margin = int((STAY_MAX_RADIUS + 6) * self.scale)
         return margin, margin, margin, margin
 
+    def pixels(
+        self,
+        trans: staticmaps.Transformer,
+        off: float = 0.0,
+        x0: float = 0.0,
+        y0: float = 0.0,
+        frame: bool = False,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Every stay and link end of the track (or of the frame), in
+        _track_lat_lon order, in pixels of an image whose origin is (x0, y0) in
+        trans's image, one world width over for off.
+
+        Projected once per zoom, in one numpy pass; every render_objects pass,
+        the crop and both render modes reuse it, and only the shift into each
+        transformer's image is per call.
+        """
+        key = (frame, trans.zoom())
+        if key not in self._tile_xy:
+            lat, lon = _track_lat_lon(self.frame if frame else self.track)
+            x, y = mercator(lat, lon)
+            n = trans.number_of_tiles()
+            self._tile_xy[key] = (n * x, n * y)
+        tx, ty = self._tile_xy[key]
+        x, y = _tiles_to_image(trans, tx, ty)
+        return x + off - x0, y - y0
+
     def render_pillow(self, renderer) -> None:
-        trans = renderer.transformer()
+        xy = self.pixels(renderer.transformer(), renderer.offset_x())
         overlay = Image.new("RGBA", renderer.image().size, (0, 0, 0, 0))
-        draw = ImageDraw.Draw(overlay)
-        off = renderer.offset_x()
-
-        def to_px(lat: float, lon: float) -> Tuple[float, float]:
-            x, y = trans.ll2pixel(s2sphere.LatLng.from_degrees(lat, lon))
-            return x + off, y
-
-        for link in self.track.links:
-            self._draw_link(draw, link, to_px)
-        for stay in self.track.stays:
-            self._draw_stay(draw, stay, to_px)
-
+        self.draw_track(ImageDraw.Draw(overlay), *xy)
         renderer.alpha_compose(overlay)
-
         # labels go on the composited image so their halo reads against the map
-        label_draw = ImageDraw.Draw(renderer.image())
-        for stay in self.track.stays:
-            self._draw_stay_label(label_draw, stay, to_px)
+        self.draw_labels(ImageDraw.Draw(renderer.image()), *xy)
+
+    def draw_track(self, draw, x: np.ndarray, y: np.ndarray) -> None:
+        """The links, then the stays over them, at the points pixels() gave."""
+        points = list(zip(x.tolist(), y.tolist()))
+        ends = points[len(self.track.stays) :]
+        for i, link in enumerate(self.track.links):
+            self._draw_link(draw, link, ends[2 * i], ends[2 * i + 1])
+        for stay, center in zip(self.track.stays, points):
+            self._draw_stay(draw, stay, center)
+
+    def draw_labels(
+        self, draw, x: np.ndarray, y: np.ndarray, scale: Optional[float] = None
+    ) -> None:
+        """The stays' duration labels; scale, if given, in place of self.scale,
+        for an image drawn at another size than the track was."""
+        scale = self.scale if scale is None else scale
+        for stay, center in zip(self.track.stays, zip(x.tolist(), y.tolist())):
+            self._draw_stay_label(draw, stay, center, scale)
 
-    def _draw_link(self, draw, link: Link, to_px) -> None:
+    def _draw_link(self, draw, link: Link, start, end) -> None:
         color = _hex_to_rgb(link.period.color)
         width = max(1, int(LINE_WIDTH * self.scale))
-        start = to_px(link.start_lat, link.start_lon)
-        end = to_px(link.end_lat, link.end_lon)
         if link.uncertain:
             _dashed_line(
                 draw,
@@ -227,39 +323,60 @@ class TrackOverlay(staticmaps.Object):
         for point in (start, end):
             _dot(draw, point, width / 2, color + (255,))
 
-    def _draw_stay(self, draw, stay: Stay, to_px) -> None:
+    def _draw_stay(self, draw, stay: Stay, center) -> None:
         color = _hex_to_rgb(stay.period.color)
-        center = to_px(stay.lat, stay.lon)
         radius = stay_radius(stay.duration_minutes) * self.scale
         # a surface ring first, so the circle separates from the track beneath
         _ring(draw, center, radius + 1.5 * self.scale, SURFACE + (200,), 3 * self.scale)
         _disc(draw, center, radius, color + (STAY_FILL_ALPHA,))
         _ring(draw, center, radius, color + (STAY_STROKE_ALPHA,), 2 * self.scale)
 
-    def _draw_stay_label(self, draw, stay: Stay, to_px) -> None:
+    def _draw_stay_label(self, draw, stay: Stay, center, scale: float) -> None:
         if stay.duration_minutes < LABEL_MIN_MINUTES:
             return  # selective labels only, never one on every mark
-        center = to_px(stay.lat, stay.lon)
-        radius = stay_radius(stay.duration_minutes) * self.scale
+        radius = stay_radius(stay.duration_minutes) * scale
         draw.text(
-            (center[0], center[1] + radius + 3 * self.scale),
+            (center[0], center[1] + radius + 3 * scale),
             stay.duration_label(),
-            font=_font(11 * self.scale),
+            font=_font(11 * scale),
             fill=INK,
-            stroke_width=max(1, self.scale),
+            stroke_width=max(1, round(scale)),
             stroke_fill=SURFACE,
             anchor="ma",
         )
 
 
+def _tiles_to_image(
+    trans: staticmaps.Transformer, tx: np.ndarray, ty: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Transformer.ll2pixel's last step, over arrays: tile coordinates
+    (Transformer.ll2t) to pixels in trans's image.
+
+    Measured from the first tile, where the renderer pastes it, as tiles_for
+    walks them: through the Transformer's public API only, and on the tiles as
+    drawn rather than ll2pixel's unrounded centre, which can be up to a pixel
+    off them.
+    """
+    s = trans.tile_size()
+    x = trans.tile_offset_x() + (tx - trans.first_tile_x()) * s
+    y = trans.tile_offset_y() + (ty - trans.first_tile_y()) * s
+    return x, y
+
+
 class LabelsOverlay(staticmaps.Object):
     """Street names, composited last so they stay readable over the track."""
 
-    def __init__(self, cache_dir: str) -> None:
+    def __init__(
+        self,
+        cache_dir: str,
+        layers: Optional["SharedLayers"] = None,
+        missing: Optional[List[str]] = None,
+    ) -> None:
         super().__init__()
         self.cache_dir = cache_dir
-        self.downloader = staticmaps.TileDownloader()
-        self.downloader.set_user_agent(USER_AGENT)
+        self.downloader = TileFetcher(USER_AGENT)
+        self.layers = layers
+        self.missing = missing
 
     def bounds(self) -> s2sphere.LatLngRect:
         return s2sphere.LatLngRect()
@@ -269,6 +386,9 @@ class LabelsOverlay(staticmaps.Object):
 
     def render_pillow(self, renderer) -> None:
         trans = renderer.transformer()
+        if self.layers is not None and self.layers.covers(trans):
+            renderer.alpha_compose(self.layers.region("labels", trans))
+            return
         overlay = Image.new("RGBA", renderer.image().size, (0, 0, 0, 0))
         size = trans.tile_size()
         for yy in range(trans.tiles_y()):
@@ -278,15 +398,21 @@ class LabelsOverlay(staticmaps.Object):
             for xx in range(trans.tiles_x()):
                 x = (trans.first_tile_x() + xx) % trans.number_of_tiles()
                 try:
-                    data = self.downloader.get(
-                        LABELS_PROVIDER, self.cache_dir, trans.zoom(), x, y
+                    tile = get_tile(
+                        self.downloader,
+                        LABELS_PROVIDER,
+                        self.cache_dir,
+                        trans.zoom(),
+                        x,
+                        y,
                     )
+                except TilesOffline:
+                    raise
                 except Exception as e:  # a missing label tile must not fail the map
-                    logger.warning(f"could not fetch label tile {trans.zoom()}/{x}/{y}: {e}")
+                    _missed(self.missing, LABELS_PROVIDER, trans.zoom(), x, y, e)
                     continue
-                if data is None:
+                if tile is None:
                     continue
-                tile = Image.open(io.BytesIO(data)).convert("RGBA")
                 overlay.paste(
                     tile,
                     (
@@ -298,6 +424,185 @@ class LabelsOverlay(staticmaps.Object):
         renderer.alpha_compose(overlay)
 
 
+class _MapContext(staticmaps.Context):
+    """staticmaps.Context, drawing its basemap from the decoded-tile cache.
+
+    render_pillow is Context.render_pillow with the renderer swapped; the
+    tile provider, cache dir and downloader are the ones set on the context.
+    Given layers, the basemap is cropped from them instead. Given missing, a
+    basemap tile that could not be fetched is added to it.
+    """
+
+    layers: Optional["SharedLayers"] = None
+    missing: Optional[List[str]] = None
+
+    def render_pillow(self, width: int, height: int) -> Image.Image:
+        center, zoom = self.determine_center_zoom(width, height)
+        if center is None or zoom is None:
+            raise RuntimeError("Cannot render map without center/zoom.")
+        trans = staticmaps.Transformer(
+            width, height, zoom, center, self._tile_provider.tile_size()
+        )
+        renderer = _CachedTileRenderer(
+            trans,
+            self._tile_downloader,
+            self._tile_provider,
+            self._cache_dir,
+            self.missing,
+        )
+        if self.layers is not None and self.layers.covers(trans):
+            renderer.image().paste(self.layers.region("basemap", trans), (0, 0))
+        else:
+            renderer.render_background(self._background_color)
+            renderer.render_tiles(self._fetch_tile)
+        renderer.render_objects(self._objects)
+        renderer.render_attribution(self._tile_provider.attribution())
+        return renderer.image()
+
+
+class _CachedTileRenderer(PillowRenderer):
+    def __init__(
+        self,
+        trans,
+        downloader,
+        provider: TileProvider,
+        cache_dir: str,
+        missing: Optional[List[str]] = None,
+    ):
+        super().__init__(trans)
+        self.downloader = downloader
+        self.provider = provider
+        self.cache_dir = cache_dir
+        self.missing = missing
+
+    def fetch_tile(self, download, x: int, y: int) -> Optional[Image.Image]:
+        # render_tiles itself only skips a RuntimeError; any other failure
+        # leaves a hole here too, as the label and shared-layer paths do
+        zoom = self._trans.zoom()
+        try:
+            return get_tile(self.downloader, self.provider, self.cache_dir, zoom, x, y)
+        except TilesOffline:
+            raise
+        except Exception as e:
+            _missed(self.missing, self.provider, zoom, x, y, e)
+            return None
+
+
+class SharedLayers:
+    """A block of tiles at one zoom, composed once -- the basemap on the
+    background colour, and the labels on transparent -- for every panel over
+    it to crop its own region from.
+
+    What a panel crops is pixel for pixel what it would have composed tile by
+    tile, so sharing changes the cost of a render and nothing else.
+    """
+
+    def __init__(self, zoom: int, x0: int, y0: int, x1: int, y1: int) -> None:
+        # tile columns unwrapped (x may run past the antimeridian), end-exclusive
+        self.zoom = zoom
+        self.x0, self.y0, self.x1, self.y1 = x0, y0, x1, y1
+        self.images: dict = {}
+        # tiles that could not be fetched, so every panel cropping these
+        # layers may have a hole
+        self.missing: List[str] = []
+
+    @staticmethod
+    def rect(trans: staticmaps.Transformer) -> Tuple[int, int, int, int]:
+        x0, y0 = trans.first_tile_x(), trans.first_tile_y()
+        return x0, y0, x0 + trans.tiles_x(), y0 + trans.tiles_y()
+
+    def overlaps(self, zoom: int, rect: Tuple[int, int, int, int]) -> bool:
+        x0, y0, x1, y1 = rect
+        return (
+            zoom == self.zoom
+            and x0 < self.x1
+            and self.x0 < x1
+            and y0 < self.y1
+            and self.y0 < y1
+        )
+
+    def extend(self, rect: Tuple[int, int, int, int]) -> None:
+        x0, y0, x1, y1 = rect
+        self.x0, self.y0 = min(self.x0, x0), min(self.y0, y0)
+        self.x1, self.y1 = max(self.x1, x1), max(self.y1, y1)
+
+    def covers(self, trans: staticmaps.Transformer) -> bool:
+        x0, y0, x1, y1 = self.rect(trans)
+        return (
+            trans.zoom() == self.zoom
+            and self.x0 <= x0
+            and self.y0 <= y0
+            and x1 <= self.x1
+            and y1 <= self.y1
+        )
+
+    def compose(self, downloader, cache_dir: str, background) -> None:
+        size = BASEMAP_PROVIDER.tile_size()
+        shape = ((self.x1 - self.x0) * size, (self.y1 - self.y0) * size)
+        basemap = Image.new("RGBA", shape, background.int_rgba())
+        labels = Image.new("RGBA", shape, (0, 0, 0, 0))
+        tiles = [
+            (x, y, ((x - self.x0) * size, (y - self.y0) * size))
+            for y in range(max(self.y0, 0), min(self.y1, 2**self.zoom))
+            for x in range(self.x0, self.x1)
+        ]
+        _paste_tiles(
+            downloader, cache_dir, self.zoom, tiles, basemap, labels, self.missing
+        )
+        self.images = {"basemap": basemap, "labels": labels}
+
+    def region(self, layer: str, trans: staticmaps.Transformer) -> Image.Image:
+        """The layer as the image this transformer renders sees it."""
+        size = trans.tile_size()
+        left = (trans.first_tile_x() - self.x0) * size - int(trans.tile_offset_x())
+        top = (trans.first_tile_y() - self.y0) * size - int(trans.tile_offset_y())
+        return self.images[layer].crop(
+            (left, top, left + trans.image_width(), top + trans.image_height())
+        )
+
+
+def _paste_tiles(
+    downloader,
+    cache_dir: str,
+    zoom: int,
+    tiles: Sequence[Tuple[int, int, Tuple[int, int]]],
+    basemap: Image.Image,
+    labels: Image.Image,
+    missing: Optional[List[str]] = None,
+) -> None:
+    """Paste each (x, y, at) tile of both layers: the basemap as is, the labels
+    over transparent. x may run past the antimeridian; it wraps here. A tile
+    that could not be fetched is left out, and added to missing."""
+    n = 2**zoom
+    for x, y, at in tiles:
+        for provider, image in ((BASEMAP_PROVIDER, basemap), (LABELS_PROVIDER, labels)):
+            try:
+                tile = get_tile(downloader, provider, cache_dir, zoom, x % n, y)
+            except TilesOffline:
+                raise
+            except Exception as e:  # as rendering tile by tile does
+                _missed(missing, provider, zoom, x % n, y, e)
+                continue
+            if tile is None:
+                continue
+            image.paste(tile, at, None if image is basemap else tile)
+
+
+def _missed(
+    missing: Optional[List[str]],
+    provider: TileProvider,
+    zoom: int,
+    x: int,
+    y: int,
+    error: Exception,
+) -> None:
+    """A tile the map goes without: logged, and added to missing if given."""
+    tile = f"{provider.name()} {zoom}/{x}/{y}"
+    logger.warning(f"could not fetch {tile}: {error}")
+    if missing is not None:
+        missing.append(tile)
+
+
 def stay_radius(minutes: float) -> float:
     """Circle radius in output pixels. sqrt keeps a 6-hour stay from dwarfing a
     20-minute one."""
@@ -345,7 +650,7 @@ def _dashed_line(draw, start, end, fill, width, dash_on, dash_off) -> None:
 
 def _crop_box(
     ctx: "staticmaps.Context",
-    track: DayTrack,
+    overlay: "TrackOverlay",
     render_w: int,
     render_h: int,
     aspect: float,
@@ -356,24 +661,16 @@ def _crop_box(
     half the width -- one level in would not fit at all. Cropping to the content
     afterwards recovers the difference and gives effectively fractional zoom.
     """
-    center, zoom = ctx.determine_center_zoom(render_w, render_h)
-    if center is None or zoom is None:
+    trans = _transformer(ctx, render_w, render_h)
+    if trans is None:
         return None
-    trans = staticmaps.Transformer(
-        render_w, render_h, zoom, center, BASEMAP_PROVIDER.tile_size()
-    )
-    xs: List[float] = []
-    ys: List[float] = []
-    for lat, lon in _track_coords(track):
-        x, y = trans.ll2pixel(s2sphere.LatLng.from_degrees(lat, lon))
-        xs.append(x)
-        ys.append(y)
-    if not xs:
+    xs, ys = overlay.pixels(trans, frame=True)
+    if not xs.size:
         return None
 
     pad = (STAY_MAX_RADIUS + 12) * SUPERSAMPLE
-    left, right = min(xs) - pad, max(xs) + pad
-    top, bottom = min(ys) - pad, max(ys) + pad
+    left, right = float(xs.min()) - pad, float(xs.max()) + pad
+    top, bottom = float(ys.min()) - pad, float(ys.max()) + pad
 
     # never upscale: a day spent entirely in one place should not be zoomed
     # into a blur
@@ -394,12 +691,14 @@ def _crop_box(
     return int(left), int(top), int(right), int(bottom)
 
 
-def _track_coords(track: DayTrack) -> List[Tuple[float, float]]:
+def _track_lat_lon(track: DayTrack) -> Tuple[np.ndarray, np.ndarray]:
+    """Every stay, then each link's start and end, as lat and lon arrays."""
     coords = [(s.lat, s.lon) for s in track.stays]
     for link in track.links:
         coords.append((link.start_lat, link.start_lon))
         coords.append((link.end_lat, link.end_lon))
-    return coords
+    lat_lon = np.array(coords, dtype=float).reshape(-1, 2)
+    return lat_lon[:, 0], lat_lon[:, 1]
 
 
 def bounds_for(track: DayTrack) -> s2sphere.LatLngRect:
@@ -444,12 +743,58 @@ def _draw_footer(image: Image.Image, track: DayTrack, width: int, top: int) -> N
     draw.text((width - 10, mid + 7), ATTRIBUTION, font=_font(9), fill=MUTED, anchor="rm")
 
 
+def _fitted_context(
+    track: DayTrack, frame: Optional[DayTrack]
+) -> Tuple["_MapContext", TrackOverlay]:
+    """A context fitted to the day, with its track overlay, and no tiles yet."""
+    ctx = _MapContext()
+    ctx.set_tile_provider(BASEMAP_PROVIDER)
+    overlay = TrackOverlay(track, scale=SUPERSAMPLE, frame=frame)
+    ctx.add_bounds(
+        bounds_for(overlay.frame), extra_pixel_bounds=overlay.extra_pixel_bounds()
+    )
+    ctx.add_object(overlay)
+    return ctx, overlay
+
+
+def _transformer(
+    ctx: "staticmaps.Context", render_w: int, render_h: int
+) -> Optional[staticmaps.Transformer]:
+    center, zoom = ctx.determine_center_zoom(render_w, render_h)
+    if center is None or zoom is None:
+        return None
+    return staticmaps.Transformer(
+        render_w, render_h, zoom, center, BASEMAP_PROVIDER.tile_size()
+    )
+
+
+def tiles_for_map(
+    track: DayTrack,
+    render: Optional[RenderParams] = None,
+    frame: Optional[DayTrack] = None,
+) -> Tuple[int, List[Tuple[int, int]]]:
+    """The zoom render_day_map would draw this map at, and the (x, y) of the
+    tiles it would draw -- in both layers. Nothing is fetched or drawn."""
+    if track.is_empty():
+        raise ValueError("cannot render a map for a day with no location data")
+    if frame is not None and frame.is_empty():
+        frame = None
+    render = render or RenderParams()
+    ctx, _ = _fitted_context(track, frame)
+    map_height = render.height - FOOTER_HEIGHT
+    trans = _transformer(ctx, render.width * SUPERSAMPLE, map_height * SUPERSAMPLE)
+    if trans is None:
+        return 0, []
+    return trans.zoom(), tiles_for(trans)
+
+
 def render_day_map(
     track: DayTrack,
     params: Optional[TrackParams] = None,
     render: Optional[RenderParams] = None,
     tile_downloader=None,
     frame: Optional[DayTrack] = None,
+    missing: Optional[List[str]] = None,
 ) -> bytes:
     """Render a day's track to encoded image bytes.
 
@@ -458,7 +803,14 @@ def render_day_map(
     the area does not drag the zoom back to the whole journey. Defaults to the
     track itself.
 
-    tile_downloader is only for tests; leaving it None uses the real, cached one.
+    tile_downloader is only for tests; leaving it None uses the real, cached one,
+    which prefetches every basemap and label tile the map needs concurrently
+    before drawing starts -- unless tiles are offline, when a tile that is not
+    stored raises TilesOffline instead.
+
+    A tile that fails to download leaves a hole in the map rather than failing
+    it; given missing, each such tile is added to it, so a caller can tell a
+    complete map from one worth rendering again.
     """
     if track.is_empty():
         raise ValueError("cannot render a map for a day with no location data")
@@ -466,51 +818,334 @@ def render_day_map(
         frame = None
 
     render = render or RenderParams()
-    width, height = render.width, render.height
+    render.validate()
+    cache_dir = str(thumbnail_cache.get_cache_dir(subdir="map_tiles"))
+    downloader = tile_downloader or TileFetcher(USER_AGENT)
+    if isinstance(downloader, TileFetcher) and not downloader.offline:
+        zoom, tiles = tiles_for_map(track, render, frame)
+        prefetch(downloader, LAYERS, cache_dir, zoom, tiles)
+    data = _render(track, render, frame, downloader, cache_dir, missing=missing)
+    logger.debug(f"decoded tile cache: {get_tile_cache().stats()}")
+    return data
+
+
+def render_panels(
+    panels: Sequence[Tuple[DayTrack, Optional[DayTrack]]],
+    params: Optional[TrackParams] = None,
+    render: Optional[RenderParams] = None,
+    tile_downloader=None,
+    missing: Optional[List[List[str]]] = None,
+) -> List[bytes]:
+    """render_day_map for each (track, frame) of a day's panels, in one pass.
+
+    Panels at the same zoom whose tiles overlap -- an area panel inside the
+    overview, two areas in one city -- share one composition of the basemap
+    and labels; each panel then draws only its own track and crop. The bytes
+    are the same as rendering each panel on its own.
+
+    Given missing, it gets one list per panel of the tiles that panel went
+    without, as render_day_map's missing.
+    """
+    render = render or RenderParams()
+    render.validate()
     cache_dir = str(thumbnail_cache.get_cache_dir(subdir="map_tiles"))
+    downloader = tile_downloader or TileFetcher(USER_AGENT)
+    map_height = render.height - FOOTER_HEIGHT
+    render_w, render_h = render.width * SUPERSAMPLE, map_height * SUPERSAMPLE
+
+    groups: List[SharedLayers] = []
+    chosen: List[Optional[SharedLayers]] = []
+    for track, frame in panels:
+        if track.is_empty():
+            raise ValueError("cannot render a map for a day with no location data")
+        if frame is not None and frame.is_empty():
+            frame = None
+        trans = _transformer(_fitted_context(track, frame)[0], render_w, render_h)
+        if trans is None:
+            chosen.append(None)
+            continue
+        rect = SharedLayers.rect(trans)
+        group = next((g for g in groups if g.overlaps(trans.zoom(), rect)), None)
+        if group is None:
+            group = SharedLayers(trans.zoom(), *rect)
+            groups.append(group)
+        else:
+            group.extend(rect)
+        chosen.append(group)
+
+    if isinstance(downloader, TileFetcher) and not downloader.offline:
+        for group in groups:
+            tiles = [
+                (x % 2**group.zoom, y)
+                for y in range(max(group.y0, 0), min(group.y1, 2**group.zoom))
+                for x in range(group.x0, group.x1)
+            ]
+            prefetch(downloader, LAYERS, cache_dir, group.zoom, tiles)
+    if render.overlay_only:
+        # those panels paste their (halved, cached) tiles straight at output
+        # size, which is cheaper than cropping them out of a 2x composition
+        chosen = [None] * len(panels)
+    else:
+        background = staticmaps.parse_color("#fafaf9")
+        for group in groups:
+            group.compose(downloader, cache_dir, background)
+
+    images = []
+    for (track, frame), layers in zip(panels, chosen):
+        panel_missing: List[str] = []
+        images.append(
+            _render(track, render, frame, downloader, cache_dir, layers, panel_missing)
+        )
+        if missing is not None:
+            missing.append(panel_missing)
+    logger.debug(
+        f"{len(panels)} panel(s) over {len(groups)} shared layer(s); "
+        f"decoded tile cache: {get_tile_cache().stats()}"
+    )
+    return images
+
+
+def _render(
+    track: DayTrack,
+    render: RenderParams,
+    frame: Optional[DayTrack],
+    downloader,
+    cache_dir: str,
+    layers: Optional[SharedLayers] = None,
+    missing: Optional[List[str]] = None,
+) -> bytes:
+    if frame is not None and frame.is_empty():
+        frame = None
+    width, height = render.width, render.height
     map_height = height - FOOTER_HEIGHT
 
-    ctx = staticmaps.Context()
-    ctx.set_tile_provider(BASEMAP_PROVIDER)
+    ctx, overlay = _fitted_context(track, frame)
     ctx.set_cache_dir(cache_dir)
-    if tile_downloader is None:
-        downloader = staticmaps.TileDownloader()
-        downloader.set_user_agent(USER_AGENT)
-    else:
-        downloader = tile_downloader
     ctx.set_tile_downloader(downloader)
     ctx.set_background_color(staticmaps.parse_color("#fafaf9"))
-
-    overlay = TrackOverlay(track, scale=SUPERSAMPLE, frame=frame)
-    ctx.add_bounds(
-        bounds_for(overlay.frame), extra_pixel_bounds=overlay.extra_pixel_bounds()
-    )
-    ctx.add_object(overlay)
-    labels = LabelsOverlay(cache_dir)
-    if tile_downloader is not None:
-        labels.downloader = tile_downloader
-    ctx.add_object(labels)
-
-    render_w, render_h = width * SUPERSAMPLE, map_height * SUPERSAMPLE
-    rendered = ctx.render_pillow(render_w, render_h)
-    box = _crop_box(ctx, overlay.frame, render_w, render_h, width / map_height)
-    if box is not None:
-        rendered = rendered.crop(box)
-    rendered = rendered.convert("RGB").resize((width, map_height), Image.LANCZOS)
+    if render.overlay_only:
+        rendered = _render_overlay_only(
+            ctx, overlay, downloader, cache_dir, width, map_height, missing
+        )
+    else:
+        if layers is not None and missing is not None:
+            missing.extend(layers.missing)
+        ctx.layers = layers
+        ctx.missing = missing
+        labels = LabelsOverlay(cache_dir, layers, missing)
+        labels.downloader = downloader
+        ctx.add_object(labels)
+
+        render_w, render_h = width * SUPERSAMPLE, map_height * SUPERSAMPLE
+        rendered = ctx.render_pillow(render_w, render_h)
+        box = _crop_box(ctx, overlay, render_w, render_h, width / map_height)
+        if box is not None:
+            rendered = rendered.crop(box)
+        rendered = rendered.convert("RGB").resize((width, map_height), Image.LANCZOS)
 
     canvas = Image.new("RGB", (width, height), SURFACE)
     canvas.paste(rendered, (0, 0))
     _draw_footer(canvas, track, width, map_height)
 
+    data, encoding = encode_map(canvas, render)
+    if render.max_bytes is not None:
+        logger.debug(f"encoded to {len(data)} bytes: {encoding}")
+    return data
+
+
+@dataclass(frozen=True)
+class MapEncoding:
+    """What encode_map settled on for one image."""
+
+    quality: Optional[int]  # None for PNG
+    width: int
+    height: int
+    num_encodes: int
+    fits: bool  # False if nothing within the bounds met max_bytes
+
+
+def _encode(image: Image.Image, fmt: str, quality: int) -> bytes:
     buf = io.BytesIO()
-    fmt = render.format
     if fmt == "JPEG":
         # subsampling=0 (4:4:4) is not the default and matters here: the track
         # is thin saturated colour over a near-grey basemap, which is exactly
         # what 4:2:0 chroma subsampling smears. canvas is already RGB.
-        canvas.save(buf, format=fmt, quality=render.quality, optimize=True, subsampling=0)
+        image.save(buf, format=fmt, quality=quality, optimize=True, subsampling=0)
     elif fmt == "WEBP":
-        canvas.save(buf, format=fmt, quality=render.quality)
+        image.save(buf, format=fmt, quality=quality)
     else:
-        canvas.save(buf, format=fmt, optimize=True)
+        image.save(buf, format=fmt, optimize=True)
     return buf.getvalue()
+
+
+def encode_map(canvas: Image.Image, render: RenderParams) -> Tuple[bytes, MapEncoding]:
+    """Encode a finished canvas as render asks, within render.max_bytes if set.
+
+    Without a budget, or when render.quality already fits, that is one encode.
+    Otherwise the highest quality from min_quality up that fits is found by
+    bisection on the same canvas, and with resize_to_fit a canvas that does
+    not fit even at min_quality is scaled down -- by the square root of the
+    overshoot, as bytes go roughly with pixels -- and searched again. At most
+    MAX_ENCODES encodes in all; if nothing fits, the smallest one is returned.
+    """
+    render.validate()
+    fmt = render.format
+    budget = render.max_bytes
+    lossy = fmt in LOSSY_FORMATS
+    data = _encode(canvas, fmt, render.quality)
+    if budget is None or len(data) <= budget:
+        quality = render.quality if lossy else None
+        return data, MapEncoding(quality, *canvas.size, 1, True)
+
+    tried = [(data, render.quality, canvas.size)]
+    image = canvas
+    for attempt in range(2 if render.resize_to_fit else 1):
+        if attempt:
+            if len(tried) >= MAX_ENCODES:
+                break
+            smallest = min(len(data) for data, _, _ in tried)
+            scale = max(math.sqrt(budget / smallest) * RESIZE_MARGIN, MIN_RESIZE)
+            size = (round(canvas.width * scale), round(canvas.height * scale))
+            image = canvas.resize(size, Image.LANCZOS)
+            # the full quality first: the shrink may have been enough on its own
+            data = _encode(image, fmt, render.quality)
+            tried.append((data, render.quality, size))
+            if len(data) <= budget:
+                quality = render.quality if lossy else None
+                return data, MapEncoding(quality, *size, len(tried), True)
+        if lossy:
+            fit = _bisect_quality(image, fmt, render, budget, tried)
+            if fit is not None:
+                data, quality = fit
+                return data, MapEncoding(quality, *image.size, len(tried), True)
+
+    data, quality, size = min(tried, key=lambda t: len(t[0]))
+    logger.warning(
+        f"no encoding within {budget} bytes in {len(tried)} tries; "
+        f"the smallest is {len(data)} bytes"
+    )
+    return data, MapEncoding(quality if lossy else None, *size, len(tried), False)
+
+
+def _bisect_quality(
+    image: Image.Image,
+    fmt: str,
+    render: RenderParams,
+    budget: int,
+    tried: List[Tuple[bytes, int, Tuple[int, int]]],
+) -> Optional[Tuple[bytes, int]]:
+    """The highest quality in [min_quality, render.quality) whose encode fits,
+    or the best one within the encodes left. render.quality is known not to
+    fit. Appends every encode to tried."""
+    if len(tried) >= MAX_ENCODES:
+        return None
+    data = _encode(image, fmt, render.min_quality)
+    tried.append((data, render.min_quality, image.size))
+    if len(data) > budget:
+        return None
+    fit, too_big = (data, render.min_quality), render.quality
+    while too_big - fit[1] > 1 and len(tried) < MAX_ENCODES:
+        quality = (fit[1] + too_big) // 2
+        data = _encode(image, fmt, quality)
+        tried.append((data, quality, image.size))
+        if len(data) <= budget:
+            fit = (data, quality)
+        else:
+            too_big = quality
+    return fit
+
+
+def _render_overlay_only(
+    ctx: "_MapContext",
+    overlay: TrackOverlay,
+    downloader,
+    cache_dir: str,
+    width: int,
+    map_height: int,
+    missing: Optional[List[str]] = None,
+) -> Image.Image:
+    """The map part of an "overlay" supersample render, RGB at output size.
+
+    Same transformer and crop as a full render, so everything lands where it
+    would there; the difference is what is composited at 2x. Tiles are pasted
+    (a copy) over the crop alone rather than the whole 2x map, and both layers
+    go straight down to output size: halved, uncropped, or resampled once,
+    cropped. Only the track is drawn at 2x, and only the part of it with
+    anything on it is scaled down. Then, as a full render draws them, the stay
+    labels go onto the composited map, so their halo reads against it, and the
+    street labels over everything.
+    """
+    render_w, render_h = width * SUPERSAMPLE, map_height * SUPERSAMPLE
+    trans = _transformer(ctx, render_w, render_h)
+    if trans is None:
+        raise RuntimeError("Cannot render map without center/zoom.")
+    box = _crop_box(ctx, overlay, render_w, render_h, width / map_height)
+    left, top, right, bottom = box or (0, 0, render_w, render_h)
+    w, h = right - left, bottom - top
+    offset_x, offset_y = int(trans.tile_offset_x()), int(trans.tile_offset_y())
+    size = trans.tile_size()
+    tiles = []
+    for yy in range(trans.tiles_y()):
+        y = trans.first_tile_y() + yy
+        py = yy * size + offset_y - top
+        if not 0 <= y < trans.number_of_tiles() or py >= h or py + size <= 0:
+            continue
+        for xx in range(trans.tiles_x()):
+            px = xx * size + offset_x - left
+            if px < w and px + size > 0:
+                tiles.append((trans.first_tile_x() + xx, y, (px, py)))
+    basemap = Image.new("RGBA", (w, h), staticmaps.parse_color("#fafaf9").int_rgba())
+    labels = Image.new("RGBA", (w, h), (0, 0, 0, 0))
+    _paste_tiles(downloader, cache_dir, trans.zoom(), tiles, basemap, labels, missing)
+    shape = (width, map_height)
+    if (w, h) == (render_w, render_h):
+        # pasting is a copy; a box filter halves it in one cheap pass.
+        # Premultiplied, or a label's edge would average towards the colour
+        # of the transparent pixels around it
+        basemap = basemap.reduce(SUPERSAMPLE)
+        labels = labels.convert("RGBa").reduce(SUPERSAMPLE).convert("RGBA")
+    elif (w, h) != shape:
+        # a crop has no whole-pixel scale: the basemap gets the filter a full
+        # render finishes with, as RGB since it is opaque, and the labels a box
+        # filter as above (resize premultiplies RGBA itself)
+        basemap = basemap.convert("RGB").resize(shape, Image.LANCZOS).convert("RGBA")
+        labels = labels.resize(shape, Image.BOX)
+    sx, sy = width / w, map_height / h
+
+    # the track for each copy of the world the image spans, as
+    # Renderer.render_objects draws them
+    layer = Image.new("RGBA", (w, h), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(layer)
+    x_count = math.ceil(trans.image_width() / (2 * trans.world_width()))
+    offsets = [p * trans.world_width() for p in range(-x_count, x_count + 1)]
+    for off in offsets:
+        overlay.draw_track(draw, *overlay.pixels(trans, off, left, top))
+    bbox = layer.getbbox()
+    if bbox is not None and (w, h) != shape:
+        # padded past LANCZOS's reach, and out to whole output pixels
+        pad = 4 * SUPERSAMPLE
+        l, t, r, b = (
+            max(math.floor((bbox[0] - pad) * sx), 0),
+            max(math.floor((bbox[1] - pad) * sy), 0),
+            min(math.ceil((bbox[2] + pad) * sx), shape[0]),
+            min(math.ceil((bbox[3] + pad) * sy), shape[1]),
+        )
+        # cropped first: resize premultiplies the whole image it is given
+        x0, y0 = math.floor(l / sx), math.floor(t / sy)
+        part = layer.crop((x0, y0, math.ceil(r / sx), math.ceil(b / sy)))
+        box = (l / sx - x0, t / sy - y0, r / sx - x0, b / sy - y0)
+        small = part.resize((r - l, b - t), Image.LANCZOS, box=box)
+        basemap.alpha_composite(small, (l, t))
+    elif bbox is not None:
+        basemap.alpha_composite(layer)
+
+    # the stay labels on the composited map, so their halo reads against it
+    draw = ImageDraw.Draw(basemap)
+    for off in offsets:
+        x, y = overlay.pixels(trans, off, left, top)
+        overlay.draw_labels(draw, x * sx, y * sy, scale=overlay.scale * sx)
+    # once per copy of the world too: LabelsOverlay is one of those objects,
+    # and stacking its translucent edges is how the street names have looked
+    for _ in offsets:
+        basemap.alpha_composite(labels)
+    return basemap.convert("RGB")
@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Basemap tiles for map_render: which ones a map needs, and getting them.
+
+staticmaps.TileDownloader fetches a tile when the renderer reaches it, with a
+fresh requests.get each time -- one round trip, and one TLS handshake, after
+another. A map at 2x is a dozen or more 512px tiles, twice over: the basemap,
+then the labels layer on top. On a cold cache those sequential fetches are
+most of the time a render takes.
+
+So render_day_map works out the tiles first (tiles_for, the same walk the
+renderer does) and prefetch downloads the missing ones for both layers at
+once, on a few threads sharing one keep-alive session. By the time the
+renderer asks, every tile is a read from the tile store (tile_store.py).
+
+Reading it is still a PNG decode, for the same tiles over and over: a day's
+overview and area panels share most of theirs, and a backfill renders
+neighbouring days over the same streets. TileCache keeps decoded tiles in
+memory, least recently used out first, within a byte budget
+(MYDIARY_TILE_CACHE_MB); both layers draw from it through get_tile.
+
+With MYDIARY_TILES_OFFLINE set, a TileFetcher never goes to the network: a
+tile that is not stored raises TilesOffline, and the render fails rather than
+come out with holes. scripts/owntracks_seed_tiles.py stores every tile the
+history's maps need beforehand, rate limited (RateLimiter), so backfills can
+run that way."""
+
+import io
+import itertools
+import math
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import requests
+import staticmaps
+from PIL import Image
+from requests.adapters import HTTPAdapter
+from staticmaps.tile_provider import TileProvider
+
+from .tile_store import get_store
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+# concurrent fetches; CARTO serves from four shard hosts, and this stays well
+# within what a tile server expects of one client
+TILE_WORKERS = 8
+TILE_TIMEOUT = 10
+
+# a decoded 512px RGBA tile is 1MB, so this holds a few days' worth of panels
+DEFAULT_TILE_CACHE_MB = 128
+
+
+class TilesOffline(LookupError):
+    """A tile is not stored, and tiles are offline."""
+
+
+def tiles_offline() -> bool:
+    """Whether MYDIARY_TILES_OFFLINE is set (to anything but 0)."""
+    return os.getenv("MYDIARY_TILES_OFFLINE", "") not in ("", "0")
+
+
+class RateLimiter:
+    """At most per_second calls to wait() return per second, across threads,
+    spaced evenly.
+
+    Given a multiprocessing context, the limit holds across processes too:
+    hand the limiter to a pool's workers as an initializer argument.
+    """
+
+    def __init__(self, per_second: float, mp_context=None) -> None:
+        self.interval = 1.0 / per_second
+        if mp_context is None:
+            self._next = SimpleNamespace(value=time.monotonic())
+            self._lock = threading.Lock()
+        else:
+            # CLOCK_MONOTONIC is system-wide, so every process reads one clock
+            self._next = mp_context.Value("d", time.monotonic(), lock=False)
+            self._lock = mp_context.Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next.value, now)
+            self._next.value = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+# provider name -> the limit every TileFetcher in this process downloads that
+# provider's tiles under; see set_rate_limits
+_rate_limits: Dict[str, RateLimiter] = {}
+
+
+def set_rate_limits(limits: Dict[str, RateLimiter]) -> None:
+    """Throttle this process's tile downloads, per provider name. The render
+    service sets this in each worker, with limiters shared by all of them."""
+    global _rate_limits
+    _rate_limits = dict(limits)
+
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """The process's tile session: its connections are kept alive across
+    renders, up to TILE_WORKERS per shard host."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=TILE_WORKERS)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+class TileFetcher(staticmaps.TileDownloader):
+    """staticmaps.TileDownloader over the pooled session, caching in the
+    cache dir's TileStore rather than a file per tile.
+
+    offline=None follows MYDIARY_TILES_OFFLINE.
+    """
+
+    def __init__(
+        self, user_agent: Optional[str] = None, offline: Optional[bool] = None
+    ) -> None:
+        super().__init__()
+        if user_agent is not None:
+            self.set_user_agent(user_agent)
+        self._offline = offline
+
+    @property
+    def offline(self) -> bool:
+        return tiles_offline() if self._offline is None else self._offline
+
+    def fetch(self, url: str) -> bytes:
+        res = get_session().get(
+            url, headers={"user-agent": self._user_agent}, timeout=TILE_TIMEOUT
+        )
+        if res.status_code != 200:
+            raise RuntimeError(f"fetch {url} yields {res.status_code}")
+        return res.content
+
+    def is_cached(
+        self, provider: TileProvider, cache_dir: str, zoom: int, x: int, y: int
+    ) -> bool:
+        return get_store(cache_dir).has(provider.name(), zoom, x, y)
+
+    def get(
+        self, provider: TileProvider, cache_dir: str, zoom: int, x: int, y: int
+    ) -> Optional[bytes]:
+        store = None
+        if cache_dir is not None:
+            store = get_store(cache_dir)
+            data = store.get(provider.name(), zoom, x, y)
+            if data is not None:
+                return data
+        url = provider.url(zoom, x, y)
+        if url is None:
+            return None
+        if self.offline:
+            raise TilesOffline(
+                f"{provider.name()} tile {zoom}/{x}/{y} is not stored, "
+                "and tiles are offline"
+            )
+        limiter = _rate_limits.get(provider.name())
+        if limiter is not None:
+            limiter.wait()
+        data = self.fetch(url)
+        if store is not None:
+            store.put(provider.name(), zoom, x, y, data)
+        return data
+
+
+def mercator(lat, lon) -> Tuple[np.ndarray, np.ndarray]:
+    """staticmaps.Transformer.mercator over arrays of degrees: where each point
+    is in the Web Mercator world, 0 to 1 from left to right and top to bottom.
+    The same operations in the same order, so the same floats come out."""
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lng = np.radians(np.asarray(lon, dtype=float))
+    x = lng / (2 * math.pi) + 0.5
+    y = (1 - np.log(np.tan(lat) + (1 / np.cos(lat))) / math.pi) / 2
+    return x, y
+
+
+def tiles_for(trans: staticmaps.Transformer) -> List[Tuple[int, int]]:
+    """The (x, y) of every tile a render with this transformer draws -- the
+    walk PillowRenderer.render_tiles and LabelsOverlay make."""
+    n = trans.number_of_tiles()
+    tiles = []
+    for yy in range(trans.tiles_y()):
+        y = trans.first_tile_y() + yy
+        if y < 0 or y >= n:
+            continue
+        for xx in range(trans.tiles_x()):
+            tiles.append(((trans.first_tile_x() + xx) % n, y))
+    return tiles
+
+
+def prefetch(
+    downloader: TileFetcher,
+    providers: Sequence[TileProvider],
+    cache_dir: str,
+    zoom: int,
+    tiles: Sequence[Tuple[int, int]],
+    workers: int = TILE_WORKERS,
+    rate: Optional[RateLimiter] = None,
+) -> int:
+    """Download the tiles not already stored in cache_dir, for every provider, at
+    most workers at a time (and, given a rate, no faster than it allows).
+    Returns how many were fetched.
+
+    A tile that fails is logged and left out; the render asks for it again
+    and copes with it missing as it always has.
+    """
+    missing = [
+        (provider, x, y)
+        for provider in providers
+        for x, y in dict.fromkeys(tiles)
+        if not downloader.is_cached(provider, cache_dir, zoom, x, y)
+    ]
+    if not missing:
+        return 0
+
+    def fetch(job) -> bool:
+        provider, x, y = job
+        if rate is not None:
+            rate.wait()
+        try:
+            downloader.get(provider, cache_dir, zoom, x, y)
+        except Exception as e:
+            logger.warning(f"could not prefetch {provider.name()} {zoom}/{x}/{y}: {e}")
+            return False
+        return True
+
+    if workers <= 1 or len(missing) == 1:
+        num_fetched = sum(map(fetch, missing))
+    else:
+        with ThreadPoolExecutor(max_workers=min(workers, len(missing))) as executor:
+            num_fetched = sum(executor.map(fetch, missing))
+    logger.debug(f"prefetched {num_fetched} of {len(missing)} missing tile(s)")
+    return num_fetched
+
+
+TileKey = Tuple[str, str, int, int, int]
+
+
+class TileCache:
+    """Decoded tiles, least recently used evicted once over max_bytes.
+
+    Keyed by (cache_dir, provider name, z, x, y): each entry is the decoded
+    form of one tile in that cache dir's store, or, for a downloader that is
+    not a TileFetcher, of one tile it served. Tiles are shared, not copied --
+    callers paste them and must not draw on them. Thread-safe.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._tiles: "OrderedDict[TileKey, Image.Image]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.num_bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    @staticmethod
+    def size_of(tile: Image.Image) -> int:
+        return tile.width * tile.height * len(tile.getbands())
+
+    def get(self, key: TileKey) -> Optional[Image.Image]:
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is None:
+                self.misses += 1
+                return None
+            self._tiles.move_to_end(key)
+            self.hits += 1
+            return tile
+
+    def put(self, key: TileKey, tile: Image.Image) -> None:
+        size = self.size_of(tile)
+        with self._lock:
+            old = self._tiles.pop(key, None)
+            if old is not None:
+                self.num_bytes -= self.size_of(old)
+            if size > self.max_bytes:
+                return
+            self._tiles[key] = tile
+            self.num_bytes += size
+            while self.num_bytes > self.max_bytes:
+                _, evicted = self._tiles.popitem(last=False)
+                self.num_bytes -= self.size_of(evicted)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tiles.clear()
+            self.num_bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                num_tiles=len(self._tiles),
+                num_bytes=self.num_bytes,
+                max_bytes=self.max_bytes,
+            )
+
+
+_tile_cache: Optional[TileCache] = None
+_tile_cache_lock = threading.Lock()
+
+
+def get_tile_cache() -> TileCache:
+    """The process's decoded-tile cache, sized by MYDIARY_TILE_CACHE_MB."""
+    global _tile_cache
+    with _tile_cache_lock:
+        if _tile_cache is None:
+            mb = float(os.getenv("MYDIARY_TILE_CACHE_MB") or DEFAULT_TILE_CACHE_MB)
+            _tile_cache = TileCache(int(mb * 1024 * 1024))
+        return _tile_cache
+
+
+def get_tile(
+    downloader,
+    provider: TileProvider,
+    cache_dir: str,
+    zoom: int,
+    x: int,
+    y: int,
+    cache: Optional[TileCache] = None,
+) -> Optional[Image.Image]:
+    """A tile decoded to RGBA, from memory if it has been drawn before, else
+    from the downloader (its tile store, or the network). None if the provider
+    has no tile there; a failed download raises, as downloader.get does.
+
+    A TileFetcher's tiles are its cache dir's store, so every TileFetcher
+    shares them. Any other downloader serves tiles of its own, and they are
+    kept under keys only it uses.
+    """
+    cache = cache or get_tile_cache()
+    key = (_cache_scope(downloader, cache_dir), provider.name(), zoom, x, y)
+    tile = cache.get(key)
+    if tile is not None:
+        return tile
+    data = downloader.get(provider, cache_dir, zoom, x, y)
+    if data is None:
+        return None
+    tile = Image.open(io.BytesIO(data)).convert("RGBA")
+    cache.put(key, tile)
+    return tile
+
+
+# numbered rather than keyed on id(), which a later downloader can reuse
+_downloader_numbers: "weakref.WeakKeyDictionary[object, int]" = (
+    weakref.WeakKeyDictionary()
+)
+_next_downloader_number = itertools.count(1)
+
+
+def _cache_scope(downloader, cache_dir: str) -> str:
+    """The first part of a TileCache key: the cache dir, for a TileFetcher."""
+    if isinstance(downloader, TileFetcher):
+        return cache_dir
+    with _tile_cache_lock:
+        number = _downloader_numbers.get(downloader)
+        if number is None:
+            number = next(_next_downloader_number)
+            _downloader_numbers[downloader] = number
+    return f"{cache_dir}#{number}"
@@ -698,6 +698,114 @@ class OwnTracksDayMap(SQLModel, table=True):
     created_at: datetime  # stored in the database in UTC timezone
 
 
+class OwnTracksStayState(SQLModel, table=True):
+    # where the track pipeline had got to for a day, so the hourly sync folds
+    # in only the fixes it brought. purely derived: a missing or stale row just
+    # means the day is rebuilt. see owntracks_incremental.py
+    diary_date: date = Field(primary_key=True)
+    timezone: str = Field(primary_key=True)  # the local day the fixes were binned into
+    params_key: str = Field(primary_key=True)  # TrackParams.cache_key()
+    version: int  # owntracks_incremental.STATE_VERSION
+    num_fixes: int  # fixes folded in, to notice one arriving out of order
+    last_tst: Optional[datetime] = None  # the newest fix folded in, UTC
+    data: str  # JSON: IncrementalTrack
+    updated_at: datetime  # stored in the database in UTC timezone
+
+
+class OwnTracksPlaceBase(SQLModel):
+    # somewhere stays keep coming back to: home, the office. unnamed until
+    # someone names it; the itinerary shows the name instead of coordinates
+    name: Optional[str] = Field(default=None, index=True)
+    lat: float
+    lon: float
+
+
+class OwnTracksPlace(OwnTracksPlaceBase, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    created_at: datetime  # stored in the database in UTC timezone
+
+
+class OwnTracksPlaceVisit(SQLModel, table=True):
+    # one stay at a place, so "how long at X" is a sum over an index rather
+    # than a rebuild of every day. see owntracks_places.py
+    id: Optional[int] = Field(default=None, primary_key=True)
+    place_id: int = Field(foreign_key="owntracksplace.id", index=True)
+    diary_date: date = Field(index=True)
+    t_start: datetime  # stored in the database in UTC timezone
+    t_end: datetime  # stored in the database in UTC timezone
+    minutes: float
+
+
+class OwnTracksDayPoints(SQLModel, table=True):
+    # a local day's fixes as one compressed columnar blob, so loading a day for
+    # the track pipeline is one row and a decode rather than an ORM object per
+    # fix. purely derived: deleting every row is always safe. see
+    # owntracks_daypoints.py
+    diary_date: date = Field(primary_key=True)
+    timezone: str = Field(primary_key=True)  # the local day the fixes were binned into
+    # encoding version plus a stamp of the day's fixes; either changing means
+    # the blob is stale
+    version: str
+    num_fixes: int
+    data: bytes  # zlib-compressed columns: see owntracks_daypoints.encode_columns
+    updated_at: datetime  # stored in the database in UTC timezone
+
+
+class OwnTracksDaySummary(SQLModel, table=True):
+    # the numbers a week/month/year total needs from one day's default track,
+    # so /owntracks/stats is a GROUP BY rather than a year of build_track.
+    # written by processed_day; purely derived. see owntracks_stats.py
+    diary_date: date = Field(primary_key=True)
+    timezone: str  # the local day the fixes were binned into
+    # summary version plus a stamp of the day's fixes; either changing means
+    # the row is stale
+    version: str
+    num_fixes: int
+    distance_m: float
+    num_stays: int
+    stay_minutes: float
+    moving_minutes: float  # links that are not gaps in the data
+    num_areas: int
+    # bounding box of the track; None for a day with nothing to draw
+    min_lat: Optional[float] = None
+    min_lon: Optional[float] = None
+    max_lat: Optional[float] = None
+    max_lon: Optional[float] = None
+    updated_at: datetime  # stored in the database in UTC timezone
+
+
+class OwnTracksTrackCache(SQLModel, table=True):
+    # a day's processed track and areas, so the track/areas/map routes, note
+    # init and the note sync stop re-running the pipeline over the same fixes.
+    # purely derived: deleting every row is always safe. see owntracks_cache.py
+    diary_date: date = Field(primary_key=True)
+    timezone: str = Field(primary_key=True)  # the local day the fixes were binned into
+    params_key: str = Field(primary_key=True)  # TrackParams.cache_key()
+    area_threshold_m: float = Field(primary_key=True)
+    # pipeline version plus a stamp of the day's fixes; either changing means
+    # the stored result is stale
+    version: str = Field(primary_key=True)
+    data: str  # JSON: the DayTrack and its areas
+    created_at: datetime  # stored in the database in UTC timezone
+
+
+class MapRenderJob(SQLModel, table=True):
+    # a day's map(s) to render into the map cache, queued by map_jobs.submit and
+    # worked off by map_jobs.RenderService. persisted so a backfill survives a
+    # restart: a job still "running" when the service starts again is requeued
+    id: Optional[int] = Field(default=None, primary_key=True)
+    diary_date: date = Field(index=True)
+    timezone: str  # the day's zone, inferred when the job was queued
+    panel: Optional[int] = None  # None renders every panel the day has
+    params: str  # JSON: the TrackParams fields
+    render: str  # JSON: the RenderParams fields
+    status: str = Field(index=True)  # queued | running | done | failed
+    attempts: int = 0
+    error: Optional[str] = None  # the last failure
+    created_at: datetime  # stored in the database in UTC timezone
+    updated_at: datetime  # stored in the database in UTC timezone
+
+
 class SpellingBeeMissBase(SQLModel):
     # a word from the NYT Spelling Bee that wasn't found on the day it ran.
     # entered by hand -- there's no API for the puzzle.
@@ -61,6 +61,15 @@ class MyDiaryDay:
         owntracks_day_maps: List[
             OwnTracksDayMap
         ] = [],  # the day's rendered maps, ordered by panel
+        owntracks_track: Optional[
+            Any
+        ] = None,  # the processed DayTrack, when already computed for the locations
+        owntracks_areas: Optional[
+            List[Any]
+        ] = None,  # and the Areas it splits into
+        owntracks_places: Optional[
+            Any
+        ] = None,  # the known-places PlaceIndex, to name stays in the itinerary
         rating: Optional[
             int
         ] = None,  # (emotional) rating for the day. should it be an enum? should it also include a text description (and be its own object type)?
@@ -79,6 +88,9 @@ class MyDiaryDay:
         self.google_calendar_events = google_calendar_events
         self.owntracks_locations = owntracks_locations
         self.owntracks_day_maps = owntracks_day_maps
+        self.owntracks_track = owntracks_track
+        self.owntracks_areas = owntracks_areas
+        self.owntracks_places = owntracks_places
         self.rating = rating
         self.flagged = flagged
 
@@ -96,7 +108,9 @@ class MyDiaryDay:
         from .pocket_connector import MyDiaryPocket
         from .spotify_connector import MyDiarySpotify
         from .googlecalendar_connector import MyDiaryGCal
+        from .owntracks_cache import processed_day
         from .owntracks_connector import MyDiaryOwnTracks
+        from .owntracks_places import load_index
 
         if session is None:
             session = Session(engine)
@@ -154,6 +168,12 @@ class MyDiaryDay:
         owntracks_locations = mydiary_owntracks.get_locations_for_day(
             dt, session=session
         )
+        # from the cache: the Location section needs the processed track, and the
+        # map sync that follows note init needs the very same one
+        owntracks_track, owntracks_areas = (
+            processed_day(dt, session) if owntracks_locations else (None, None)
+        )
+        owntracks_places = load_index(session) if owntracks_locations else None
         owntracks_day_maps = list(
             session.exec(
                 select(OwnTracksDayMap)
@@ -171,6 +191,9 @@ class MyDiaryDay:
             google_calendar_events=google_calendar_events,
             owntracks_locations=owntracks_locations,
             owntracks_day_maps=owntracks_day_maps,
+            owntracks_track=owntracks_track,
+            owntracks_areas=owntracks_areas,
+            owntracks_places=owntracks_places,
             joplin_note_id=getattr(note, "id", None),
             **kwargs,
         )
@@ -232,6 +255,9 @@ class MyDiaryDay:
         """
         from .owntracks_track import build_track, points_from_locations
 
+        if params is None and self.owntracks_track is not None:
+            return self.owntracks_track
+
         points = points_from_locations(
             self.owntracks_locations, timezone=self.dt.timezone_name
         )
@@ -239,6 +265,7 @@ class MyDiaryDay:
 
     def owntracks_markdown(self) -> str:
         # lazily imported: owntracks_maps imports this module
+        from .gazetteer import get_gazetteer
         from .owntracks_maps import panels_for_track, section_content
 
         if not self.owntracks_locations:
@@ -250,10 +277,12 @@ class MyDiaryDay:
         # that has already been split into areas must not be flattened back to
         # one map here, or sync_day_map_to_note would see an unchanged hash and
         # leave the note that way
-        panels = panels_for_track(track)
+        panels = panels_for_track(track, areas=self.owntracks_areas)
         by_panel = {m.panel: m.joplin_resource_id for m in self.owntracks_day_maps}
         resource_ids = [by_panel.get(i) for i in range(len(panels))]
-        return section_content(resource_ids, panels)
+        return section_content(
+            resource_ids, panels, self.owntracks_places, get_gazetteer()
+        )
 
     def spotify_tracks_markdown(self, timezone=None) -> str:
         if not self.spotify_tracks:
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """A day's processed track and areas, computed once.
+
+Opening a day in the UI asks for its track, its areas and its map; writing the
+note builds the panels again. Each of those used to reload the day's fixes and
+re-run build_track and split_into_areas from scratch, three or four times over
+for one look at one day.
+
+The result is stored in OwnTracksTrackCache, keyed by everything that decides
+it: the local day and its timezone, the TrackParams, the area threshold, and a
+version made of CACHE_VERSION and a stamp of the day's fixes. New fixes change
+the stamp, so a stale row is never read; save_locations_to_database also
+deletes the rows for the days it touched, so they do not pile up.
+
+The stored track has to be *the same* track, not an approximation of it --
+content_hash decides whether a note's map is re-rendered -- so coordinates are
+stored as JSON floats (which round-trip exactly) and times as exact epoch
+microseconds, rebuilt in the day's timezone."""
+
+import json
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import pendulum
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select
+
+from .models import OwnTracksTrackCache
+from .owntracks_columns import build_track as build_track_from_columns
+from .owntracks_columns import epoch_us, from_epoch_us
+from .owntracks_connector import MyDiaryOwnTracks
+from .owntracks_daypoints import day_columns
+from .owntracks_incremental import has_state, update_day
+from .owntracks_stats import record_summary
+from .owntracks_track import (
+    AREA_SPLIT_M,
+    Area,
+    DayTrack,
+    Link,
+    Stay,
+    TrackParams,
+    split_into_areas,
+)
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+# bump whenever the pipeline's output changes for the same fixes and params --
+# new stay logic, a different area split -- so every cached day is recomputed
+CACHE_VERSION = 1
+
+
+def processed_day(
+    dt: datetime,
+    session: Session,
+    params: Optional[TrackParams] = None,
+    area_threshold_m: float = AREA_SPLIT_M,
+    incremental: bool = False,
+) -> Tuple[DayTrack, List[Area]]:
+    """The day's track and areas, from the cache when its fixes are unchanged.
+
+    A day with no fixes at all comes back as an empty track, as build_track
+    would return for it; telling the caller why there is nothing to draw is
+    the caller's business.
+
+    On a miss, a day the hourly sync keeps an OwnTracksStayState for -- or any
+    day, with incremental=True -- folds in just its new fixes rather than
+    running build_track over all of them. Any other day is built from its
+    OwnTracksDayPoints columns. The track is the same either way. See
+    store_day for what is stored.
+    """
+    params = params or TrackParams()
+    dt = pendulum.instance(dt)
+    fixes_version = MyDiaryOwnTracks().get_fixes_version_for_day(dt, session=session)
+    cached = cached_day(dt, session, params, area_threshold_m, fixes_version)
+    if cached is not None:
+        return cached
+
+    if incremental or has_state(dt, session, params):
+        track = update_day(dt, session, params)
+    else:
+        cols = day_columns(dt, session, fixes_version)
+        track = build_track_from_columns(cols, params)
+    areas = split_into_areas(track, area_threshold_m)
+    store_day(dt, session, params, area_threshold_m, fixes_version, track, areas)
+    return track, areas
+
+
+def _key(dt: pendulum.DateTime, params: TrackParams, area_threshold_m: float):
+    return dict(
+        diary_date=dt.date(),
+        timezone=dt.timezone_name,
+        params_key=params.cache_key(),
+        area_threshold_m=float(area_threshold_m),
+    )
+
+
+def cached_day(
+    dt: datetime,
+    session: Session,
+    params: TrackParams,
+    area_threshold_m: float,
+    fixes_version: str,
+) -> Optional[Tuple[DayTrack, List[Area]]]:
+    """The stored track and areas for the day, if there are any for these
+    fixes (fixes_version is get_fixes_version_for_day's stamp)."""
+    dt = pendulum.instance(dt)
+    key = _key(dt, params, area_threshold_m)
+    row = session.get(
+        OwnTracksTrackCache, dict(key, version=f"{CACHE_VERSION}|{fixes_version}")
+    )
+    if row is None:
+        return None
+    return _from_json(row.data, dt.timezone_name)
+
+
+def store_day(
+    dt: datetime,
+    session: Session,
+    params: TrackParams,
+    area_threshold_m: float,
+    fixes_version: str,
+    track: DayTrack,
+    areas: List[Area],
+) -> None:
+    """Store a day's track and areas, built from the fixes fixes_version stamps.
+
+    A day built with the default params and area threshold also gets its
+    OwnTracksDaySummary.
+    """
+    dt = pendulum.instance(dt)
+    key = _key(dt, params, area_threshold_m)
+    version = f"{CACHE_VERSION}|{fixes_version}"
+    _store(session, key, version, _to_json(track, areas))
+    if params == TrackParams() and area_threshold_m == AREA_SPLIT_M:
+        record_summary(dt, track, areas, session, fixes_version)
+
+
+def _store(session: Session, key: Dict[str, Any], version: str, data: str) -> None:
+    # in a savepoint: losing the race below must not throw away whatever else
+    # the caller has pending in the session
+    try:
+        with session.begin_nested():
+            # whatever else is stored under this key is for fixes that no
+            # longer exist
+            stale = session.exec(
+                select(OwnTracksTrackCache)
+                .where(OwnTracksTrackCache.diary_date == key["diary_date"])
+                .where(OwnTracksTrackCache.timezone == key["timezone"])
+                .where(OwnTracksTrackCache.params_key == key["params_key"])
+                .where(OwnTracksTrackCache.area_threshold_m == key["area_threshold_m"])
+            ).all()
+            for old in stale:
+                session.delete(old)
+            session.add(
+                OwnTracksTrackCache(
+                    **key, version=version, data=data, created_at=pendulum.now(tz="UTC")
+                )
+            )
+    except IntegrityError:
+        # a concurrent request computed and stored the same day first; its row
+        # is as good as ours
+        logger.debug(f"owntracks cache row for {key['diary_date']} already stored")
+    session.commit()
+
+
+def _track_to_dict(track: DayTrack) -> Dict[str, Any]:
+    return {
+        "stays": [
+            [s.lat, s.lon, epoch_us(s.t_start), epoch_us(s.t_end), s.num_points]
+            for s in track.stays
+        ],
+        "links": [
+            [
+                x.start_lat,
+                x.start_lon,
+                x.end_lat,
+                x.end_lon,
+                epoch_us(x.t_start),
+                epoch_us(x.t_end),
+                x.distance_m,
+                x.uncertain,
+            ]
+            for x in track.links
+        ],
+        "num_points": track.num_points,
+        "num_dropped": track.num_dropped,
+        "distance_m": track.distance_m,
+    }
+
+
+def _track_from_dict(data: Dict[str, Any], tz: str) -> DayTrack:
+    return DayTrack(
+        stays=[
+            Stay(
+                lat,
+                lon,
+                from_epoch_us(t_start, tz),
+                from_epoch_us(t_end, tz),
+                num_points,
+            )
+            for lat, lon, t_start, t_end, num_points in data["stays"]
+        ],
+        links=[
+            Link(
+                start_lat,
+                start_lon,
+                end_lat,
+                end_lon,
+                from_epoch_us(t_start, tz),
+                from_epoch_us(t_end, tz),
+                distance_m,
+                uncertain,
+            )
+            for (
+                start_lat,
+                start_lon,
+                end_lat,
+                end_lon,
+                t_start,
+                t_end,
+                distance_m,
+                uncertain,
+            ) in data["links"]
+        ],
+        num_points=data["num_points"],
+        num_dropped=data["num_dropped"],
+        distance_m=data["distance_m"],
+    )
+
+
+def _to_json(track: DayTrack, areas: List[Area]) -> str:
+    return json.dumps(
+        {
+            "track": _track_to_dict(track),
+            "areas": [
+                {
+                    "track": _track_to_dict(area.track),
+                    "t_start": epoch_us(area.t_start),
+                    "t_end": epoch_us(area.t_end),
+                }
+                for area in areas
+            ],
+        }
+    )
+
+
+def _from_json(data: str, tz: str) -> Tuple[DayTrack, List[Area]]:
+    parsed = json.loads(data)
+    return _track_from_dict(parsed["track"], tz), [
+        Area(
+            track=_track_from_dict(area["track"], tz),
+            t_start=from_epoch_us(area["t_start"], tz),
+            t_end=from_epoch_us(area["t_end"], tz),
+        )
+        for area in parsed["areas"]
+    ]
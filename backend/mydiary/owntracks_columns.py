@@ -0,0 +1,496 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """build_track over columns instead of point objects.
+
+owntracks_track is the reference: one frozen TrackPoint per fix, and a math
+call per comparison. That is the right shape for reading and for tuning, and
+the wrong one for a month of fixes or a parameter sweep, where most of the time
+goes on allocating dataclasses and calling haversine_m one pair at a time.
+
+Here lat/lon/tst/acc are NumPy columns and the per-fix stages run as array
+operations. The output is the same DayTrack, and has to be *exactly* the same:
+content_hash decides whether a note's map is re-rendered, so a track that
+differs in the last bit of a centroid is a different map. Two things make that
+hold:
+
+  * numpy's transcendental functions are not bit-identical to math's (arcsin
+    differs in ~10% of inputs), so the vectorised distances only ever decide
+    comparisons that are not close. Anything within a hair of its threshold is
+    re-decided with haversine_m, and every distance that ends up in the output
+    is computed by haversine_m too.
+  * sums are accumulated in the same order as the reference loop: a running
+    centroid is a cumsum from the group's first fix, never a difference of
+    prefix sums.
+
+What stays per-object is what the output is made of -- stays, and one link per
+pair of nodes -- so the cost that is left scales with what gets drawn rather
+than with how many fixes went in."""
+
+import calendar
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pendulum
+
+from .owntracks_track import (
+    EARTH_RADIUS_M,
+    DayTrack,
+    Link,
+    Stay,
+    TrackParams,
+    TrackPoint,
+    haversine_m,
+    merge_stays,
+)
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+
+_UTC = timezone.utc
+
+# a vectorised comparison this close to its threshold (relative) is re-decided
+# with the scalar reference. numpy and libm agree to within a few ulps, so this
+# is many orders of magnitude wider than it needs to be, and still rare to hit.
+_BORDERLINE = 1e-9
+
+
+def epoch_us(dt: datetime) -> int:
+    """Microseconds since the epoch, exactly -- no float timestamp() rounding."""
+    return calendar.timegm(dt.utctimetuple()) * 1_000_000 + dt.microsecond
+
+
+def from_epoch_us(us: int, tz: str) -> datetime:
+    """epoch_us's inverse, in timezone tz."""
+    seconds, micro = divmod(us, 1_000_000)
+    return pendulum.from_timestamp(seconds, tz=tz).replace(microsecond=micro)
+
+
+@dataclass
+class TrackColumns:
+    """A day's fixes as parallel arrays, in time order.
+
+    tst is int64 microseconds since the epoch, so every time difference is the
+    exact integer a timedelta would hold. acc is float64 with NaN for a fix that
+    reported no accuracy.
+
+    The output needs real datetimes for the handful of fixes that become stays
+    and nodes. times holds them when the columns came from TrackPoints (so the
+    output carries the very same objects); otherwise they are made on demand
+    from tst in timezone.
+    """
+
+    tst: np.ndarray
+    lat: np.ndarray
+    lon: np.ndarray
+    acc: np.ndarray
+    motion: Optional[List[Optional[str]]] = None
+    times: Optional[List[datetime]] = None
+    timezone: str = "UTC"
+
+    def __len__(self) -> int:
+        return len(self.tst)
+
+    def take(self, idx: np.ndarray) -> "TrackColumns":
+        """The fixes at idx (an index array or boolean mask), in that order."""
+        if idx.dtype == bool:
+            idx = np.flatnonzero(idx)
+        return TrackColumns(
+            tst=self.tst[idx],
+            lat=self.lat[idx],
+            lon=self.lon[idx],
+            acc=self.acc[idx],
+            motion=None if self.motion is None else [self.motion[i] for i in idx],
+            times=None if self.times is None else [self.times[i] for i in idx],
+            timezone=self.timezone,
+        )
+
+    def time_at(self, i: int) -> datetime:
+        if self.times is not None:
+            return self.times[i]
+        return from_epoch_us(int(self.tst[i]), self.timezone)
+
+    @classmethod
+    def from_points(cls, points: Sequence[TrackPoint]) -> "TrackColumns":
+        return cls(
+            tst=np.fromiter(
+                (epoch_us(p.tst) for p in points), dtype=np.int64, count=len(points)
+            ),
+            lat=np.fromiter(
+                (p.lat for p in points), dtype=np.float64, count=len(points)
+            ),
+            lon=np.fromiter(
+                (p.lon for p in points), dtype=np.float64, count=len(points)
+            ),
+            acc=np.fromiter(
+                (np.nan if p.acc is None else p.acc for p in points),
+                dtype=np.float64,
+                count=len(points),
+            ),
+            motion=[p.motion for p in points],
+            times=[p.tst for p in points],
+        )
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Tuple], timezone: str = "UTC") -> "TrackColumns":
+        """From (tst, lat, lon, acc, motion) rows, tst UTC and possibly naive --
+        what a database query returns. Sorted by time, like points_from_locations."""
+        rows = list(rows)
+        tst = np.fromiter(
+            (
+                epoch_us(t if t.tzinfo is not None else t.replace(tzinfo=_UTC))
+                for t, *_ in rows
+            ),
+            dtype=np.int64,
+            count=len(rows),
+        )
+        lat = np.fromiter((r[1] for r in rows), dtype=np.float64, count=len(rows))
+        lon = np.fromiter((r[2] for r in rows), dtype=np.float64, count=len(rows))
+        order = np.argsort(tst, kind="stable")
+        return cls(
+            tst=tst[order],
+            lat=lat[order],
+            lon=lon[order],
+            acc=np.fromiter(
+                (np.nan if r[3] is None else r[3] for r in rows),
+                dtype=np.float64,
+                count=len(rows),
+            )[order],
+            motion=[rows[i][4] for i in order],
+            timezone=timezone,
+        )
+
+
+def haversine_np(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """haversine_m over arrays. Agrees with it to a few ulps, not exactly."""
+    p1, p2 = np.radians(lat1), np.radians(lat2)
+    dp = p2 - p1
+    dl = np.radians(lon2 - lon1)
+    a = np.sin(dp / 2) ** 2 + np.cos(p1) * np.cos(p2) * np.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def _exceeds(values: np.ndarray, limit: float, exact) -> np.ndarray:
+    """values > limit, with anything borderline re-decided by exact(k) -- the
+    reference computation of values[k]."""
+    out = values > limit
+    close = np.flatnonzero(np.abs(values - limit) <= _BORDERLINE * max(abs(limit), 1.0))
+    for k in close:
+        out[k] = exact(int(k)) > limit
+    return out
+
+
+def _seconds(cols: TrackColumns, i: int, j: int) -> float:
+    return abs(int(cols.tst[j]) - int(cols.tst[i])) / 1e6
+
+
+def _kmh(cols: TrackColumns, i: int, j: int) -> float:
+    """_implied_kmh between two fixes, computed exactly as the reference does."""
+    seconds = _seconds(cols, i, j)
+    if seconds == 0:
+        return 0.0
+    d = haversine_m(
+        float(cols.lat[i]), float(cols.lon[i]), float(cols.lat[j]), float(cols.lon[j])
+    )
+    return d / seconds * 3.6
+
+
+def implied_kmh_np(cols: TrackColumns, i: np.ndarray, j: np.ndarray) -> np.ndarray:
+    """_implied_kmh for every pair (i[k], j[k]); 0 where no time passes."""
+    seconds = np.abs(cols.tst[j] - cols.tst[i]) / 1e6
+    d = haversine_np(cols.lat[i], cols.lon[i], cols.lat[j], cols.lon[j])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        kmh = d / seconds * 3.6
+    kmh[seconds == 0] = 0.0
+    return kmh
+
+
+def dedupe(cols: TrackColumns) -> TrackColumns:
+    """owntracks_track.dedupe: drop repeats of the same instant and position.
+
+    Only fixes sharing a timestamp can be repeats, and those are rare, so the
+    position comparison -- which has to use Python's round() to agree with the
+    reference -- only ever runs on them.
+    """
+    n = len(cols)
+    if n < 2:
+        return cols
+    order = np.argsort(cols.tst, kind="stable")
+    same = cols.tst[order][1:] == cols.tst[order][:-1]
+    if not same.any():
+        return cols
+    shared = np.zeros(n, dtype=bool)
+    shared[order[1:][same]] = True
+    shared[order[:-1][same]] = True
+    keep = np.ones(n, dtype=bool)
+    seen = set()
+    for i in np.flatnonzero(shared):
+        key = (
+            int(cols.tst[i]),
+            round(float(cols.lat[i]), 6),
+            round(float(cols.lon[i]), 6),
+        )
+        if key in seen:
+            keep[i] = False
+            continue
+        seen.add(key)
+    return cols.take(keep)
+
+
+def filter_accuracy(cols: TrackColumns, max_acc: int) -> TrackColumns:
+    """owntracks_track.filter_accuracy. NaN (no accuracy reported) is kept."""
+    keep = np.isnan(cols.acc) | (cols.acc <= max_acc)
+    if keep.all():
+        return cols
+    return cols.take(keep)
+
+
+def despike(cols: TrackColumns, max_kmh: float) -> TrackColumns:
+    """owntracks_track.despike.
+
+    A fix can only be dropped if leaving it toward its successor is too fast,
+    and that does not depend on what was dropped before it -- so one vectorised
+    pass finds the few candidates, and only those walk the reference logic,
+    which compares against the last fix *kept*.
+    """
+    n = len(cols)
+    if n < 3:
+        return cols
+    i = np.arange(1, n - 1)
+    leaving = _exceeds(
+        implied_kmh_np(cols, i, i + 1), max_kmh, lambda k: _kmh(cols, k + 1, k + 2)
+    )
+    candidates = i[leaving]
+    if not len(candidates):
+        return cols
+    keep = np.ones(n, dtype=bool)
+    for cur in candidates:
+        cur = int(cur)
+        prev = cur - 1
+        while not keep[prev]:
+            prev -= 1
+        if _kmh(cols, prev, cur) > max_kmh and _kmh(cols, prev, cur + 1) <= max_kmh:
+            logger.debug(f"despike: dropping outlier fix at {cols.time_at(cur)}")
+            keep[cur] = False
+    return cols.take(keep)
+
+
+def _group_end(cols: TrackColumns, i: int, radius_m: float) -> Tuple[int, float, float]:
+    """Where detect_stays' group starting at i breaks, and its coordinate sums.
+
+    Grows a window from i, doubling, until some fix leaves the running centroid
+    of the fixes before it. The cumsum starts at fix i, so every partial sum is
+    the same float the reference loop accumulates.
+    """
+    n = len(cols)
+    width = 16
+    while True:
+        stop = min(n, i + width)
+        lat_sums = np.cumsum(cols.lat[i:stop])
+        lon_sums = np.cumsum(cols.lon[i:stop])
+        counts = np.arange(1, stop - i)
+        c_lat = lat_sums[:-1] / counts
+        c_lon = lon_sums[:-1] / counts
+        d = haversine_np(c_lat, c_lon, cols.lat[i + 1 : stop], cols.lon[i + 1 : stop])
+
+        def exact(k: int) -> float:
+            return haversine_m(
+                float(c_lat[k]),
+                float(c_lon[k]),
+                float(cols.lat[i + 1 + k]),
+                float(cols.lon[i + 1 + k]),
+            )
+
+        out = np.flatnonzero(_exceeds(d, radius_m, exact))
+        if len(out):
+            k = int(out[0])
+            return i + 1 + k, float(lat_sums[k]), float(lon_sums[k])
+        if stop == n:
+            return n, float(lat_sums[-1]), float(lon_sums[-1])
+        width *= 4
+
+
+def detect_stays(
+    cols: TrackColumns, radius_m: float, min_minutes: float
+) -> Tuple[List[Stay], List[Tuple[int, int]]]:
+    """owntracks_track.detect_stays.
+
+    On a moving stretch every group breaks at its second fix, and the reference
+    spends a haversine_m on each to find that out. Here one vectorised pass
+    marks those fixes and the walk jumps straight over them; only where the
+    track actually lingers does it grow a group.
+    """
+    n = len(cols)
+    stays: List[Stay] = []
+    ranges: List[Tuple[int, int]] = []
+    if n == 0:
+        return stays, ranges
+    # a group of one has its only fix as its centroid, so whether it grows at
+    # all is a plain consecutive-pair distance
+    lingers = np.zeros(n, dtype=bool)
+    if n > 1:
+        lingers[:-1] = ~_exceeds(
+            haversine_np(cols.lat[:-1], cols.lon[:-1], cols.lat[1:], cols.lon[1:]),
+            radius_m,
+            lambda k: haversine_m(
+                float(cols.lat[k]),
+                float(cols.lon[k]),
+                float(cols.lat[k + 1]),
+                float(cols.lon[k + 1]),
+            ),
+        )
+    starts = np.flatnonzero(lingers)
+    i = 0
+    while True:
+        # the next fix at or after i whose group grows past one
+        s = np.searchsorted(starts, i)
+        if s == len(starts):
+            break
+        i = int(starts[s])
+        j, lat_sum, lon_sum = _group_end(cols, i, radius_m)
+        span = (int(cols.tst[j - 1]) - int(cols.tst[i])) / 1e6 / 60.0
+        if j - i >= 2 and span >= min_minutes:
+            count = j - i
+            stays.append(
+                Stay(
+                    lat=lat_sum / count,
+                    lon=lon_sum / count,
+                    t_start=cols.time_at(i),
+                    t_end=cols.time_at(j - 1),
+                    num_points=count,
+                )
+            )
+            ranges.append((i, j))
+            i = j
+        else:
+            i += 1
+    return stays, ranges
+
+
+def _in_stay_mask(n: int, consumed: Sequence[Tuple[int, int]]) -> np.ndarray:
+    in_stay = np.zeros(n, dtype=bool)
+    for start, end in consumed:
+        in_stay[start:end] = True
+    return in_stay
+
+
+def detect_gap_stays(
+    cols: TrackColumns,
+    consumed: Sequence[Tuple[int, int]],
+    min_minutes: float,
+    max_kmh: float,
+) -> List[Stay]:
+    """owntracks_track.detect_gap_stays, over every consecutive pair at once."""
+    n = len(cols)
+    if n < 2:
+        return []
+    in_stay = _in_stay_mask(n, consumed)
+    a = np.arange(n - 1)
+    minutes = (cols.tst[1:] - cols.tst[:-1]) / 1e6 / 60.0
+    candidate = ~(in_stay[:-1] & in_stay[1:]) & (minutes >= min_minutes)
+    a = a[candidate]
+    if not len(a):
+        return []
+    fast = _exceeds(
+        implied_kmh_np(cols, a, a + 1),
+        max_kmh,
+        lambda k: _kmh(cols, int(a[k]), int(a[k]) + 1),
+    )
+    return [
+        Stay(
+            lat=float(cols.lat[i]),
+            lon=float(cols.lon[i]),
+            t_start=cols.time_at(i),
+            t_end=cols.time_at(i + 1),
+            num_points=2,
+        )
+        for i in a[~fast].tolist()
+    ]
+
+
+def clean(cols: TrackColumns, params: TrackParams) -> TrackColumns:
+    """dedupe, accuracy filter and despike: the fixes the track is built from."""
+    return despike(filter_accuracy(dedupe(cols), params.max_acc), params.max_kmh)
+
+
+def build_track(cols: TrackColumns, params: Optional[TrackParams] = None) -> DayTrack:
+    """owntracks_track.build_track over columns. Same DayTrack, same hash."""
+    params = params or TrackParams()
+    raw_count = len(cols)
+    cleaned = clean(cols, params)
+    n = len(cleaned)
+    if not n:
+        return DayTrack(num_points=0, num_dropped=raw_count)
+
+    stays, ranges = detect_stays(cleaned, params.stay_radius_m, params.stay_minutes)
+    gap_stays = detect_gap_stays(
+        cleaned, ranges, params.stay_minutes, params.dwell_max_kmh
+    )
+    return assemble(cleaned, stays, ranges, gap_stays, params, raw_count)
+
+
+def assemble(
+    cleaned: TrackColumns,
+    stays: List[Stay],
+    ranges: Sequence[Tuple[int, int]],
+    gap_stays: List[Stay],
+    params: TrackParams,
+    raw_count: int,
+) -> DayTrack:
+    """The tail of build_track: nodes from stays and free fixes, then links."""
+    n = len(cleaned)
+    in_stay = _in_stay_mask(n, ranges)
+    # a gap-stay consumes the fix(es) at its anchor instant, as in the reference
+    if gap_stays:
+        anchors = np.fromiter(
+            (epoch_us(s.t_start) for s in gap_stays),
+            dtype=np.int64,
+            count=len(gap_stays),
+        )
+        in_stay |= np.isin(cleaned.tst, anchors)
+
+    stays = merge_stays(stays + gap_stays, params.stay_radius_m)
+
+    # (t_start_us, t_end_us, lat, lon, t_start, t_end), free fixes first and
+    # then stays, so the stable sort breaks ties as the reference's does
+    nodes = []
+    for i in np.flatnonzero(~in_stay).tolist():
+        us, t = int(cleaned.tst[i]), cleaned.time_at(i)
+        nodes.append((us, us, float(cleaned.lat[i]), float(cleaned.lon[i]), t, t))
+    nodes.extend(
+        (epoch_us(s.t_start), epoch_us(s.t_end), s.lat, s.lon, s.t_start, s.t_end)
+        for s in stays
+    )
+    nodes.sort(key=lambda node: node[0])
+
+    links: List[Link] = []
+    total_m = 0.0
+    for a, b in zip(nodes, nodes[1:]):
+        distance = haversine_m(a[2], a[3], b[2], b[3])
+        gap_minutes = (b[0] - a[1]) / 1e6 / 60.0
+        uncertain = gap_minutes > params.gap_minutes and distance > params.gap_metres
+        links.append(
+            Link(
+                start_lat=a[2],
+                start_lon=a[3],
+                end_lat=b[2],
+                end_lon=b[3],
+                t_start=a[5],
+                t_end=b[4],
+                distance_m=distance,
+                uncertain=uncertain,
+            )
+        )
+        total_m += distance
+
+    return DayTrack(
+        stays=stays,
+        links=links,
+        num_points=n,
+        num_dropped=raw_count - n,
+        distance_m=total_m,
+    )
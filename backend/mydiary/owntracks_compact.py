@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Compact forms of the owntracks GeoJSON responses, and compression.
+
+GeoJSON spells every feature out in full: "type": "Feature", a geometry
+object, the same property keys over and over, an ISO timestamp per time.
+Fine for a day; a lot of bytes for a week of fixes. The compact form is the
+same collection, columnar:
+
+  * features grouped by geometry -- "lines" (LineStrings) and "points" --
+    with one array per property key instead of one object per feature
+  * geometry as Google encoded polylines at POLYLINE_PRECISION decimals --
+    one polyline through all the points in order, one per line. The recorder
+    reports six decimals, so a fix comes back exactly; a stay's centroid moves
+    by at most 5cm
+  * the time properties (TIME_KEYS) as epoch seconds, with the collection's
+    timezone alongside to turn them back into local times
+
+expand_collection turns it back into the GeoJSON it came from. MessagePack
+carries the same document in binary; it needs the optional msgpack package.
+
+Any of the three is compressed with brotli (if the brotli package is there)
+or gzip, whichever the client accepts. A streamed response -- many days, one
+record each -- is NDJSON for GeoJSON and the compact form, and a sequence of
+MessagePack documents for msgpack (msgpack.Unpacker reads them one by one);
+compress_stream flushes after every record."""
+
+import gzip
+import json
+import zlib
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import pendulum
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+COMPACT_VERSION = 1
+POLYLINE_PRECISION = 6
+
+GEOJSON_MEDIA_TYPE = "application/json"
+COMPACT_MEDIA_TYPE = "application/vnd.mydiary.compact+json"
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+
+FORMATS = {
+    "geojson": GEOJSON_MEDIA_TYPE,
+    "compact": COMPACT_MEDIA_TYPE,
+    "msgpack": MSGPACK_MEDIA_TYPE,
+}
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+# a streamed response, a record at a time
+STREAM_FORMATS = {
+    "geojson": NDJSON_MEDIA_TYPE,
+    "compact": NDJSON_MEDIA_TYPE,
+    "msgpack": MSGPACK_MEDIA_TYPE,
+}
+# what an Accept header may call each format
+_ACCEPT = {
+    "application/json": "geojson",
+    "application/geo+json": "geojson",
+    COMPACT_MEDIA_TYPE: "compact",
+    MSGPACK_MEDIA_TYPE: "msgpack",
+    "application/x-msgpack": "msgpack",
+    "application/vnd.msgpack": "msgpack",
+}
+
+TIME_KEYS = ("tst", "t_start", "t_end")
+
+# below this a compressed body is barely smaller, and not worth the header
+MIN_COMPRESS_BYTES = 1024
+
+
+class FormatNotAvailable(Exception):
+    """The format needs a package that is not installed."""
+
+
+# --- polylines ---
+
+
+def _encode_value(value: int, out: List[str]) -> None:
+    value = ~(value << 1) if value < 0 else value << 1
+    while value >= 0x20:
+        out.append(chr((0x20 | (value & 0x1F)) + 63))
+        value >>= 5
+    out.append(chr(value + 63))
+
+
+def encode_polyline(
+    coords: Sequence[Tuple[float, float]], precision: int = POLYLINE_PRECISION
+) -> str:
+    """(lat, lon) pairs as a Google encoded polyline."""
+    factor = 10**precision
+    out: List[str] = []
+    prev_lat = prev_lon = 0
+    for lat, lon in coords:
+        qlat, qlon = round(lat * factor), round(lon * factor)
+        _encode_value(qlat - prev_lat, out)
+        _encode_value(qlon - prev_lon, out)
+        prev_lat, prev_lon = qlat, qlon
+    return "".join(out)
+
+
+def decode_polyline(
+    encoded: str, precision: int = POLYLINE_PRECISION
+) -> List[Tuple[float, float]]:
+    factor = 10**precision
+    coords = []
+    values: List[int] = []
+    shift = result = 0
+    for ch in encoded:
+        b = ord(ch) - 63
+        result |= (b & 0x1F) << shift
+        shift += 5
+        if b < 0x20:
+            values.append(~(result >> 1) if result & 1 else result >> 1)
+            shift = result = 0
+    lat = lon = 0
+    for dlat, dlon in zip(values[::2], values[1::2]):
+        lat += dlat
+        lon += dlon
+        coords.append((lat / factor, lon / factor))
+    return coords
+
+
+# --- the columnar document ---
+
+
+def _epoch(value: Optional[str]) -> Optional[float]:
+    if value is None:
+        return None
+    seconds = datetime.fromisoformat(value).timestamp()
+    return int(seconds) if seconds.is_integer() else seconds
+
+
+def _iso(value: Optional[float], timezone: str) -> Optional[str]:
+    if value is None:
+        return None
+    return pendulum.from_timestamp(value, tz=timezone).isoformat()
+
+
+def _columns(features: List[Dict[str, Any]]) -> Dict[str, List[Any]]:
+    keys: Dict[str, None] = {}
+    for feature in features:
+        keys.update(dict.fromkeys(feature["properties"]))
+    columns = {k: [f["properties"].get(k) for f in features] for k in keys}
+    for k in TIME_KEYS:
+        if k in columns:
+            columns[k] = [_epoch(v) for v in columns[k]]
+    return columns
+
+
+def compact_collection(
+    collection: Dict[str, Any],
+    timezone: str,
+    precision: int = POLYLINE_PRECISION,
+) -> Dict[str, Any]:
+    """A GeoJSON FeatureCollection of Points and LineStrings, columnar."""
+    features = collection["features"]
+    lines = [f for f in features if f["geometry"]["type"] == "LineString"]
+    points = [f for f in features if f["geometry"]["type"] == "Point"]
+    if len(lines) + len(points) != len(features):
+        raise ValueError("only Point and LineString features have a compact form")
+    doc = {
+        "format": "compact",
+        "version": COMPACT_VERSION,
+        "precision": precision,
+        "timezone": timezone,
+        "lines": {
+            "count": len(lines),
+            "coordinates": [
+                encode_polyline(
+                    [(lat, lon) for lon, lat in f["geometry"]["coordinates"]],
+                    precision,
+                )
+                for f in lines
+            ],
+            "properties": _columns(lines),
+        },
+        "points": {
+            "count": len(points),
+            "coordinates": encode_polyline(
+                [
+                    (f["geometry"]["coordinates"][1], f["geometry"]["coordinates"][0])
+                    for f in points
+                ],
+                precision,
+            ),
+            "properties": _columns(points),
+        },
+    }
+    if "properties" in collection:
+        doc["properties"] = collection["properties"]
+    return doc
+
+
+def _features(
+    geometry_type: str, coordinates: List, properties: Dict[str, List], tz: str
+) -> List[Dict[str, Any]]:
+    properties = {
+        k: [_iso(v, tz) for v in values] if k in TIME_KEYS else values
+        for k, values in properties.items()
+    }
+    return [
+        {
+            "type": "Feature",
+            "geometry": {"type": geometry_type, "coordinates": coords},
+            "properties": {k: values[i] for k, values in properties.items()},
+        }
+        for i, coords in enumerate(coordinates)
+    ]
+
+
+def expand_collection(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """compact_collection's document back as GeoJSON, lines then points."""
+    precision, tz = doc["precision"], doc["timezone"]
+    lines = [
+        [[lon, lat] for lat, lon in decode_polyline(encoded, precision)]
+        for encoded in doc["lines"]["coordinates"]
+    ]
+    points = [
+        [lon, lat]
+        for lat, lon in decode_polyline(doc["points"]["coordinates"], precision)
+    ]
+    collection = {
+        "type": "FeatureCollection",
+        "features": _features("LineString", lines, doc["lines"]["properties"], tz)
+        + _features("Point", points, doc["points"]["properties"], tz),
+    }
+    if "properties" in doc:
+        collection["properties"] = doc["properties"]
+    return collection
+
+
+# --- negotiation and encoding ---
+
+
+def accepted(value: Optional[str]) -> List[str]:
+    """An Accept or Accept-Encoding header's tokens, lowercased, most
+    preferred first, without any q=0."""
+    ranked = []
+    for i, part in enumerate((value or "").split(",")):
+        token, _, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            name, _, v = param.strip().partition("=")
+            if name == "q":
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        if token and q > 0:
+            ranked.append((-q, i, token.strip().lower()))
+    return [token for _, _, token in sorted(ranked)]
+
+
+def _msgpack():
+    try:
+        import msgpack
+    except ImportError:
+        return None
+    return msgpack
+
+
+def _brotli():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def negotiate(fmt: Optional[str], accept: Optional[str]) -> str:
+    """The format to respond in: fmt if given, else the best the Accept header
+    allows that can be produced here, else GeoJSON."""
+    if fmt is not None:
+        if fmt not in FORMATS:
+            raise ValueError(f"fmt must be one of {', '.join(FORMATS)}, not {fmt!r}")
+        if fmt == "msgpack" and _msgpack() is None:
+            raise FormatNotAvailable("msgpack is not installed")
+        return fmt
+    for media_type in accepted(accept):
+        name = _ACCEPT.get(media_type)
+        if name == "msgpack" and _msgpack() is None:
+            continue
+        if name is not None:
+            return name
+    return "geojson"
+
+
+def encode(collection: Dict[str, Any], fmt: str, timezone: str) -> bytes:
+    """The body for a collection in a negotiated format."""
+    if fmt == "geojson":
+        doc = collection
+    else:
+        doc = compact_collection(collection, timezone)
+    if fmt == "msgpack":
+        msgpack = _msgpack()
+        if msgpack is None:
+            raise FormatNotAvailable("msgpack is not installed")
+        return msgpack.packb(doc, use_bin_type=True)
+    return _dumps(doc)
+
+
+def _dumps(doc: Any) -> bytes:
+    # as FastAPI's JSONResponse renders it
+    return json.dumps(
+        doc, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def encode_record(record: Dict[str, Any], fmt: str) -> bytes:
+    """One record of a streamed response in a negotiated format: a line of
+    NDJSON, or one MessagePack document. Any collection in it is already in
+    the form fmt asks for."""
+    if fmt == "msgpack":
+        msgpack = _msgpack()
+        if msgpack is None:
+            raise FormatNotAvailable("msgpack is not installed")
+        return msgpack.packb(record, use_bin_type=True)
+    return _dumps(record) + b"\n"
+
+
+def compress(
+    body: bytes, accept_encoding: Optional[str]
+) -> Tuple[bytes, Optional[str]]:
+    """(body, Content-Encoding) -- brotli or gzip if accepted and worth it."""
+    if len(body) < MIN_COMPRESS_BYTES:
+        return body, None
+    for coding in accepted(accept_encoding):
+        if coding == "br" and _brotli() is not None:
+            return _brotli().compress(body, quality=5), "br"
+        if coding == "gzip":
+            return gzip.compress(body, compresslevel=6, mtime=0), "gzip"
+    return body, None
+
+
+def compress_stream(
+    chunks: Iterable[bytes], accept_encoding: Optional[str]
+) -> Tuple[Iterator[bytes], Optional[str]]:
+    """compress for a streamed body: (chunks, Content-Encoding). Flushed after
+    every chunk, so each arrives as soon as it is made, and still one valid
+    brotli or gzip stream."""
+    for coding in accepted(accept_encoding):
+        if coding == "br" and _brotli() is not None:
+            return _brotli_stream(chunks), "br"
+        if coding == "gzip":
+            return _gzip_stream(chunks), "gzip"
+    return iter(chunks), None
+
+
+def _gzip_stream(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    z = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield z.compress(chunk) + z.flush(zlib.Z_SYNC_FLUSH)
+    yield z.flush()
+
+
+def _brotli_stream(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    c = _brotli().Compressor(quality=5)
+    for chunk in chunks:
+        yield c.process(chunk) + c.flush()
+    yield c.finish()
@@ -10,13 +10,13 @@ the app) creates a new device id, and history is split across them."""
 
 import os
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 import pendulum
 import requests
 
-from .db import Session, engine, select
-from .models import OwnTracksLocation
+from .db import Session, engine, func, select
+from .models import OwnTracksLocation, OwnTracksTrackCache
 
 import logging
 
@@ -108,12 +108,16 @@ class MyDiaryOwnTracks:
         days_back: int = 7,
         start: Optional[datetime] = None,
         end: Optional[datetime] = None,
+        touched: Optional[List[datetime]] = None,
     ) -> int:
         """Mirror recent fixes from the recorder into the database.
 
         Existing rows are left alone: the recorder is append-only and can emit
         two records with the same timestamp and position but different trigger,
         which the (username, device, tst) unique constraint collapses.
+
+        Given touched, the (UTC) time of every fix added is appended to it, for
+        a caller that brings what is derived from those days up to date.
         """
         if session is None:
             session = self.new_session()
@@ -155,18 +159,52 @@ class MyDiaryOwnTracks:
             session.add(OwnTracksLocation(**row.model_dump()))
             num_added += 1
         logger.info(f"adding {num_added} new rows (in owntrackslocation) to database")
+        if touched is not None:
+            touched.extend(sorted(t for _, _, t in seen))
+        if seen:
+            self.invalidate_processed_days(
+                min(t for _, _, t in seen), max(t for _, _, t in seen), session
+            )
         session.commit()
         return num_added
 
+    @staticmethod
+    def invalidate_processed_days(
+        start: datetime, end: datetime, session: Session
+    ) -> None:
+        """Drop cached processed tracks for every day fixes in [start, end] (UTC)
+        could fall on.
+
+        The cache is keyed by local day and the day's timezone is not known
+        here, so this takes a day of margin either side: no timezone is more
+        than fourteen hours off UTC. Stale rows would never be *read* -- their
+        version stamp no longer matches -- but they would pile up.
+        """
+        first = pendulum.instance(start).date().subtract(days=1)
+        last = pendulum.instance(end).date().add(days=1)
+        stale = session.exec(
+            select(OwnTracksTrackCache)
+            .where(OwnTracksTrackCache.diary_date >= first)
+            .where(OwnTracksTrackCache.diary_date <= last)
+        ).all()
+        for row in stale:
+            session.delete(row)
+        if stale:
+            logger.debug(f"invalidated {len(stale)} cached owntracks day(s)")
+
+    @staticmethod
+    def _day_window(dt: datetime) -> Tuple[datetime, datetime]:
+        """The UTC instants a (local) day starts and ends at."""
+        dt = pendulum.instance(dt)
+        return dt.start_of("day").in_timezone("UTC"), dt.end_of("day").in_timezone("UTC")
+
     def get_locations_for_day(
         self, dt: datetime, session: Optional[Session] = None
     ) -> List[OwnTracksLocation]:
         """Get the location fixes for a given (local) day from the database."""
         if session is None:
             session = self.new_session()
-        dt = pendulum.instance(dt)
-        start = dt.start_of("day").in_timezone("UTC")
-        end = dt.end_of("day").in_timezone("UTC")
+        start, end = self._day_window(dt)
         stmt = (
             select(OwnTracksLocation)
             .where(OwnTracksLocation.tst >= start)
@@ -174,3 +212,47 @@ class MyDiaryOwnTracks:
             .order_by(OwnTracksLocation.tst)
         )
         return list(session.exec(stmt).all())
+
+    def get_fix_rows_for_day(
+        self,
+        dt: datetime,
+        session: Optional[Session] = None,
+        after: Optional[datetime] = None,
+    ) -> List[Tuple]:
+        """(tst, lat, lon, acc, motion) for each of the day's fixes, oldest first.
+
+        The lean counterpart of get_locations_for_day, for the track pipeline: a
+        Core select of the five columns it reads, run on the session's
+        connection, so no OwnTracksLocation is constructed per fix. tst is naive
+        UTC, as stored. after, if given, keeps only fixes later than it.
+        """
+        if session is None:
+            session = self.new_session()
+        start, end = self._day_window(dt)
+        table = OwnTracksLocation.__table__
+        stmt = (
+            select(table.c.tst, table.c.lat, table.c.lon, table.c.acc, table.c.motion)
+            .where(table.c.tst >= start if after is None else table.c.tst > after)
+            .where(table.c.tst <= end)
+            .order_by(table.c.tst, table.c.id)
+        )
+        return session.connection().execute(stmt).all()
+
+    def get_fixes_version_for_day(
+        self, dt: datetime, session: Optional[Session] = None
+    ) -> str:
+        """A stamp that changes whenever the day's fixes do.
+
+        Rows are only ever added, and ids only grow, so the count and the
+        highest id between them notice any new fix -- with one aggregate over
+        the tst index instead of loading the rows.
+        """
+        if session is None:
+            session = self.new_session()
+        start, end = self._day_window(dt)
+        num, max_id = session.exec(
+            select(func.count(OwnTracksLocation.id), func.max(OwnTracksLocation.id))
+            .where(OwnTracksLocation.tst >= start)
+            .where(OwnTracksLocation.tst <= end)
+        ).one()
+        return f"{num}:{max_id or 0}"
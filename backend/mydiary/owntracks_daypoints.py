@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """A day's fixes as one compressed columnar blob.
+
+Loading a day used to mean hydrating every OwnTracksLocation row -- fifteen
+columns into an ORM object each -- then a pendulum conversion per fix in
+points_from_locations, then a sort. The pipeline only ever reads five of those
+columns. OwnTracksDayPoints keeps exactly those five for one local day, in time
+order, as one zlib-compressed blob that decodes straight into TrackColumns:
+
+  * tst as int32 second offsets from the day's first fix
+  * lat/lon as int32 microdegrees, delta-encoded (the recorder reports six
+    decimals, so the deltas of a walk are small and compress well)
+  * acc as int32, the int32 minimum for none (the recorder can report a
+    negative accuracy, so -1 is a value, not a gap)
+  * motion as int32 codes into a table of the day's distinct strings
+
+The track has to come out *exactly* the same as from the rows -- content_hash
+decides whether a note's map is re-rendered -- so encoding checks that the
+compact form round-trips and, for a day where it would not (a sub-second
+timestamp, a coordinate with more than six decimals, a fractional accuracy),
+keeps that column at full precision instead.
+
+A row is stamped with the day's fixes version, like OwnTracksTrackCache, so a
+day that has gained fixes is re-encoded on its next read rather than served
+stale. The hourly sync re-encodes today as it goes."""
+
+import json
+import struct
+import zlib
+from datetime import datetime
+from typing import Optional
+
+import numpy as np
+import pendulum
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session
+
+from .models import OwnTracksDayPoints
+from .owntracks_columns import TrackColumns
+from .owntracks_connector import MyDiaryOwnTracks
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+# bump when the blob layout changes, so every stored day is re-encoded
+ENCODING_VERSION = 2
+
+# encoding version, flags, number of fixes, first fix (epoch microseconds)
+_HEADER = struct.Struct("<BBIq")
+
+# flags: which columns had to be kept at full precision
+_US_TIMES = 1  # int64 microsecond offsets instead of int32 seconds
+_FLOAT_COORDS = 2  # float64 lat/lon instead of int32 microdegree deltas
+_FLOAT_ACC = 4  # float64 acc (NaN for none) instead of int32
+
+_MICRO = 1_000_000
+_INT32_MAX = np.iinfo(np.int32).max
+_NO_ACC = np.iinfo(np.int32).min  # outside the range an int32 acc is kept in
+
+
+def encode_columns(cols: TrackColumns) -> bytes:
+    """A day's columns as a compressed blob. decode_columns reverses it exactly."""
+    n = len(cols)
+    flags = 0
+    t0 = int(cols.tst[0]) if n else 0
+
+    offsets = cols.tst - t0
+    if n and (np.any(offsets % _MICRO) or offsets.max() // _MICRO > _INT32_MAX):
+        flags |= _US_TIMES
+        times = offsets.astype("<i8")
+    else:
+        times = (offsets // _MICRO).astype("<i4")
+
+    qlat = np.round(cols.lat * 1e6)
+    qlon = np.round(cols.lon * 1e6)
+    if np.array_equal(qlat / 1e6, cols.lat) and np.array_equal(qlon / 1e6, cols.lon):
+        lat = np.diff(qlat.astype(np.int64), prepend=0).astype("<i4")
+        lon = np.diff(qlon.astype(np.int64), prepend=0).astype("<i4")
+    else:
+        flags |= _FLOAT_COORDS
+        lat = cols.lat.astype("<f8")
+        lon = cols.lon.astype("<f8")
+
+    known = ~np.isnan(cols.acc)
+    if np.array_equal(cols.acc[known], np.round(cols.acc[known])) and (
+        not known.any() or np.abs(cols.acc[known]).max() <= _INT32_MAX
+    ):
+        acc = np.where(known, cols.acc, _NO_ACC).astype("<i4")
+    else:
+        flags |= _FLOAT_ACC
+        acc = cols.acc.astype("<f8")
+
+    motions = cols.motion if cols.motion is not None else [None] * n
+    table: dict = {}
+    codes = np.fromiter(
+        (-1 if m is None else table.setdefault(m, len(table)) for m in motions),
+        dtype="<i4",
+        count=n,
+    )
+    table_json = json.dumps(list(table)).encode()
+
+    raw = b"".join(
+        [
+            _HEADER.pack(ENCODING_VERSION, flags, n, t0),
+            struct.pack("<I", len(table_json)),
+            table_json,
+            times.tobytes(),
+            lat.tobytes(),
+            lon.tobytes(),
+            acc.tobytes(),
+            codes.tobytes(),
+        ]
+    )
+    return zlib.compress(raw)
+
+
+def decode_columns(data: bytes, timezone: str = "UTC") -> TrackColumns:
+    raw = zlib.decompress(data)
+    version, flags, n, t0 = _HEADER.unpack_from(raw)
+    if version != ENCODING_VERSION:
+        raise ValueError(f"owntracks day points encoding {version} is not supported")
+    pos = _HEADER.size
+    (table_len,) = struct.unpack_from("<I", raw, pos)
+    pos += 4
+    table = json.loads(raw[pos : pos + table_len])
+    pos += table_len
+
+    def column(dtype: str) -> np.ndarray:
+        nonlocal pos
+        values = np.frombuffer(raw, dtype=dtype, count=n, offset=pos)
+        pos += values.nbytes
+        return values
+
+    if flags & _US_TIMES:
+        tst = t0 + column("<i8").astype(np.int64)
+    else:
+        tst = t0 + column("<i4").astype(np.int64) * _MICRO
+    if flags & _FLOAT_COORDS:
+        lat = column("<f8").astype(np.float64)
+        lon = column("<f8").astype(np.float64)
+    else:
+        lat = np.cumsum(column("<i4"), dtype=np.int64) / 1e6
+        lon = np.cumsum(column("<i4"), dtype=np.int64) / 1e6
+    if flags & _FLOAT_ACC:
+        acc = column("<f8").astype(np.float64)
+    else:
+        stored = column("<i4")
+        acc = stored.astype(np.float64)
+        acc[stored == _NO_ACC] = np.nan
+    codes = column("<i4")
+    return TrackColumns(
+        tst=tst,
+        lat=lat,
+        lon=lon,
+        acc=acc,
+        motion=[None if c < 0 else table[c] for c in codes.tolist()],
+        timezone=timezone,
+    )
+
+
+def day_columns(
+    dt: datetime, session: Session, fixes_version: Optional[str] = None
+) -> TrackColumns:
+    """The (local) day's fixes as columns, from its blob when that is current.
+
+    fixes_version is get_fixes_version_for_day's stamp, for a caller that
+    already has it.
+    """
+    dt = pendulum.instance(dt)
+    tz = dt.timezone_name
+    owntracks = MyDiaryOwnTracks()
+    if fixes_version is None:
+        fixes_version = owntracks.get_fixes_version_for_day(dt, session=session)
+    version = f"{ENCODING_VERSION}|{fixes_version}"
+
+    row = session.get(OwnTracksDayPoints, (dt.date(), tz))
+    if row is not None and row.version == version:
+        return decode_columns(row.data, tz)
+
+    rows = owntracks.get_fix_rows_for_day(dt, session)
+    cols = TrackColumns.from_rows(rows, timezone=tz)
+    # in a savepoint, so losing the race keeps what else the caller has pending
+    try:
+        with session.begin_nested():
+            if row is None:
+                row = OwnTracksDayPoints(diary_date=dt.date(), timezone=tz)
+            row.version = version
+            row.num_fixes = len(cols)
+            row.data = encode_columns(cols)
+            row.updated_at = pendulum.now(tz="UTC")
+            session.add(row)
+    except IntegrityError:
+        # a concurrent request encoded the same day first
+        logger.debug(f"owntracks day points for {dt.date()} already stored")
+    session.commit()
+    return cols
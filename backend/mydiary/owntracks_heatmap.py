@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Heatmap tiles of everywhere the history has been.
+
+Two layers, in the same z/x/y Web Mercator tiling map_render's basemaps use
+(256px tiles here, the size Leaflet overlays expect):
+
+  * fixes -- every OwnTracksLocation fix good enough for build_track to keep
+  * stays -- the time at each known place, from OwnTracksPlaceVisit
+
+Density over years of fixes cannot be computed per pan, so it is accumulated
+once into per-tile count grids for every zoom from MIN_ZOOM to MAX_ZOOM and
+kept on disk under {MYDIARY_CACHE_DIR}/heatmap/. Grids are sparse -- most of a
+tile is somewhere never been -- so each is stored as the nonzero pixels only.
+
+update() is incremental. Fixes are append-only, so the fixes layer keeps the
+highest id it has folded in and only ever adds what came after. Visits are
+replaced a day at a time (today's, every hour), so the stays layer keeps each
+place's minutes as last folded in and adds only the difference: a place whose
+time changed, by however much it changed.
+
+PNG tiles are rendered from the grids on first request and kept until a grid
+they draw from changes. Rendering does not wait for a fold-in in progress; a
+tile rendered while one ran is served but not kept. The colour scale is fixed
+rather than relative to the data's maximum, so a new fix only ever redraws the
+tiles it lands in. The blur reads the neighbouring tiles' grids, so tiles meet
+without seams."""
+
+import io
+import json
+import math
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+import numpy as np
+from PIL import Image
+from sqlmodel import Session, func, or_, select
+
+from .map_tiles import mercator
+from .models import OwnTracksLocation, OwnTracksPlace, OwnTracksPlaceVisit
+from .owntracks_track import TrackParams
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+# bump when the grids or the rendering change, so every layer is rebuilt
+HEATMAP_VERSION = 1
+
+MODES = ("fixes", "stays")
+TILE_SIZE = 256
+MIN_ZOOM = 0
+MAX_ZOOM = 16  # past this Leaflet can over-zoom: the points do not get sharper
+BLUR_SIGMA = 1.5  # pixels
+_PAD = int(math.ceil(3 * BLUR_SIGMA))
+
+# (unit, saturation) per layer: weight per pixel, after the blur, at which
+# colour starts and at which it is full. a lone fix blurs to ~0.07 of a fix at
+# its centre; a stay's weight is its minutes
+SCALE = {"fixes": (0.05, 2000.0), "stays": (1.0, 50000.0)}
+
+# fixes folded in per query on a first build
+BATCH_SIZE = 200_000
+
+# a grid cell whose weight has been added and taken away again is float
+# residue, not a place: anything this small is zero
+EPSILON = 1e-6
+
+_MAX_LAT = 85.0511287798  # where Web Mercator is square
+
+
+def world_pixels(
+    lat: np.ndarray, lon: np.ndarray, zoom: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Web Mercator pixel coordinates at zoom, over the whole world."""
+    size = TILE_SIZE * 2**zoom
+    x, y = mercator(np.clip(np.asarray(lat, dtype=float), -_MAX_LAT, _MAX_LAT), lon)
+    return x * size, y * size
+
+
+def _colormap() -> np.ndarray:
+    # transparent, then cool and faint through to hot and nearly opaque
+    stops = np.array(
+        [
+            (0.0, 49, 54, 149, 0),
+            (0.15, 49, 54, 149, 130),
+            (0.4, 69, 117, 180, 175),
+            (0.6, 254, 224, 144, 200),
+            (0.8, 244, 109, 67, 220),
+            (1.0, 165, 0, 38, 235),
+        ]
+    )
+    t = np.linspace(0.0, 1.0, 256)
+    lut = np.stack(
+        [np.interp(t, stops[:, 0], stops[:, c]) for c in range(1, 5)], axis=1
+    )
+    lut[0] = 0
+    return lut.round().astype(np.uint8)
+
+
+_LUT = _colormap()
+
+
+def _blur(grid: np.ndarray) -> np.ndarray:
+    """Separable Gaussian, 'valid' only: the result is _PAD smaller each side."""
+    k = np.exp(-0.5 * (np.arange(-_PAD, _PAD + 1) / BLUR_SIGMA) ** 2)
+    k /= k.sum()
+    width = 2 * _PAD
+    rows = sum(k[i] * grid[:, i : grid.shape[1] - width + i] for i in range(len(k)))
+    return sum(k[i] * rows[i : rows.shape[0] - width + i, :] for i in range(len(k)))
+
+
+def _png(rgba: np.ndarray) -> bytes:
+    buf = io.BytesIO()
+    Image.fromarray(rgba, "RGBA").save(buf, format="PNG")
+    return buf.getvalue()
+
+
+EMPTY_TILE = _png(np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8))
+
+
+class HeatmapStore:
+    """One layer's count grids and rendered tiles, under root/mode."""
+
+    def __init__(self, root: Path, mode: str) -> None:
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of {', '.join(MODES)}, not {mode!r}")
+        self.mode = mode
+        self.root = Path(root) / mode
+        # one fold-in at a time
+        self._add_lock = threading.Lock()
+        # guards _generation, which is odd while a fold-in is changing grids
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    # --- state ---
+
+    def _state_path(self) -> Path:
+        return self.root / "state.json"
+
+    def load_state(self) -> Dict:
+        try:
+            state = json.loads(self._state_path().read_text())
+        except FileNotFoundError:
+            state = None
+        if state is None or state.get("version") != HEATMAP_VERSION:
+            return {"version": HEATMAP_VERSION, "last_id": 0, "stamp": None}
+        return state
+
+    def save_state(self, state: Dict) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        _replace_bytes(self._state_path(), json.dumps(state).encode())
+
+    def clear(self) -> None:
+        with self._add_lock:
+            self._bump()
+            shutil.rmtree(self.root, ignore_errors=True)
+            self._bump()
+
+    def _bump(self) -> None:
+        with self._lock:
+            self._generation += 1
+
+    # --- grids ---
+
+    def _counts_path(self, z: int, x: int, y: int) -> Path:
+        return self.root / "counts" / str(z) / str(x) / f"{y}.npz"
+
+    def _tile_path(self, z: int, x: int, y: int) -> Path:
+        return self.root / "tiles" / str(z) / str(x) / f"{y}.png"
+
+    def counts(self, z: int, x: int, y: int) -> Optional[np.ndarray]:
+        """The tile's grid, TILE_SIZE x TILE_SIZE, or None if nothing is in it."""
+        try:
+            with np.load(self._counts_path(z, x, y)) as npz:
+                idx, w = npz["idx"], npz["w"]
+        except FileNotFoundError:
+            return None
+        grid = np.zeros(TILE_SIZE * TILE_SIZE, dtype=np.float64)
+        grid[idx] = w
+        return grid.reshape(TILE_SIZE, TILE_SIZE)
+
+    def _save_counts(self, z: int, x: int, y: int, grid: np.ndarray) -> None:
+        flat = grid.ravel()
+        idx = np.flatnonzero(np.abs(flat) > EPSILON)
+        path = self._counts_path(z, x, y)
+        if not len(idx):
+            path.unlink(missing_ok=True)
+            return
+        buf = io.BytesIO()
+        np.savez(buf, idx=idx.astype("<u2"), w=flat[idx].astype("<f8"))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        _replace_bytes(path, buf.getvalue())
+
+    def add(
+        self, lat: np.ndarray, lon: np.ndarray, weight: Optional[np.ndarray] = None
+    ) -> Set[Tuple[int, int, int]]:
+        """Add points (weight 1 each unless given) to every zoom's grids. A
+        negative weight takes away what an earlier add put there.
+
+        Returns the tiles whose grids changed; their rendered tiles, and their
+        neighbours' (the blur reaches across), are dropped.
+        """
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        weight = np.ones(len(lat)) if weight is None else np.asarray(weight, float)
+        changed: Set[Tuple[int, int, int]] = set()
+        if not len(lat):
+            return changed
+        with self._add_lock:
+            self._bump()
+            for z in range(MIN_ZOOM, MAX_ZOOM + 1):
+                n = 2**z
+                x, y = world_pixels(lat, lon, z)
+                last = TILE_SIZE * n - 1
+                px = np.clip(np.floor(x).astype(np.int64), 0, last)
+                py = np.clip(np.floor(y).astype(np.int64), 0, last)
+                key = (px // TILE_SIZE) * n + py // TILE_SIZE
+                local = (py % TILE_SIZE) * TILE_SIZE + px % TILE_SIZE
+                order = np.argsort(key, kind="stable")
+                keys, starts = np.unique(key[order], return_index=True)
+                for k, group in zip(keys.tolist(), np.split(order, starts[1:])):
+                    tx, ty = divmod(k, n)
+                    add = np.bincount(
+                        local[group], weights=weight[group], minlength=TILE_SIZE**2
+                    ).reshape(TILE_SIZE, TILE_SIZE)
+                    grid = self.counts(z, tx, ty)
+                    self._save_counts(z, tx, ty, add if grid is None else grid + add)
+                    changed.add((z, tx, ty))
+            for z, x, y in changed:
+                for nx, ny in _neighbours(z, x, y):
+                    self._tile_path(z, nx, ny).unlink(missing_ok=True)
+            self._bump()
+        return changed
+
+    # --- tiles ---
+
+    def tile_png(self, z: int, x: int, y: int) -> bytes:
+        """The rendered tile, from disk if it is still current."""
+        path = self._tile_path(z, x, y)
+        try:
+            return path.read_bytes()
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            generation = self._generation
+        data = self._render(z, x, y)
+        if data is EMPTY_TILE:
+            return data
+        with self._lock:
+            # a fold-in that ran meanwhile may have changed the grids this
+            # read, after dropping the tile: keep only what no fold-in touched
+            if generation == self._generation and generation % 2 == 0:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                _replace_bytes(path, data)
+        return data
+
+    def _render(self, z: int, x: int, y: int) -> bytes:
+        size = TILE_SIZE
+        n = 2**z
+        grid = np.zeros((3 * size, 3 * size))
+        found = False
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                if not 0 <= y + dy < n:
+                    continue
+                # x wraps: the world repeats across the antimeridian
+                counts = self.counts(z, (x + dx) % n, y + dy)
+                if counts is None:
+                    continue
+                found = True
+                rows = slice((dy + 1) * size, (dy + 2) * size)
+                cols = slice((dx + 1) * size, (dx + 2) * size)
+                grid[rows, cols] = counts
+        if not found:
+            return EMPTY_TILE
+        inner = slice(size - _PAD, 2 * size + _PAD)
+        blurred = _blur(grid[inner, inner])
+        unit, saturation = SCALE[self.mode]
+        t = np.log1p(blurred / unit) / math.log1p(saturation / unit)
+        level = np.clip(np.ceil(t * 255), 0, 255).astype(np.uint8)
+        return _png(_LUT[level])
+
+
+def _neighbours(z: int, x: int, y: int) -> Iterable[Tuple[int, int]]:
+    """The tile and the (up to) eight around it; x wraps, y does not."""
+    n = 2**z
+    seen = set()
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            nx, ny = (x + dx) % n, y + dy
+            if 0 <= ny < n and (nx, ny) not in seen:
+                seen.add((nx, ny))
+                yield nx, ny
+
+
+def _replace_bytes(path: Path, data: bytes) -> None:
+    tmp_path = path.with_name(path.name + f".{os.getpid()}.tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+
+_stores: Dict[Tuple[Path, str], HeatmapStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(mode: str) -> HeatmapStore:
+    """The layer's store in the cache dir, one per process, so the scheduled
+    fold-in and the tile route share its locks."""
+    from .thumbnail_cache import get_cache_dir
+
+    root = get_cache_dir("heatmap")
+    with _stores_lock:
+        store = _stores.get((root, mode))
+        if store is None:
+            store = _stores[(root, mode)] = HeatmapStore(root, mode)
+        return store
+
+
+def update(session: Session, mode: str, store: Optional[HeatmapStore] = None) -> int:
+    """Fold whatever is new since the last update into a layer.
+
+    Returns the number of points added (fixes, or places for the stays layer).
+    """
+    store = store or get_store(mode)
+    state = store.load_state()
+    if state.get("last_id") == 0 and state.get("stamp") is None:
+        store.clear()  # nothing recorded, or from an older HEATMAP_VERSION
+
+    if mode == "fixes":
+        return _update_fixes(session, store, state)
+    return _update_stays(session, store, state)
+
+
+def _update_fixes(session: Session, store: HeatmapStore, state: Dict) -> int:
+    c = OwnTracksLocation.__table__.c
+    max_acc = TrackParams().max_acc
+    num_added = 0
+    while True:
+        rows = (
+            session.connection()
+            .execute(
+                select(c.id, c.lat, c.lon)
+                .where(c.id > state["last_id"])
+                .where(or_(c.acc.is_(None), c.acc <= max_acc))
+                .order_by(c.id)
+                .limit(BATCH_SIZE)
+            )
+            .all()
+        )
+        if not rows:
+            break
+        ids, lat, lon = (np.array(col) for col in zip(*rows))
+        store.add(lat, lon)
+        state["last_id"] = int(ids[-1])
+        state["stamp"] = f"fixes:{state['last_id']}"
+        store.save_state(state)
+        num_added += len(rows)
+        logger.debug(f"heatmap: {num_added} fixes folded in")
+    return num_added
+
+
+def _update_stays(session: Session, store: HeatmapStore, state: Dict) -> int:
+    count, max_id, minutes = session.exec(
+        select(
+            func.count(OwnTracksPlaceVisit.id),
+            func.max(OwnTracksPlaceVisit.id),
+            func.sum(OwnTracksPlaceVisit.minutes),
+        )
+    ).one()
+    stamp = f"{count}:{max_id}:{minutes}"
+    if stamp == state["stamp"]:
+        return 0
+    if state["stamp"] is not None and "places" not in state:
+        store.clear()  # folded in before per-place minutes were kept
+    # place id -> [lat, lon, minutes], as folded in so far
+    before = state.get("places", {})
+    rows = session.exec(
+        select(
+            OwnTracksPlace.id,
+            OwnTracksPlace.lat,
+            OwnTracksPlace.lon,
+            func.sum(OwnTracksPlaceVisit.minutes),
+        )
+        .join(OwnTracksPlaceVisit)
+        .group_by(OwnTracksPlace.id)
+    ).all()
+    now = {str(place_id): [lat, lon, total] for place_id, lat, lon, total in rows}
+    lat, lon, delta = [], [], []
+    for place_id in now.keys() | before.keys():
+        old = before.get(place_id, [0.0, 0.0, 0.0])
+        new = now.get(place_id, old[:2] + [0.0])
+        if abs(new[2] - old[2]) > EPSILON:
+            lat.append(new[0])
+            lon.append(new[1])
+            delta.append(new[2] - old[2])
+    store.add(lat, lon, delta)
+    store.save_state(
+        {"version": HEATMAP_VERSION, "last_id": 0, "stamp": stamp, "places": now}
+    )
+    return len(delta)
@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Keep today's track up to date as the hourly sync brings in fixes.
+
+build_track starts from nothing every time, so "today" was re-derived from
+every fix of the day on every look, although each sync only ever adds the
+last hour's. IncrementalTrack holds where the pipeline had got to instead:
+
+- dedupe needs nothing: fixes arrive strictly later than the last one folded,
+  and a repeat always shares its fix's timestamp
+- despike holds back the newest kept fix, which is only judged once the fix
+  after it arrives -- exactly as build_track judges it against its successor
+- detect_stays holds the group it has not been able to close yet: its first
+  fix onward, with the running centroid sums and how far it got, so a new fix
+  is one distance test against the centroid rather than a rescan
+- everything before that group is settled: its stays, its gap stays, and the
+  fixes that were left outside a stay
+
+track() finishes from there -- the open group, the held-back fix and the
+gap-stay candidates around them -- with build_track's own stages, and the
+result is the same track build_track makes from all the fixes at once, down
+to content_hash. The state is stored per local day in OwnTracksStayState; a
+fix that turns up in the middle of what was already folded (a phone syncing
+late) cannot be folded in, and the day is rebuilt from scratch instead."""
+
+import json
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, List, Optional, Sequence
+
+import pendulum
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, func, select
+
+from .models import OwnTracksLocation, OwnTracksStayState
+from .owntracks_columns import epoch_us, from_epoch_us
+from .owntracks_connector import MyDiaryOwnTracks
+from .owntracks_track import (
+    DayTrack,
+    Stay,
+    TrackParams,
+    TrackPoint,
+    _implied_kmh,
+    assemble_track,
+    dedupe,
+    detect_gap_stays,
+    detect_stays,
+    filter_accuracy,
+    haversine_m,
+    points_from_rows,
+)
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+# bump whenever the pipeline or the stored state changes shape; a stored state
+# from any other version is discarded and the day rebuilt
+STATE_VERSION = 1
+
+
+@dataclass
+class IncrementalTrack:
+    """build_track, one batch of fixes at a time. See the module docstring."""
+
+    params: TrackParams
+    raw_count: int = 0
+    # the newest fix folded so far, kept or not; later batches must be later
+    last_tst: Optional[datetime] = None
+    # cleaned fixes that can no longer be dropped, and the newest kept fix,
+    # which still can
+    num_confirmed: int = 0
+    pending: Optional[TrackPoint] = None
+    # detect_stays: the confirmed fixes from the start of the open group on,
+    # how many of them the group holds, and their coordinate sums
+    tail: List[TrackPoint] = field(default_factory=list)
+    group_len: int = 0
+    lat_sum: float = 0.0
+    lon_sum: float = 0.0
+    # settled: the last fix before tail, and whether it is inside a stay
+    last_settled: Optional[TrackPoint] = None
+    last_settled_in_stay: bool = False
+    stays: List[Stay] = field(default_factory=list)
+    gap_stays: List[Stay] = field(default_factory=list)
+    free: List[TrackPoint] = field(default_factory=list)
+
+    def fold(self, points: Sequence[TrackPoint]) -> None:
+        """Take in the next fixes, in time order, all later than any before."""
+        if not points:
+            return
+        if self.last_tst is not None and points[0].tst <= self.last_tst:
+            raise ValueError(
+                f"fix at {points[0].tst} is not after the last one folded "
+                f"({self.last_tst}); rebuild instead"
+            )
+        self.raw_count += len(points)
+        self.last_tst = points[-1].tst
+        for p in filter_accuracy(dedupe(points), self.params.max_acc):
+            self._despike(p)
+
+    def _despike(self, p: TrackPoint) -> None:
+        # despike's rule for an interior fix, applied once its successor exists.
+        # the first fix of the day is always kept, and so is the newest one --
+        # for now.
+        cur = self.pending
+        self.pending = p
+        if cur is None:
+            return
+        prev = self._last_confirmed()
+        max_kmh = self.params.max_kmh
+        if (
+            prev is not None
+            and _implied_kmh(prev, cur) > max_kmh
+            and _implied_kmh(cur, p) > max_kmh
+            and _implied_kmh(prev, p) <= max_kmh
+        ):
+            logger.debug(f"despike: dropping outlier fix at {cur.tst}")
+            return
+        self.num_confirmed += 1
+        self.tail.append(cur)
+        self._advance()
+
+    def _last_confirmed(self) -> Optional[TrackPoint]:
+        return self.tail[-1] if self.tail else self.last_settled
+
+    def _advance(self) -> None:
+        """Run detect_stays forward until the open group reaches the newest
+        confirmed fix, settling every group that closed on the way."""
+        radius_m = self.params.stay_radius_m
+        while self.tail:
+            if self.group_len == 0:
+                self.group_len = 1
+                self.lat_sum, self.lon_sum = self.tail[0].lat, self.tail[0].lon
+            while self.group_len < len(self.tail):
+                nxt = self.tail[self.group_len]
+                c_lat = self.lat_sum / self.group_len
+                c_lon = self.lon_sum / self.group_len
+                if haversine_m(c_lat, c_lon, nxt.lat, nxt.lon) > radius_m:
+                    break
+                self.lat_sum += nxt.lat
+                self.lon_sum += nxt.lon
+                self.group_len += 1
+            if self.group_len == len(self.tail):
+                return  # the next fix may yet extend it
+            count = self.group_len
+            first, last = self.tail[0], self.tail[count - 1]
+            span = (last.tst - first.tst).total_seconds() / 60.0
+            if count >= 2 and span >= self.params.stay_minutes:
+                self.stays.append(
+                    Stay(
+                        lat=self.lat_sum / count,
+                        lon=self.lon_sum / count,
+                        t_start=first.tst,
+                        t_end=last.tst,
+                        num_points=count,
+                    )
+                )
+                for p in self.tail[:count]:
+                    self._settle(p, True)
+                del self.tail[:count]
+            else:
+                self._settle(self.tail.pop(0), False)
+            self.group_len = 0
+
+    def _settle(self, p: TrackPoint, in_stay: bool) -> None:
+        prev = self.last_settled
+        if prev is not None and not (self.last_settled_in_stay and in_stay):
+            self.gap_stays.extend(
+                detect_gap_stays(
+                    [prev, p], [], self.params.stay_minutes, self.params.dwell_max_kmh
+                )
+            )
+        if not in_stay:
+            self.free.append(p)
+        self.last_settled, self.last_settled_in_stay = p, in_stay
+
+    def track(self) -> DayTrack:
+        """The DayTrack of everything folded so far; the state is unchanged."""
+        if self.pending is None:
+            return DayTrack(num_points=0, num_dropped=self.raw_count)
+        params = self.params
+        rest = self.tail + [self.pending]
+        stays, ranges = detect_stays(rest, params.stay_radius_m, params.stay_minutes)
+        # the gap candidates still open: between the last settled fix and the
+        # rest, and within the rest
+        if self.last_settled is not None:
+            seq = [self.last_settled] + rest
+            consumed = [(start + 1, end + 1) for start, end in ranges]
+            if self.last_settled_in_stay:
+                consumed.insert(0, (0, 1))
+        else:
+            seq, consumed = rest, ranges
+        gap_stays = detect_gap_stays(
+            seq, consumed, params.stay_minutes, params.dwell_max_kmh
+        )
+        in_range = set()
+        for start, end in ranges:
+            in_range.update(range(start, end))
+        free = [p for i, p in enumerate(rest) if i not in in_range]
+        return assemble_track(
+            self.free + free,
+            self.stays + stays,
+            self.gap_stays + gap_stays,
+            params,
+            num_points=self.num_confirmed + 1,
+            raw_count=self.raw_count,
+        )
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "raw_count": self.raw_count,
+                "last_tst": None if self.last_tst is None else epoch_us(self.last_tst),
+                "num_confirmed": self.num_confirmed,
+                "pending": _point_to_list(self.pending),
+                "tail": [_point_to_list(p) for p in self.tail],
+                "group_len": self.group_len,
+                "lat_sum": self.lat_sum,
+                "lon_sum": self.lon_sum,
+                "last_settled": _point_to_list(self.last_settled),
+                "last_settled_in_stay": self.last_settled_in_stay,
+                "stays": [_stay_to_list(s) for s in self.stays],
+                "gap_stays": [_stay_to_list(s) for s in self.gap_stays],
+                "free": [_point_to_list(p) for p in self.free],
+            }
+        )
+
+    @classmethod
+    def from_json(
+        cls, data: str, params: TrackParams, timezone: str
+    ) -> "IncrementalTrack":
+        d = json.loads(data)
+        return cls(
+            params=params,
+            raw_count=d["raw_count"],
+            last_tst=(
+                None
+                if d["last_tst"] is None
+                else from_epoch_us(d["last_tst"], timezone)
+            ),
+            num_confirmed=d["num_confirmed"],
+            pending=_point_from_list(d["pending"], timezone),
+            tail=[_point_from_list(p, timezone) for p in d["tail"]],
+            group_len=d["group_len"],
+            lat_sum=d["lat_sum"],
+            lon_sum=d["lon_sum"],
+            last_settled=_point_from_list(d["last_settled"], timezone),
+            last_settled_in_stay=d["last_settled_in_stay"],
+            stays=[_stay_from_list(s, timezone) for s in d["stays"]],
+            gap_stays=[_stay_from_list(s, timezone) for s in d["gap_stays"]],
+            free=[_point_from_list(p, timezone) for p in d["free"]],
+        )
+
+
+def _point_to_list(p: Optional[TrackPoint]) -> Optional[List[Any]]:
+    if p is None:
+        return None
+    return [epoch_us(p.tst), p.lat, p.lon, p.acc, p.motion]
+
+
+def _point_from_list(data: Optional[List[Any]], tz: str) -> Optional[TrackPoint]:
+    if data is None:
+        return None
+    tst, lat, lon, acc, motion = data
+    return TrackPoint(from_epoch_us(tst, tz), lat, lon, acc, motion)
+
+
+def _stay_to_list(s: Stay) -> List[Any]:
+    return [s.lat, s.lon, epoch_us(s.t_start), epoch_us(s.t_end), s.num_points]
+
+
+def _stay_from_list(data: List[Any], tz: str) -> Stay:
+    lat, lon, t_start, t_end, num_points = data
+    return Stay(
+        lat, lon, from_epoch_us(t_start, tz), from_epoch_us(t_end, tz), num_points
+    )
+
+
+def has_state(dt: datetime, session: Session, params: TrackParams) -> bool:
+    dt = pendulum.instance(dt)
+    return (
+        session.get(
+            OwnTracksStayState,
+            dict(
+                diary_date=dt.date(),
+                timezone=dt.timezone_name,
+                params_key=params.cache_key(),
+            ),
+        )
+        is not None
+    )
+
+
+def update_day(
+    dt: datetime, session: Session, params: Optional[TrackParams] = None
+) -> DayTrack:
+    """Fold the day's new fixes into its stored state, and return its track.
+
+    The first call for a day folds everything it has. After that only fixes
+    later than the last one folded are loaded -- unless the count of the earlier
+    ones has changed, meaning a fix arrived out of order, which rebuilds.
+    """
+    params = params or TrackParams()
+    dt = pendulum.instance(dt)
+    tz = dt.timezone_name
+    key = dict(diary_date=dt.date(), timezone=tz, params_key=params.cache_key())
+    start, end = MyDiaryOwnTracks._day_window(dt)
+
+    row = session.get(OwnTracksStayState, key)
+    state = None
+    if row is not None and row.version == STATE_VERSION and row.last_tst is not None:
+        num_before = session.exec(
+            select(func.count(OwnTracksLocation.id))
+            .where(OwnTracksLocation.tst >= start)
+            .where(OwnTracksLocation.tst <= row.last_tst)
+        ).one()
+        if num_before == row.num_fixes:
+            state = IncrementalTrack.from_json(row.data, params, tz)
+            since = row.last_tst
+        else:
+            logger.info(
+                f"{dt.to_date_string()}: {num_before - row.num_fixes:+d} fix(es) "
+                "before the last one folded; rebuilding its stays"
+            )
+    if state is None:
+        state = IncrementalTrack(params)
+        since = None
+
+    rows = MyDiaryOwnTracks().get_fix_rows_for_day(dt, session, after=since)
+    state.fold(points_from_rows(rows, timezone=tz))
+
+    if rows or since is None:
+        # in a savepoint, so losing the race keeps what else the caller has
+        # pending
+        try:
+            with session.begin_nested():
+                if row is None:
+                    row = OwnTracksStayState(**key)
+                row.version = STATE_VERSION
+                row.num_fixes = state.raw_count
+                if rows:
+                    row.last_tst = max(tst for tst, *_ in rows)
+                elif since is None:
+                    row.last_tst = None
+                row.data = state.to_json()
+                row.updated_at = pendulum.now(tz="UTC")
+                session.add(row)
+        except IntegrityError:
+            # a concurrent update stored the same day first
+            logger.debug(f"owntracks stay state for {key['diary_date']} already stored")
+        session.commit()
+        logger.debug(
+            f"{dt.to_date_string()}: folded {len(rows)} fix(es) into its stays"
+        )
+    return state.track()
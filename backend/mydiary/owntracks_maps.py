@@ -16,13 +16,22 @@ import pendulum
 from sqlmodel import Session, select
 
 from .db import engine
+from .gazetteer import Gazetteer, get_gazetteer
 from .joplin_connector import MyDiaryJoplin
-from .map_render import RenderParams, render_day_map
+from .map_cache import get_map_cache
+from .map_render import RenderParams, render_panels
 from .markdown_edits import MarkdownDoc
 from .models import OwnTracksDayMap
+from .owntracks_places import PlaceIndex, load_index
 from .mydiary_day import MyDiaryDay
-from .owntracks_connector import MyDiaryOwnTracks
-from .owntracks_track import AREA_SPLIT_M, DayTrack, TrackParams, split_into_areas
+from .owntracks_track import (
+    AREA_SPLIT_M,
+    Area,
+    DayTrack,
+    TrackParams,
+    frame_locality,
+    split_into_areas,
+)
 
 import logging
 
@@ -55,22 +64,30 @@ def day_track(
     dt: datetime, session: Session, params: Optional[TrackParams] = None
 ) -> DayTrack:
     """The day's processed track, or LookupError if there is nothing to draw."""
-    from .owntracks_track import build_track, points_from_locations
+    track, _ = day_track_and_areas(dt, session, params)
+    return track
+
+
+def day_track_and_areas(
+    dt: datetime,
+    session: Session,
+    params: Optional[TrackParams] = None,
+    area_threshold_m: float = AREA_SPLIT_M,
+) -> Tuple[DayTrack, List[Area]]:
+    """day_track, plus the areas it splits into. Both come from the cache."""
+    from .owntracks_cache import processed_day
 
-    params = params or TrackParams()
     dt = pendulum.instance(dt)
-    locations = MyDiaryOwnTracks().get_locations_for_day(dt, session=session)
-    if not locations:
+    track, areas = processed_day(dt, session, params, area_threshold_m)
+    num_fixes = track.num_points + track.num_dropped
+    if not num_fixes:
         raise LookupError(f"no location data for {dt.to_date_string()}")
-    track = build_track(
-        points_from_locations(locations, timezone=dt.timezone_name), params
-    )
     if track.is_empty():
         raise LookupError(
             f"no usable location data for {dt.to_date_string()} "
-            f"({len(locations)} fixes, all filtered out)"
+            f"({num_fixes} fixes, all filtered out)"
         )
-    return track
+    return track, areas
 
 
 def _content_hash(
@@ -94,6 +111,7 @@ def panels_for_track(
     params: Optional[TrackParams] = None,
     render: Optional[RenderParams] = None,
     area_threshold_m: float = AREA_SPLIT_M,
+    areas: Optional[Sequence[Area]] = None,
 ) -> List[Panel]:
     """The maps a track needs: the overview, plus one per distinct area.
 
@@ -101,9 +119,14 @@ def panels_for_track(
     so it hashes to exactly what a day map hashed to before panels existed, and
     no already-synced day is invalidated by this. The same holds for the
     overview panel of a multi-area day, whose resource is therefore reused.
+
+    areas, when given, is split_into_areas(track, area_threshold_m) already
+    computed -- the cached one, for a day loaded through panels_for_day.
     """
     params = params or TrackParams()
     render = render or RenderParams()
+    if areas is None:
+        areas = split_into_areas(track, area_threshold_m)
     panels = [
         Panel("overview", "", track, None, _content_hash(track, params, render))
     ]
@@ -116,7 +139,7 @@ def panels_for_track(
             area.frame,
             _content_hash(area.track, params, render, _area_key(i, area)),
         )
-        for i, area in enumerate(split_into_areas(track, area_threshold_m))
+        for i, area in enumerate(areas)
     )
     return panels
 
@@ -143,8 +166,8 @@ def panels_for_day(
 ) -> Tuple[DayTrack, List[Panel]]:
     """panels_for_track, for a day that has to be loaded from the database."""
     params = params or TrackParams()
-    track = day_track(dt, session, params)
-    return track, panels_for_track(track, params, render, area_threshold_m)
+    track, areas = day_track_and_areas(dt, session, params, area_threshold_m)
+    return track, panels_for_track(track, params, render, area_threshold_m, areas)
 
 
 def render_for_day(
@@ -168,10 +191,53 @@ def render_for_day(
             f"{'' if len(panels) == 1 else 's'}, so there is no panel {panel}"
         )
     chosen = panels[panel]
-    data = render_day_map(chosen.track, params, render, frame=chosen.frame)
+    data = get_map_cache().get(chosen.content_hash)
+    if data is None:
+        # a day view asks for every panel, and they share a basemap: render
+        # the ones not cached yet together
+        data = dict(zip(_hashes(panels), render_cached(panels, params, render)))[
+            chosen.content_hash
+        ]
     return data, chosen.track, chosen.content_hash
 
 
+def _hashes(panels: Sequence[Panel]) -> List[str]:
+    return [p.content_hash for p in panels]
+
+
+def render_cached(
+    panels: Sequence[Panel],
+    params: Optional[TrackParams] = None,
+    render: Optional[RenderParams] = None,
+    refresh: bool = False,
+) -> List[bytes]:
+    """Each panel's encoded map, from the map cache where it has been rendered
+    before; the rest are rendered in one render_panels pass and cached. With
+    refresh, everything is rendered again (and the cache overwritten). A map
+    that went without some of its tiles is returned but not cached, so the
+    next request renders it again rather than keeping the hole for good."""
+    cache = get_map_cache()
+    found = {} if refresh else {h: cache.get(h) for h in _hashes(panels)}
+    missing = [p for p in panels if found.get(p.content_hash) is None]
+    if missing:
+        tiles_missing: List[List[str]] = []
+        rendered = render_panels(
+            [(p.track, p.frame) for p in missing],
+            params,
+            render,
+            missing=tiles_missing,
+        )
+        for p, data, lost in zip(missing, rendered, tiles_missing):
+            if lost:
+                logger.warning(
+                    f"not caching map {p.content_hash}: {len(lost)} tile(s) missing"
+                )
+            else:
+                cache.put(p.content_hash, data)
+            found[p.content_hash] = data
+    return [found[h] for h in _hashes(panels)]
+
+
 def sync_day_map_to_note(
     dt: datetime,
     session: Optional[Session] = None,
@@ -253,12 +319,18 @@ def _sync_day_map_to_note(
     resource_ids: List[str] = []
     created: List[str] = []
     try:
+        # the panels that need uploading are rendered together, over one
+        # composition of the basemap they share -- or, when the day has been
+        # rendered before (viewed, or uploaded to a resource since lost), read
+        # back from the map cache. force renders afresh.
+        to_upload = [p for p in panels if p.content_hash not in reusable]
+        rendered = dict(
+            zip(_hashes(to_upload), render_cached(to_upload, params, render, force))
+        )
         for i, panel in enumerate(panels):
             resource_id = reusable.get(panel.content_hash)
             if resource_id is None:
-                data = render_day_map(
-                    panel.track, params, render, frame=panel.frame
-                )
+                data = rendered[panel.content_hash]
                 # Joplin takes the resource's mime from this extension, so it is
                 # the only thing the note needs to render a non-PNG map
                 title = f"map-{diary_date}" if i == 0 else f"map-{diary_date}-{i}"
@@ -275,7 +347,11 @@ def _sync_day_map_to_note(
         # an old note predating this feature has no Location section at all, and
         # update_joplin_note will never add one
         section = md_note.ensure_section(SECTION_TITLE, after_title=SECTION_AFTER)
-        section.set_content(section_content(resource_ids, panels))
+        section.set_content(
+            section_content(
+                resource_ids, panels, load_index(session), get_gazetteer()
+            )
+        )
         response = mydiary_joplin.update_note_body(note_id, md_note.txt)
         response.raise_for_status()
 
@@ -318,7 +394,10 @@ def _sync_day_map_to_note(
 
 
 def section_content(
-    resource_ids: Sequence[Optional[str]], panels: Sequence[Panel]
+    resource_ids: Sequence[Optional[str]],
+    panels: Sequence[Panel],
+    places: Optional[PlaceIndex] = None,
+    gazetteer: Optional[Gazetteer] = None,
 ) -> str:
     """The Location section body: the map(s), then a searchable itinerary.
 
@@ -329,20 +408,37 @@ def section_content(
     split across areas leads with the whole-day overview, then gives each area
     its own heading, map and itinerary -- the day-level table would only repeat
     what the per-area ones say, since every stay belongs to exactly one area.
+
+    places, the known-places registry, names the stays at named places; a
+    gazetteer adds the nearest town to the rest, and to each area's heading.
     """
     if len(panels) == 1:
-        return _panel_content(resource_ids[0], panels[0].track)
+        return _panel_content(
+            resource_ids[0], panels[0].track, places=places, gazetteer=gazetteer
+        )
 
     parts = [_panel_content(resource_ids[0], panels[0].track, itinerary=False)]
     for resource_id, panel in zip(resource_ids[1:], panels[1:]):
+        content = _panel_content(
+            resource_id, panel.track, places=places, gazetteer=gazetteer
+        )
+        heading = panel.label
+        locality = frame_locality(panel.frame or panel.track, gazetteer)
+        if locality:
+            heading = f"{heading} · {locality}"
         # level 3, so MarkdownDoc (which splits on "## ") keeps this one section
-        parts.append(f"### {panel.label}\n\n{_panel_content(resource_id, panel.track)}")
+        parts.append(f"### {heading}\n\n{content}")
     return "\n\n".join(parts)
 
 
 def _panel_content(
-    resource_id: Optional[str], track: DayTrack, itinerary: bool = True
+    resource_id: Optional[str],
+    track: DayTrack,
+    itinerary: bool = True,
+    places: Optional[PlaceIndex] = None,
+    gazetteer: Optional[Gazetteer] = None,
 ) -> str:
+    from .owntracks_places import where_label
     from .owntracks_track import summary_label
     from .models import make_markdown_table_header
 
@@ -356,6 +452,6 @@ def _panel_content(
         for stay in track.stays:
             lines.append(
                 f"{stay.t_start:%H:%M} | {stay.t_end:%H:%M} | "
-                f"{stay.duration_label()} | {stay.lat:.5f}, {stay.lon:.5f}"
+                f"{stay.duration_label()} | {where_label(stay, places, gazetteer)}"
             )
     return "\n".join(lines)
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """The places stays keep coming back to, and how long was spent at each.
+
+The itinerary under a day's map used to say where each stay was as a pair of
+coordinates, and the same handful of places -- home, the office, the gym --
+make up most of every day. OwnTracksPlace gives each one an id and, once
+someone names it, a name; OwnTracksPlaceVisit records every stay at it, so
+"how long at the gym this year" is one indexed sum instead of a rebuild of
+every day in the range.
+
+A place is wherever a stay first happened that no known place covered, and
+it stays there: later stays within PLACE_RADIUS_M of it are visits to it. A
+place is never moved or dropped by a later rebuild, so a name given to it
+keeps meaning the same spot. PlaceIndex finds the place for a position from
+a grid of the registry rather than a scan of it."""
+
+from datetime import date
+from typing import Iterable, List, Optional, Sequence
+
+import pendulum
+from sqlmodel import Session, func, select
+
+from .gazetteer import Gazetteer
+from .models import OwnTracksPlace, OwnTracksPlaceVisit
+from .owntracks_track import Stay, _StayGrid, haversine_m
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+# a stay this close to a place is a visit to it. the same as detect_stays'
+# radius: two stays closer than this would have been one stay had they been
+# consecutive
+PLACE_RADIUS_M = 150.0
+
+
+class PlaceIndex:
+    """The registry bucketed into a _StayGrid, for which place a position is at."""
+
+    def __init__(
+        self,
+        places: Iterable[OwnTracksPlace] = (),
+        radius_m: float = PLACE_RADIUS_M,
+    ):
+        self.radius_m = radius_m
+        self.grid = _StayGrid(radius_m)
+        self.num_places = 0
+        for place in places:
+            self.add(place)
+
+    def __len__(self) -> int:
+        return self.num_places
+
+    def add(self, place: OwnTracksPlace) -> None:
+        self.grid.add(self.grid.key(place.lat, place.lon), place, place.id)
+        self.num_places += 1
+
+    def resolve(self, lat: float, lon: float) -> Optional[OwnTracksPlace]:
+        """The nearest place within radius_m, or None. Ties go to the older."""
+        best = None
+        best_d = self.radius_m
+        for cube in self.grid.around(self.grid.key(lat, lon)):
+            for place, _ in cube.items:
+                d = haversine_m(lat, lon, place.lat, place.lon)
+                if d < best_d or (
+                    d == best_d and (best is None or place.id < best.id)
+                ):
+                    best, best_d = place, d
+        return best
+
+
+def load_index(session: Session, radius_m: float = PLACE_RADIUS_M) -> PlaceIndex:
+    return PlaceIndex(session.exec(select(OwnTracksPlace)).all(), radius_m)
+
+
+def record_stays(
+    diary_date: date,
+    stays: Sequence[Stay],
+    session: Session,
+    index: Optional[PlaceIndex] = None,
+) -> List[OwnTracksPlace]:
+    """Resolve a day's stays to places, registering any new ones, and replace
+    the day's visits with them. Returns each stay's place, in order.
+
+    Re-running for the same day (today, every hour) replaces rather than adds,
+    so a day's visits are always its current stays.
+    """
+    if index is None:
+        index = load_index(session)
+    for old in session.exec(
+        select(OwnTracksPlaceVisit).where(OwnTracksPlaceVisit.diary_date == diary_date)
+    ):
+        session.delete(old)
+    places = []
+    num_new = 0
+    for stay in stays:
+        place = index.resolve(stay.lat, stay.lon)
+        if place is None:
+            place = OwnTracksPlace(
+                lat=stay.lat, lon=stay.lon, created_at=pendulum.now(tz="UTC")
+            )
+            session.add(place)
+            session.flush()  # for its id
+            index.add(place)
+            num_new += 1
+        session.add(
+            OwnTracksPlaceVisit(
+                place_id=place.id,
+                diary_date=diary_date,
+                t_start=pendulum.instance(stay.t_start).in_timezone("UTC"),
+                t_end=pendulum.instance(stay.t_end).in_timezone("UTC"),
+                minutes=stay.duration_minutes,
+            )
+        )
+        places.append(place)
+    session.commit()
+    if num_new:
+        logger.info(f"{diary_date}: {num_new} new place(s)")
+    return places
+
+
+def minutes_at(
+    place_id: int,
+    session: Session,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+) -> float:
+    """Total time spent at a place, optionally between two diary dates."""
+    stmt = select(func.coalesce(func.sum(OwnTracksPlaceVisit.minutes), 0.0)).where(
+        OwnTracksPlaceVisit.place_id == place_id
+    )
+    if start is not None:
+        stmt = stmt.where(OwnTracksPlaceVisit.diary_date >= start)
+    if end is not None:
+        stmt = stmt.where(OwnTracksPlaceVisit.diary_date <= end)
+    return session.exec(stmt).one()
+
+
+def where_label(
+    stay: Stay,
+    places: Optional[PlaceIndex] = None,
+    gazetteer: Optional[Gazetteer] = None,
+) -> str:
+    """The itinerary's Where column: a named place's name, else coordinates,
+    followed by the nearest town if there is a gazetteer to ask."""
+    place = places.resolve(stay.lat, stay.lon) if places is not None else None
+    if place is not None and place.name:
+        return place.name
+    coords = f"{stay.lat:.5f}, {stay.lon:.5f}"
+    locality = gazetteer.label(stay.lat, stay.lon) if gazetteer is not None else None
+    return f"{coords} ({locality})" if locality else coords
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Many days' tracks and areas at once.
+
+The calendar, and anything asking about a week or a month, used to call
+/owntracks/track/{dt} once per day -- each call inferring the timezone with a
+query of its own, loading the day's fixes with another, and running the
+pipeline. range_tracks does the window in one go:
+
+  * the timezone of every day from one read of TimeZoneChange, with the same
+    rule get_last_timezone applies to one day
+  * every fix of the window in one scan of the tst index, cut into local days
+    with a binary search on each day's UTC bounds -- the same fixes, in the
+    same order, as get_fix_rows_for_day would give each day
+  * days already in OwnTracksTrackCache for those fixes come from there; the
+    rest are built in a pool of worker processes and stored as processed_day
+    would store them
+
+Days come out in date order as soon as each is ready, so the route can stream
+them rather than wait for the slowest."""
+
+import bisect
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor
+from datetime import date, datetime, timezone
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pendulum
+from sqlmodel import Session, select
+
+from .models import OwnTracksLocation, TimeZoneChange
+from .owntracks_cache import cached_day, store_day
+from .owntracks_columns import TrackColumns, epoch_us
+from .owntracks_columns import build_track as build_track_from_columns
+from .owntracks_track import AREA_SPLIT_M, Area, DayTrack, TrackParams
+from .owntracks_track import split_into_areas
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+# a year and a day, so any calendar year fits
+MAX_RANGE_DAYS = 366
+
+# the pool is shared by every request, and kept small: a range is a few
+# hundred days at most, and the web server has other work to do
+RANGE_WORKERS = min(4, os.cpu_count() or 1)
+
+_executor: Optional[Executor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> Executor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn, not fork: the server has threads (the scheduler, the
+            # threadpool) that a forked child would inherit mid-whatever
+            _executor = ProcessPoolExecutor(
+                max_workers=RANGE_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _executor
+
+
+def day_timezones(days: Sequence[date], session: Session) -> Dict[date, str]:
+    """Each day's timezone, as get_last_timezone would infer it one by one:
+    the last change before the (UTC) day ends, else the zone before the first
+    change. "local" if no change was ever recorded."""
+    changes = session.exec(
+        select(TimeZoneChange).order_by(TimeZoneChange.changed_at)
+    ).all()
+    if not changes:
+        logger.warning("could not infer timezone; falling back to local")
+        return {d: "local" for d in days}
+    # compared as SQLite compares them: the stored wall time, tzinfo ignored
+    changed_at = [z.changed_at.replace(tzinfo=None) for z in changes]
+    timezones = {}
+    for d in days:
+        day_end = datetime(d.year, d.month, d.day).replace(
+            hour=23, minute=59, second=59, microsecond=999999
+        )
+        i = bisect.bisect_left(changed_at, day_end)
+        timezones[d] = changes[i - 1].tz_after if i else changes[0].tz_before
+    return timezones
+
+
+def days_of(instants: Sequence[datetime], session: Session) -> List[pendulum.DateTime]:
+    """The start of every local day any of the instants falls on, in date
+    order. A naive instant is UTC, as fixes are stored."""
+    if not instants:
+        return []
+    utc = sorted(
+        pendulum.instance(t if t.tzinfo else t.replace(tzinfo=timezone.utc))
+        for t in instants
+    )
+    # no timezone is more than fourteen hours off UTC
+    first, last = utc[0].date().subtract(days=1), utc[-1].date().add(days=1)
+    days = list(pendulum.interval(first, last).range("days"))
+    timezones = day_timezones(days, session)
+    starts = []
+    for d in days:
+        start = pendulum.parse(d.isoformat(), tz=timezones[d])
+        i = bisect.bisect_left(utc, start.in_timezone("UTC"))
+        if i < len(utc) and utc[i] <= start.end_of("day").in_timezone("UTC"):
+            starts.append(start)
+    return starts
+
+
+def fix_rows_by_day(
+    starts: Sequence[pendulum.DateTime], session: Session
+) -> List[Tuple[List[Tuple], str]]:
+    """For each local day start, its (tst, lat, lon, acc, motion) rows and its
+    fixes version, from one scan over the whole window."""
+    windows = [
+        (d.start_of("day").in_timezone("UTC"), d.end_of("day").in_timezone("UTC"))
+        for d in starts
+    ]
+    table = OwnTracksLocation.__table__
+    stmt = (
+        select(
+            table.c.tst,
+            table.c.lat,
+            table.c.lon,
+            table.c.acc,
+            table.c.motion,
+            table.c.id,
+        )
+        .where(table.c.tst >= min(w[0] for w in windows))
+        .where(table.c.tst <= max(w[1] for w in windows))
+        .order_by(table.c.tst, table.c.id)
+    )
+    rows = session.connection().execute(stmt).all()
+    # tst is naive UTC, as stored
+    tst = np.array([r[0] for r in rows], dtype="datetime64[us]").astype(np.int64)
+    days = []
+    for start, end in windows:
+        lo = int(np.searchsorted(tst, epoch_us(start), side="left"))
+        hi = int(np.searchsorted(tst, epoch_us(end), side="right"))
+        day_rows = [tuple(r[:5]) for r in rows[lo:hi]]
+        max_id = max((r[5] for r in rows[lo:hi]), default=0)
+        days.append((day_rows, f"{len(day_rows)}:{max_id}"))
+    return days
+
+
+def build_day(
+    rows: List[Tuple], timezone: str, params: TrackParams, area_threshold_m: float
+) -> Tuple[DayTrack, List[Area]]:
+    """A day's track and areas from its rows. Runs in a worker process."""
+    track = build_track_from_columns(TrackColumns.from_rows(rows, timezone), params)
+    return track, split_into_areas(track, area_threshold_m)
+
+
+def range_tracks(
+    start: date,
+    end: date,
+    session: Session,
+    params: Optional[TrackParams] = None,
+    area_threshold_m: float = AREA_SPLIT_M,
+    tz: str = "infer",
+    executor: Optional[Executor] = None,
+) -> Iterator[Tuple[pendulum.DateTime, DayTrack, List[Area]]]:
+    """(start of day, track, areas) for every day from start to end, in order.
+
+    tz="infer" gives each day its own timezone, as the per-day route does;
+    anything else is used for every day. Days not in the cache are built on
+    executor (the shared process pool unless given) and stored.
+    """
+    params = params or TrackParams()
+    if end < start:
+        raise ValueError(f"end {end} is before start {start}")
+    dates = list(pendulum.interval(start, end).range("days"))
+    if len(dates) > MAX_RANGE_DAYS:
+        raise ValueError(f"at most {MAX_RANGE_DAYS} days at a time, not {len(dates)}")
+    if tz == "infer":
+        timezones = day_timezones(dates, session)
+    else:
+        timezones = {d: tz for d in dates}
+    starts = [pendulum.parse(d.isoformat(), tz=timezones[d]) for d in dates]
+
+    days = list(zip(starts, fix_rows_by_day(starts, session)))
+    cached = [
+        cached_day(dt, session, params, area_threshold_m, fixes_version)
+        for dt, (_, fixes_version) in days
+    ]
+    misses = [i for i, c in enumerate(cached) if c is None]
+    # one day to build is quicker built here than shipped to a worker
+    if executor is None and len(misses) > 1:
+        executor = _get_executor()
+    futures = {}
+    if executor is not None:
+        for i in misses:
+            dt, (rows, _) = days[i]
+            futures[i] = executor.submit(
+                build_day, rows, dt.timezone_name, params, area_threshold_m
+            )
+
+    for i, (dt, (rows, fixes_version)) in enumerate(days):
+        result = cached[i]
+        if result is None:
+            if i in futures:
+                result = futures[i].result()
+            else:
+                result = build_day(rows, dt.timezone_name, params, area_threshold_m)
+            store_day(dt, session, params, area_threshold_m, fixes_version, *result)
+        yield (dt, *result)
+    logger.debug(f"{len(days)} day(s), {len(misses)} built, the rest from the cache")
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Per-day movement summaries, and totals over weeks, months and years.
+
+"How far did I travel per week this year" used to mean build_track for every
+day of the year. OwnTracksDaySummary keeps the handful of numbers a question
+like that needs -- distance, stays, time moving and time stopped, the bounding
+box, the number of areas -- one row per diary date, written whenever
+processed_day builds a day with the default TrackParams. Time at each place is
+already in OwnTracksPlaceVisit; period_stats sums both tables with one GROUP BY
+each over their indexed diary_date.
+
+A row is stamped like the track cache, with SUMMARY_VERSION and the day's fixes
+version. The hourly sync rebuilds every day it saves fixes for, which rewrites
+its summary; a day that gained fixes some other way keeps its old row until it
+is built, and period_stats lists such days as stale rather than add them up
+silently. The backfill script redoes whatever is not current. The summary
+is only ever of the default pipeline: a one-off look at a day with other
+params does not touch it."""
+
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional
+
+import pendulum
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, func, select
+
+from .models import OwnTracksDaySummary, OwnTracksPlace, OwnTracksPlaceVisit
+from .owntracks_connector import MyDiaryOwnTracks
+from .owntracks_track import Area, DayTrack
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+# bump whenever what goes into a summary changes, so the backfill redoes them
+SUMMARY_VERSION = 1
+
+PERIODS = ("week", "month", "year")
+
+
+def summarize(track: DayTrack, areas: List[Area]) -> Dict[str, Any]:
+    """A day's summary fields, from its track and areas.
+
+    Moving time is the links that are not gaps in the data: an uncertain link
+    says only that the day got from one place to another somehow. A day that
+    split_into_areas leaves whole is one area, not none.
+    """
+    bounds = track.bounds()
+    min_lat, min_lon, max_lat, max_lon = bounds if bounds else (None,) * 4
+    return dict(
+        num_fixes=track.num_points,
+        distance_m=track.distance_m,
+        num_stays=len(track.stays),
+        stay_minutes=sum(s.duration_minutes for s in track.stays),
+        moving_minutes=sum(
+            (x.t_end - x.t_start).total_seconds() / 60.0
+            for x in track.links
+            if not x.uncertain
+        ),
+        num_areas=len(areas) or (1 if bounds else 0),
+        min_lat=min_lat,
+        min_lon=min_lon,
+        max_lat=max_lat,
+        max_lon=max_lon,
+    )
+
+
+def summary_version(fixes_version: str) -> str:
+    return f"{SUMMARY_VERSION}|{fixes_version}"
+
+
+def is_current(row: OwnTracksDaySummary, session: Session) -> bool:
+    """Whether the summary is of the day's fixes as they are now."""
+    dt = pendulum.parse(row.diary_date.isoformat(), tz=row.timezone)
+    fixes_version = MyDiaryOwnTracks().get_fixes_version_for_day(dt, session=session)
+    return row.version == summary_version(fixes_version)
+
+
+def record_summary(
+    dt: datetime,
+    track: DayTrack,
+    areas: List[Area],
+    session: Session,
+    fixes_version: str,
+) -> OwnTracksDaySummary:
+    """Store (or replace) the summary for the (local) day dt."""
+    dt = pendulum.instance(dt)
+    # in a savepoint, as owntracks_cache stores a day: losing the race must not
+    # throw away what else the caller has pending
+    try:
+        with session.begin_nested():
+            row = session.get(OwnTracksDaySummary, dt.date())
+            if row is None:
+                row = OwnTracksDaySummary(diary_date=dt.date())
+            row.timezone = dt.timezone_name
+            row.version = summary_version(fixes_version)
+            for k, v in summarize(track, areas).items():
+                setattr(row, k, v)
+            row.updated_at = pendulum.now(tz="UTC")
+            session.add(row)
+    except IntegrityError:
+        # a concurrent request summarized the same day first
+        logger.debug(f"owntracks summary for {dt.date()} already stored")
+    session.commit()
+    return row
+
+
+def _period_start(column, by: str):
+    # sqlite date functions: weeks start on Monday, as pendulum's do
+    if by == "week":
+        return func.date(column, "weekday 0", "-6 days")
+    if by == "month":
+        return func.strftime("%Y-%m-01", column)
+    if by == "year":
+        return func.strftime("%Y-01-01", column)
+    raise ValueError(f"by must be one of {', '.join(PERIODS)}, not {by!r}")
+
+
+def period_stats(
+    session: Session,
+    by: str = "week",
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    num_places: int = 5,
+) -> List[Dict[str, Any]]:
+    """Summaries added up by week, month or year, between two diary dates.
+
+    Each period comes with its num_places places where the most time was
+    spent. A period with no summarized days is absent rather than zero.
+    stale_days are its days whose summary is out of date (see is_current):
+    counted as they were last built, until they are built again.
+    """
+    S = OwnTracksDaySummary
+    period = _period_start(S.diary_date, by).label("period")
+    stmt = select(
+        period,
+        func.count(),
+        func.sum(S.distance_m),
+        func.max(S.distance_m),
+        func.sum(S.num_stays),
+        func.sum(S.stay_minutes),
+        func.sum(S.moving_minutes),
+        func.sum(S.num_areas),
+        func.min(S.min_lat),
+        func.min(S.min_lon),
+        func.max(S.max_lat),
+        func.max(S.max_lon),
+    )
+    if start is not None:
+        stmt = stmt.where(S.diary_date >= start)
+    if end is not None:
+        stmt = stmt.where(S.diary_date <= end)
+    stmt = stmt.group_by(period).order_by(period)
+
+    periods: Dict[str, Dict[str, Any]] = {}
+    for (
+        key,
+        num_days,
+        distance_m,
+        max_distance_m,
+        num_stays,
+        stay_minutes,
+        moving_minutes,
+        num_areas,
+        min_lat,
+        min_lon,
+        max_lat,
+        max_lon,
+    ) in session.exec(stmt):
+        periods[key] = {
+            "start": date.fromisoformat(key),
+            "num_days": num_days,
+            "distance_m": distance_m,
+            "max_day_distance_m": max_distance_m,
+            "num_stays": num_stays,
+            "stay_minutes": stay_minutes,
+            "moving_minutes": moving_minutes,
+            "num_areas": num_areas,
+            "bounds": (
+                None if min_lat is None else (min_lat, min_lon, max_lat, max_lon)
+            ),
+            "places": [],
+            "stale_days": [],
+        }
+
+    stmt = select(period, S)
+    if start is not None:
+        stmt = stmt.where(S.diary_date >= start)
+    if end is not None:
+        stmt = stmt.where(S.diary_date <= end)
+    for key, row in session.exec(stmt.order_by(S.diary_date)):
+        if not is_current(row, session):
+            periods[key]["stale_days"].append(row.diary_date)
+
+    if not periods or num_places <= 0:
+        return list(periods.values())
+
+    V = OwnTracksPlaceVisit
+    period = _period_start(V.diary_date, by).label("period")
+    minutes = func.sum(V.minutes).label("minutes")
+    stmt = select(period, V.place_id, OwnTracksPlace.name, minutes).join(
+        OwnTracksPlace
+    )
+    if start is not None:
+        stmt = stmt.where(V.diary_date >= start)
+    if end is not None:
+        stmt = stmt.where(V.diary_date <= end)
+    stmt = stmt.group_by(period, V.place_id).order_by(period, minutes.desc())
+    for key, place_id, name, place_minutes in session.exec(stmt):
+        places = periods.get(key, {}).get("places")
+        if places is not None and len(places) < num_places:
+            places.append(
+                {"place_id": place_id, "name": name, "minutes": place_minutes}
+            )
+    return list(periods.values())
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Evaluate a grid of TrackParams over many days at once.
+
+The thresholds in TrackParams are meant to be tuned, but the /owntracks/track
+query parameters only show one day under one set of them. A sweep runs every
+parameter set over every day and says, for each set, how the days come out:
+the spread of stays, uncertain links, dropped fixes and area splits per day,
+and which days would be drawn differently than under the baseline.
+
+Each day is loaded once and handed to a worker process with the whole grid,
+so the work is one build_track per day per set and no more I/O than one pass
+over the history. Nothing is written anywhere.
+
+"Drawn differently" is content_hash under the *baseline's* params key.
+content_hash includes the params, so every day of any other set hashes
+differently by construction; fixing the key leaves only what is drawn."""
+
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field, fields, replace
+from datetime import date
+from functools import partial
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .owntracks_columns import TrackColumns, build_track
+from .owntracks_track import AREA_SPLIT_M, TrackParams, split_into_areas
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+METRICS = ("num_stays", "num_uncertain", "num_dropped", "num_areas")
+
+
+@dataclass(frozen=True)
+class DayOutcome:
+    """What one parameter set made of one day."""
+
+    num_stays: int
+    num_uncertain: int
+    num_dropped: int
+    # as split_into_areas returns them: 0 is a day one map frames
+    num_areas: int
+    drawn_hash: str
+
+
+def param_grid(
+    base: Optional[TrackParams] = None, **values: Sequence
+) -> List[TrackParams]:
+    """Every combination of the given field values, the rest taken from base.
+
+    >>> len(param_grid(stay_radius_m=[100, 150], stay_minutes=[10, 20, 30]))
+    6
+    """
+    base = base or TrackParams()
+    names = {f.name for f in fields(TrackParams)}
+    unknown = sorted(set(values) - names)
+    if unknown:
+        raise ValueError(f"not TrackParams fields: {', '.join(unknown)}")
+    keys = list(values)
+    return [
+        replace(base, **dict(zip(keys, combo)))
+        for combo in itertools.product(*(values[k] for k in keys))
+    ]
+
+
+def evaluate_day(
+    cols: TrackColumns,
+    param_sets: Sequence[TrackParams],
+    hash_params: TrackParams,
+    area_threshold_m: float = AREA_SPLIT_M,
+) -> List[DayOutcome]:
+    """One day under each parameter set, in order."""
+    outcomes = []
+    for params in param_sets:
+        track = build_track(cols, params)
+        areas = split_into_areas(track, area_threshold_m)
+        outcomes.append(
+            DayOutcome(
+                num_stays=len(track.stays),
+                num_uncertain=sum(1 for x in track.links if x.uncertain),
+                num_dropped=track.num_dropped,
+                num_areas=len(areas),
+                drawn_hash=track.content_hash(hash_params),
+            )
+        )
+    return outcomes
+
+
+def _distribution(values: Sequence[float]) -> Optional[Dict[str, float]]:
+    if not len(values):
+        return None
+    a = np.asarray(values, dtype=float)
+    p10, median, p90 = np.percentile(a, [10, 50, 90])
+    return {
+        "mean": float(a.mean()),
+        "min": float(a.min()),
+        "p10": float(p10),
+        "median": float(median),
+        "p90": float(p90),
+        "max": float(a.max()),
+    }
+
+
+@dataclass
+class SweepResult:
+    param_sets: List[TrackParams]
+    baseline: TrackParams
+    days: List[date] = field(default_factory=list)
+    # per day, one outcome per parameter set, in param_sets order
+    outcomes: List[List[DayOutcome]] = field(default_factory=list)
+
+    def _column(self, i: int) -> List[DayOutcome]:
+        return [day[i] for day in self.outcomes]
+
+    def distribution(self, i: int, metric: str) -> Optional[Dict[str, float]]:
+        """The spread of metric per day under param_sets[i]."""
+        return _distribution([getattr(o, metric) for o in self._column(i)])
+
+    def changed_days(self, i: int) -> List[date]:
+        """Days param_sets[i] draws differently than the baseline does."""
+        b = self.param_sets.index(self.baseline)
+        return [
+            d
+            for d, day in zip(self.days, self.outcomes)
+            if day[i].drawn_hash != day[b].drawn_hash
+        ]
+
+    def report(self) -> List[Dict[str, Any]]:
+        """One JSON-ready entry per parameter set."""
+        entries = []
+        for i, params in enumerate(self.param_sets):
+            entries.append(
+                {
+                    "params": dict(params.__dict__),
+                    "baseline": params == self.baseline,
+                    "num_days": len(self.days),
+                    **{m: self.distribution(i, m) for m in METRICS},
+                    "num_split_days": sum(
+                        1 for o in self._column(i) if o.num_areas > 0
+                    ),
+                    "changed_days": [d.isoformat() for d in self.changed_days(i)],
+                }
+            )
+        return entries
+
+
+def _in_order(
+    days: Iterable[Tuple[date, TrackColumns]], fn, workers: Optional[int]
+) -> Iterator[Tuple[date, List[DayOutcome]]]:
+    if workers == 1:
+        for d, cols in days:
+            yield d, fn(cols)
+        return
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # a batch at a time, so the history is never all in memory at once
+        batch_size = 4 * workers
+        days = iter(days)
+        while True:
+            batch = list(itertools.islice(days, batch_size))
+            if not batch:
+                return
+            results = executor.map(fn, [cols for _, cols in batch])
+            yield from zip([d for d, _ in batch], results)
+
+
+def sweep(
+    days: Iterable[Tuple[date, TrackColumns]],
+    param_sets: Sequence[TrackParams],
+    baseline: Optional[TrackParams] = None,
+    area_threshold_m: float = AREA_SPLIT_M,
+    workers: Optional[int] = None,
+) -> SweepResult:
+    """Run every parameter set over every (date, columns) day.
+
+    days is consumed lazily, so it can load from the database as it goes. The
+    baseline (the default TrackParams unless given) is added to the grid if it
+    is not already in it. workers=1 runs in this process; None is one worker
+    process per core.
+    """
+    baseline = baseline or TrackParams()
+    param_sets = list(param_sets)
+    if baseline not in param_sets:
+        param_sets.insert(0, baseline)
+    fn = partial(
+        evaluate_day,
+        param_sets=param_sets,
+        hash_params=baseline,
+        area_threshold_m=area_threshold_m,
+    )
+    result = SweepResult(param_sets=param_sets, baseline=baseline)
+    for d, outcomes in _in_order(days, fn, workers):
+        result.days.append(d)
+        result.outcomes.append(outcomes)
+        if len(result.days) % 100 == 0:
+            logger.info(f"{len(result.days)} day(s) evaluated")
+    return result
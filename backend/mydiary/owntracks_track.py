@@ -14,11 +14,15 @@ drawing -- so the thresholds can be tuned and tested on their own."""
 import hashlib
 import math
 from dataclasses import dataclass, field, replace
-from datetime import datetime
-from typing import Iterable, List, Optional, Sequence, Tuple
+from datetime import datetime, timezone as _timezone
+from typing import TYPE_CHECKING, Callable, Iterable, List, Optional, Sequence, Tuple
 
 import pendulum
 
+if TYPE_CHECKING:
+    # for the annotations only: naming places is the caller's I/O, not ours
+    from .gazetteer import Gazetteer
+
 import logging
 
 root_logger = logging.getLogger()
@@ -27,6 +31,8 @@ logger = root_logger.getChild(__name__)
 
 EARTH_RADIUS_M = 6371000.0
 
+_UTC = _timezone.utc
+
 
 @dataclass(frozen=True)
 class TrackParams:
@@ -234,6 +240,44 @@ def points_from_locations(
     return points
 
 
+def points_from_rows(rows: Iterable[Tuple], timezone: str = "UTC") -> List[TrackPoint]:
+    """points_from_locations for (tst, lat, lon, acc, motion) tuples, as
+    get_fix_rows_for_day returns them.
+
+    The timezone is looked up once for the day, and each fix is converted with
+    a plain astimezone before becoming a pendulum DateTime -- the same instant,
+    offset and fold as pendulum.instance(...).in_timezone(...), at a quarter of
+    the cost.
+    """
+    tz = pendulum.timezone(timezone)
+    points = []
+    for tst, lat, lon, acc, motion in rows:
+        if tst.tzinfo is None:
+            tst = tst.replace(tzinfo=_UTC)
+        local = tst.astimezone(tz)
+        points.append(
+            TrackPoint(
+                tst=pendulum.DateTime(
+                    local.year,
+                    local.month,
+                    local.day,
+                    local.hour,
+                    local.minute,
+                    local.second,
+                    local.microsecond,
+                    tzinfo=tz,
+                    fold=local.fold,
+                ),
+                lat=lat,
+                lon=lon,
+                acc=acc,
+                motion=motion,
+            )
+        )
+    points.sort(key=lambda p: p.tst)
+    return points
+
+
 def dedupe(points: Sequence[TrackPoint]) -> List[TrackPoint]:
     """Drop repeats of the same instant and position.
 
@@ -422,24 +466,38 @@ def build_track(
         cleaned, ranges, params.stay_minutes, params.dwell_max_kmh
     )
 
+    in_range = set()
+    for start, end in ranges:
+        in_range.update(range(start, end))
+    free = [p for i, p in enumerate(cleaned) if i not in in_range]
+    return assemble_track(
+        free, stays, gap_stays, params, num_points=len(cleaned), raw_count=raw_count
+    )
+
+
+def assemble_track(
+    free: Sequence[TrackPoint],
+    stays: Sequence[Stay],
+    gap_stays: Sequence[Stay],
+    params: TrackParams,
+    num_points: int,
+    raw_count: int,
+) -> DayTrack:
+    """The last step of build_track: stays and loose fixes into nodes and links.
+
+    free is the cleaned fixes outside every detect_stays range, in order. Split
+    out so owntracks_incremental can finish a track from its own state.
+    """
     # a fix is consumed by the stay it belongs to. a gap-stay consumes only the
     # fix it is anchored at -- the one that ends the gap is where the next leg
     # departs from, so it stays a node of its own.
-    in_stay = set()
-    for start, end in ranges:
-        in_stay.update(range(start, end))
     anchors = {s.t_start for s in gap_stays}
-    for i, p in enumerate(cleaned):
-        if p.tst in anchors:
-            in_stay.add(i)
 
-    stays = merge_stays(stays + gap_stays, params.stay_radius_m)
+    stays = merge_stays(list(stays) + list(gap_stays), params.stay_radius_m)
 
     # one node per stay, one per fix that is not inside a stay, in time order
     nodes: List[_Node] = [
-        _Node(p.lat, p.lon, p.tst, p.tst)
-        for i, p in enumerate(cleaned)
-        if i not in in_stay
+        _Node(p.lat, p.lon, p.tst, p.tst) for p in free if p.tst not in anchors
     ]
     nodes.extend(_Node(s.lat, s.lon, s.t_start, s.t_end) for s in stays)
     nodes.sort(key=lambda n: n.t_start)
@@ -469,8 +527,8 @@ def build_track(
     return DayTrack(
         stays=stays,
         links=links,
-        num_points=len(cleaned),
-        num_dropped=raw_count - len(cleaned),
+        num_points=num_points,
+        num_dropped=raw_count - num_points,
         distance_m=total_m,
     )
 
@@ -505,6 +563,70 @@ class Area:
         return f"{self.t_start:%H:%M}–{self.t_end:%H:%M}"
 
 
+class _Cube:
+    """The stays in one cube of a _StayGrid, and which cluster(s) they are in."""
+
+    def __init__(self):
+        self.items: list = []  # (stay, cluster id)
+        self.cluster: Optional[int] = None  # the cluster of the first stay
+        self.mixed = False  # whether any stay went in under a different cluster
+
+
+class _StayGrid:
+    """Stays bucketed into cubes on the unit sphere, for "which stays are within
+    threshold_m of here" without measuring to every one of them.
+
+    Cubes on the sphere rather than on lat/lon, which would shrink toward the
+    poles and break at the antimeridian. A cube's diagonal is just short of the
+    chord threshold_m subtends, so two stays sharing a cube are always within
+    reach of each other -- a cube is in practice one cluster, and can be
+    skipped whole once that cluster is known -- and anything within reach of a
+    position is in the cubes at most two steps from its own.
+
+    The cubes only choose candidates: whether a stay is within reach is still
+    decided by haversine_m, exactly as before, so nothing near the threshold
+    changes sides.
+    """
+
+    def __init__(self, threshold_m: float):
+        angle = min(max(threshold_m, 0.0) / EARTH_RADIUS_M, math.pi)
+        chord = 2 * math.sin(angle / 2)
+        self.side = max(chord * (1 - 1e-6) / math.sqrt(3), 1e-12)
+        # a little slack, so rounding in the cube assignment never hides a stay
+        # the distance test would have accepted
+        reach = max(math.ceil(chord * (1 + 1e-6) / self.side), 1)
+        steps = range(-reach, reach + 1)
+        # nearest cubes first, so a hit usually comes from the first one looked at
+        self.offsets = sorted(
+            ((dx, dy, dz) for dx in steps for dy in steps for dz in steps),
+            key=lambda o: o[0] ** 2 + o[1] ** 2 + o[2] ** 2,
+        )
+        self.cubes: dict = {}
+
+    def key(self, lat: float, lon: float) -> Tuple[int, int, int]:
+        p, l = math.radians(lat), math.radians(lon)
+        return (
+            math.floor(math.cos(p) * math.cos(l) / self.side),
+            math.floor(math.cos(p) * math.sin(l) / self.side),
+            math.floor(math.sin(p) / self.side),
+        )
+
+    def around(self, key: Tuple[int, int, int]) -> List[_Cube]:
+        x, y, z = key
+        cubes = (
+            self.cubes.get((x + dx, y + dy, z + dz)) for dx, dy, dz in self.offsets
+        )
+        return [cube for cube in cubes if cube is not None]
+
+    def add(self, key: Tuple[int, int, int], stay: Stay, cluster: int) -> _Cube:
+        cube = self.cubes.get(key)
+        if cube is None:
+            cube = self.cubes[key] = _Cube()
+            cube.cluster = cluster
+        cube.items.append((stay, cluster))
+        return cube
+
+
 def cluster_stays(
     stays: Sequence[Stay], threshold_m: float = AREA_SPLIT_M
 ) -> List[List[Stay]]:
@@ -513,40 +635,100 @@ def cluster_stays(
     Single rather than complete linkage on purpose -- a city is a chain of
     places you were, and two ends of it being 25km apart does not make them two
     areas as long as something sits between them.
+
+    Stays are taken in order; each joins every earlier cluster it reaches, and
+    bridging several merges them into the oldest, the newer ones appended
+    newest first. Only stays in nearby cubes of a _StayGrid are measured, and
+    clusters are tracked with union-find, so a history-wide view with thousands
+    of stays is not quadratic.
     """
-    clusters: List[List[Stay]] = []
+    grid = _StayGrid(threshold_m)
+    parent: List[int] = []  # cluster id -> the cluster it was merged into
+    members: dict = {}  # live cluster id -> stays; ids only grow, so in order
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
     for stay in stays:
-        joined = [
-            i
-            for i, cluster in enumerate(clusters)
-            if any(
-                haversine_m(stay.lat, stay.lon, other.lat, other.lon) <= threshold_m
-                for other in cluster
-            )
-        ]
+        key = grid.key(stay.lat, stay.lon)
+        reached = set()
+        for cube in grid.around(key):
+            # every stay in an unmixed cube shares one cluster
+            if not cube.mixed and find(cube.cluster) in reached:
+                continue
+            for other, c in cube.items:
+                c = find(c)
+                if c in reached:
+                    continue
+                if haversine_m(stay.lat, stay.lon, other.lat, other.lon) <= threshold_m:
+                    reached.add(c)
+                    if not cube.mixed:
+                        break
+        joined = sorted(reached)
         if not joined:
-            clusters.append([stay])
-            continue
-        first = joined[0]
-        clusters[first].append(stay)
-        # this stay may be the bridge between clusters that were separate
-        for i in reversed(joined[1:]):
-            clusters[first].extend(clusters.pop(i))
-    return clusters
+            c = len(parent)
+            parent.append(c)
+            members[c] = [stay]
+        else:
+            c = joined[0]
+            members[c].append(stay)
+            # this stay may be the bridge between clusters that were separate
+            for i in reversed(joined[1:]):
+                members[c].extend(members.pop(i))
+                parent[i] = c
+        cube = grid.add(key, stay, c)
+        if find(cube.cluster) != c:
+            cube.mixed = True
+    return list(members.values())
+
+
+class _ClusterIndex:
+    """Which of a list of clusters a position falls in; see _nearest_cluster."""
+
+    def __init__(self, clusters: Sequence[Sequence[Stay]], threshold_m: float):
+        self.threshold_m = threshold_m
+        self.grid = _StayGrid(threshold_m)
+        for i, cluster in enumerate(clusters):
+            for s in cluster:
+                cube = self.grid.add(self.grid.key(s.lat, s.lon), s, i)
+                if cube.cluster != i:
+                    cube.mixed = True
+
+    def nearest(self, lat: float, lon: float) -> Optional[int]:
+        cubes = self.grid.around(self.grid.key(lat, lon))
+        if not cubes:
+            return None
+        if not any(cube.mixed or cube.cluster != cubes[0].cluster for cube in cubes):
+            # one cluster in reach: any stay close enough settles it
+            for cube in cubes:
+                for s, _ in cube.items:
+                    if haversine_m(lat, lon, s.lat, s.lon) <= self.threshold_m:
+                        return cube.cluster
+            return None
+        best_i: Optional[int] = None
+        best_d = math.inf
+        for cube in cubes:
+            for s, i in cube.items:
+                d = haversine_m(lat, lon, s.lat, s.lon)
+                # ties go to the earlier cluster, as a scan in cluster order would
+                if d < best_d or (d == best_d and i < best_i):
+                    best_i, best_d = i, d
+        return best_i if best_d <= self.threshold_m else None
 
 
 def _nearest_cluster(
     lat: float, lon: float, clusters: Sequence[Sequence[Stay]], threshold_m: float
 ) -> Optional[int]:
     """Index of the cluster this position belongs to, or None if it is between
-    them (in transit)."""
-    best_i: Optional[int] = None
-    best_d = math.inf
-    for i, cluster in enumerate(clusters):
-        d = min(haversine_m(lat, lon, s.lat, s.lon) for s in cluster)
-        if d < best_d:
-            best_i, best_d = i, d
-    return best_i if best_d <= threshold_m else None
+    them (in transit).
+
+    Looking up many positions against the same clusters, build one
+    _ClusterIndex and ask it instead.
+    """
+    return _ClusterIndex(clusters, threshold_m).nearest(lat, lon)
 
 
 def extent_m(track: DayTrack) -> float:
@@ -607,10 +789,11 @@ def split_into_areas(
         return []  # pure transit: nowhere to frame more tightly than the day
 
     clusters.sort(key=lambda c: min(s.t_start for s in c))
+    index = _ClusterIndex(clusters, threshold_m)
     ends = [
         (
-            _nearest_cluster(link.start_lat, link.start_lon, clusters, threshold_m),
-            _nearest_cluster(link.end_lat, link.end_lon, clusters, threshold_m),
+            index.nearest(link.start_lat, link.start_lon),
+            index.nearest(link.end_lat, link.end_lon),
         )
         for link in track.links
     ]
@@ -651,8 +834,99 @@ def split_into_areas(
     return areas
 
 
+def frame_locality(
+    track: DayTrack, gazetteer: Optional["Gazetteer"]
+) -> Optional[str]:
+    """The town at the middle of a track's bounds, e.g. to name an area by."""
+    bounds = track.bounds() if gazetteer is not None else None
+    if bounds is None:
+        return None
+    min_lat, min_lon, max_lat, max_lon = bounds
+    return gazetteer.label((min_lat + max_lat) / 2, (min_lon + max_lon) / 2)
+
+
+# Web Mercator: the ground width of one 256px tile at zoom 0, at the equator
+_MERCATOR_TILE_M = 2 * math.pi * 6378137.0
+
+# simplified geometry may stray this far (screen pixels) from the real line
+SIMPLIFY_PIXELS = 1.0
+
+
+def zoom_tolerance_m(zoom: float, lat: float, pixels: float = SIMPLIFY_PIXELS) -> float:
+    """What `pixels` screen pixels span on the ground at a map zoom and latitude."""
+    return pixels * _MERCATOR_TILE_M * math.cos(math.radians(lat)) / (256 * 2**zoom)
+
+
+def simplify_line(
+    coords: Sequence[Tuple[float, float]], tolerance_m: float
+) -> List[Tuple[float, float]]:
+    """Douglas-Peucker over (lat, lon) pairs: the fewest vertices that keep the
+    line within tolerance_m of every one dropped. The ends are always kept.
+
+    Distances are measured in a local equirectangular projection, which at the
+    length of one chain of links is indistinguishable from the sphere.
+    """
+    n = len(coords)
+    if n < 3:
+        return list(coords)
+    lat0 = coords[0][0]
+    k = math.radians(1) * EARTH_RADIUS_M
+    kx = k * math.cos(math.radians(lat0))
+    # unwrap longitude so a line over the antimeridian stays continuous
+    xs, ys = [0.0], [0.0]
+    for (lat_a, lon_a), (lat_b, lon_b) in zip(coords, coords[1:]):
+        dlon = (lon_b - lon_a + 180.0) % 360.0 - 180.0
+        xs.append(xs[-1] + dlon * kx)
+        ys.append((lat_b - lat0) * k)
+    keep = [False] * n
+    keep[0] = keep[-1] = True
+    tol2 = tolerance_m * tolerance_m
+    stack = [(0, n - 1)]
+    while stack:
+        a, b = stack.pop()
+        ax, ay = xs[a], ys[a]
+        dx, dy = xs[b] - ax, ys[b] - ay
+        seg2 = dx * dx + dy * dy
+        worst, worst_d2 = -1, tol2
+        for i in range(a + 1, b):
+            px, py = xs[i] - ax, ys[i] - ay
+            # distance to the segment, not the infinite line: an out-and-back
+            # has its far end beyond both endpoints
+            t = max(0.0, min(1.0, (px * dx + py * dy) / seg2)) if seg2 else 0.0
+            ex, ey = px - t * dx, py - t * dy
+            d2 = ex * ex + ey * ey
+            if d2 > worst_d2:
+                worst, worst_d2 = i, d2
+        if worst >= 0:
+            keep[worst] = True
+            stack.append((a, worst))
+            stack.append((worst, b))
+    return [c for c, kept in zip(coords, keep) if kept]
+
+
+def _link_chains(
+    links: Sequence[Link], key: Callable[[Link], tuple]
+) -> List[List[Link]]:
+    """Runs of consecutive links that join end to start and agree on key."""
+    chains: List[List[Link]] = []
+    for link in links:
+        if chains:
+            prev = chains[-1][-1]
+            if (
+                (prev.end_lat, prev.end_lon) == (link.start_lat, link.start_lon)
+                and key(prev) == key(link)
+            ):
+                chains[-1].append(link)
+                continue
+        chains.append([link])
+    return chains
+
+
 def track_to_geojson(
-    track: DayTrack, areas: Optional[Sequence[Area]] = None
+    track: DayTrack,
+    areas: Optional[Sequence[Area]] = None,
+    gazetteer: Optional["Gazetteer"] = None,
+    zoom: Optional[float] = None,
 ) -> dict:
     """FeatureCollection for the frontend map -- same pipeline as the image.
 
@@ -660,6 +934,15 @@ def track_to_geojson(
     belongs to (None for a link between two of them), and the collection carries
     the areas themselves. That is what lets the frontend draw the same set of
     maps the note gets, rather than one map of everything.
+
+    Pass a gazetteer and stays and areas carry the nearest town as `locality`;
+    without one it is None.
+
+    Pass the zoom the map will be viewed at and consecutive links that would be
+    drawn alike (same area, period and certainty) are merged into one
+    LineString, simplified to within SIMPLIFY_PIXELS at that zoom; num_links
+    says how many went into each. Without it every link is its own two-point
+    feature, which is full detail and what a single day needs.
     """
     area_of = {}
     for i, area in enumerate(areas or []):
@@ -667,28 +950,40 @@ def track_to_geojson(
             area_of[stay] = i
         for link in area.track.links:
             area_of[link] = i
+    if zoom is None:
+        chains = [[link] for link in track.links]
+    else:
+        chains = _link_chains(
+            track.links,
+            key=lambda link: (area_of.get(link), link.uncertain, link.period),
+        )
     features = []
-    for link in track.links:
+    for chain in chains:
+        first, last = chain[0], chain[-1]
+        coords = [(first.start_lat, first.start_lon)]
+        coords.extend((link.end_lat, link.end_lon) for link in chain)
+        if zoom is not None:
+            coords = simplify_line(coords, zoom_tolerance_m(zoom, first.start_lat))
+        properties = {
+            "kind": "link",
+            "area": area_of.get(first),
+            "uncertain": first.uncertain,
+            "period": first.period.name,
+            "color": first.period.color,
+            "t_start": first.t_start.isoformat(),
+            "t_end": last.t_end.isoformat(),
+            "distance_m": round(sum(link.distance_m for link in chain)),
+        }
+        if zoom is not None:
+            properties["num_links"] = len(chain)
         features.append(
             {
                 "type": "Feature",
                 "geometry": {
                     "type": "LineString",
-                    "coordinates": [
-                        [link.start_lon, link.start_lat],
-                        [link.end_lon, link.end_lat],
-                    ],
-                },
-                "properties": {
-                    "kind": "link",
-                    "area": area_of.get(link),
-                    "uncertain": link.uncertain,
-                    "period": link.period.name,
-                    "color": link.period.color,
-                    "t_start": link.t_start.isoformat(),
-                    "t_end": link.t_end.isoformat(),
-                    "distance_m": round(link.distance_m),
+                    "coordinates": [[lon, lat] for lat, lon in coords],
                 },
+                "properties": properties,
             }
         )
     for stay in track.stays:
@@ -706,6 +1001,11 @@ def track_to_geojson(
                     "duration_minutes": round(stay.duration_minutes),
                     "duration_label": stay.duration_label(),
                     "num_points": stay.num_points,
+                    "locality": (
+                        gazetteer.label(stay.lat, stay.lon)
+                        if gazetteer is not None
+                        else None
+                    ),
                 },
             }
         )
@@ -723,6 +1023,7 @@ def track_to_geojson(
                 {
                     "index": i,
                     "label": area.label(),
+                    "locality": frame_locality(area.frame, gazetteer),
                     "t_start": area.t_start.isoformat(),
                     "t_end": area.t_end.isoformat(),
                     "num_stays": len(area.track.stays),
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Map tiles in one SQLite file, bounded, least recently used out first.
+
+staticmaps' cache is a file per tile under map_tiles/{provider}/{z}/{x}/, never
+pruned. Years of maps at 512px @2x, in two layers, is a lot of small files --
+an inode and an open() each -- and no limit on how much of the disk they take.
+
+TileStore keeps them in map_tiles/tiles.mbtiles instead: the MBTiles layout
+(metadata and tiles tables, TMS row numbering) plus a provider column, since
+the basemap and its labels share the file, and a last_access column. A read
+marks the tile used (written back in batches, not per read); a write that
+takes the store past max_bytes (MYDIARY_TILE_STORE_MB) starts a background
+thread that deletes the least recently used tiles down to LOW_WATER of it.
+
+scripts/map_tiles_import_loose.py moves an existing file-per-tile cache in."""
+
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+STORE_FILENAME = "tiles.mbtiles"
+DEFAULT_STORE_MB = 2048
+# evict down to this fraction of max_bytes, so one eviction covers many writes
+LOW_WATER = 0.9
+# touched tiles are written back after this many reads (and on every write)
+TOUCH_BATCH = 256
+# render workers and the seed script write to one file; a writer waits this
+# many seconds for another's transaction rather than fail
+BUSY_TIMEOUT = 30
+# other processes' writes are not in num_bytes: recount it from the file
+# after this many tiles written
+RECOUNT_EVERY = 256
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS tiles (
+    provider TEXT NOT NULL,
+    zoom_level INTEGER NOT NULL,
+    tile_column INTEGER NOT NULL,
+    tile_row INTEGER NOT NULL,
+    tile_data BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    last_access INTEGER NOT NULL,
+    PRIMARY KEY (provider, zoom_level, tile_column, tile_row)
+);
+CREATE INDEX IF NOT EXISTS ix_tiles_last_access ON tiles (last_access);
+"""
+
+TileId = Tuple[str, int, int, int]
+
+
+def _tms_row(zoom: int, y: int) -> int:
+    # MBTiles numbers rows from the south; slippy-map y from the north
+    return (1 << zoom) - 1 - y
+
+
+class TileStore:
+    """One tiles.mbtiles. Thread-safe: one connection, behind a lock.
+
+    Several processes may share the file. Writes take the write lock up front
+    (BEGIN IMMEDIATE) and wait their turn; num_bytes is this process's view,
+    recounted from the file every RECOUNT_EVERY writes and by evict.
+    """
+
+    def __init__(self, path: os.PathLike, max_bytes: int) -> None:
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(
+            str(self.path),
+            timeout=BUSY_TIMEOUT,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO metadata (name, value) VALUES (?, ?)",
+            [("name", "mydiary map tiles"), ("format", "png")],
+        )
+        self._lock = threading.Lock()
+        self._touched: Dict[TileId, int] = {}
+        self._since_recount = 0
+        self._recount()
+        self._evicting: Optional[threading.Thread] = None
+
+    def _recount(self) -> None:
+        # caller holds the lock (or is __init__)
+        (self.num_bytes,) = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM tiles"
+        ).fetchone()
+        self._since_recount = 0
+
+    def _where(self, provider: str, zoom: int, x: int, y: int):
+        return (
+            "provider = ? AND zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (provider, zoom, x, _tms_row(zoom, y)),
+        )
+
+    def get(self, provider: str, zoom: int, x: int, y: int) -> Optional[bytes]:
+        where, args = self._where(provider, zoom, x, y)
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT tile_data FROM tiles WHERE {where}", args
+            ).fetchone()
+            if row is None:
+                return None
+            self._touched[(provider, zoom, x, y)] = int(time.time())
+            if len(self._touched) >= TOUCH_BATCH:
+                self._flush_touched()
+        return row[0]
+
+    def has(self, provider: str, zoom: int, x: int, y: int) -> bool:
+        where, args = self._where(provider, zoom, x, y)
+        with self._lock:
+            row = self._conn.execute(f"SELECT 1 FROM tiles WHERE {where}", args)
+            return row.fetchone() is not None
+
+    def put(self, provider: str, zoom: int, x: int, y: int, data: bytes) -> None:
+        self.put_many([((provider, zoom, x, y), data)])
+
+    def put_many(self, tiles: Iterable[Tuple[TileId, bytes]]) -> int:
+        """Store tiles in one transaction; returns how many."""
+        now = int(time.time())
+        num = growth = 0
+        with self._lock:
+            # IMMEDIATE: a deferred transaction that reads, then writes, gets
+            # SQLITE_BUSY at once under WAL when another connection wrote
+            # since, without waiting out the busy timeout
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for (provider, zoom, x, y), data in tiles:
+                    where, args = self._where(provider, zoom, x, y)
+                    old = self._conn.execute(
+                        f"SELECT size FROM tiles WHERE {where}", args
+                    ).fetchone()
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO tiles (provider, zoom_level, "
+                        "tile_column, tile_row, tile_data, size, last_access) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (*args, data, len(data), now),
+                    )
+                    growth += len(data) - (old[0] if old else 0)
+                    num += 1
+                self._flush_touched(begin=False)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self.num_bytes += growth
+            self._since_recount += num
+            if self._since_recount >= RECOUNT_EVERY:
+                self._recount()
+        if self.num_bytes > self.max_bytes:
+            self._evict_in_background()
+        return num
+
+    def _flush_touched(self, begin: bool = True) -> None:
+        # caller holds the lock
+        if not self._touched:
+            return
+        rows = []
+        for (provider, zoom, x, y), t in self._touched.items():
+            rows.append((t, provider, zoom, x, _tms_row(zoom, y)))
+        self._touched.clear()
+        if begin:
+            self._conn.execute("BEGIN IMMEDIATE")
+        self._conn.executemany(
+            "UPDATE tiles SET last_access = MAX(last_access, ?) WHERE provider = ? "
+            "AND zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            rows,
+        )
+        if begin:
+            self._conn.execute("COMMIT")
+
+    def _evict_in_background(self) -> None:
+        with self._lock:
+            if self._evicting is not None and self._evicting.is_alive():
+                return
+            self._evicting = threading.Thread(
+                target=self.evict, name="tile-store-evict", daemon=True
+            )
+            self._evicting.start()
+
+    def evict(self, target_bytes: Optional[int] = None, batch: int = 500) -> int:
+        """Delete least recently used tiles until the store is at most
+        target_bytes (LOW_WATER of max_bytes by default). Returns how many."""
+        if target_bytes is None:
+            target_bytes = int(self.max_bytes * LOW_WATER)
+        num = 0
+        while True:
+            # a batch at a time, so renders are not locked out for long
+            with self._lock:
+                self._flush_touched()
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    # what every process has written, not just this one --
+                    # counted and chosen under the write lock, so no other
+                    # writer changes the rows in between
+                    self._recount()
+                    rows = []
+                    if self.num_bytes > target_bytes:
+                        rows = self._conn.execute(
+                            "SELECT rowid, size FROM tiles "
+                            "ORDER BY last_access, rowid LIMIT ?",
+                            (batch,),
+                        ).fetchall()
+                    chosen, freed = [], 0
+                    for rowid, size in rows:
+                        if self.num_bytes - freed <= target_bytes:
+                            break
+                        chosen.append((rowid,))
+                        freed += size
+                    self._conn.executemany("DELETE FROM tiles WHERE rowid = ?", chosen)
+                    self._conn.execute("COMMIT")
+                except BaseException:
+                    self._conn.execute("ROLLBACK")
+                    raise
+                if not chosen:
+                    break
+                self.num_bytes -= freed
+                num += len(chosen)
+        if num:
+            logger.debug(f"evicted {num} tile(s); store is {self.num_bytes} bytes")
+        return num
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            (num_tiles,) = self._conn.execute("SELECT COUNT(*) FROM tiles").fetchone()
+            return dict(
+                num_tiles=num_tiles, num_bytes=self.num_bytes, max_bytes=self.max_bytes
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush_touched()
+            self._conn.close()
+
+
+def import_loose(
+    store: TileStore,
+    cache_dir: os.PathLike,
+    provider_names: Dict[str, str],
+    delete: bool = False,
+    batch: int = 500,
+) -> int:
+    """Move a staticmaps file-per-tile cache ({slug}/{z}/{x}/{y}.png under
+    cache_dir) into store. provider_names maps each directory's slug to the
+    provider name tiles are stored under; an unknown slug is used as is.
+    With delete, each file is removed once its tile is committed."""
+    cache_dir = Path(cache_dir)
+    pending = []
+    num = 0
+
+    def commit():
+        nonlocal num
+        num += store.put_many((tile_id, f.read_bytes()) for tile_id, f in pending)
+        if delete:
+            for _, f in pending:
+                f.unlink()
+        pending.clear()
+
+    for f in sorted(cache_dir.glob("*/*/*/*.png")):
+        slug, z, x = f.parts[-4:-1]
+        try:
+            tile_id = (provider_names.get(slug, slug), int(z), int(x), int(f.stem))
+        except ValueError:
+            logger.warning(f"skipping {f}: not a z/x/y tile path")
+            continue
+        pending.append((tile_id, f))
+        if len(pending) >= batch:
+            commit()
+    commit()
+    if delete:
+        for d in sorted(cache_dir.glob("*/**/"), reverse=True):
+            if d.is_dir() and not any(d.iterdir()):
+                d.rmdir()
+    return num
+
+
+_stores: Dict[Path, TileStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(cache_dir: os.PathLike) -> TileStore:
+    """The store in cache_dir, opened once per process. Its cap is
+    MYDIARY_TILE_STORE_MB, read when it is first opened."""
+    path = Path(cache_dir) / STORE_FILENAME
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            mb = float(os.getenv("MYDIARY_TILE_STORE_MB") or DEFAULT_STORE_MB)
+            store = _stores[path] = TileStore(path, int(mb * 1024 * 1024))
+        return store
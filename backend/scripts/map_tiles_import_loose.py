@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Move the file-per-tile map cache into the tile store.
+
+Before tile_store.py, staticmaps kept every basemap and label tile as its own
+PNG under map_tiles/{provider}/{z}/{x}/{y}.png. This imports them into
+map_tiles/tiles.mbtiles, so maps already rendered do not fetch their tiles
+again. Safe to re-run; with --delete the loose files are removed as they are
+imported."""
+
+import sys, os
+from datetime import datetime
+from timeit import default_timer as timer
+
+import staticmaps
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+from mydiary import thumbnail_cache
+from mydiary.map_render import BASEMAP_PROVIDER, LABELS_PROVIDER
+from mydiary.tile_store import get_store, import_loose
+
+
+def main(args):
+    cache_dir = thumbnail_cache.get_cache_dir(subdir="map_tiles")
+    # the directory names staticmaps gave each provider
+    downloader = staticmaps.TileDownloader()
+    provider_names = {
+        downloader.sanitized_name(p.name()): p.name()
+        for p in (BASEMAP_PROVIDER, LABELS_PROVIDER)
+    }
+    store = get_store(cache_dir)
+    start = timer()
+    num = import_loose(store, cache_dir, provider_names, delete=args.delete)
+    logger.info(
+        f"imported {num} tile(s) into {store.path} in "
+        f"{format_timespan(timer() - start)}; {store.stats()}"
+    )
+    store.evict(target_bytes=store.max_bytes)
+    store.close()
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument(
+        "--delete", action="store_true", help="remove each loose file once imported"
+    )
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+        logging.getLogger("mydiary").setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
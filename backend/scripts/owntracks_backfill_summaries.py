@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Fill OwnTracksDaySummary for every day of OwnTracks history.
+
+processed_day writes a day's summary whenever it builds the day's track, so
+from now on the table keeps itself up to date; this covers the days nobody has
+looked at since. Days are built in parallel, one worker process per core by
+default, each with its own database connection: a worker loads the day's fixes
+and runs the default pipeline, read-only, and the main process does all the
+writing, in date order, so SQLite sees one writer.
+
+A day whose summary is already current (same SUMMARY_VERSION, same fixes) is
+skipped unless --force. With --visits each day's place visits are replaced as
+well, as owntracks_build_places.py does."""
+
+import sys, os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from timeit import default_timer as timer
+
+import pendulum
+from sqlmodel import Session, func, select
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+from mydiary.core import start_of_day
+from mydiary.db import engine
+from mydiary.models import OwnTracksDaySummary, OwnTracksLocation
+from mydiary.owntracks_columns import TrackColumns
+from mydiary.owntracks_columns import build_track as build_track_from_columns
+from mydiary.owntracks_connector import MyDiaryOwnTracks
+from mydiary.owntracks_places import load_index, record_stays
+from mydiary.owntracks_stats import record_summary, summary_version
+from mydiary.owntracks_track import TrackParams, split_into_areas
+
+
+def init_worker():
+    # the forked engine's pooled connections belong to the parent
+    engine.dispose(close=False)
+
+
+def build_day(diary_date, force=False):
+    """The day's default track and areas, or None if its summary is current."""
+    owntracks = MyDiaryOwnTracks()
+    with Session(engine) as session:
+        dt = start_of_day(diary_date, session)
+        fixes_version = owntracks.get_fixes_version_for_day(dt, session=session)
+        row = session.get(OwnTracksDaySummary, dt.date())
+        if not force and row is not None:
+            if row.version == summary_version(fixes_version):
+                return None
+        rows = owntracks.get_fix_rows_for_day(dt, session)
+    cols = TrackColumns.from_rows(rows, timezone=dt.timezone_name)
+    track = build_track_from_columns(cols, TrackParams())
+    return dt, fixes_version, track, split_into_areas(track)
+
+
+def main(args):
+    with Session(engine) as session:
+        first, last = session.exec(
+            select(func.min(OwnTracksLocation.tst), func.max(OwnTracksLocation.tst))
+        ).one()
+    if first is None:
+        logger.info("no OwnTracks locations in the database")
+        return
+    start = pendulum.parse(args.start).date() if args.start else first.date()
+    end = pendulum.parse(args.end).date() if args.end else last.date()
+    days = list(pendulum.interval(start, end).range("days"))
+    logger.info(f"summarizing {len(days)} day(s), {start} to {end}")
+
+    num_written = 0
+    with Session(engine) as session:
+        index = load_index(session) if args.visits else None
+        init_worker()  # nothing of the parent's pool goes across the fork
+        with ProcessPoolExecutor(
+            max_workers=args.workers, initializer=init_worker
+        ) as executor:
+            results = executor.map(
+                build_day, days, [args.force] * len(days), chunksize=args.chunksize
+            )
+            # map yields in date order, which keeps place registration the
+            # same as a serial run
+            for result in results:
+                if result is None:
+                    continue
+                dt, fixes_version, track, areas = result
+                record_summary(dt, track, areas, session, fixes_version)
+                if args.visits and track.stays:
+                    record_stays(dt.date(), track.stays, session, index=index)
+                num_written += 1
+                if num_written % 100 == 0:
+                    logger.info(f"{num_written} day(s) summarized so far")
+    logger.info(
+        f"{num_written} day(s) summarized; "
+        f"{len(days) - num_written} already current"
+    )
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument("--start", help="only days on or after this date (YYYY-MM-DD)")
+    parser.add_argument("--end", help="only days on or before this date (YYYY-MM-DD)")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="worker processes (default: one per core)",
+    )
+    parser.add_argument(
+        "--chunksize", type=int, default=4, help="days handed to a worker at a time"
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="rebuild days that are already current"
+    )
+    parser.add_argument(
+        "--visits", action="store_true", help="replace each day's place visits too"
+    )
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+        logging.getLogger("mydiary").setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Time cluster_stays and link assignment on a synthetic set of stays.
+
+A day has a handful of stays, but a range view or a history-wide look at where
+you have been has thousands. This scatters --num-stays stays over a few cities
+and some one-off trips, clusters them, assigns a link end to its cluster for
+every stay, and -- unless --skip-reference -- does the same with the old
+all-pairs version and checks the answers are identical.
+
+Touches nothing: no database, no network."""
+
+import sys, os
+import math
+import random
+from datetime import datetime
+from timeit import default_timer as timer
+
+import pendulum
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+from mydiary.owntracks_track import (
+    AREA_SPLIT_M,
+    Stay,
+    _ClusterIndex,
+    cluster_stays,
+    haversine_m,
+)
+
+CITIES = [
+    (47.61, -122.33),
+    (45.52, -122.68),
+    (37.77, -122.42),
+    (40.71, -74.01),
+    (51.05, 3.72),
+    (35.68, 139.69),
+]
+
+
+def synthetic_stays(num_stays: int, seed: int) -> list:
+    """Mostly around the cities, a tenth of them anywhere at all."""
+    rng = random.Random(seed)
+    base = pendulum.datetime(2026, 1, 1, tz="UTC")
+    stays = []
+    for i in range(num_stays):
+        if rng.random() < 0.1:
+            lat, lon = rng.uniform(-60, 70), rng.uniform(-180, 180)
+        else:
+            lat, lon = rng.choice(CITIES)
+            lat += rng.gauss(0, 0.15)
+            lon += rng.gauss(0, 0.15)
+        t = base.add(hours=3 * i)
+        stays.append(Stay(lat, lon, t, t.add(hours=1), 3))
+    return stays
+
+
+def quadratic_cluster_stays(stays, threshold_m):
+    """The all-pairs version cluster_stays replaced, for comparison."""
+    clusters = []
+    for stay in stays:
+        joined = [
+            i
+            for i, cluster in enumerate(clusters)
+            if any(
+                haversine_m(stay.lat, stay.lon, other.lat, other.lon) <= threshold_m
+                for other in cluster
+            )
+        ]
+        if not joined:
+            clusters.append([stay])
+            continue
+        first = joined[0]
+        clusters[first].append(stay)
+        for i in reversed(joined[1:]):
+            clusters[first].extend(clusters.pop(i))
+    return clusters
+
+
+def quadratic_nearest_cluster(lat, lon, clusters, threshold_m):
+    best_i, best_d = None, math.inf
+    for i, cluster in enumerate(clusters):
+        d = min(haversine_m(lat, lon, s.lat, s.lon) for s in cluster)
+        if d < best_d:
+            best_i, best_d = i, d
+    return best_i if best_d <= threshold_m else None
+
+
+def timed(fn, *args):
+    start = timer()
+    result = fn(*args)
+    return result, timer() - start
+
+
+def main(args):
+    stays = synthetic_stays(args.num_stays, args.seed)
+    threshold_m = args.threshold_m
+
+    clusters, t_cluster = timed(cluster_stays, stays, threshold_m)
+    index = _ClusterIndex(clusters, threshold_m)
+    ends, t_nearest = timed(
+        lambda: [index.nearest(s.lat + 0.01, s.lon - 0.01) for s in stays]
+    )
+    logger.info(
+        f"{len(stays)} stays -> {len(clusters)} clusters: "
+        f"cluster_stays {format_timespan(t_cluster)}, "
+        f"{len(ends)} link ends {format_timespan(t_nearest)}"
+    )
+    if args.skip_reference:
+        return
+
+    expected, t_ref_cluster = timed(quadratic_cluster_stays, stays, threshold_m)
+    expected_ends, t_ref_nearest = timed(
+        lambda: [
+            quadratic_nearest_cluster(s.lat + 0.01, s.lon - 0.01, expected, threshold_m)
+            for s in stays
+        ]
+    )
+    logger.info(
+        f"all-pairs: cluster_stays {format_timespan(t_ref_cluster)}, "
+        f"link ends {format_timespan(t_ref_nearest)}"
+    )
+    logger.info(
+        f"speedup: cluster_stays {t_ref_cluster / t_cluster:.0f}x, "
+        f"link ends {t_ref_nearest / t_nearest:.0f}x"
+    )
+    if clusters != expected or ends != expected_ends:
+        logger.error("results differ from the all-pairs version")
+        sys.exit(1)
+    logger.info("results are identical")
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument("--num-stays", type=int, default=10_000)
+    parser.add_argument("--threshold-m", type=float, default=AREA_SPLIT_M)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--skip-reference",
+        action="store_true",
+        help="do not run the all-pairs version (slow at 10k stays)",
+    )
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+        logging.getLogger("mydiary").setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
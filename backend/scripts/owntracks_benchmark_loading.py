@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Time loading a dense day of fixes into build_track, three ways.
+
+  orm:     get_locations_for_day + points_from_locations, an OwnTracksLocation
+           and a pendulum.instance(...).in_timezone(...) per fix
+  lean:    get_fix_rows_for_day + points_from_rows, five columns as tuples and
+           one timezone lookup for the day
+  columns: day_columns, the day's stored OwnTracksDayPoints blob decoded into
+           arrays, built by the columnar build_track
+
+Fills a temporary SQLite database with --num-fixes synthetic fixes for one day,
+times each path --repeat times (best of), and checks all three give the same
+track. Touches nothing else: no app database, no network."""
+
+import sys, os
+import random
+import tempfile
+from datetime import datetime
+from timeit import default_timer as timer
+
+import pendulum
+from sqlmodel import Session, SQLModel, create_engine
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+from mydiary.models import OwnTracksLocation
+from mydiary.owntracks_columns import build_track as build_track_from_columns
+from mydiary.owntracks_connector import MyDiaryOwnTracks
+from mydiary.owntracks_daypoints import day_columns
+from mydiary.owntracks_track import (
+    TrackParams,
+    build_track,
+    points_from_locations,
+    points_from_rows,
+)
+
+
+def fill_day(session: Session, day: pendulum.DateTime, num_fixes: int, seed: int):
+    """A walk with pauses, reported as the recorder does: whole seconds, six
+    decimals, one device."""
+    rng = random.Random(seed)
+    lat, lon = 47.61, -122.33
+    t = day.in_timezone("UTC")
+    step = 86400 // (num_fixes + 1)
+    for i in range(num_fixes):
+        t = t.add(seconds=step)
+        if rng.random() < 0.7:
+            lat += rng.gauss(0, 0.0003)
+            lon += rng.gauss(0, 0.0003)
+        session.add(
+            OwnTracksLocation(
+                tst=t,
+                lat=round(lat + rng.gauss(0, 0.00005), 6),
+                lon=round(lon + rng.gauss(0, 0.00005), 6),
+                acc=rng.choice([5, 10, 16, 30, 65, 150]),
+                motion=rng.choice([None, "walking", "stationary", "automotive"]),
+                username="u",
+                device="d",
+            )
+        )
+    session.commit()
+
+
+def best_of(repeat: int, fn):
+    times = []
+    for _ in range(repeat):
+        start = timer()
+        result = fn()
+        times.append(timer() - start)
+    return result, min(times)
+
+
+def main(args):
+    params = TrackParams()
+    day = pendulum.parse(args.date, tz=args.tz)
+    owntracks = MyDiaryOwnTracks()
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        SQLModel.metadata.create_all(engine)
+        with Session(engine) as session:
+            fill_day(session, day, args.num_fixes, args.seed)
+
+        def orm_load(session):
+            locations = owntracks.get_locations_for_day(day, session=session)
+            return points_from_locations(locations, args.tz)
+
+        def lean_load(session):
+            rows = owntracks.get_fix_rows_for_day(day, session=session)
+            return points_from_rows(rows, args.tz)
+
+        paths = [
+            ("orm", orm_load, build_track),
+            ("lean", lean_load, build_track),
+            (
+                "columns",
+                lambda session: day_columns(day, session),
+                build_track_from_columns,
+            ),
+        ]
+        with Session(engine) as session:
+            day_columns(day, session)  # encode and store, so the runs decode it
+
+        tracks, load_s, total_s = {}, {}, {}
+        for name, load, build in paths:
+
+            def load_only():
+                with Session(engine) as session:
+                    return load(session)
+
+            def load_and_build():
+                with Session(engine) as session:
+                    return build(load(session), params)
+
+            _, load_s[name] = best_of(args.repeat, load_only)
+            tracks[name], total_s[name] = best_of(args.repeat, load_and_build)
+            logger.info(
+                f"{name:>8}: load {format_timespan(load_s[name])}, "
+                f"load + build_track {format_timespan(total_s[name])}"
+            )
+        engine.dispose()
+
+    for name in ("lean", "columns"):
+        logger.info(
+            f"{name}: loading {load_s['orm'] / load_s[name]:.1f}x, "
+            f"with build_track {total_s['orm'] / total_s[name]:.1f}x the ORM path "
+            f"({args.num_fixes} fixes)"
+        )
+    expected = tracks["orm"]
+    if tracks["lean"] != expected or tracks["columns"] != expected:
+        logger.error("tracks differ between loading paths")
+        sys.exit(1)
+    expected_hash = expected.content_hash(params)
+    if any(t.content_hash(params) != expected_hash for t in tracks.values()):
+        logger.error("content hashes differ between loading paths")
+        sys.exit(1)
+    logger.info("tracks are identical")
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument("--num-fixes", type=int, default=5000)
+    parser.add_argument("--date", default="2026-07-01")
+    parser.add_argument("--tz", default="America/Los_Angeles")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+        logging.getLogger("mydiary").setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
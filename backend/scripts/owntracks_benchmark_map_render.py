@@ -0,0 +1,506 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Benchmark the day map pipeline on synthetic days, over synthetic tiles.
+
+Four days of increasing density and spread, each generated from --seed:
+
+  errand:    a dense local day -- a dozen short stops within a few km
+  commute:   home, a cafe, an afternoon 40km away, and back: two areas
+  road_trip: 450km of driving with a fix every 30s and a few stops
+  flight:    a morning in New York, a gap over the continent, an evening in
+             Seattle: two areas 3900km apart
+
+Each day is timed stage by stage (best of --repeat): build_track,
+split_into_areas, panels_for_track, then for each supersample mode (--modes)
+render_day_map over every panel, split into the tile decoding of a cold
+render, and the drawing and the encode_map of a warm one. With both modes,
+how far apart their images are per pixel; with --memory, the peak memory of a
+render, in a fresh process per mode.
+
+The tiles come through render_day_map's tile_downloader, from memory, so no
+network is involved; the stage timings come from wrapping the map_render
+functions in this process. Results are written as JSON (--output, or stdout),
+and --baseline compares them against an earlier run's JSON: a stage more than
+--tolerance times slower is logged and fails the run. Touches nothing else:
+no database, no network, a temporary cache directory."""
+
+import sys, os
+import io
+import json
+import multiprocessing
+import platform
+import random
+import tempfile
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import replace
+from datetime import datetime, timezone
+from timeit import default_timer as timer
+
+import numpy as np
+import pendulum
+import PIL
+from PIL import Image, ImageChops, ImageDraw
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+from mydiary import map_render
+from mydiary.map_render import LAYERS, RenderParams, render_day_map, tiles_for_map
+from mydiary.map_tiles import get_tile, get_tile_cache
+from mydiary.owntracks_maps import panels_for_track
+from mydiary.owntracks_track import TrackParams, TrackPoint, build_track
+from mydiary.owntracks_track import split_into_areas
+
+MODES = ("full", "overlay")
+TZ = "America/New_York"
+
+
+class SyntheticTiles:
+    """A TileDownloader serving made-up tiles: streets and blocks on the
+    basemap, dark translucent name boxes on the labels layer. The same z/x/y
+    is the same tile every time."""
+
+    def __init__(self) -> None:
+        self.tiles = {}
+
+    def set_user_agent(self, user_agent) -> None:
+        pass
+
+    def get(self, provider, cache_dir, zoom, x, y) -> bytes:
+        key = (provider.name(), zoom, x, y)
+        if key not in self.tiles:
+            rng = random.Random(repr(key))
+            if "nolabels" in provider.name():
+                tile = Image.new("RGBA", (512, 512), (235, 235, 233, 255))
+                draw = ImageDraw.Draw(tile)
+                for _ in range(12):
+                    at = rng.randrange(512)
+                    width = rng.choice([3, 6, 10])
+                    end = at + rng.randrange(-40, 40)
+                    draw.line([(0, at), (511, end)], "white", width)
+                    draw.line([(at, 0), (at, 511)], (200, 200, 200, 255), width)
+            else:
+                tile = Image.new("RGBA", (512, 512), (0, 0, 0, 0))
+                draw = ImageDraw.Draw(tile)
+                for _ in range(6):
+                    x0, y0 = rng.randrange(480), rng.randrange(490)
+                    draw.rectangle([x0, y0, x0 + 30, y0 + 12], (80, 80, 80, 230))
+            buf = io.BytesIO()
+            tile.save(buf, format="PNG")
+            self.tiles[key] = buf.getvalue()
+        return self.tiles[key]
+
+
+class _Day:
+    """Fixes for one synthetic day, as the recorder would report them."""
+
+    def __init__(self, seed: int) -> None:
+        self.rng = random.Random(seed)
+        self.t = pendulum.datetime(2026, 7, 1, 0, 0, tz=TZ)
+        self.points = []
+
+    def _fix(self, lat: float, lon: float, acc: int) -> None:
+        self.points.append(TrackPoint(tst=self.t, lat=lat, lon=lon, acc=acc))
+
+    def stay(self, at, minutes: int, every: int = 5) -> None:
+        for _ in range(minutes // every):
+            self.t = self.t.add(minutes=every)
+            jitter = self.rng.gauss
+            self._fix(at[0] + jitter(0, 0.00005), at[1] + jitter(0, 0.00005), 10)
+
+    def move(self, start, end, minutes: int, every_s: int = 120) -> None:
+        steps = max(minutes * 60 // every_s, 1)
+        for i in range(1, steps + 1):
+            self.t = self.t.add(seconds=every_s)
+            lat = start[0] + (end[0] - start[0]) * i / steps
+            lon = start[1] + (end[1] - start[1]) * i / steps
+            jitter = self.rng.gauss
+            self._fix(lat + jitter(0, 0.0002), lon + jitter(0, 0.0002), 16)
+
+    def gap(self, minutes: int) -> None:
+        self.t = self.t.add(minutes=minutes)
+
+
+def errand_day(seed: int):
+    day = _Day(seed)
+    home = (47.610, -122.330)
+    day.stay(home, 7 * 60)
+    here = home
+    for _ in range(12):
+        there = (
+            home[0] + day.rng.uniform(-0.03, 0.03),
+            home[1] + day.rng.uniform(-0.04, 0.04),
+        )
+        day.move(here, there, day.rng.randrange(8, 20), every_s=60)
+        day.stay(there, day.rng.randrange(15, 45), every=2)
+        here = there
+    day.move(here, home, 15, every_s=60)
+    day.stay(home, 3 * 60)
+    return day.points
+
+
+def commute_day(seed: int):
+    day = _Day(seed)
+    home, cafe, office = (47.610, -122.330), (47.622, -122.318), (47.980, -122.200)
+    day.stay(home, 8 * 60)
+    day.move(home, cafe, 20)
+    day.stay(cafe, 90)
+    day.move(cafe, office, 40)
+    day.stay(office, 4 * 60)
+    day.move(office, home, 50)
+    day.stay(home, 3 * 60)
+    return day.points
+
+
+def road_trip_day(seed: int):
+    day = _Day(seed)
+    route = [
+        (47.610, -122.330),  # Seattle
+        (47.390, -121.400),  # Snoqualmie Pass
+        (46.980, -120.550),  # Ellensburg
+        (47.130, -119.280),  # Moses Lake
+        (47.660, -117.420),  # Spokane
+    ]
+    day.stay(route[0], 6 * 60)
+    for start, end in zip(route, route[1:]):
+        day.move(start, end, day.rng.randrange(80, 130), every_s=30)
+        day.stay(end, day.rng.randrange(20, 45))
+    day.stay(route[-1], 5 * 60)
+    return day.points
+
+
+def flight_day(seed: int):
+    day = _Day(seed)
+    home, jfk = (40.730, -73.990), (40.640, -73.780)
+    sea, hotel = (47.450, -122.300), (47.615, -122.340)
+    day.stay(home, 7 * 60)
+    day.move(home, jfk, 50)
+    day.stay(jfk, 90)
+    day.gap(6 * 60)  # phone in airplane mode
+    day.stay(sea, 30)
+    day.move(sea, hotel, 35)
+    day.stay(hotel, 4 * 60)
+    return day.points
+
+
+DAYS = {
+    "errand": errand_day,
+    "commute": commute_day,
+    "road_trip": road_trip_day,
+    "flight": flight_day,
+}
+
+
+@contextmanager
+def timing(module, names, totals):
+    """Add the time spent in each of module's functions names to totals."""
+    originals = {name: getattr(module, name) for name in names}
+
+    def wrap(name, fn):
+        def timed(*args, **kwargs):
+            start = timer()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                totals[name] += timer() - start
+
+        return timed
+
+    for name, fn in originals.items():
+        setattr(module, name, wrap(name, fn))
+    try:
+        yield totals
+    finally:
+        for name, fn in originals.items():
+            setattr(module, name, fn)
+
+
+def best_of(repeat: int, fn):
+    times = []
+    for _ in range(repeat):
+        start = timer()
+        result = fn()
+        times.append(timer() - start)
+    return result, min(times)
+
+
+def _status_kb(field: str) -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    raise LookupError(field)
+
+
+def peak_memory(name: str, render: RenderParams, seed: int) -> int:
+    """How far rendering a day's panels takes the resident set above where it
+    started, in bytes. Runs in a process of its own, with the tiles already
+    decoded, so what is counted is the renders' own buffers. Linux only: it
+    resets the high-water mark through /proc/self/clear_refs."""
+    panels = panels_for_track(build_track(DAYS[name](seed)), render=render)
+    tiles = SyntheticTiles()
+    cache_dir = str(map_render.thumbnail_cache.get_cache_dir(subdir="map_tiles"))
+    for p in panels:
+        zoom, wanted = tiles_for_map(p.track, render, p.frame)
+        for provider in LAYERS:
+            for x, y in wanted:
+                get_tile(tiles, provider, cache_dir, zoom, x, y)
+    baseline = _status_kb("VmRSS")
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    for p in panels:
+        render_day_map(p.track, render=render, frame=p.frame, tile_downloader=tiles)
+    return (_status_kb("VmHWM") - baseline) * 1024
+
+
+def difference(a: bytes, b: bytes, threshold: int):
+    """Mean difference (of 255), and the fraction of pixels more than
+    threshold apart."""
+    a, b = (Image.open(io.BytesIO(data)).convert("RGB") for data in (a, b))
+    histogram = ImageChops.difference(a, b).convert("L").histogram()
+    num_pixels = a.width * a.height
+    mean = sum(v * n for v, n in enumerate(histogram)) / num_pixels
+    return mean, sum(histogram[threshold + 1 :]) / num_pixels
+
+
+def bench_day(name: str, args, ctx) -> dict:
+    params = TrackParams()
+    points = DAYS[name](args.seed)
+    track, build_s = best_of(args.repeat, lambda: build_track(points, params))
+    areas, split_s = best_of(args.repeat, lambda: split_into_areas(track))
+    result = {
+        "num_points": len(points),
+        "num_stays": len(track.stays),
+        "num_links": len(track.links),
+        "seconds": {"build_track": build_s, "split_into_areas": split_s},
+    }
+    render = RenderParams(width=args.width, height=args.height, fmt=args.fmt)
+    panels, panels_s = best_of(
+        args.repeat, lambda: panels_for_track(track, params, render, areas=areas)
+    )
+    result["num_panels"] = len(panels)
+    result["seconds"]["panels_for_track"] = panels_s
+    result["modes"] = {}
+    tiles = SyntheticTiles()
+    images = {}
+    for mode in args.modes:
+        render = replace(render, supersample=mode)
+
+        def render_all():
+            return [
+                render_day_map(
+                    p.track, params, render, frame=p.frame, tile_downloader=tiles
+                )
+                for p in panels
+            ]
+
+        # once untimed, so making up the tiles' PNGs is not counted
+        render_all()
+        # cold: every tile decoded from its PNG, as on a fresh process
+        get_tile_cache().clear()
+        with timing(map_render, ["get_tile"], defaultdict(float)) as cold:
+            start = timer()
+            render_all()
+            cold_s = timer() - start
+        # warm: best of repeat, with the tile decoding already done
+        best = None
+        for _ in range(args.repeat):
+            with timing(map_render, ["encode_map"], defaultdict(float)) as spent:
+                start = timer()
+                data = render_all()
+                total = timer() - start
+            if best is None or total < best[0]:
+                best = (total, spent["encode_map"], data)
+        render_s, encode_s, images[mode] = best
+        result["modes"][mode] = {
+            "seconds": {
+                "render_cold": cold_s,
+                "tiles_cold": cold["get_tile"],
+                "render": render_s,
+                "draw": render_s - encode_s,
+                "encode": encode_s,
+            },
+            "bytes": sum(len(data) for data in images[mode]),
+        }
+        if args.memory:
+            with ctx.Pool(1) as pool:
+                peak = pool.apply(peak_memory, (name, render, args.seed))
+            result["modes"][mode]["peak_bytes"] = peak
+
+    if len(images) == 2:
+        diffs = [difference(a, b, args.threshold) for a, b in zip(*images.values())]
+        result["difference"] = {
+            "mean": max(mean for mean, _ in diffs),
+            "over_threshold": max(over for _, over in diffs),
+            "threshold": args.threshold,
+        }
+    return result
+
+
+def _stages(results: dict):
+    """(day, stage, seconds) for every timing in a run's results."""
+    for day, r in results["days"].items():
+        for stage, seconds in r["seconds"].items():
+            yield day, stage, seconds
+        for mode, m in r["modes"].items():
+            for stage, seconds in m["seconds"].items():
+                yield day, f"{mode}.{stage}", seconds
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> int:
+    """Log each stage against the baseline run; returns how many are more
+    than tolerance times slower."""
+    before = {(day, stage): s for day, stage, s in _stages(baseline)}
+    slower = 0
+    for day, stage, seconds in _stages(results):
+        then = before.get((day, stage))
+        if not then:
+            continue
+        ratio = seconds / then
+        if ratio > tolerance:
+            slower += 1
+            logger.warning(f"{day} {stage}: {ratio:.2f}x the baseline's time")
+        else:
+            logger.debug(f"{day} {stage}: {ratio:.2f}x the baseline's time")
+    return slower
+
+
+def main(args):
+    ctx = multiprocessing.get_context("spawn")
+    results = {
+        "benchmark": "owntracks_benchmark_map_render",
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "versions": {
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "numpy": np.__version__,
+        },
+        "settings": {
+            "repeat": args.repeat,
+            "seed": args.seed,
+            "width": args.width,
+            "height": args.height,
+            "fmt": args.fmt,
+        },
+        "days": {},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["MYDIARY_CACHE_DIR"] = tmp
+        for name in args.days:
+            r = results["days"][name] = bench_day(name, args, ctx)
+            logger.info(
+                f"{name}: {r['num_points']} fixes, {r['num_stays']} stays, "
+                f"{r['num_links']} links, {r['num_panels']} panel(s); "
+                f"build_track {format_timespan(r['seconds']['build_track'])}"
+            )
+            for mode, m in r["modes"].items():
+                s = m["seconds"]
+                logger.info(
+                    f"{name} {mode}: render {format_timespan(s['render'])} "
+                    f"(encode {format_timespan(s['encode'])}), cold "
+                    f"{format_timespan(s['render_cold'])}, {m['bytes']} bytes"
+                )
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+        logger.info(f"results written to {args.output}")
+    else:
+        print(text)
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare(results, json.load(f), args.tolerance)
+        if slower:
+            logger.error(f"{slower} stage(s) slower than {args.baseline}")
+            sys.exit(1)
+        logger.info(f"no stage more than {args.tolerance}x slower than the baseline")
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument(
+        "--days",
+        nargs="+",
+        choices=list(DAYS),
+        default=list(DAYS),
+        help="which synthetic days (default: all)",
+    )
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        choices=MODES,
+        default=list(MODES),
+        help="supersample modes to render in (default: both)",
+    )
+    parser.add_argument(
+        "--fmt", default="JPEG", help="output format (default: %(default)s)"
+    )
+    parser.add_argument("--width", type=int, default=RenderParams.width)
+    parser.add_argument("--height", type=int, default=RenderParams.height)
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="runs per timing, best of (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--memory",
+        action="store_true",
+        help="also measure each mode's peak memory (Linux only)",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=int,
+        default=16,
+        help="a pixel this far apart (of 255) counts as different "
+        "(default: %(default)s)",
+    )
+    parser.add_argument("--seed", type=int, default=1, help="(default: %(default)s)")
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    parser.add_argument("--baseline", help="an earlier run's JSON to compare with")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.25,
+        help="slower than the baseline by more than this factor fails the run "
+        "(default: %(default)s)",
+    )
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+        logging.getLogger("mydiary").setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Build the heatmap layers from the whole OwnTracks history.
+
+The hourly sync folds new fixes into the heatmap as they arrive, but the first
+build goes through every fix ever recorded; run this once beforehand rather
+than leave it to the sync. Safe to re-run: without --rebuild it only adds
+what has arrived since the last update, like the sync does."""
+
+import sys, os
+from datetime import datetime
+from timeit import default_timer as timer
+
+from sqlmodel import Session
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+from mydiary.db import engine
+from mydiary.owntracks_heatmap import MODES, get_store, update
+
+
+def main(args):
+    modes = [args.mode] if args.mode else MODES
+    with Session(engine) as session:
+        for mode in modes:
+            store = get_store(mode)
+            if args.rebuild:
+                logger.info(f"clearing {store.root}")
+                store.clear()
+            start = timer()
+            num_added = update(session, mode, store)
+            logger.info(
+                f"{mode}: {num_added} point(s) added in "
+                f"{format_timespan(timer() - start)}"
+            )
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument("--mode", choices=MODES, help="only this layer")
+    parser.add_argument(
+        "--rebuild", action="store_true", help="throw the layer away and start over"
+    )
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+        logging.getLogger("mydiary").setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Build the known-places registry from every day of OwnTracks history.
+
+The hourly sync registers today's stays as it goes; this covers everything
+before that. Each day's stays -- from the processed-track cache, so a day
+already looked at costs nothing to recompute -- are resolved to places in date
+order, new places registered, and the day's visits replaced.
+
+Safe to re-run: places are only ever added, never moved or dropped, so a name
+already given to one survives, and a day's visits are replaced rather than
+added to."""
+
+import sys, os
+from datetime import datetime
+from timeit import default_timer as timer
+
+import pendulum
+from sqlmodel import Session, func, select
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+from mydiary.core import start_of_day
+from mydiary.db import engine
+from mydiary.models import OwnTracksLocation
+from mydiary.owntracks_cache import processed_day
+from mydiary.owntracks_places import load_index, record_stays
+
+
+def main(args):
+    with Session(engine) as session:
+        first, last = session.exec(
+            select(func.min(OwnTracksLocation.tst), func.max(OwnTracksLocation.tst))
+        ).one()
+        if first is None:
+            logger.info("no OwnTracks locations in the database")
+            return
+        start = pendulum.parse(args.start).date() if args.start else first.date()
+        end = pendulum.parse(args.end).date() if args.end else last.date()
+
+        index = load_index(session)
+        logger.info(f"{len(index)} known place(s); visiting {start} to {end}")
+        num_days = 0
+        num_visits = 0
+        for day in pendulum.interval(start, end).range("days"):
+            dt = start_of_day(day, session)
+            track, _ = processed_day(dt, session)
+            # a day with no stays (any more) still runs, to clear its visits
+            record_stays(dt.date(), track.stays, session, index=index)
+            if track.stays:
+                num_days += 1
+                num_visits += len(track.stays)
+        logger.info(
+            f"{num_visits} visit(s) on {num_days} day(s); {len(index)} known place(s)"
+        )
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument("--start", help="only days on or after this date (YYYY-MM-DD)")
+    parser.add_argument("--end", help="only days on or before this date (YYYY-MM-DD)")
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+        logging.getLogger("mydiary").setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
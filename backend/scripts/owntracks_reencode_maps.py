@@ -8,9 +8,10 @@ OwnTracksDayMap is re-rendered and its Joplin resource replaced.
 
 Resumable and safe to re-run: OwnTracksDayMap.content_hash now covers the
 render parameters, so an un-migrated day hashes differently and gets the work,
-while a migrated day hashes equal and is skipped. Run it inside the backend
-container -- JOPLIN_BASE_URL points at host.docker.internal, which does not
-resolve from the host."""
+while a migrated day hashes equal and is skipped. The days that need it are
+rendered first, on --workers processes (map_jobs.py), then uploaded one by
+one. Run it inside the backend container -- JOPLIN_BASE_URL points at
+host.docker.internal, which does not resolve from the host."""
 
 import sys, os
 from datetime import datetime
@@ -32,30 +33,33 @@ import logging
 root_logger = logging.getLogger()
 logger = root_logger.getChild(__name__)
 
-from mydiary.core import get_last_timezone
+from mydiary.core import start_of_day
 from mydiary.db import engine
 from mydiary.joplin_connector import MyDiaryJoplin
+from mydiary.map_jobs import RENDER_WORKERS, RenderService, submit
 from mydiary.models import OwnTracksDayMap
-from mydiary.owntracks_maps import render_for_day, sync_day_map_to_note
+from mydiary.owntracks_maps import panels_for_day, render_for_day
+from mydiary.owntracks_maps import sync_day_map_to_note
 
 
 def format_bytes(num: int) -> str:
     return f"{num / 1024:,.0f} KB"
 
 
-def start_of_day(diary_date, session: Session) -> pendulum.DateTime:
-    """Start of the day in the day's own timezone, as the API routes do it.
-
-    get_last_timezone raises when TimeZoneChange is empty (todo item 4.3); a
-    backfill must not die on that, so it falls back the same way the routes do.
-    """
-    dt_str = diary_date.isoformat()
+def is_stale(row: OwnTracksDayMap, session: Session) -> bool:
+    """Whether any of the day's maps would render differently from the stored
+    ones -- the check sync_day_map_to_note makes, so a day with a changed or an
+    added area panel is rendered on the pool too."""
     try:
-        tz = get_last_timezone(dt_str, session=session)
-    except (AttributeError, TypeError):
-        logger.warning("could not infer timezone; falling back to local")
-        tz = "local"
-    return pendulum.parse(dt_str, tz=tz)
+        _, panels = panels_for_day(start_of_day(row.diary_date, session), session)
+    except LookupError:
+        return False  # the sync reports it
+    stored = session.exec(
+        select(OwnTracksDayMap.content_hash)
+        .where(OwnTracksDayMap.diary_date == row.diary_date)
+        .order_by(OwnTracksDayMap.panel)
+    ).all()
+    return list(stored) != [p.content_hash for p in panels]
 
 
 def main(args):
@@ -83,6 +87,12 @@ def main(args):
             stmt = stmt.limit(args.limit)
         rows = session.exec(stmt).all()
         logger.info(f"{len(rows)} day map(s) to consider")
+        if args.workers and not args.dry_run:
+            # render the stale days on a pool first, into the map cache; each
+            # sync below then finds its maps there and only uploads
+            stale = [row.diary_date for row in rows if is_stale(row, session)]
+            submit(stale, session)
+            RenderService(workers=args.workers).run(session)
 
         total_before = 0
         total_after = 0
@@ -113,7 +123,8 @@ def main(args):
                     session.expire(row)
                     after = mydiary_joplin.get_resource_size(row.joplin_resource_id)
             except LookupError as e:
-                # no Joplin note for the day, or no usable location data left
+                # no Joplin note for the day, no usable location data left, or
+                # (--offline) a map tile that was never seeded
                 logger.warning(f"{diary_date}: skipped -- {e}")
                 num_failed += 1
                 continue
@@ -130,9 +141,7 @@ def main(args):
             )
 
         verb = "would update" if args.dry_run else "updated"
-        logger.info(
-            f"{verb} {num_updated}, skipped {num_skipped}, failed {num_failed}"
-        )
+        logger.info(f"{verb} {num_updated}, skipped {num_skipped}, failed {num_failed}")
         if total_before:
             logger.info(
                 f"total: {format_bytes(total_before)} -> {format_bytes(total_after)} "
@@ -166,6 +175,19 @@ if __name__ == "__main__":
         action="store_true",
         help="render and report sizes without touching Joplin or the database",
     )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="never fetch map tiles; a day missing one is skipped "
+        "(seed them first with owntracks_seed_tiles.py)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=RENDER_WORKERS,
+        help="render on this many processes before uploading; 0 renders each "
+        "day as it is synced (default: %(default)s)",
+    )
     parser.add_argument("--debug", action="store_true", help="output debugging info")
     global args
     args = parser.parse_args()
@@ -173,6 +195,8 @@ if __name__ == "__main__":
         logger.setLevel(logging.DEBUG)
         logging.getLogger("mydiary").setLevel(logging.DEBUG)
         logger.debug("debug mode is on")
+    if args.offline:
+        os.environ["MYDIARY_TILES_OFFLINE"] = "1"
     main(args)
     total_end = timer()
     logger.info(
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Store every map tile the location history's maps need.
+
+Walks every day with fixes, works out each of its panels' zoom and tiles as
+render_day_map would draw them (the overview and every area panel, at the
+default RenderParams), and downloads what the tile store does not have yet --
+concurrently, but no faster than --rate tiles a second, to stay polite to the
+tile CDN.
+
+Afterwards maps render with MYDIARY_TILES_OFFLINE=1 (or
+owntracks_reencode_maps.py --offline) without touching the network, at CPU
+speed, whether or not the CDN is up. Safe to re-run: stored tiles are skipped,
+so a second run only fetches for days that are new since.
+
+The tile store is capped at MYDIARY_TILE_STORE_MB, and least recently used
+tiles go first past it -- which, while seeding, are the ones this run stored
+earliest. A plan that looks bigger than the cap is refused (--force seeds it
+anyway), and tiles the plan wanted that are not in the store afterwards are
+reported."""
+
+import sys, os
+from collections import defaultdict
+from datetime import datetime
+from timeit import default_timer as timer
+
+import pendulum
+from sqlmodel import Session, func, select
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+from mydiary import thumbnail_cache
+from mydiary.core import start_of_day
+from mydiary.db import engine
+from mydiary.map_render import LAYERS, USER_AGENT, RenderParams, tiles_for_map
+from mydiary.map_tiles import TILE_WORKERS, RateLimiter, TileFetcher, prefetch
+from mydiary.models import OwnTracksLocation
+from mydiary.owntracks_maps import panels_for_day
+from mydiary.tile_store import get_store
+
+# a 512px tile of either layer, about; a store with tiles in it averages its own
+TYPICAL_TILE_BYTES = 40 * 1024
+
+
+def main(args):
+    with Session(engine) as session:
+        first, last = session.exec(
+            select(func.min(OwnTracksLocation.tst), func.max(OwnTracksLocation.tst))
+        ).one()
+        if first is None:
+            logger.info("no OwnTracks locations in the database")
+            return
+        start = pendulum.parse(args.start).date() if args.start else first.date()
+        end = pendulum.parse(args.end).date() if args.end else last.date()
+        days = list(pendulum.interval(start, end).range("days"))
+        logger.info(f"planning tiles for {len(days)} day(s), {start} to {end}")
+
+        render = RenderParams()
+        wanted = defaultdict(set)  # zoom -> {(x, y)}
+        num_panels = 0
+        for diary_date in days:
+            try:
+                _, panels = panels_for_day(start_of_day(diary_date, session), session)
+            except LookupError as e:
+                logger.debug(f"{diary_date}: skipped -- {e}")
+                continue
+            for panel in panels:
+                zoom, tiles = tiles_for_map(panel.track, render, panel.frame)
+                wanted[zoom].update(tiles)
+                num_panels += 1
+
+    num_tiles = sum(len(tiles) for tiles in wanted.values())
+    logger.info(
+        f"{num_panels} panel(s) need {num_tiles} distinct tile(s) per layer, "
+        f"at zoom(s) {sorted(wanted)}"
+    )
+    cache_dir = str(thumbnail_cache.get_cache_dir(subdir="map_tiles"))
+    store = get_store(cache_dir)
+    stats = store.stats()
+    tile_bytes = (
+        stats["num_bytes"] // stats["num_tiles"]
+        if stats["num_tiles"]
+        else TYPICAL_TILE_BYTES
+    )
+    estimate = num_tiles * len(LAYERS) * tile_bytes
+    logger.info(
+        f"about {estimate / 2**20:.0f} MB of tiles, against a store capped at "
+        f"{store.max_bytes / 2**20:.0f} MB (MYDIARY_TILE_STORE_MB)"
+    )
+    if estimate > store.max_bytes and not args.force:
+        logger.error(
+            "the planned tiles would not fit: the first stored would be evicted "
+            "before the run ends. Raise MYDIARY_TILE_STORE_MB, seed fewer days "
+            "(--start/--end), or pass --force"
+        )
+        sys.exit(1)
+    if args.dry_run:
+        return
+
+    fetcher = TileFetcher(USER_AGENT, offline=False)
+    rate = RateLimiter(args.rate)
+    num_fetched = 0
+    for zoom in sorted(wanted):
+        start_time = timer()
+        fetched = prefetch(
+            fetcher,
+            LAYERS,
+            cache_dir,
+            zoom,
+            sorted(wanted[zoom]),
+            workers=args.workers,
+            rate=rate,
+        )
+        num_fetched += fetched
+        logger.info(
+            f"zoom {zoom}: fetched {fetched} tile(s) in "
+            f"{format_timespan(timer() - start_time)}"
+        )
+    logger.info(f"fetched {num_fetched} tile(s) in all")
+
+    num_evicted = sum(
+        not store.has(provider.name(), zoom, x, y)
+        for zoom, tiles in wanted.items()
+        for x, y in tiles
+        for provider in LAYERS
+    )
+    if num_evicted:
+        logger.warning(
+            f"{num_evicted} planned tile(s) are not in the store: evicted past "
+            f"MYDIARY_TILE_STORE_MB ({store.stats()}), or failed to download"
+        )
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument("--start", help="first day (default: the first fix)")
+    parser.add_argument("--end", help="last day (default: the latest fix)")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=TILE_WORKERS,
+        help="concurrent downloads (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=10.0,
+        help="at most this many tile downloads a second (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="count the tiles, fetch nothing"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="seed even if the tiles look bigger than MYDIARY_TILE_STORE_MB",
+    )
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+        logging.getLogger("mydiary").setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
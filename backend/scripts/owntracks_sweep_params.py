@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Run a grid of TrackParams over the whole OwnTracks history.
+
+Each --grid gives one TrackParams field and the values to try; the grid is
+every combination of them, the other fields at their defaults, plus the
+defaults themselves as the baseline. Every day with fixes is loaded once (its
+OwnTracksDayPoints columns) and evaluated under the whole grid in a worker
+process.
+
+For each parameter set this logs the per-day spread of stays, uncertain links,
+dropped fixes and area splits, and how many days would be drawn differently
+than they are now; --out writes all of it, with the list of those days, as
+JSON. Only reads the database (apart from encoding day points not yet stored).
+
+    python owntracks_sweep_params.py --grid stay_radius_m=100,150,200 \\
+        --grid stay_minutes=10,20 --start 2025-01-01 --out sweep.json"""
+
+import sys, os
+import json
+from dataclasses import fields
+from datetime import datetime
+from timeit import default_timer as timer
+
+import pendulum
+from sqlmodel import Session, func, select
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+from mydiary.core import start_of_day
+from mydiary.db import engine
+from mydiary.models import OwnTracksLocation
+from mydiary.owntracks_daypoints import day_columns
+from mydiary.owntracks_sweep import param_grid, sweep
+from mydiary.owntracks_track import TrackParams
+
+
+def parse_grid(specs):
+    """["stay_minutes=10,20", ...] -> {"stay_minutes": [10.0, 20.0], ...}"""
+    types = {f.name: type(f.default) for f in fields(TrackParams)}
+    values = {}
+    for spec in specs:
+        name, _, vals = spec.partition("=")
+        if name not in types:
+            raise SystemExit(f"--grid {spec}: {name} is not a TrackParams field")
+        values[name] = [types[name](v) for v in vals.split(",") if v]
+    return values
+
+
+def load_days(session: Session, start, end):
+    for day in pendulum.interval(start, end).range("days"):
+        dt = start_of_day(day, session)
+        cols = day_columns(dt, session)
+        if len(cols):
+            yield dt.date(), cols
+
+
+def describe(entry, baseline):
+    changed = {
+        k: v for k, v in entry["params"].items() if v != getattr(baseline, k)
+    }
+    label = (
+        "baseline"
+        if entry["baseline"]
+        else " ".join(f"{k}={v}" for k, v in changed.items())
+    )
+    if entry["num_stays"] is None:
+        return f"{label}: no days"
+    return (
+        f"{label}: stays/day median {entry['num_stays']['median']:g} "
+        f"(p10 {entry['num_stays']['p10']:g}, p90 {entry['num_stays']['p90']:g}), "
+        f"uncertain/day mean {entry['num_uncertain']['mean']:.2f}, "
+        f"dropped/day mean {entry['num_dropped']['mean']:.1f}, "
+        f"{entry['num_split_days']} split day(s), "
+        f"{len(entry['changed_days'])} day(s) drawn differently"
+    )
+
+
+def main(args):
+    param_sets = param_grid(**parse_grid(args.grid))
+    baseline = TrackParams()
+    with Session(engine) as session:
+        first, last = session.exec(
+            select(func.min(OwnTracksLocation.tst), func.max(OwnTracksLocation.tst))
+        ).one()
+        if first is None:
+            logger.info("no OwnTracks locations in the database")
+            return
+        start = pendulum.parse(args.start).date() if args.start else first.date()
+        end = pendulum.parse(args.end).date() if args.end else last.date()
+        logger.info(
+            f"{len(param_sets)} parameter set(s) over {start} to {end}, "
+            f"{args.workers or os.cpu_count()} worker(s)"
+        )
+        result = sweep(
+            load_days(session, start, end),
+            param_sets,
+            baseline=baseline,
+            workers=args.workers,
+        )
+
+    logger.info(f"{len(result.days)} day(s) with fixes")
+    report = result.report()
+    for entry in report:
+        logger.info(describe(entry, baseline))
+    if args.out:
+        with open(args.out, "w") as outf:
+            json.dump(
+                {"start": str(start), "end": str(end), "param_sets": report},
+                outf,
+                indent=2,
+            )
+        logger.info(f"wrote {args.out}")
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description=DESCRIPTION, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--grid",
+        action="append",
+        default=[],
+        metavar="FIELD=V1,V2,...",
+        help="a TrackParams field and the values to try (repeatable)",
+    )
+    parser.add_argument("--start", help="only days on or after this date (YYYY-MM-DD)")
+    parser.add_argument("--end", help="only days on or before this date (YYYY-MM-DD)")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="worker processes (default: one per core; 1 runs in-process)",
+    )
+    parser.add_argument("--out", help="write the full report here as JSON")
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+        logging.getLogger("mydiary").setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
@@ -1,5 +1,5 @@
 import json
-from datetime import datetime
+from datetime import date, datetime
 import pendulum
 import pytest
 from pathlib import Path
@@ -1097,3 +1097,194 @@ class TestImages:
         )
         assert r3.status_code == 304
         assert len(calls) == 1
+
+
+def test_owntracks_places_can_be_named_and_totalled(session: Session, client: TestClient):
+    from mydiary.models import OwnTracksPlace, OwnTracksPlaceVisit
+
+    place = OwnTracksPlace(lat=47.61, lon=-122.33, created_at=pendulum.now(tz="UTC"))
+    session.add(place)
+    session.commit()
+    for d, minutes in [(1, 90.0), (2, 30.0)]:
+        t = pendulum.datetime(2026, 7, d, 12)
+        session.add(
+            OwnTracksPlaceVisit(
+                place_id=place.id,
+                diary_date=t.date(),
+                t_start=t,
+                t_end=t.add(minutes=minutes),
+                minutes=minutes,
+            )
+        )
+    session.commit()
+
+    response = client.patch(f"/owntracks/places/{place.id}", json={"name": "Home"})
+    assert response.status_code == 200
+    assert response.json()["name"] == "Home"
+
+    [listed] = client.get("/owntracks/places").json()
+    assert (listed["name"], listed["num_visits"], listed["minutes"]) == ("Home", 2, 120)
+
+    response = client.get(
+        f"/owntracks/places/{place.id}/minutes", params={"start": "2026-07-02"}
+    )
+    assert response.json()["minutes"] == 30
+    assert client.get("/owntracks/places/999/minutes").status_code == 404
+
+
+def test_owntracks_stats_adds_up_day_summaries(session: Session, client: TestClient):
+    from mydiary.models import OwnTracksDaySummary
+
+    for d, distance_m in [
+        (date(2026, 7, 1), 1000.0),
+        (date(2026, 7, 2), 2000.0),
+        (date(2026, 8, 1), 31000.0),
+    ]:
+        session.add(
+            OwnTracksDaySummary(
+                diary_date=d,
+                timezone="UTC",
+                version="1|0:0",
+                num_fixes=10,
+                distance_m=distance_m,
+                num_stays=1,
+                stay_minutes=60.0,
+                moving_minutes=30.0,
+                num_areas=1,
+                updated_at=pendulum.now(tz="UTC"),
+            )
+        )
+    session.commit()
+
+    response = client.get("/owntracks/stats", params={"by": "month"})
+    assert response.status_code == 200
+    periods = response.json()["periods"]
+    assert [(p["start"], p["num_days"], p["distance_m"]) for p in periods] == [
+        ("2026-07-01", 2, 3000.0),
+        ("2026-08-01", 1, 31000.0),
+    ]
+    assert periods[0]["bounds"] is None
+    assert client.get("/owntracks/stats", params={"by": "day"}).status_code == 422
+
+
+def test_owntracks_track_negotiates_a_compact_form(session: Session, client: TestClient):
+    from mydiary.models import OwnTracksLocation
+
+    t = pendulum.datetime(2026, 7, 1, 8, tz="America/New_York")
+    for i in range(300):
+        session.add(
+            OwnTracksLocation(
+                tst=t.add(minutes=2 * i).in_timezone("UTC"),
+                lat=round(47.6 + 0.0004 * (i % 50), 6),
+                lon=round(-122.3 + 0.0004 * (i // 50), 6),
+                acc=10,
+                username="u",
+                device="d",
+            )
+        )
+    session.commit()
+    params = {"tz": "America/New_York"}
+
+    geojson = client.get("/owntracks/locations/2026-07-01", params=params)
+    assert geojson.status_code == 200
+    assert geojson.headers["content-type"] == "application/json"
+    assert geojson.headers["content-encoding"] == "gzip"
+    assert len(geojson.json()["features"]) == 300
+
+    compact = client.get(
+        "/owntracks/locations/2026-07-01",
+        params=params,
+        headers={"Accept": "application/vnd.mydiary.compact+json"},
+    )
+    assert compact.headers["content-type"] == "application/vnd.mydiary.compact+json"
+    assert compact.json()["points"]["count"] == 300
+    assert int(compact.headers["content-length"]) < int(
+        geojson.headers["content-length"]
+    )
+
+    track = client.get(
+        "/owntracks/track/2026-07-01", params={**params, "fmt": "compact"}
+    )
+    assert track.status_code == 200
+    assert track.json()["format"] == "compact"
+    assert "num_maps" in track.json()["properties"]
+    response = client.get("/owntracks/track/2026-07-01", params={"fmt": "xml"})
+    assert response.status_code == 422
+
+
+def test_owntracks_map_jobs_queue_a_range_of_days(
+    session: Session, client: TestClient, monkeypatch
+):
+    from mydiary import map_jobs
+
+    started = []
+    monkeypatch.setattr(map_jobs, "run_in_background", lambda: started.append(1) or True)
+    params = {"start": "2026-07-01", "end": "2026-07-03"}
+    response = client.post("/owntracks/map_jobs", params=params)
+    assert response.status_code == 200
+    assert response.json()["num_queued"] == 3
+    assert started == [1]
+    again = client.post("/owntracks/map_jobs", params=params)
+    assert again.json()["num_queued"] == 0
+    status = client.get("/owntracks/map_jobs").json()
+    assert status["queued"] == 3
+
+    backwards = {"start": "2026-07-03", "end": "2026-07-01"}
+    assert client.post("/owntracks/map_jobs", params=backwards).status_code == 422
+    bad_fmt = dict(params, fmt="bmp")
+    assert client.post("/owntracks/map_jobs", params=bad_fmt).status_code == 400
+
+
+def test_owntracks_track_streams_a_range_of_days(session: Session, client: TestClient):
+    from mydiary.models import OwnTracksLocation
+
+    for day in (1, 3):
+        t = pendulum.datetime(2026, 7, day, 8, tz="America/New_York")
+        for i in range(120):
+            session.add(
+                OwnTracksLocation(
+                    tst=t.add(minutes=2 * i).in_timezone("UTC"),
+                    lat=round(47.6 + 0.0004 * (i % 40), 6),
+                    lon=-122.3,
+                    acc=10,
+                    username="u",
+                    device="d",
+                )
+            )
+    session.commit()
+    params = {"start": "2026-07-01", "end": "2026-07-03", "tz": "America/New_York"}
+
+    response = client.get("/owntracks/track", params=params)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    # flushed per day, and still one valid gzip stream
+    assert response.headers["content-encoding"] == "gzip"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["date"] for line in lines] == [
+        "2026-07-01",
+        "2026-07-02",
+        "2026-07-03",
+    ]
+    assert lines[0]["timezone"] == "America/New_York"
+    one_day = client.get("/owntracks/track/2026-07-03", params={"tz": params["tz"]})
+    assert lines[2]["track"] == one_day.json()
+    assert lines[1]["track"]["features"] == []
+
+    compact = client.get("/owntracks/track", params={**params, "fmt": "compact"})
+    assert json.loads(compact.text.splitlines()[0])["track"]["format"] == "compact"
+
+    too_long = {"start": "2025-01-01", "end": "2026-07-01"}
+    assert client.get("/owntracks/track", params=too_long).status_code == 422
+    backwards = {"start": "2026-07-02", "end": "2026-07-01"}
+    assert client.get("/owntracks/track", params=backwards).status_code == 422
+
+    msgpack = pytest.importorskip("msgpack")
+    packed = client.get(
+        "/owntracks/track", params=params, headers={"Accept": "application/msgpack"}
+    )
+    assert packed.headers["content-type"] == "application/msgpack"
+    unpacker = msgpack.Unpacker(raw=False)
+    unpacker.feed(packed.content)
+    records = list(unpacker)
+    assert [r["date"] for r in records] == [line["date"] for line in lines]
+    assert records[0]["track"]["format"] == "compact"
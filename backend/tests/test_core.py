@@ -1,10 +1,14 @@
+from datetime import date
 from pathlib import Path
 from io import BytesIO
 
+import pendulum
 import pytest
 from PIL import Image
 
 from mydiary.core import get_hash_from_txt, reduce_image_size, reduce_size_recurse
+from mydiary.core import start_of_day
+from mydiary.models import TimeZoneChange
 
 IMAGE_NAME = "24-05-18 13-50-28 9143.jpg"
 
@@ -33,3 +37,25 @@ def test_reduce_size_recurse_stays_under_threshold(rootdir):
     threshold = 20000
     result = reduce_size_recurse(original, (512, 512), threshold)
     assert len(result) <= threshold
+
+
+def test_start_of_day_takes_a_date_or_a_route_string(db_session):
+    db_session.add(
+        TimeZoneChange(
+            changed_at=pendulum.datetime(2020, 1, 1),
+            tz_before="Europe/London",
+            tz_after="America/New_York",
+        )
+    )
+    db_session.commit()
+    expected = pendulum.datetime(2026, 7, 1, tz="America/New_York")
+    assert start_of_day(date(2026, 7, 1), db_session) == expected
+    assert start_of_day("2026-07-01", db_session) == expected
+    assert start_of_day("today", db_session) == pendulum.today(tz="America/New_York")
+    assert start_of_day("2026-07-01", db_session, tz="UTC").timezone_name == "UTC"
+
+
+def test_start_of_day_falls_back_to_local_without_timezone_changes(db_session):
+    assert start_of_day(date(2026, 7, 1), db_session) == pendulum.datetime(
+        2026, 7, 1, tz="local"
+    )
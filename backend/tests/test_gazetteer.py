@@ -0,0 +1,143 @@
+import math
+import random
+
+import numpy as np
+import pendulum
+import pytest
+
+from mydiary import gazetteer as gazetteer_module
+from mydiary.gazetteer import Gazetteer, get_gazetteer
+from mydiary.owntracks_maps import Panel, section_content
+from mydiary.owntracks_places import where_label
+from mydiary.owntracks_track import (
+    Area,
+    DayTrack,
+    Stay,
+    haversine_m,
+    track_to_geojson,
+)
+
+TZ = "America/Los_Angeles"
+
+ROWS = [
+    # geonameid, name, asciiname, alternatenames, lat, lon, class, code, country
+    ("5809844", "Seattle", "47.60621", "-122.33207", "P", "US"),
+    ("5786882", "Bellevue", "47.61038", "-122.20068", "P", "US"),
+    ("2797656", "Gent", "51.05", "3.71667", "P", "BE"),
+    ("4036284", "Apia", "-13.83333", "-171.76666", "P", "WS"),
+    ("2208330", "Suva", "-18.14161", "178.44149", "P", "FJ"),
+    ("5808079", "Mount Rainier", "46.85283", "-121.76042", "T", "US"),
+]
+
+
+def write_tsv(path, rows):
+    lines = ["# a comment line"]
+    for gid, name, lat, lon, fclass, cc in rows:
+        cols = [gid, name, name, "", lat, lon, fclass, "PPL", cc]
+        cols += ["", "", "", "", "", "1000", "", "10", "UTC", "2024-01-01"]
+        lines.append("\t".join(cols))
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    return path
+
+
+@pytest.fixture
+def gazetteer(tmp_path):
+    return Gazetteer.open_tsv(write_tsv(tmp_path / "cities.txt", ROWS), tmp_path)
+
+
+def test_nearest_matches_a_scan_of_every_place(tmp_path):
+    rng = random.Random(0)
+    rows = []
+    for i in range(3000):
+        lat = math.degrees(math.asin(rng.uniform(-1, 1)))
+        lon = rng.uniform(-180, 180)
+        rows.append((str(i), f"town{i}", f"{lat:.5f}", f"{lon:.5f}", "P", "XX"))
+    g = Gazetteer.open_tsv(write_tsv(tmp_path / "cities.txt", rows), tmp_path)
+    assert len(g) == 3000
+    for _ in range(500):
+        lat = math.degrees(math.asin(rng.uniform(-1, 1)))
+        lon = rng.uniform(-180, 180)
+        d, i = min(
+            (haversine_m(lat, lon, float(r[2]), float(r[3])), i)
+            for i, r in enumerate(rows)
+        )
+        found = g.nearest(lat, lon, max_distance_m=math.inf)
+        assert found.name == f"town{i}"
+        assert found.distance_m == pytest.approx(d, rel=1e-6, abs=1e-3)
+
+
+def test_nearest_across_the_antimeridian(gazetteer):
+    # Suva is 1.5 degrees west of here; Apia is 10 degrees east
+    assert gazetteer.nearest(-17.0, -179.9, max_distance_m=math.inf).name == "Suva"
+
+
+def test_far_from_every_town_is_nowhere(gazetteer):
+    assert gazetteer.nearest(47.6, -130.0) is None
+    assert gazetteer.label(47.6101, -122.3301) == "Seattle, US"
+
+
+def test_only_populated_places_are_indexed(gazetteer):
+    # at the summit; a town is not what the mountain is
+    assert gazetteer.nearest(46.85283, -121.76042, math.inf).name != "Mount Rainier"
+    assert len(gazetteer) == len(ROWS) - 1
+
+
+def test_the_index_is_compiled_once_and_memory_mapped(tmp_path, monkeypatch):
+    tsv = write_tsv(tmp_path / "cities.txt", ROWS)
+    Gazetteer.open_tsv(tsv, tmp_path)
+    monkeypatch.setattr(
+        gazetteer_module,
+        "build_index",
+        lambda *a: pytest.fail("compiled an index that was already there"),
+    )
+    g = Gazetteer.open_tsv(tsv, tmp_path)
+    assert isinstance(g.points, np.memmap)
+    assert g.label(51.054, 3.725) == "Gent, BE"
+
+
+@pytest.fixture
+def open_gazetteers():
+    gazetteer_module._open.cache_clear()
+    yield
+    gazetteer_module._open.cache_clear()
+
+
+def test_without_a_gazetteer_configured_nothing_is_named(
+    monkeypatch, tmp_path, open_gazetteers
+):
+    monkeypatch.setenv("MYDIARY_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.delenv("MYDIARY_GAZETTEER", raising=False)
+    assert get_gazetteer() is None
+    monkeypatch.setenv("MYDIARY_GAZETTEER", str(tmp_path / "missing.txt"))
+    assert get_gazetteer() is None
+    monkeypatch.setenv("MYDIARY_GAZETTEER", str(write_tsv(tmp_path / "c.txt", ROWS)))
+    assert get_gazetteer().label(47.61, -122.2) == "Bellevue, US"
+    assert list((tmp_path / "cache" / "gazetteer").iterdir())
+
+
+def test_stays_and_areas_are_named_by_the_gazetteer(gazetteer):
+    start = pendulum.datetime(2026, 7, 1, 9, tz=TZ)
+    seattle = Stay(47.6101, -122.3301, start, start.add(hours=2), 4)
+    at_sea = Stay(47.6, -130.0, start.add(hours=5), start.add(hours=6), 3)
+    track = DayTrack(stays=[seattle, at_sea])
+    area = Area(DayTrack(stays=[seattle]), seattle.t_start, seattle.t_end)
+
+    gj = track_to_geojson(track, [area], gazetteer)
+    localities = [f["properties"]["locality"] for f in gj["features"]]
+    assert localities == ["Seattle, US", None]
+    assert gj["properties"]["areas"][0]["locality"] == "Seattle, US"
+    assert track_to_geojson(track)["features"][0]["properties"]["locality"] is None
+
+    assert (
+        where_label(seattle, gazetteer=gazetteer)
+        == "47.61010, -122.33010 (Seattle, US)"
+    )
+    assert where_label(at_sea, gazetteer=gazetteer) == "47.60000, -130.00000"
+
+    panels = [
+        Panel("overview", "", track, None, ""),
+        Panel("area", area.label(), area.track, area.frame, ""),
+    ]
+    content = section_content([None, None], panels, gazetteer=gazetteer)
+    assert "### 09:00–11:00 · Seattle, US" in content
+    assert "· Seattle" not in section_content([None, None], panels)
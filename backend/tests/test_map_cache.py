@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+from mydiary.map_cache import MapCache, get_map_cache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return MapCache(tmp_path / "maps", max_bytes=1000)
+
+
+def test_a_map_round_trips_by_its_hash(cache):
+    assert cache.get("ab12") is None
+    cache.put("ab12", b"jpeg")
+    assert cache.get("ab12") == b"jpeg"
+    cache.put("ab12", b"jpg")
+    assert cache.num_bytes == 3
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+    # another process opening the directory sees what is there
+    assert MapCache(cache.cache_dir, max_bytes=1000).num_bytes == 3
+
+
+def test_a_key_that_is_not_a_hash_is_rejected(cache):
+    with pytest.raises(ValueError):
+        cache.get("../database")
+
+
+def test_eviction_drops_the_least_recently_read(cache):
+    for i, key in enumerate(["aa", "bb", "cc", "dd"]):
+        cache.put(key, b"x" * 200)
+        os.utime(cache.cache_dir / f"{key}.img", (1000 + i, 1000 + i))
+    assert cache.get("aa")  # the oldest write, but read since
+    assert cache.evict(target_bytes=400) == 2
+    assert [cache.get(k) is not None for k in ["aa", "bb", "cc", "dd"]] == [
+        True,
+        False,
+        False,
+        True,
+    ]
+    assert cache.num_bytes == 400
+
+
+def test_going_over_the_cap_evicts(cache):
+    for i in range(8):
+        cache.put(f"k{i}", b"x" * 200)
+    assert cache.num_bytes <= 900  # LOW_WATER of the cap
+    assert len(list(cache.cache_dir.glob("*.img"))) == cache.num_bytes // 200
+
+
+def test_the_cache_follows_the_cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("MYDIARY_CACHE_DIR", str(tmp_path))
+    monkeypatch.setenv("MYDIARY_MAP_CACHE_MB", "2")
+    cache = get_map_cache()
+    assert cache is get_map_cache()
+    assert cache.cache_dir == tmp_path / "maps"
+    assert cache.max_bytes == 2 * 1024 * 1024
@@ -0,0 +1,163 @@
+import json
+from pathlib import Path
+
+import pendulum
+import pytest
+from sqlmodel import Session, select
+
+from mydiary import map_jobs, owntracks_maps
+from mydiary.map_cache import get_map_cache
+from mydiary.map_jobs import RenderService, queue_status, submit
+from mydiary.map_render import RenderParams
+from mydiary.models import MapRenderJob, OwnTracksLocation, TimeZoneChange
+from mydiary.owntracks_maps import panels_for_day, sync_day_map_to_note
+
+from .helpers import DAY, TZ, FakeJoplin, FakeTileDownloader
+
+
+@pytest.fixture(autouse=True)
+def tmp_cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("MYDIARY_CACHE_DIR", str(tmp_path))
+
+
+@pytest.fixture(autouse=True)
+def offline_tiles(monkeypatch):
+    """Render without the network."""
+    real_render_panels = owntracks_maps.render_panels
+
+    def _render_panels(
+        panels, params=None, render=None, tile_downloader=None, missing=None
+    ):
+        return real_render_panels(
+            panels,
+            params,
+            render,
+            tile_downloader=FakeTileDownloader(),
+            missing=missing,
+        )
+
+    monkeypatch.setattr(owntracks_maps, "render_panels", _render_panels)
+
+
+@pytest.fixture
+def db_with_locations(rootdir: str, db_session: Session):
+    items = json.loads(
+        Path(rootdir).joinpath("owntracks_data", f"owntracks_{DAY}.json").read_text()
+    )
+    seen = set()
+    for x in items:
+        key = (x["username"], x["device"], x["tst"])
+        if key in seen:
+            continue
+        seen.add(key)
+        db_session.add(
+            OwnTracksLocation(
+                tst=pendulum.from_timestamp(x["tst"], tz="UTC"),
+                lat=x["lat"],
+                lon=x["lon"],
+                acc=x.get("acc"),
+                username=x["username"],
+                device=x["device"],
+            )
+        )
+    db_session.commit()
+    return db_session
+
+
+@pytest.fixture
+def dt():
+    return pendulum.parse(DAY, tz=TZ)
+
+
+@pytest.fixture
+def db(db_with_locations):
+    db_with_locations.add(
+        TimeZoneChange(
+            changed_at=pendulum.datetime(2020, 1, 1), tz_before=TZ, tz_after=TZ
+        )
+    )
+    db_with_locations.commit()
+    return db_with_locations
+
+
+@pytest.fixture
+def render_calls(monkeypatch):
+    calls = []
+    real_render_panels = owntracks_maps.render_panels
+
+    def _render_panels(
+        panels, params=None, render=None, tile_downloader=None, missing=None
+    ):
+        calls.append(len(panels))
+        return real_render_panels(panels, params, render, missing=missing)
+
+    monkeypatch.setattr(owntracks_maps, "render_panels", _render_panels)
+    return calls
+
+
+def test_a_day_is_queued_once(db, dt):
+    assert submit([dt.date()], db) == 1
+    assert submit([dt.date()], db) == 0
+    # other parameters are another job
+    assert submit([dt.date()], db, render=RenderParams(fmt="PNG")) == 1
+    assert queue_status(db) == {"queued": 2, "running": 0, "done": 0, "failed": 0}
+    job = db.exec(select(MapRenderJob)).first()
+    assert job.timezone == TZ
+
+
+def test_rendered_jobs_leave_only_the_upload_to_the_sync(db, dt, render_calls):
+    submit([dt.date()], db)
+    progress = RenderService(workers=0).run(db)
+    assert progress == dict(total=1, done=1, failed=0, retried=0)
+    assert queue_status(db)["done"] == 1
+    _, panels = panels_for_day(dt, db)
+    assert all(get_map_cache().get(p.content_hash) for p in panels)
+
+    joplin = FakeJoplin()
+    result, _ = sync_day_map_to_note(dt, session=db, mydiary_joplin=joplin)
+    assert result == "updated"
+    assert render_calls == [len(panels)]  # by the service; none by the sync
+
+    # a finished day can be queued again
+    assert submit([dt.date()], db) == 1
+
+
+def test_a_failed_job_is_retried_and_then_given_up_on(db, dt, monkeypatch):
+    failures = iter([RuntimeError("tile server hiccup")])
+
+    def _flaky(*args, **kwargs):
+        e = next(failures, None)
+        if e is not None:
+            raise e
+        return []
+
+    monkeypatch.setattr(map_jobs, "render_job", _flaky)
+    submit([dt.date()], db)
+    progress = RenderService(workers=0).run(db)
+    assert (progress["done"], progress["retried"]) == (1, 1)
+
+    def _broken(*args, **kwargs):
+        raise RuntimeError("still broken")
+
+    monkeypatch.setattr(map_jobs, "render_job", _broken)
+    submit([dt.date()], db)
+    progress = RenderService(workers=0, max_attempts=3).run(db)
+    assert (progress["failed"], progress["retried"]) == (1, 2)
+    job = db.exec(select(MapRenderJob)).one()
+    assert (job.status, job.attempts) == ("failed", 3)
+    assert job.error == "RuntimeError: still broken"
+
+
+def test_a_day_without_fixes_is_not_retried(db):
+    submit([pendulum.date(2020, 2, 2)], db)
+    progress = RenderService(workers=0).run(db)
+    assert (progress["failed"], progress["retried"]) == (1, 0)
+
+
+def test_a_job_left_running_is_picked_up_again(db, dt):
+    submit([dt.date()], db)
+    job = db.exec(select(MapRenderJob)).one()
+    job.status = "running"  # its service died
+    db.add(job)
+    db.commit()
+    assert RenderService(workers=0).run(db)["done"] == 1
@@ -0,0 +1,254 @@
+import io
+import os
+import threading
+import time
+
+import pytest
+import s2sphere
+import staticmaps
+from PIL import Image
+
+from mydiary import map_tiles, thumbnail_cache
+from mydiary.map_render import BASEMAP_PROVIDER, LABELS_PROVIDER, render_day_map
+from mydiary.map_render import RenderParams, tiles_for_map
+from mydiary.map_tiles import RateLimiter, TileCache, TileFetcher, TilesOffline
+from mydiary.map_tiles import get_tile_cache, mercator, prefetch, tiles_for
+from mydiary.owntracks_track import build_track
+
+from .helpers import load_fixture
+
+
+@pytest.fixture(autouse=True)
+def tmp_cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("MYDIARY_CACHE_DIR", str(tmp_path))
+
+
+@pytest.fixture
+def july1_track(rootdir: str):
+    return build_track(load_fixture(rootdir, "owntracks_2026-07-01.json"))
+
+
+class SlowFetcher(TileFetcher):
+    """A TileFetcher whose network is a short sleep and a flat tile."""
+
+    def __init__(self, delay=0.02, fail=()):
+        super().__init__()
+        buf = io.BytesIO()
+        Image.new("RGBA", (512, 512), (235, 235, 233, 255)).save(buf, format="PNG")
+        self.tile = buf.getvalue()
+        self.delay = delay
+        self.fail = fail
+        self.urls = []
+        self.active = self.peak = 0
+        self.lock = threading.Lock()
+
+    def fetch(self, url):
+        with self.lock:
+            self.urls.append(url)
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+        if any(part in url for part in self.fail):
+            raise RuntimeError(f"fetch {url} yields 503")
+        return self.tile
+
+
+def test_a_cold_render_fetches_every_tile_once_and_concurrently(july1_track):
+    fetcher = SlowFetcher()
+    render_day_map(
+        july1_track, render=RenderParams(width=800, height=600), tile_downloader=fetcher
+    )
+    assert len(fetcher.urls) == len(set(fetcher.urls))
+    assert {"light_nolabels" in u for u in fetcher.urls} == {True, False}
+    assert fetcher.peak > 1
+
+    again = SlowFetcher()
+    render_day_map(
+        july1_track, render=RenderParams(width=800, height=600), tile_downloader=again
+    )
+    assert again.urls == []
+
+
+def test_mercator_is_staticmaps_over_arrays():
+    lat = [0.0, 47.6062, -33.8688, 85.0, -85.0]
+    lon = [0.0, -122.3321, 151.2093, 179.9, -179.9]
+    x, y = mercator(lat, lon)
+    for i in range(len(lat)):
+        expected = staticmaps.Transformer.mercator(
+            s2sphere.LatLng.from_degrees(lat[i], lon[i])
+        )
+        assert (x[i], y[i]) == expected
+
+
+def test_the_prefetched_tiles_are_the_ones_the_renderer_draws():
+    trans = staticmaps.Transformer(
+        1600, 1200, 12, s2sphere.LatLng.from_degrees(47.6, -122.3), 512
+    )
+    tiles = tiles_for(trans)
+    assert len(tiles) == trans.tiles_x() * trans.tiles_y()
+    cache_dir = str(thumbnail_cache.get_cache_dir(subdir="map_tiles"))
+    fetcher = SlowFetcher(delay=0)
+    assert prefetch(fetcher, [BASEMAP_PROVIDER], cache_dir, 12, tiles) == len(tiles)
+
+    ctx = staticmaps.Context()
+    ctx.set_tile_provider(BASEMAP_PROVIDER)
+    ctx.set_cache_dir(cache_dir)
+    ctx.set_tile_downloader(fetcher)
+    ctx.set_center(s2sphere.LatLng.from_degrees(47.6, -122.3))
+    ctx.set_zoom(12)
+    ctx.render_pillow(1600, 1200)
+    assert len(fetcher.urls) == len(tiles)
+
+
+def test_a_failed_tile_does_not_fail_the_map(july1_track):
+    fetcher = SlowFetcher(delay=0, fail=("only_labels",))
+    data = render_day_map(
+        july1_track, render=RenderParams(width=400, height=300), tile_downloader=fetcher
+    )
+    assert Image.open(io.BytesIO(data)).size == (400, 300)
+
+
+def test_tiles_are_kept_in_one_store_file():
+    cache_dir = str(thumbnail_cache.get_cache_dir(subdir="map_tiles"))
+    fetcher = SlowFetcher(delay=0)
+    prefetch(fetcher, [LABELS_PROVIDER], cache_dir, 3, [(1, 2), (2, 2)])
+    names = {n for _, _, files in os.walk(cache_dir) for n in files}
+    assert names <= {"tiles.mbtiles", "tiles.mbtiles-wal", "tiles.mbtiles-shm"}
+    assert fetcher.get(LABELS_PROVIDER, cache_dir, 3, 2, 2) == fetcher.tile
+    assert len(fetcher.urls) == 2
+
+
+def rgba(size=16, color=(1, 2, 3, 255)):
+    return Image.new("RGBA", (size, size), color)
+
+
+def test_the_tile_cache_evicts_the_least_recently_used():
+    one = TileCache.size_of(rgba())
+    cache = TileCache(max_bytes=2 * one)
+    cache.put("a", rgba())
+    cache.put("b", rgba())
+    assert cache.get("a") is not None  # now b is the oldest
+    cache.put("c", rgba())
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (3, 1, 1)
+    assert stats["num_bytes"] == 2 * one <= stats["max_bytes"]
+    # bigger than the whole budget: not kept, and nothing evicted for it
+    cache.put("huge", rgba(size=64))
+    assert cache.get("huge") is None
+    assert cache.stats()["num_tiles"] == 2
+
+
+def test_renders_share_decoded_tiles(july1_track, monkeypatch):
+    cache = TileCache(max_bytes=256 * 1024 * 1024)
+    monkeypatch.setattr(map_tiles, "_tile_cache", cache)
+    fetcher = SlowFetcher(delay=0)
+    render = RenderParams(width=400, height=300)
+    first = render_day_map(july1_track, render=render, tile_downloader=fetcher)
+    after_first = cache.stats()
+    assert after_first["misses"] == after_first["num_tiles"] > 0
+
+    decoded = []
+    real_open = Image.open
+    monkeypatch.setattr(Image, "open", lambda *a: decoded.append(a) or real_open(*a))
+    again = render_day_map(july1_track, render=render, tile_downloader=fetcher)
+    assert again == first
+    assert decoded == []
+    assert cache.stats()["misses"] == after_first["misses"]
+    assert cache.stats()["hits"] > after_first["hits"]
+
+
+class ColourDownloader:
+    """Not a TileFetcher: serves its own flat tile, from no tile store."""
+
+    def __init__(self, colour):
+        buf = io.BytesIO()
+        Image.new("RGBA", (512, 512), colour).save(buf, format="PNG")
+        self.tile = buf.getvalue()
+
+    def set_user_agent(self, user_agent):
+        pass
+
+    def get(self, provider, cache_dir, zoom, x, y):
+        return self.tile
+
+
+def test_each_downloader_gets_its_own_tiles_back(monkeypatch):
+    cache = TileCache(max_bytes=256 * 1024 * 1024)
+    monkeypatch.setattr(map_tiles, "_tile_cache", cache)
+    red = ColourDownloader((255, 0, 0, 255))
+    blue = ColourDownloader((0, 0, 255, 255))
+    for downloader, colour in ((red, (255, 0, 0, 255)), (blue, (0, 0, 255, 255))):
+        tile = map_tiles.get_tile(downloader, BASEMAP_PROVIDER, "d", 3, 1, 2)
+        assert tile.getpixel((0, 0)) == colour
+    # and each still draws its own from memory the next time
+    assert map_tiles.get_tile(red, BASEMAP_PROVIDER, "d", 3, 1, 2).getpixel(
+        (0, 0)
+    ) == (255, 0, 0, 255)
+    assert cache.stats()["hits"] == 1
+
+
+def test_the_budget_comes_from_the_environment(monkeypatch):
+    monkeypatch.setattr(map_tiles, "_tile_cache", None)
+    monkeypatch.setenv("MYDIARY_TILE_CACHE_MB", "3")
+    assert get_tile_cache().max_bytes == 3 * 1024 * 1024
+
+
+def test_tiles_for_map_is_what_a_render_fetches(july1_track):
+    render = RenderParams(width=800, height=600)
+    zoom, tiles = tiles_for_map(july1_track, render)
+    fetcher = SlowFetcher(delay=0)
+    render_day_map(july1_track, render=render, tile_downloader=fetcher)
+    assert len(fetcher.urls) == 2 * len(tiles)
+    assert all(f"/{zoom}/" in url for url in fetcher.urls)
+
+
+def test_a_seeded_map_renders_offline(july1_track, monkeypatch):
+    render = RenderParams(width=400, height=300)
+    monkeypatch.setenv("MYDIARY_TILES_OFFLINE", "1")
+    offline = SlowFetcher(delay=0)
+    assert offline.offline
+    with pytest.raises(TilesOffline):
+        render_day_map(july1_track, render=render, tile_downloader=offline)
+    assert offline.urls == []
+
+    zoom, tiles = tiles_for_map(july1_track, render)
+    cache_dir = str(thumbnail_cache.get_cache_dir(subdir="map_tiles"))
+    seeder = SlowFetcher(delay=0)
+    seeder._offline = False
+    providers = [BASEMAP_PROVIDER, LABELS_PROVIDER]
+    assert prefetch(seeder, providers, cache_dir, zoom, tiles, rate=RateLimiter(500))
+    render_day_map(july1_track, render=render, tile_downloader=offline)
+    assert offline.urls == []
+
+
+def test_the_rate_limiter_spaces_calls_out():
+    limiter = RateLimiter(per_second=200)
+    start = time.monotonic()
+    for _ in range(11):
+        limiter.wait()
+    assert time.monotonic() - start >= 10 / 200 * 0.95
+
+
+def _wait_on(limiter, times):
+    for _ in range(times):
+        limiter.wait()
+
+
+def test_a_shared_rate_limit_holds_across_processes():
+    import multiprocessing
+
+    ctx = multiprocessing.get_context("spawn")
+    start = time.monotonic()
+    limiter = RateLimiter(per_second=100, mp_context=ctx)
+    procs = [ctx.Process(target=_wait_on, args=(limiter, 5)) for _ in range(3)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    assert all(p.exitcode == 0 for p in procs)
+    # every process's calls took a slot from the one schedule: 15 of them
+    assert limiter._next.value >= start + 15 / 100
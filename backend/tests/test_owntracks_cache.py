@@ -0,0 +1,187 @@
+import json
+from pathlib import Path
+
+import pendulum
+import pytest
+from sqlmodel import Session, select
+
+from mydiary import owntracks_cache
+from mydiary.models import OwnTracksLocation, OwnTracksTrackCache
+from mydiary.owntracks_cache import processed_day
+from mydiary.owntracks_connector import MyDiaryOwnTracks
+from mydiary.owntracks_track import (
+    TrackParams,
+    build_track,
+    points_from_locations,
+    split_into_areas,
+)
+
+TZ = "America/New_York"
+DAY = "2026-07-01"
+
+
+@pytest.fixture
+def db_with_locations(rootdir: str, db_session: Session):
+    items = json.loads(
+        Path(rootdir).joinpath("owntracks_data", f"owntracks_{DAY}.json").read_text()
+    )
+    seen = set()
+    for x in items:
+        key = (x["username"], x["device"], x["tst"])
+        if key in seen:
+            continue
+        seen.add(key)
+        db_session.add(
+            OwnTracksLocation(
+                tst=pendulum.from_timestamp(x["tst"], tz="UTC"),
+                lat=x["lat"],
+                lon=x["lon"],
+                acc=x.get("acc"),
+                username=x["username"],
+                device=x["device"],
+            )
+        )
+    db_session.commit()
+    return db_session
+
+
+@pytest.fixture
+def dt():
+    return pendulum.parse(DAY, tz=TZ)
+
+
+def uncached(dt, session, params):
+    locations = MyDiaryOwnTracks().get_locations_for_day(dt, session=session)
+    track = build_track(points_from_locations(locations, timezone=TZ), params)
+    return track, split_into_areas(track)
+
+
+def cache_rows(session):
+    return list(session.exec(select(OwnTracksTrackCache)))
+
+
+@pytest.mark.parametrize(
+    "params", [TrackParams(), TrackParams(max_acc=1000, stay_minutes=5)]
+)
+def test_a_cached_day_is_the_same_day(db_with_locations, dt, params):
+    expected_track, expected_areas = uncached(dt, db_with_locations, params)
+    processed_day(dt, db_with_locations, params)  # stores
+    track, areas = processed_day(dt, db_with_locations, params)  # reads
+    assert track == expected_track
+    assert areas == expected_areas
+    # the hash decides whether a note's map is re-rendered, so it must survive
+    # the round trip exactly, timezone and all
+    assert track.content_hash(params) == expected_track.content_hash(params)
+    assert str(track.stays[0].t_start) == str(expected_track.stays[0].t_start)
+
+
+def test_the_second_call_does_not_rerun_the_pipeline(db_with_locations, dt, monkeypatch):
+    first = processed_day(dt, db_with_locations)
+    calls = []
+    monkeypatch.setattr(
+        owntracks_cache,
+        "build_track_from_columns",
+        lambda *a, **kw: calls.append(a),
+    )
+    assert processed_day(dt, db_with_locations) == first
+    assert calls == []
+    assert len(cache_rows(db_with_locations)) == 1
+
+
+def test_each_params_set_is_cached_separately(db_with_locations, dt):
+    processed_day(dt, db_with_locations, TrackParams())
+    processed_day(dt, db_with_locations, TrackParams(max_acc=50))
+    assert len(cache_rows(db_with_locations)) == 2
+
+
+def test_a_new_fix_is_never_served_stale(db_with_locations, dt):
+    before, _ = processed_day(dt, db_with_locations)
+    # added behind save_locations_to_database's back, so nothing invalidated it
+    db_with_locations.add(
+        OwnTracksLocation(
+            tst=dt.add(hours=23, minutes=50).in_timezone("UTC"),
+            lat=47.6,
+            lon=-122.3,
+            acc=10,
+            username="u",
+            device="d",
+        )
+    )
+    db_with_locations.commit()
+    after, _ = processed_day(dt, db_with_locations)
+    assert after.num_points + after.num_dropped == before.num_points + before.num_dropped + 1
+    assert len(cache_rows(db_with_locations)) == 1  # the stale row was replaced
+
+
+def test_saving_new_fixes_drops_the_cached_days(db_with_locations, dt, monkeypatch):
+    processed_day(dt, db_with_locations)
+    owntracks = MyDiaryOwnTracks()
+    tst = dt.add(hours=12).int_timestamp
+    monkeypatch.setattr(
+        owntracks,
+        "fetch_locations_all_devices",
+        lambda start, end: [
+            {"_type": "location", "tst": tst, "lat": 47.6, "lon": -122.3,
+             "username": "u", "device": "d"}
+        ],
+    )
+    num_added = owntracks.save_locations_to_database(
+        session=db_with_locations, start=dt, end=dt.end_of("day")
+    )
+    assert num_added == 1
+    assert cache_rows(db_with_locations) == []
+
+
+def test_a_day_without_fixes_is_an_empty_track(db_session, dt):
+    track, areas = processed_day(dt, db_session)
+    assert track.is_empty()
+    assert track.num_points + track.num_dropped == 0
+    assert areas == []
+
+
+def test_the_lean_rows_are_the_rows_the_pipeline_reads(db_with_locations, dt):
+    from mydiary.owntracks_track import points_from_rows
+
+    owntracks = MyDiaryOwnTracks()
+    locations = owntracks.get_locations_for_day(dt, session=db_with_locations)
+    rows = owntracks.get_fix_rows_for_day(dt, session=db_with_locations)
+    assert [tuple(r) for r in rows] == [
+        (x.tst, x.lat, x.lon, x.acc, x.motion) for x in locations
+    ]
+    assert points_from_rows(rows, TZ) == points_from_locations(locations, TZ)
+    later = owntracks.get_fix_rows_for_day(
+        dt, session=db_with_locations, after=rows[4][0]
+    )
+    assert later == rows[5:]
+
+
+
+class NothingStale:
+    def all(self):
+        return []
+
+
+def test_losing_the_race_to_store_a_day_keeps_the_callers_changes(
+    db_with_locations, dt, monkeypatch
+):
+    from mydiary.owntracks_cache import _key, _store
+
+    key = _key(dt, TrackParams(), 1000.0)
+    _store(db_with_locations, key, "1|v", "{}")
+    pending = OwnTracksLocation(
+        tst=dt.add(hours=23).in_timezone("UTC"),
+        lat=47.6,
+        lon=-122.3,
+        username="u",
+        device="d",
+    )
+    db_with_locations.add(pending)
+    # as if another request stored the row after this one looked for it
+    monkeypatch.setattr(db_with_locations, "exec", lambda stmt: NothingStale())
+    _store(db_with_locations, key, "1|v", "{}")
+    monkeypatch.undo()
+    assert pending in db_with_locations
+    assert db_with_locations.exec(
+        select(OwnTracksLocation).where(OwnTracksLocation.lat == 47.6)
+    ).all() == [pending]
+    assert len(cache_rows(db_with_locations)) == 1
@@ -0,0 +1,91 @@
+import pendulum
+import pytest
+
+from mydiary import owntracks_columns as oc
+from mydiary import owntracks_track as ot
+from mydiary.owntracks_columns import TrackColumns
+from mydiary.owntracks_track import TrackParams, TrackPoint
+
+from .helpers import PARAM_SETS, TZ, load_fixture, synthetic_day
+
+
+def assert_same_track(points, params):
+    expected = ot.build_track(points, params)
+    actual = oc.build_track(TrackColumns.from_points(points), params)
+    assert actual == expected
+    assert actual.content_hash(params) == expected.content_hash(params)
+
+
+@pytest.mark.parametrize("params", PARAM_SETS)
+@pytest.mark.parametrize(
+    "name", ["owntracks_2026-07-01.json", "owntracks_2026-06-27.json"]
+)
+def test_matches_the_reference_on_real_days(rootdir, name, params):
+    assert_same_track(load_fixture(rootdir, name), params)
+
+
+@pytest.mark.parametrize("params", PARAM_SETS)
+@pytest.mark.parametrize("seed", range(12))
+def test_matches_the_reference_on_synthetic_days(seed, params):
+    assert_same_track(synthetic_day(seed), params)
+
+
+def test_matches_the_reference_across_a_dst_change():
+    # 2026-03-08 loses an hour in New York: time differences must be absolute,
+    # not wall-clock, or every span across 02:00 is an hour off
+    start = pendulum.datetime(2026, 3, 8, 0, 0, tz=TZ)
+    assert_same_track(synthetic_day(99, n=300, start=start), TrackParams())
+
+
+@pytest.mark.parametrize("n", [0, 1, 2, 3])
+def test_matches_the_reference_on_tiny_days(n):
+    assert_same_track(synthetic_day(7)[:n], TrackParams())
+
+
+def test_each_stage_matches_the_reference(rootdir):
+    points = load_fixture(rootdir, "owntracks_2026-06-27.json")
+    points = points + points[10:14]  # repeats, out of order
+    cols = TrackColumns.from_points(points)
+
+    deduped = ot.dedupe(points)
+    assert oc.dedupe(cols).times == [p.tst for p in deduped]
+
+    filtered = ot.filter_accuracy(deduped, 100)
+    assert oc.filter_accuracy(oc.dedupe(cols), 100).times == [p.tst for p in filtered]
+
+    despiked = ot.despike(filtered, 300.0)
+    cleaned = oc.despike(oc.filter_accuracy(oc.dedupe(cols), 100), 300.0)
+    assert cleaned.times == [p.tst for p in despiked]
+
+    assert oc.detect_stays(cleaned, 150, 20) == ot.detect_stays(despiked, 150, 20)
+
+
+def test_despike_compares_against_the_last_kept_fix():
+    base = pendulum.datetime(2026, 7, 1, 9, tz=TZ)
+    points = [
+        TrackPoint(base, 33.498, -42.0054),
+        TrackPoint(base.add(minutes=1), 44.23, -42.0054),  # out...
+        TrackPoint(base.add(minutes=2), 44.24, -42.0054),  # ...still out
+        TrackPoint(base.add(minutes=3), 33.499, -42.0054),
+        TrackPoint(base.add(minutes=4), 33.4991, -42.0054),
+    ]
+    expected = ot.despike(points, 1200.0)
+    assert oc.despike(TrackColumns.from_points(points), 1200.0).times == [
+        p.tst for p in expected
+    ]
+
+
+def test_columns_from_rows_make_the_same_times_as_points_from_locations(rootdir):
+    # naive UTC rows, as sqlite hands them back
+    points = load_fixture(rootdir, "owntracks_2026-07-01.json")
+    rows = [
+        (p.tst.in_timezone("UTC").naive(), p.lat, p.lon, p.acc, p.motion)
+        for p in reversed(points)
+    ]
+    cols = TrackColumns.from_rows(rows, timezone=TZ)
+    assert [cols.time_at(i) for i in range(len(cols))] == [p.tst for p in points]
+    assert str(cols.time_at(0)) == str(points[0].tst)
+    params = TrackParams()
+    assert oc.build_track(cols, params).content_hash(params) == ot.build_track(
+        points, params
+    ).content_hash(params)
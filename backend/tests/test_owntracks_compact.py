@@ -0,0 +1,133 @@
+import gzip
+import json
+
+import numpy as np
+import pytest
+
+from mydiary.owntracks_columns import TrackColumns, build_track
+from mydiary.owntracks_compact import (
+    accepted,
+    compact_collection,
+    compress,
+    compress_stream,
+    decode_polyline,
+    encode,
+    encode_polyline,
+    encode_record,
+    expand_collection,
+    negotiate,
+)
+from mydiary.owntracks_track import TrackParams, split_into_areas, track_to_geojson
+
+from .helpers import TZ, load_fixture
+
+
+def test_the_polyline_is_googles():
+    coords = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+    encoded = encode_polyline(coords, precision=5)
+    # the worked example from Google's documentation
+    assert encoded == "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+    assert decode_polyline(encoded, precision=5) == coords
+
+
+def test_six_decimal_fixes_come_back_exactly(rootdir):
+    points = load_fixture(rootdir, "owntracks_2026-07-01.json")
+    coords = [(p.lat, p.lon) for p in points]
+    assert decode_polyline(encode_polyline(coords)) == coords
+
+
+@pytest.fixture
+def track_collection(rootdir):
+    cols = TrackColumns.from_points(load_fixture(rootdir, "owntracks_2026-06-27.json"))
+    track = build_track(cols, TrackParams())
+    return track_to_geojson(track, split_into_areas(track))
+
+
+def test_a_track_round_trips(track_collection):
+    doc = compact_collection(track_collection, TZ)
+    assert doc["lines"]["count"] + doc["points"]["count"] == len(
+        track_collection["features"]
+    )
+    assert all(isinstance(t, int) for t in doc["points"]["properties"]["t_start"])
+    again = expand_collection(json.loads(json.dumps(doc)))
+    expected = json.loads(json.dumps(track_collection["properties"]))
+    assert again["properties"] == expected
+    assert len(again["features"]) == len(track_collection["features"])
+    for a, b in zip(again["features"], track_collection["features"]):
+        assert a["properties"] == b["properties"]
+        assert a["geometry"]["type"] == b["geometry"]["type"]
+        flat = lambda g: np.ravel(g["coordinates"])
+        assert flat(a["geometry"]) == pytest.approx(flat(b["geometry"]), abs=1e-6)
+
+
+def test_the_compact_form_is_smaller(track_collection):
+    geojson = encode(track_collection, "geojson", TZ)
+    compact = encode(track_collection, "compact", TZ)
+    assert len(compact) < len(geojson) / 2
+
+
+def test_negotiation():
+    assert negotiate(None, None) == "geojson"
+    assert negotiate(None, "*/*") == "geojson"
+    assert negotiate("compact", "application/json") == "compact"
+    assert (
+        negotiate(
+            None,
+            "application/json;q=0.5, application/vnd.mydiary.compact+json",
+        )
+        == "compact"
+    )
+    with pytest.raises(ValueError):
+        negotiate("xml", None)
+
+
+def test_msgpack_carries_the_compact_document(track_collection):
+    msgpack = pytest.importorskip("msgpack")
+    assert negotiate(None, "application/x-msgpack") == "msgpack"
+    body = encode(track_collection, "msgpack", TZ)
+    assert msgpack.unpackb(body) == json.loads(encode(track_collection, "compact", TZ))
+
+
+def test_compression_follows_accept_encoding():
+    body = b'{"a": 1}' * 1000
+    compressed, coding = compress(body, "gzip, deflate")
+    assert coding == "gzip"
+    assert gzip.decompress(compressed) == body
+    assert compress(body, "identity") == (body, None)
+    assert compress(body, "gzip;q=0") == (body, None)
+    # not worth it for a small body
+    assert compress(b"{}", "gzip") == (b"{}", None)
+
+
+def test_accepted_ranks_by_q():
+    assert accepted("gzip;q=0.5, br, identity;q=0") == ["br", "gzip"]
+    assert accepted(None) == []
+
+
+def test_a_streamed_body_is_one_compressed_stream():
+    records = [encode_record({"date": f"2026-07-0{d}"}, "geojson") for d in (1, 2)]
+    chunks, coding = compress_stream(records, "gzip")
+    assert coding == "gzip"
+    assert gzip.decompress(b"".join(chunks)).splitlines() == [
+        b'{"date":"2026-07-01"}',
+        b'{"date":"2026-07-02"}',
+    ]
+    chunks, coding = compress_stream(records, "identity")
+    assert (list(chunks), coding) == (records, None)
+
+
+def test_a_streamed_body_can_be_brotli():
+    brotli = pytest.importorskip("brotli")
+    records = [encode_record({"date": f"2026-07-0{d}"}, "geojson") for d in (1, 2)]
+    chunks, coding = compress_stream(records, "br, gzip")
+    assert coding == "br"
+    assert brotli.decompress(b"".join(chunks)) == b"".join(records)
+
+
+def test_msgpack_records_are_a_sequence_of_documents():
+    msgpack = pytest.importorskip("msgpack")
+    records = [{"date": "2026-07-01"}, {"date": "2026-07-02"}]
+    body = b"".join(encode_record(r, "msgpack") for r in records)
+    unpacker = msgpack.Unpacker(raw=False)
+    unpacker.feed(body)
+    assert list(unpacker) == records
@@ -0,0 +1,153 @@
+import zlib
+
+import numpy as np
+import pendulum
+import pytest
+from sqlmodel import select
+
+from mydiary import owntracks_daypoints
+from mydiary.models import OwnTracksDayPoints, OwnTracksLocation
+from mydiary.owntracks_cache import processed_day
+from mydiary.owntracks_columns import TrackColumns
+from mydiary.owntracks_connector import MyDiaryOwnTracks
+from mydiary.owntracks_daypoints import day_columns, decode_columns, encode_columns
+from mydiary.owntracks_track import (
+    TrackParams,
+    TrackPoint,
+    build_track,
+    points_from_locations,
+)
+
+from .helpers import TZ, load_fixture, synthetic_day
+
+
+def assert_same_columns(a: TrackColumns, b: TrackColumns):
+    assert a.tst.dtype == b.tst.dtype == np.int64
+    assert np.array_equal(a.tst, b.tst)
+    assert np.array_equal(a.lat, b.lat)
+    assert np.array_equal(a.lon, b.lon)
+    assert np.array_equal(a.acc, b.acc, equal_nan=True)
+    assert list(a.motion) == list(b.motion)
+
+
+def quantized(points):
+    """As the recorder reports them: whole seconds, six decimals."""
+    return [
+        TrackPoint(
+            p.tst.replace(microsecond=0),
+            round(p.lat, 6),
+            round(p.lon, 6),
+            p.acc,
+            "walking" if i % 3 else None,
+        )
+        for i, p in enumerate(points)
+    ]
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_a_recorder_day_round_trips_in_the_compact_form(seed):
+    cols = TrackColumns.from_points(quantized(synthetic_day(seed)))
+    data = encode_columns(cols)
+    assert_same_columns(decode_columns(data, TZ), cols)
+    # well under the 40 bytes a fix takes as five raw float64/int64 columns
+    assert len(data) < 12 * len(cols)
+
+
+def test_a_day_the_compact_form_would_round_keeps_full_precision():
+    points = synthetic_day(7)  # unrounded coordinates
+    points[3] = TrackPoint(
+        points[3].tst.replace(microsecond=250_000), points[3].lat, points[3].lon, 12.5
+    )
+    cols = TrackColumns.from_points(points)
+    assert_same_columns(decode_columns(encode_columns(cols), TZ), cols)
+
+
+def test_a_negative_accuracy_round_trips_apart_from_a_missing_one():
+    points = quantized(synthetic_day(3, n=6))
+    for i, acc in enumerate([-1, None, 0, -2147483647, 2147483647, 5]):
+        p = points[i]
+        points[i] = TrackPoint(p.tst, p.lat, p.lon, acc, p.motion)
+    cols = TrackColumns.from_points(points)
+    data = encode_columns(cols)
+    # in the compact int32 column, not the float64 fallback
+    _, flags, _, _ = owntracks_daypoints._HEADER.unpack_from(zlib.decompress(data))
+    assert not flags & owntracks_daypoints._FLOAT_ACC
+    decoded = decode_columns(data, TZ)
+    assert_same_columns(decoded, cols)
+    assert decoded.acc[0] == -1
+    assert np.isnan(decoded.acc[1])
+
+
+def test_an_empty_day_round_trips():
+    cols = TrackColumns.from_points([])
+    assert len(decode_columns(encode_columns(cols), TZ)) == 0
+
+
+DAY = pendulum.datetime(2026, 7, 1, tz=TZ)
+
+
+@pytest.fixture
+def db_day(rootdir, db_session):
+    seen = set()
+    for p in load_fixture(rootdir, "owntracks_2026-07-01.json"):
+        if p.tst in seen:
+            continue
+        seen.add(p.tst)
+        db_session.add(
+            OwnTracksLocation(
+                tst=p.tst.in_timezone("UTC"),
+                lat=p.lat,
+                lon=p.lon,
+                acc=p.acc,
+                motion=p.motion,
+                username="u",
+                device="d",
+            )
+        )
+    db_session.commit()
+    return db_session
+
+
+def test_day_columns_reads_the_blob_once_it_is_stored(db_day, monkeypatch):
+    first = day_columns(DAY, db_day)
+    row = db_day.exec(select(OwnTracksDayPoints)).one()
+    assert row.num_fixes == len(first)
+
+    monkeypatch.setattr(
+        owntracks_daypoints.TrackColumns,
+        "from_rows",
+        classmethod(lambda cls, *a, **kw: pytest.fail("loaded the rows again")),
+    )
+    again = day_columns(DAY, db_day)
+    assert_same_columns(again, first)
+    assert again.time_at(0) == first.time_at(0)
+    assert str(again.time_at(0)) == str(first.time_at(0))
+
+
+def test_a_day_that_gains_a_fix_is_re_encoded(db_day):
+    before = day_columns(DAY, db_day)
+    db_day.add(
+        OwnTracksLocation(
+            tst=DAY.add(hours=23).in_timezone("UTC"),
+            lat=33.51,
+            lon=-42.0,
+            acc=10,
+            username="u",
+            device="d",
+        )
+    )
+    db_day.commit()
+    assert len(day_columns(DAY, db_day)) == len(before) + 1
+    assert db_day.exec(select(OwnTracksDayPoints)).one().num_fixes == len(before) + 1
+
+
+@pytest.mark.parametrize(
+    "params", [TrackParams(), TrackParams(max_acc=1000, stay_minutes=5)]
+)
+def test_a_track_built_from_the_blob_is_the_same_track(db_day, params):
+    locations = MyDiaryOwnTracks().get_locations_for_day(DAY, session=db_day)
+    expected = build_track(points_from_locations(locations, timezone=TZ), params)
+    day_columns(DAY, db_day)  # stored, so processed_day decodes it
+    track, _ = processed_day(DAY, db_day, params)
+    assert track == expected
+    assert track.content_hash(params) == expected.content_hash(params)
@@ -0,0 +1,244 @@
+import io
+import math
+
+import numpy as np
+import pendulum
+import pytest
+from PIL import Image
+from sqlmodel import select
+
+from mydiary import owntracks_heatmap
+from mydiary.models import OwnTracksLocation, OwnTracksPlace, OwnTracksPlaceVisit
+from mydiary.owntracks_heatmap import (
+    EMPTY_TILE,
+    MAX_ZOOM,
+    TILE_SIZE,
+    HeatmapStore,
+    update,
+    world_pixels,
+)
+
+SEATTLE = (47.6062, -122.3321)
+
+
+def tile_of(lat, lon, z):
+    x, y = world_pixels(np.array([lat]), np.array([lon]), z)
+    return int(x[0] // TILE_SIZE), int(y[0] // TILE_SIZE)
+
+
+def decode(png):
+    return np.asarray(Image.open(io.BytesIO(png)).convert("RGBA"))
+
+
+def test_world_pixels_is_the_slippy_map_scheme():
+    x, y = world_pixels(np.array([0.0]), np.array([0.0]), 0)
+    assert (x[0], y[0]) == (128.0, 128.0)
+    # the standard OSM tile formula
+    lat, lon = SEATTLE
+    n = 2**12
+    expected_x = int((lon + 180) / 360 * n)
+    lat_r = math.radians(lat)
+    expected_y = int((1 - math.asinh(math.tan(lat_r)) / math.pi) / 2 * n)
+    assert tile_of(lat, lon, 12) == (expected_x, expected_y)
+
+
+def add_fixes(session, points, acc=10):
+    # a minute apart, after whatever is already there
+    t = pendulum.datetime(2026, 7, 1, tz="UTC").add(
+        minutes=len(session.exec(select(OwnTracksLocation)).all())
+    )
+    for i, (lat, lon) in enumerate(points):
+        session.add(
+            OwnTracksLocation(
+                tst=t.add(minutes=i),
+                lat=lat,
+                lon=lon,
+                acc=acc,
+                username="u",
+                device="d",
+            )
+        )
+    session.commit()
+
+
+def test_every_fix_lands_once_at_every_zoom(db_session, tmp_path):
+    store = HeatmapStore(tmp_path, "fixes")
+    add_fixes(db_session, [SEATTLE] * 3 + [(40.7128, -74.0060)])
+    assert update(db_session, "fixes", store) == 4
+    for z in (0, 5, MAX_ZOOM):
+        tiles = {tile_of(*SEATTLE, z), tile_of(40.7128, -74.0060, z)}
+        assert sum(store.counts(z, *t).sum() for t in tiles) == 4
+
+
+def test_updates_only_fold_in_new_fixes(db_session, tmp_path):
+    store = HeatmapStore(tmp_path, "fixes")
+    add_fixes(db_session, [SEATTLE] * 2)
+    update(db_session, "fixes", store)
+    assert update(db_session, "fixes", store) == 0
+    add_fixes(db_session, [SEATTLE])
+    assert update(db_session, "fixes", store) == 1
+    assert store.counts(MAX_ZOOM, *tile_of(*SEATTLE, MAX_ZOOM)).sum() == 3
+
+
+def test_fixes_build_track_would_drop_are_left_out(db_session, tmp_path):
+    store = HeatmapStore(tmp_path, "fixes")
+    add_fixes(db_session, [SEATTLE], acc=3000)
+    assert update(db_session, "fixes", store) == 0
+    assert store.counts(0, 0, 0) is None
+
+
+def test_a_tile_draws_where_the_fixes_are(tmp_path):
+    store = HeatmapStore(tmp_path, "fixes")
+    store.add([SEATTLE[0]] * 50, [SEATTLE[1]] * 50)
+    z = 12
+    x, y = tile_of(*SEATTLE, z)
+    rgba = decode(store.tile_png(z, x, y))
+    assert rgba.shape == (TILE_SIZE, TILE_SIZE, 4)
+    assert rgba[..., 3].max() > 0
+    # mostly transparent: it is one spot
+    assert (rgba[..., 3] == 0).mean() > 0.99
+    assert store.tile_png(z, x + 3, y) == EMPTY_TILE
+
+
+def test_the_blur_reaches_across_a_tile_edge(tmp_path):
+    store = HeatmapStore(tmp_path, "fixes")
+    z = 10
+    # a point just inside the left edge of its tile
+    px, py = 300 * TILE_SIZE + 1.5, 400 * TILE_SIZE + 128.5
+    size = TILE_SIZE * 2**z
+    lon = px / size * 360 - 180
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * py / size))))
+    store.add([lat] * 100, [lon] * 100)
+    assert tile_of(lat, lon, z) == (300, 400)
+    left = decode(store.tile_png(z, 299, 400))
+    assert left[:, -1, 3].max() > 0
+    assert left[:, :-8, 3].max() == 0
+
+
+def test_new_fixes_redraw_the_tile(tmp_path):
+    store = HeatmapStore(tmp_path, "fixes")
+    z = 14
+    x, y = tile_of(*SEATTLE, z)
+    store.add([SEATTLE[0]], [SEATTLE[1]])
+    before = store.tile_png(z, x, y)
+    assert store.tile_png(z, x, y) == before  # from disk
+    store.add([SEATTLE[0]] * 500, [SEATTLE[1]] * 500)
+    assert store.tile_png(z, x, y) != before
+
+
+def test_the_stays_layer_is_weighted_by_time_and_follows_the_visits(
+    db_session, tmp_path
+):
+    store = HeatmapStore(tmp_path, "stays")
+    home = OwnTracksPlace(lat=SEATTLE[0], lon=SEATTLE[1], created_at=pendulum.now())
+    db_session.add(home)
+    db_session.commit()
+    t = pendulum.datetime(2026, 7, 1, 20, tz="UTC")
+    for minutes in (600.0, 30.0):
+        db_session.add(
+            OwnTracksPlaceVisit(
+                place_id=home.id,
+                diary_date=t.date(),
+                t_start=t,
+                t_end=t.add(minutes=minutes),
+                minutes=minutes,
+            )
+        )
+    db_session.commit()
+
+    assert update(db_session, "stays", store) == 1
+    assert store.counts(0, 0, 0).sum() == pytest.approx(630.0)
+    assert update(db_session, "stays", store) == 0
+
+    visit = db_session.get(OwnTracksPlaceVisit, 2)
+    db_session.delete(visit)
+    db_session.commit()
+    assert update(db_session, "stays", store) == 1
+    assert store.counts(0, 0, 0).sum() == pytest.approx(600.0)
+
+
+def test_the_stays_layer_folds_in_only_what_changed(db_session, tmp_path, monkeypatch):
+    store = HeatmapStore(tmp_path, "stays")
+    home = OwnTracksPlace(lat=SEATTLE[0], lon=SEATTLE[1], created_at=pendulum.now())
+    cafe = OwnTracksPlace(lat=45.5152, lon=-122.6784, created_at=pendulum.now())
+    db_session.add_all([home, cafe])
+    db_session.commit()
+    t = pendulum.datetime(2026, 7, 1, 20, tz="UTC")
+
+    def visit(place, minutes):
+        db_session.add(
+            OwnTracksPlaceVisit(
+                place_id=place.id,
+                diary_date=t.date(),
+                t_start=t,
+                t_end=t.add(minutes=minutes),
+                minutes=minutes,
+            )
+        )
+        db_session.commit()
+
+    visit(home, 600.0)
+    visit(cafe, 45.0)
+    assert update(db_session, "stays", store) == 2
+    z = 12
+    x, y = tile_of(*SEATTLE, z)
+    home_tile = store.tile_png(z, x, y)
+
+    # today's visits re-recorded: only the cafe's time changed
+    def visits_to(place):
+        query = select(OwnTracksPlaceVisit).where(
+            OwnTracksPlaceVisit.place_id == place.id
+        )
+        return db_session.exec(query).all()
+
+    monkeypatch.setattr(store, "clear", lambda: pytest.fail("the layer was cleared"))
+    db_session.delete(visits_to(cafe)[0])
+    db_session.commit()
+    visit(cafe, 90.0)
+    assert update(db_session, "stays", store) == 1
+    assert store.counts(0, 0, 0).sum() == pytest.approx(690.0)
+    assert store._tile_path(z, x, y).read_bytes() == home_tile  # kept
+
+    # the cafe's last visit gone: nothing of it is left
+    db_session.delete(visits_to(cafe)[0])
+    db_session.commit()
+    assert update(db_session, "stays", store) == 1
+    assert store.counts(z, *tile_of(45.5152, -122.6784, z)) is None
+    assert store.counts(0, 0, 0).sum() == pytest.approx(600.0)
+
+
+def test_a_tile_rendered_during_a_fold_in_is_not_kept(tmp_path, monkeypatch):
+    store = HeatmapStore(tmp_path, "fixes")
+    z = 10
+    x, y = tile_of(*SEATTLE, z)
+    store.add([SEATTLE[0]], [SEATTLE[1]])
+    render = store._render
+
+    def render_while_adding(*args):
+        data = render(*args)
+        store.add([SEATTLE[0]] * 100, [SEATTLE[1]] * 100)
+        return data
+
+    monkeypatch.setattr(store, "_render", render_while_adding)
+    stale = store.tile_png(z, x, y)
+    monkeypatch.setattr(store, "_render", render)
+    assert not store._tile_path(z, x, y).exists()
+    assert store.tile_png(z, x, y) != stale
+
+
+def test_the_route_serves_tiles(tmp_path, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    from mydiary.api import app
+
+    monkeypatch.setenv("MYDIARY_CACHE_DIR", str(tmp_path))
+    owntracks_heatmap.get_store("fixes").add([SEATTLE[0]] * 10, [SEATTLE[1]] * 10)
+    client = TestClient(app)
+    x, y = tile_of(*SEATTLE, 9)
+    response = client.get(f"/owntracks/heatmap/fixes/9/{x}/{y}.png")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/png"
+    assert decode(response.content)[..., 3].max() > 0
+    assert client.get("/owntracks/heatmap/nope/9/0/0.png").status_code == 404
+    assert client.get("/owntracks/heatmap/fixes/9/512/0.png").status_code == 404
+    assert client.get("/owntracks/heatmap/fixes/30/0/0.png").status_code == 404
@@ -0,0 +1,161 @@
+import random
+
+import pendulum
+import pytest
+from sqlmodel import Session, select
+
+from mydiary import owntracks_incremental
+from mydiary.models import OwnTracksLocation, OwnTracksStayState
+from mydiary.owntracks_cache import processed_day
+from mydiary.owntracks_incremental import IncrementalTrack, update_day
+from mydiary.owntracks_track import TrackParams, build_track
+
+from .helpers import PARAM_SETS, TZ, load_fixture, synthetic_day
+
+
+def fold_in_chunks(points, params, seed, roundtrip=False):
+    """Fold points a random handful at a time, checking the track after each."""
+    rng = random.Random(seed)
+    state = IncrementalTrack(params)
+    i = 0
+    while i < len(points):
+        n = rng.choice([1, 1, 2, 3, 7, 20])
+        # a chunk boundary must not split fixes sharing a timestamp: the sync
+        # only ever brings fixes later than the last one it saw
+        while i + n < len(points) and points[i + n].tst == points[i + n - 1].tst:
+            n += 1
+        state.fold(points[i : i + n])
+        i += n
+        if roundtrip:
+            state = IncrementalTrack.from_json(state.to_json(), params, TZ)
+        expected = build_track(points[:i], params)
+        actual = state.track()
+        assert actual == expected, f"after {i} fixes"
+        assert actual.content_hash(params) == expected.content_hash(params)
+    return state
+
+
+@pytest.mark.parametrize("params", PARAM_SETS)
+@pytest.mark.parametrize("seed", range(6))
+def test_folding_matches_a_full_rebuild_after_every_batch(seed, params):
+    fold_in_chunks(synthetic_day(seed, n=250), params, seed)
+
+
+@pytest.mark.parametrize("params", PARAM_SETS)
+@pytest.mark.parametrize(
+    "name", ["owntracks_2026-07-01.json", "owntracks_2026-06-27.json"]
+)
+def test_folding_matches_a_full_rebuild_on_real_days(rootdir, name, params):
+    fold_in_chunks(load_fixture(rootdir, name), params, 0)
+
+
+def test_the_stored_state_resumes_exactly():
+    fold_in_chunks(synthetic_day(3, n=250), TrackParams(), 3, roundtrip=True)
+
+
+def test_folding_one_timestamp_at_a_time_across_a_dst_change():
+    from itertools import groupby
+
+    start = pendulum.datetime(2026, 3, 8, 0, 0, tz=TZ)
+    points = synthetic_day(99, n=200, start=start)
+    state = IncrementalTrack(TrackParams())
+    for _, same_tst in groupby(points, key=lambda p: p.tst):
+        state.fold(list(same_tst))
+    assert state.track() == build_track(points, TrackParams())
+
+
+def test_a_fix_older_than_the_last_one_folded_is_refused():
+    points = synthetic_day(1, n=20)
+    state = IncrementalTrack(TrackParams())
+    state.fold(points[10:])
+    with pytest.raises(ValueError):
+        state.fold(points[:10])
+
+
+DAY = pendulum.datetime(2026, 7, 1, tz=TZ)
+
+
+def add_fixes(session: Session, points):
+    for p in points:
+        session.add(
+            OwnTracksLocation(
+                tst=p.tst.in_timezone("UTC"),
+                lat=p.lat,
+                lon=p.lon,
+                acc=p.acc,
+                username="u",
+                device="d",
+            )
+        )
+    session.commit()
+
+
+@pytest.fixture
+def day_points():
+    # no repeats: each fix is its own row under the unique constraint
+    points = synthetic_day(5, n=120, start=DAY.add(minutes=5))
+    seen = set()
+    out = []
+    for p in points:
+        if p.tst in seen or p.tst.date() != DAY.date():
+            continue
+        seen.add(p.tst)
+        out.append(p)
+    return out
+
+
+def test_update_day_folds_only_the_new_fixes(db_session, day_points, monkeypatch):
+    params = TrackParams()
+    add_fixes(db_session, day_points[:40])
+    assert update_day(DAY, db_session, params) == build_track(day_points[:40], params)
+
+    folded = []
+    real_fold = IncrementalTrack.fold
+    monkeypatch.setattr(
+        IncrementalTrack,
+        "fold",
+        lambda self, points: folded.append(len(points)) or real_fold(self, points),
+    )
+    add_fixes(db_session, day_points[40:])
+    track = update_day(DAY, db_session, params)
+    assert folded == [len(day_points) - 40]
+    assert track == build_track(day_points, params)
+
+    row = db_session.exec(select(OwnTracksStayState)).one()
+    assert row.num_fixes == len(day_points)
+
+
+def test_a_late_fix_in_the_middle_rebuilds_the_day(db_session, day_points):
+    params = TrackParams()
+    late = day_points.pop(30)
+    add_fixes(db_session, day_points)
+    update_day(DAY, db_session, params)
+    add_fixes(db_session, [late])
+    day_points.insert(30, late)
+    assert update_day(DAY, db_session, params) == build_track(day_points, params)
+
+
+def test_a_state_from_another_version_is_not_trusted(
+    db_session, day_points, monkeypatch
+):
+    params = TrackParams()
+    add_fixes(db_session, day_points)
+    update_day(DAY, db_session, params)
+    monkeypatch.setattr(owntracks_incremental, "STATE_VERSION", 99)
+    monkeypatch.setattr(
+        IncrementalTrack,
+        "from_json",
+        classmethod(lambda cls, *a: pytest.fail("read a stale state")),
+    )
+    assert update_day(DAY, db_session, params) == build_track(day_points, params)
+
+
+def test_the_cache_uses_the_days_stored_state(db_session, day_points):
+    add_fixes(db_session, day_points[:50])
+    processed_day(DAY, db_session, incremental=True)
+    add_fixes(db_session, day_points[50:])
+    track, _ = processed_day(DAY, db_session)  # has a state, so folds
+    assert track == build_track(day_points, TrackParams())
+    assert db_session.exec(select(OwnTracksStayState)).one().num_fixes == len(
+        day_points
+    )
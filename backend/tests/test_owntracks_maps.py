@@ -7,10 +7,11 @@ import pytest
 from PIL import Image
 from sqlmodel import Session, select
 
-from mydiary import owntracks_maps
+from mydiary import map_render, owntracks_maps
+from mydiary.map_cache import get_map_cache
 from mydiary.map_render import RenderParams
 from mydiary.markdown_edits import MarkdownDoc
-from mydiary.models import JoplinNote, OwnTracksDayMap, OwnTracksLocation
+from mydiary.models import OwnTracksDayMap, OwnTracksLocation
 from mydiary.owntracks_maps import (
     panels_for_track,
     render_for_day,
@@ -18,91 +19,11 @@ from mydiary.owntracks_maps import (
     sync_day_map_to_note,
 )
 
+from .helpers import NOTE_BODY, FakeJoplin, FakeTileDownloader
+
 TZ = "America/New_York"
 DAY = "2026-07-01"
 
-NOTE_BODY = """# Tuesday, July 1, 2026
-
-timezone: America/New_York
-
-## Words
-
-Something handwritten that must survive.
-
-## Images
-
-![](:/aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa)
-
-## Google Calendar events
-
-None
-
-## Spotify tracks
-
-None
-"""
-
-
-class FakeResponse:
-    def __init__(self, payload):
-        self._payload = payload
-
-    def json(self):
-        return self._payload
-
-    def raise_for_status(self):
-        pass
-
-
-class FakeJoplin:
-    """Stands in for MyDiaryJoplin so tests never touch the real diary."""
-
-    def __init__(self, body=NOTE_BODY, note_id="note-1"):
-        self.note = JoplinNote(id=note_id, title=DAY, body=body)
-        self.resources = {}
-        self.deleted = []
-        self.update_count = 0
-        self.exts = []
-
-    def get_note_id_by_date(self, dt):
-        return self.note.id
-
-    def get_note(self, id, fields=None):
-        return self.note
-
-    def create_resource(self, data, title=None, ext="jpg"):
-        import hashlib
-
-        resource_id = hashlib.md5(data).hexdigest()
-        self.resources[resource_id] = title
-        self.exts.append(ext)
-        return FakeResponse({"id": resource_id})
-
-    def resource_exists(self, resource_id):
-        return resource_id in self.resources
-
-    def delete_resource(self, resource_id, force=False):
-        self.deleted.append(resource_id)
-        self.resources.pop(resource_id, None)
-
-    def update_note_body(self, note_id, new_body):
-        self.note.body = new_body
-        self.update_count += 1
-        return FakeResponse({"id": note_id})
-
-
-class FakeTileDownloader:
-    def __init__(self):
-        buf = io.BytesIO()
-        Image.new("RGBA", (512, 512), (235, 235, 233, 255)).save(buf, format="PNG")
-        self.tile = buf.getvalue()
-
-    def set_user_agent(self, user_agent):
-        pass
-
-    def get(self, provider, cache_dir, zoom, x, y):
-        return self.tile
-
 
 @pytest.fixture(autouse=True)
 def tmp_cache_dir(tmp_path, monkeypatch):
@@ -112,14 +33,20 @@ def tmp_cache_dir(tmp_path, monkeypatch):
 @pytest.fixture(autouse=True)
 def offline_tiles(monkeypatch):
     """Render without the network."""
-    real_render = owntracks_maps.render_day_map
-
-    def _render(track, params=None, render=None, tile_downloader=None, frame=None):
-        return real_render(
-            track, params, render, tile_downloader=FakeTileDownloader(), frame=frame
+    real_render_panels = owntracks_maps.render_panels
+
+    def _render_panels(
+        panels, params=None, render=None, tile_downloader=None, missing=None
+    ):
+        return real_render_panels(
+            panels,
+            params,
+            render,
+            tile_downloader=FakeTileDownloader(),
+            missing=missing,
         )
 
-    monkeypatch.setattr(owntracks_maps, "render_day_map", _render)
+    monkeypatch.setattr(owntracks_maps, "render_panels", _render_panels)
 
 
 @pytest.fixture
@@ -232,12 +159,14 @@ def test_force_replaces_the_resource_and_deletes_the_old_one(
     first_id = next(iter(joplin.resources))
 
     # a different render produces different bytes, hence a different resource
-    real_render = owntracks_maps.render_day_map
+    real_render_panels = owntracks_maps.render_panels
 
-    def _bigger(track, params=None, render=None, tile_downloader=None, frame=None):
-        return real_render(track, params, RenderParams(width=640, height=480))
+    def _bigger(panels, params=None, render=None, tile_downloader=None, missing=None):
+        return real_render_panels(
+            panels, params, RenderParams(width=640, height=480), missing=missing
+        )
 
-    monkeypatch.setattr(owntracks_maps, "render_day_map", _bigger)
+    monkeypatch.setattr(owntracks_maps, "render_panels", _bigger)
     result, _ = sync_day_map_to_note(
         dt, session=db_with_locations, mydiary_joplin=joplin, force=True
     )
@@ -416,18 +345,20 @@ def test_a_day_that_gains_areas_reuses_its_overview_resource(
 ):
     # what an already-synced flight day looks like when this lands: it has a
     # panel-0 row already, and only the two area panels are new work
-    import mydiary.owntracks_maps as om
+    import mydiary.owntracks_cache as oc
 
     joplin = FakeJoplin()
-    original = om.split_into_areas
-    monkeypatch.setattr(om, "split_into_areas", lambda track, threshold_m=0: [])
+    original = oc.split_into_areas
+    monkeypatch.setattr(oc, "split_into_areas", lambda track, threshold_m=0: [])
     sync_day_map_to_note(dt_two_areas, session=db_two_areas, mydiary_joplin=joplin)
     assert len(joplin.resources) == 1
     overview_id = next(iter(joplin.resources))
 
     # restore by setattr rather than undo(), which would also roll back the
-    # autouse fixture's MYDIARY_CACHE_DIR and send tile writes at the real cache
-    monkeypatch.setattr(om, "split_into_areas", original)
+    # autouse fixture's MYDIARY_CACHE_DIR and send tile writes at the real cache.
+    # the area split landing is a pipeline change, so it bumps CACHE_VERSION
+    monkeypatch.setattr(oc, "split_into_areas", original)
+    monkeypatch.setattr(oc, "CACHE_VERSION", oc.CACHE_VERSION + 1)
     result, num_maps = sync_day_map_to_note(
         dt_two_areas, session=db_two_areas, mydiary_joplin=joplin
     )
@@ -505,3 +436,89 @@ def test_the_panel_key_covers_how_it_is_framed():
 
     assert _area_key(0, on_the_stay) != _area_key(0, on_the_contents)
     assert _area_key(0, on_the_stay) != _area_key(1, on_the_stay)
+
+
+@pytest.fixture
+def render_calls(monkeypatch):
+    calls = []
+    real_render_panels = owntracks_maps.render_panels
+
+    def _render_panels(
+        panels, params=None, render=None, tile_downloader=None, missing=None
+    ):
+        calls.append(len(panels))
+        return real_render_panels(panels, params, render, missing=missing)
+
+    monkeypatch.setattr(owntracks_maps, "render_panels", _render_panels)
+    return calls
+
+
+def test_a_rendered_map_is_served_from_the_map_cache(
+    db_two_areas, dt_two_areas, render_calls
+):
+    overview, _, content_hash = render_for_day(dt_two_areas, db_two_areas)
+    assert render_calls == [3]  # every panel of the day, in one pass
+    assert get_map_cache().get(content_hash) == overview
+    again, _, _ = render_for_day(dt_two_areas, db_two_areas)
+    area, _, _ = render_for_day(dt_two_areas, db_two_areas, panel=2)
+    assert again == overview and area != overview
+    assert render_calls == [3]
+
+
+def test_a_lost_resource_is_reuploaded_without_rendering(
+    db_with_locations, dt, render_calls
+):
+    joplin = FakeJoplin()
+    sync_day_map_to_note(dt, session=db_with_locations, mydiary_joplin=joplin)
+    assert render_calls == [1]
+    lost = next(iter(joplin.resources))
+    joplin.resources.clear()  # deleted in Joplin, say
+
+    result, _ = sync_day_map_to_note(
+        dt, session=db_with_locations, mydiary_joplin=joplin
+    )
+    assert result == "updated"
+    assert list(joplin.resources) == [lost]  # the same bytes, uploaded again
+    assert render_calls == [1]
+
+    sync_day_map_to_note(
+        dt, session=db_with_locations, mydiary_joplin=joplin, force=True
+    )
+    assert render_calls == [1, 1]
+
+
+
+class FlakyTileDownloader:
+    """A flat tile everywhere, but the first one asked for fails."""
+
+    def __init__(self):
+        buf = io.BytesIO()
+        Image.new("RGBA", (512, 512), (235, 235, 233, 255)).save(buf, format="PNG")
+        self.tile = buf.getvalue()
+        self.flaky = True
+
+    def set_user_agent(self, user_agent):
+        pass
+
+    def get(self, provider, cache_dir, zoom, x, y):
+        if self.flaky:
+            self.flaky = False
+            raise OSError("connection reset")
+        return self.tile
+
+
+def test_a_map_missing_tiles_is_not_cached(db_with_locations, dt, monkeypatch):
+    downloader = FlakyTileDownloader()
+
+    def _render_panels(
+        panels, params=None, render=None, tile_downloader=None, missing=None
+    ):
+        return map_render.render_panels(panels, params, render, downloader, missing)
+
+    monkeypatch.setattr(owntracks_maps, "render_panels", _render_panels)
+    _, _, content_hash = render_for_day(dt, db_with_locations)
+    assert get_map_cache().get(content_hash) is None
+
+    # the next request renders it again, and that one is whole
+    whole, _, _ = render_for_day(dt, db_with_locations)
+    assert get_map_cache().get(content_hash) == whole
@@ -0,0 +1,184 @@
+import random
+
+import pendulum
+from sqlmodel import select
+
+from mydiary.models import OwnTracksPlace, OwnTracksPlaceVisit
+from mydiary.owntracks_maps import Panel, section_content
+from mydiary.owntracks_places import (
+    PLACE_RADIUS_M,
+    PlaceIndex,
+    load_index,
+    minutes_at,
+    record_stays,
+    where_label,
+)
+from mydiary.owntracks_track import DayTrack, Stay, haversine_m
+
+TZ = "America/New_York"
+HOME = (47.6101, -122.3301)
+GYM = (47.6203, -122.3120)
+
+
+def stay(lat, lon, start, hours=2):
+    return Stay(lat, lon, start, start.add(hours=hours), 3)
+
+
+def day(d):
+    return pendulum.datetime(2026, 7, d, 8, tz=TZ)
+
+
+def test_resolve_finds_the_nearest_place_within_the_radius():
+    rng = random.Random(0)
+    places = [
+        OwnTracksPlace(
+            id=i,
+            lat=HOME[0] + rng.uniform(-0.05, 0.05),
+            lon=HOME[1] + rng.uniform(-0.05, 0.05),
+        )
+        for i in range(1, 400)
+    ]
+    index = PlaceIndex(places)
+    for _ in range(500):
+        lat = HOME[0] + rng.uniform(-0.05, 0.05)
+        lon = HOME[1] + rng.uniform(-0.05, 0.05)
+        in_reach = [
+            (haversine_m(lat, lon, p.lat, p.lon), p.id)
+            for p in places
+            if haversine_m(lat, lon, p.lat, p.lon) <= PLACE_RADIUS_M
+        ]
+        expected = min(in_reach)[1] if in_reach else None
+        found = index.resolve(lat, lon)
+        assert (found.id if found else None) == expected
+
+
+def test_stays_at_the_same_place_on_different_days_share_it(db_session):
+    record_stays(
+        day(1).date(),
+        [stay(*HOME, day(1)), stay(*GYM, day(1).add(hours=3))],
+        db_session,
+    )
+    places = record_stays(
+        day(2).date(), [stay(HOME[0] + 0.0004, HOME[1], day(2))], db_session
+    )
+    assert len(db_session.exec(select(OwnTracksPlace)).all()) == 2
+    # the place stays where it was first seen
+    assert (places[0].lat, places[0].lon) == HOME
+    assert minutes_at(places[0].id, db_session) == 240
+
+
+def test_recording_a_day_again_replaces_its_visits(db_session):
+    record_stays(day(1).date(), [stay(*HOME, day(1))], db_session)
+    # today, an hour later: the stay is longer now
+    [home] = record_stays(day(1).date(), [stay(*HOME, day(1), hours=3)], db_session)
+    assert len(db_session.exec(select(OwnTracksPlaceVisit)).all()) == 1
+    assert minutes_at(home.id, db_session) == 180
+    assert minutes_at(home.id, db_session, start=day(2).date()) == 0
+
+
+def test_recording_a_day_with_no_stays_clears_its_visits(db_session):
+    [home] = record_stays(day(1).date(), [stay(*HOME, day(1))], db_session)
+    # the day's fixes were reprocessed, and the stay was not one after all
+    assert record_stays(day(1).date(), [], db_session) == []
+    assert db_session.exec(select(OwnTracksPlaceVisit)).all() == []
+    assert minutes_at(home.id, db_session) == 0
+
+
+def test_the_itinerary_names_named_places_only(db_session):
+    home_stay = stay(*HOME, day(1))
+    gym_stay = stay(*GYM, day(1).add(hours=3))
+    home, _ = record_stays(day(1).date(), [home_stay, gym_stay], db_session)
+    home.name = "Home"
+    db_session.add(home)
+    db_session.commit()
+
+    places = load_index(db_session)
+    assert where_label(home_stay, places) == "Home"
+    assert where_label(gym_stay, places) == f"{GYM[0]:.5f}, {GYM[1]:.5f}"
+    assert where_label(home_stay) == f"{HOME[0]:.5f}, {HOME[1]:.5f}"
+
+    track = DayTrack(stays=[home_stay, gym_stay])
+    content = section_content([None], [Panel("overview", "", track, None, "")], places)
+    assert "| Home" in content
+
+
+def test_the_sync_counts_late_fixes_into_an_earlier_days_visits(
+    db_session, tmp_path, monkeypatch
+):
+    from mydiary.api import sync_owntracks
+    from mydiary.owntracks_connector import MyDiaryOwnTracks
+
+    monkeypatch.setenv("MYDIARY_CACHE_DIR", str(tmp_path))
+    evening = pendulum.yesterday(tz="local").add(hours=20)
+    owntracks = MyDiaryOwnTracks()
+
+    def upload(start, minutes):
+        items = [
+            {
+                "_type": "location",
+                "tst": start.add(minutes=m).int_timestamp,
+                "lat": HOME[0],
+                "lon": HOME[1],
+                "acc": 10,
+                "username": "u",
+                "device": "d",
+            }
+            for m in range(0, minutes, 5)
+        ]
+        monkeypatch.setattr(
+            owntracks, "fetch_locations_all_devices", lambda start, end: items
+        )
+        sync_owntracks(db_session, owntracks)
+
+    # the last run of the day, at 23:25
+    upload(evening, 205)
+    [visit] = db_session.exec(select(OwnTracksPlaceVisit)).all()
+    before = minutes_at(visit.place_id, db_session)
+    # the rest of the evening arrives after midnight
+    upload(evening.add(minutes=205), 30)
+    assert minutes_at(visit.place_id, db_session) > before
+    assert len(db_session.exec(select(OwnTracksPlaceVisit)).all()) == 1
+
+
+def test_a_failing_step_does_not_stop_the_rest_of_the_sync(
+    db_session, tmp_path, monkeypatch
+):
+    from mydiary import owntracks_daypoints, owntracks_heatmap
+    from mydiary.api import sync_owntracks
+    from mydiary.owntracks_connector import MyDiaryOwnTracks
+
+    monkeypatch.setenv("MYDIARY_CACHE_DIR", str(tmp_path))
+    evening = pendulum.yesterday(tz="local").add(hours=20)
+    items = [
+        {
+            "_type": "location",
+            "tst": evening.add(minutes=m).int_timestamp,
+            "lat": HOME[0],
+            "lon": HOME[1],
+            "acc": 10,
+            "username": "u",
+            "device": "d",
+        }
+        for m in range(0, 60, 5)
+    ]
+    owntracks = MyDiaryOwnTracks()
+    monkeypatch.setattr(
+        owntracks, "fetch_locations_all_devices", lambda start, end: items
+    )
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+
+    updated = []
+
+    def update(session, mode):
+        updated.append(mode)
+        if mode == "fixes":
+            raise OSError("disk full")
+
+    monkeypatch.setattr(owntracks_daypoints, "day_columns", fail)
+    monkeypatch.setattr(owntracks_heatmap, "update", update)
+    assert sync_owntracks(db_session, owntracks) == len(items)
+    # yesterday's visit was still recorded, and both heatmaps were tried
+    assert len(db_session.exec(select(OwnTracksPlaceVisit)).all()) == 1
+    assert updated == list(owntracks_heatmap.MODES)
@@ -0,0 +1,142 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from pathlib import Path
+
+import pendulum
+import pytest
+from sqlmodel import Session, select
+
+from mydiary import owntracks_range
+from mydiary.core import get_last_timezone
+from mydiary.models import OwnTracksLocation, OwnTracksTrackCache, TimeZoneChange
+from mydiary.owntracks_cache import processed_day
+from mydiary.owntracks_connector import MyDiaryOwnTracks
+from mydiary.owntracks_range import (
+    day_timezones,
+    days_of,
+    fix_rows_by_day,
+    range_tracks,
+)
+from mydiary.owntracks_track import TrackParams
+
+TZ = "America/New_York"
+DAYS = ("2026-06-27", "2026-07-01")
+
+
+@pytest.fixture
+def db_with_days(rootdir: str, db_session: Session):
+    seen = set()
+    for day in DAYS:
+        path = Path(rootdir).joinpath("owntracks_data", f"owntracks_{day}.json")
+        for x in json.loads(path.read_text()):
+            key = (x["username"], x["device"], x["tst"])
+            if key in seen:
+                continue
+            seen.add(key)
+            db_session.add(
+                OwnTracksLocation(
+                    tst=pendulum.from_timestamp(x["tst"], tz="UTC"),
+                    lat=x["lat"],
+                    lon=x["lon"],
+                    acc=x.get("acc"),
+                    username=x["username"],
+                    device=x["device"],
+                )
+            )
+    db_session.add(
+        TimeZoneChange(
+            changed_at=pendulum.datetime(2026, 6, 29, 15, tz="UTC"),
+            tz_before="America/Los_Angeles",
+            tz_after=TZ,
+        )
+    )
+    db_session.commit()
+    return db_session
+
+
+def test_timezones_are_inferred_as_one_day_at_a_time(db_session):
+    for changed_at, before, after in [
+        (pendulum.datetime(2024, 3, 10, 7, tz="UTC"), TZ, "Europe/Paris"),
+        (pendulum.datetime(2024, 3, 20, tz="UTC"), "Europe/Paris", "Asia/Tokyo"),
+    ]:
+        db_session.add(
+            TimeZoneChange(changed_at=changed_at, tz_before=before, tz_after=after)
+        )
+    db_session.commit()
+    days = list(pendulum.interval(date(2024, 3, 1), date(2024, 3, 31)).range("days"))
+    timezones = day_timezones(days, db_session)
+    for d in days:
+        assert timezones[d] == get_last_timezone(d.isoformat(), db_session), d
+
+
+def test_without_any_change_the_zone_is_local(db_session):
+    assert day_timezones([date(2026, 7, 1)], db_session) == {date(2026, 7, 1): "local"}
+
+
+def test_the_days_of_some_fixes_are_local_days(db_with_days):
+    fixes = [
+        pendulum.datetime(2026, 7, 2, 3, tz="UTC"),  # the evening before, in TZ
+        datetime(2026, 7, 2, 14),  # naive, as stored
+        pendulum.datetime(2026, 7, 2, 15, tz="UTC"),
+    ]
+    assert days_of(fixes, db_with_days) == [
+        pendulum.parse("2026-07-01", tz=TZ),
+        pendulum.parse("2026-07-02", tz=TZ),
+    ]
+    assert days_of([], db_with_days) == []
+
+
+def test_one_scan_cuts_the_days_as_the_per_day_queries_do(db_with_days):
+    ot = MyDiaryOwnTracks()
+    starts = [
+        pendulum.parse(d, tz=tz)
+        for d in ("2026-06-26", "2026-06-27", "2026-06-28", "2026-07-01")
+        for tz in (TZ, "Asia/Tokyo")
+    ]
+    for dt, (rows, version) in zip(starts, fix_rows_by_day(starts, db_with_days)):
+        expected = ot.get_fix_rows_for_day(dt, session=db_with_days)
+        assert rows == [tuple(r) for r in expected]
+        assert version == ot.get_fixes_version_for_day(dt, session=db_with_days)
+
+
+def test_the_range_is_every_day_as_processed_day_gives_it(db_with_days):
+    with ThreadPoolExecutor(2) as executor:
+        days = list(
+            range_tracks(
+                date(2026, 6, 26), date(2026, 7, 2), db_with_days, executor=executor
+            )
+        )
+    assert [dt.day for dt, _, _ in days] == [26, 27, 28, 29, 30, 1, 2]
+    assert days[1][0].timezone_name == "America/Los_Angeles"
+    assert days[5][0].timezone_name == TZ
+    # rebuilt one at a time, not read back from what the range stored
+    for row in db_with_days.exec(select(OwnTracksTrackCache)):
+        db_with_days.delete(row)
+    db_with_days.commit()
+    for dt, track, areas in days:
+        assert (track, areas) == processed_day(dt, db_with_days)
+    assert days[5][1].stays
+
+
+def test_a_second_range_comes_from_the_cache(db_with_days, monkeypatch):
+    params = TrackParams(stay_minutes=10)
+    first = list(
+        range_tracks(date(2026, 6, 27), date(2026, 7, 1), db_with_days, params, tz=TZ)
+    )
+
+    def fail(*args):
+        raise AssertionError("rebuilt a cached day")
+
+    monkeypatch.setattr(owntracks_range, "build_day", fail)
+    again = list(
+        range_tracks(date(2026, 6, 27), date(2026, 7, 1), db_with_days, params, tz=TZ)
+    )
+    assert again == first
+
+
+def test_an_overlong_range_is_refused(db_session):
+    with pytest.raises(ValueError):
+        next(range_tracks(date(2025, 1, 1), date(2026, 1, 2), db_session))
+    with pytest.raises(ValueError):
+        next(range_tracks(date(2026, 1, 2), date(2026, 1, 1), db_session))
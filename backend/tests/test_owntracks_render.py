@@ -1,13 +1,18 @@
 import io
 import json
+import random
 from pathlib import Path
 
 import pendulum
 import pytest
-from PIL import Image
+import s2sphere
+import staticmaps
+from PIL import Image, ImageChops, ImageStat
 
 from mydiary import map_render
 from mydiary.map_render import FOOTER_HEIGHT, RenderParams, render_day_map, stay_radius
+from mydiary.map_render import MAX_ENCODES, encode_map, render_panels, tiles_for_map
+from mydiary.owntracks_maps import panels_for_track
 from mydiary.owntracks_track import TrackPoint, build_track
 
 TZ = "America/New_York"
@@ -89,7 +94,7 @@ def test_render_params_describe_their_encoding():
 def test_render_params_reject_an_unknown_format():
     # the API takes fmt as a query parameter, so this is a 400, not a 500
     with pytest.raises(ValueError):
-        RenderParams(fmt="tiff").media_type
+        RenderParams(fmt="tiff").validate()
 
 
 def test_render_fetches_both_basemap_and_label_tiles(july1_track, downloader):
@@ -167,3 +172,258 @@ def test_retina_provider_declares_512px_tiles():
     url = map_render.BASEMAP_PROVIDER.url(3, 1, 2)
     assert "@2x" in url
     assert url.startswith("https://")
+
+
+
+class PatternTileDownloader(FakeTileDownloader):
+    """A different tile at every z/x/y, with detail inside it, so a region
+    cropped from the wrong place shows."""
+
+    def get(self, provider, cache_dir, zoom, x, y):
+        self.requested.append((provider.name(), zoom, x, y))
+        tile = Image.linear_gradient("L").resize((512, 512)).convert("RGBA")
+        alpha = 255 if "nolabels" in provider.name() else 96
+        color = (x * 37 % 256, y * 59 % 256, zoom * 13 % 256, alpha)
+        tile.paste(color, (64, 64, 200, 300))
+        buf = io.BytesIO()
+        tile.save(buf, format="PNG")
+        return buf.getvalue()
+
+
+def test_render_panels_matches_rendering_each_panel(july1_track):
+    panels = [
+        (p.track, p.frame)
+        for p in panels_for_track(july1_track, area_threshold_m=500)
+    ]
+    assert len(panels) == 3
+    render = RenderParams(width=400, height=300)
+    one_by_one = [
+        render_day_map(
+            track, render=render, frame=frame, tile_downloader=PatternTileDownloader()
+        )
+        for track, frame in panels
+    ]
+    map_render.get_tile_cache().clear()
+    shared = PatternTileDownloader()
+    assert render_panels(panels, render=render, tile_downloader=shared) == one_by_one
+
+    # the two area panels are at one zoom, over mostly the same tiles
+    needed = [tiles_for_map(track, render, frame) for track, frame in panels]
+    assert needed[1][0] == needed[2][0]
+    assert len(shared.requested) == len(set(shared.requested))
+    assert len(shared.requested) < 2 * sum(len(tiles) for _, tiles in needed)
+
+
+def test_render_params_supersample_mode():
+    assert RenderParams().cache_key() == RenderParams(supersample="full").cache_key()
+    # the default is left out of the key, so maps hashed before it still match
+    assert "supersample" not in RenderParams().cache_key()
+    assert "supersample=overlay" in RenderParams(supersample="overlay").cache_key()
+    with pytest.raises(ValueError):
+        RenderParams(supersample="half").validate()
+
+
+def _pixels_apart(a: bytes, b: bytes, threshold: int = 16):
+    """Mean difference (of 255), and the fraction of pixels more than
+    threshold apart in any channel."""
+    a, b = (Image.open(io.BytesIO(data)).convert("RGB") for data in (a, b))
+    diff = ImageChops.difference(a, b)
+    num_pixels = diff.width * diff.height
+    mean = sum(ImageStat.Stat(diff).mean) / 3
+    worst = ImageChops.lighter(
+        ImageChops.lighter(*diff.split()[:2]), diff.split()[2]
+    ).histogram()
+    return mean, sum(worst[threshold + 1 :]) / num_pixels
+
+
+class SparseLabelsTileDownloader(PatternTileDownloader):
+    """PatternTileDownloader, but with labels that leave the map and the
+    track visible: a translucent box and a thin opaque bar on clear tiles."""
+
+    def get(self, provider, cache_dir, zoom, x, y):
+        if "nolabels" in provider.name():
+            return super().get(provider, cache_dir, zoom, x, y)
+        self.requested.append((provider.name(), zoom, x, y))
+        tile = Image.new("RGBA", (512, 512), (0, 0, 0, 0))
+        tile.paste((40, 40, 40, 160), (300, 100, 420, 130))
+        tile.paste((40, 40, 40, 255), (100, 400, 220, 403))
+        buf = io.BytesIO()
+        tile.save(buf, format="PNG")
+        return buf.getvalue()
+
+
+@pytest.mark.parametrize("cropped", [True, False])
+def test_overlay_supersampling_stays_within_a_pixel_budget(
+    july1_track, monkeypatch, cropped
+):
+    # nearly every map is cropped to its track (tiles pasted at 2x over the
+    # crop); one whose track fills the fitted zoom is the whole 2x map, which
+    # overlay mode composes from halved tiles at output size
+    if not cropped:
+        monkeypatch.setattr(map_render, "_crop_box", lambda *args: None)
+    panels = panels_for_track(july1_track, area_threshold_m=500)
+    assert len(panels) == 3
+    for p in panels:
+        full, overlay = (
+            render_day_map(
+                p.track,
+                render=RenderParams(width=600, height=450, fmt="PNG", supersample=mode),
+                frame=p.frame,
+                tile_downloader=SparseLabelsTileDownloader(),
+            )
+            for mode in ("full", "overlay")
+        )
+        assert Image.open(io.BytesIO(overlay)).size == (600, 450)
+        mean, over = _pixels_apart(full, overlay)
+        assert mean < 1.5, p.kind
+        assert over < 0.01, p.kind
+
+
+def test_a_cropped_overlay_render_composites_at_output_size(july1_track, monkeypatch):
+    # the crop is the normal case, and it has no whole-pixel scale: the layers
+    # still go down to output size before anything is composited onto them
+    panels = panels_for_track(july1_track, area_threshold_m=500)
+    render = RenderParams(width=600, height=450, supersample="overlay")
+    crops = []
+    real_crop_box = map_render._crop_box
+
+    def _crop_box(*args):
+        crops.append(real_crop_box(*args))
+        return crops[-1]
+
+    sizes = []
+    real_alpha_composite = Image.Image.alpha_composite
+
+    def alpha_composite(self, im, dest=(0, 0), source=(0, 0)):
+        sizes.append(self.size)
+        return real_alpha_composite(self, im, dest, source)
+
+    monkeypatch.setattr(map_render, "_crop_box", _crop_box)
+    monkeypatch.setattr(Image.Image, "alpha_composite", alpha_composite)
+    for p in panels:
+        render_day_map(
+            p.track,
+            render=render,
+            frame=p.frame,
+            tile_downloader=SparseLabelsTileDownloader(),
+        )
+    # one crop that has to be scaled, not just the ones already at output size
+    assert any(c[2] - c[0] > 600 for c in crops if c is not None)
+    assert sizes and set(sizes) == {(600, 450 - FOOTER_HEIGHT)}
+
+
+def test_render_panels_in_overlay_mode_matches_rendering_each_panel(july1_track):
+    panels = [
+        (p.track, p.frame)
+        for p in panels_for_track(july1_track, area_threshold_m=500)
+    ]
+    render = RenderParams(width=400, height=300, supersample="overlay")
+    one_by_one = [
+        render_day_map(
+            track, render=render, frame=frame, tile_downloader=PatternTileDownloader()
+        )
+        for track, frame in panels
+    ]
+    map_render.get_tile_cache().clear()
+    shared = PatternTileDownloader()
+    assert render_panels(panels, render=render, tile_downloader=shared) == one_by_one
+    assert len(shared.requested) == len(set(shared.requested))
+
+
+def test_render_params_byte_budget():
+    assert "max_bytes" not in RenderParams().cache_key()
+    assert "min_quality" not in RenderParams().cache_key()
+    key = RenderParams(max_bytes=100_000).cache_key()
+    assert "max_bytes=100000" in key and "min_quality=40" in key
+    assert key != RenderParams(max_bytes=100_000, resize_to_fit=True).cache_key()
+    for bad in (
+        RenderParams(max_bytes=0),
+        RenderParams(max_bytes=1000, min_quality=90),
+        RenderParams(max_bytes=1000, fmt="PNG"),
+    ):
+        with pytest.raises(ValueError):
+            bad.validate()
+    RenderParams(max_bytes=1000, fmt="PNG", resize_to_fit=True).validate()
+
+
+@pytest.fixture
+def busy_canvas(july1_track):
+    """A finished map canvas with detail everywhere, like a city day's."""
+    data = render_day_map(
+        july1_track,
+        render=RenderParams(width=600, height=450, fmt="PNG"),
+        tile_downloader=PatternTileDownloader(),
+    )
+    canvas = Image.open(io.BytesIO(data)).convert("RGB")
+    # the same noise every run, so the search lands the same way every run
+    grain = random.Random(0).randbytes(canvas.width * canvas.height)
+    noise = Image.frombytes("L", canvas.size, grain).convert("RGB")
+    return Image.blend(canvas, noise, 0.2)
+
+
+@pytest.mark.parametrize("fmt", ["JPEG", "WEBP"])
+def test_a_byte_budget_lowers_quality_until_the_map_fits(busy_canvas, fmt):
+    fixed, fixed_encoding = encode_map(busy_canvas, RenderParams(fmt=fmt))
+    assert fixed_encoding.num_encodes == 1
+    budget = len(fixed) * 2 // 3
+    render = RenderParams(fmt=fmt, max_bytes=budget)
+    data, encoding = encode_map(busy_canvas, render)
+    assert encoding.fits
+    assert len(data) <= budget
+    assert render.min_quality <= encoding.quality < render.quality
+    assert (encoding.width, encoding.height) == busy_canvas.size
+    assert encoding.num_encodes <= MAX_ENCODES
+    # the highest quality that fits, give or take the last bisection step
+    better = RenderParams(fmt=fmt, quality=encoding.quality + 2)
+    assert len(encode_map(busy_canvas, better)[0]) > budget
+    # the same canvas and budget give the same bytes
+    assert encode_map(busy_canvas, render)[0] == data
+
+
+def test_a_map_within_budget_is_encoded_once(busy_canvas):
+    fixed, _ = encode_map(busy_canvas, RenderParams())
+    data, encoding = encode_map(busy_canvas, RenderParams(max_bytes=len(fixed)))
+    assert data == fixed
+    assert (encoding.quality, encoding.num_encodes) == (85, 1)
+
+
+def test_resize_to_fit_shrinks_what_quality_alone_cannot(busy_canvas):
+    at_min, _ = encode_map(busy_canvas, RenderParams(quality=40))
+    budget = len(at_min) // 2
+    data, encoding = encode_map(busy_canvas, RenderParams(max_bytes=budget))
+    assert not encoding.fits and len(data) == len(at_min)
+
+    data, encoding = encode_map(
+        busy_canvas, RenderParams(max_bytes=budget, resize_to_fit=True)
+    )
+    assert encoding.fits
+    assert len(data) <= budget
+    assert Image.open(io.BytesIO(data)).size == (encoding.width, encoding.height)
+    assert encoding.width < busy_canvas.width
+    assert encoding.num_encodes <= MAX_ENCODES
+
+
+def test_overlay_pixels_sit_on_the_drawn_tiles(july1_track):
+    overlay = map_render.TrackOverlay(july1_track)
+    center = s2sphere.LatLng.from_degrees(47.6, -122.3)
+    for zoom in (3, 14):
+        trans = staticmaps.Transformer(1200, 800, zoom, center, 512)
+        size = trans.tile_size()
+        x, y = overlay.pixels(trans, off=trans.world_width(), x0=10, y0=20)
+        expected = [(s.lat, s.lon) for s in july1_track.stays]
+        for link in july1_track.links:
+            expected += [(link.start_lat, link.start_lon), (link.end_lat, link.end_lon)]
+        assert len(x) == len(expected)
+        for (lat, lon), px, py in zip(expected, x.tolist(), y.tolist()):
+            latlng = s2sphere.LatLng.from_degrees(lat, lon)
+            tx, ty = trans.ll2t(latlng)
+            # where the renderer pastes the tile under the point
+            ex = trans.tile_offset_x() + (tx - trans.first_tile_x()) * size
+            ey = trans.tile_offset_y() + (ty - trans.first_tile_y()) * size
+            assert (px, py) == pytest.approx(
+                (ex + trans.world_width() - 10, ey - 20), abs=1e-6
+            )
+            # and within the pixel ll2pixel's unrounded tile offset is off it
+            lx, ly = trans.ll2pixel(latlng)
+            assert abs(px - (lx + trans.world_width() - 10)) < 1
+            assert abs(py - (ly - 20)) < 1
@@ -0,0 +1,185 @@
+from datetime import date
+
+import pendulum
+import pytest
+from sqlmodel import select
+
+from mydiary.models import (
+    OwnTracksDaySummary,
+    OwnTracksLocation,
+    OwnTracksPlace,
+    OwnTracksPlaceVisit,
+)
+from mydiary.owntracks_cache import processed_day
+from mydiary.owntracks_stats import period_stats
+from mydiary.owntracks_track import TrackParams
+
+from .helpers import TZ, load_fixture
+
+DAY = pendulum.datetime(2026, 7, 1, tz=TZ)
+
+
+@pytest.fixture
+def db_day(rootdir, db_session):
+    seen = set()
+    for p in load_fixture(rootdir, "owntracks_2026-07-01.json"):
+        if p.tst in seen:
+            continue
+        seen.add(p.tst)
+        db_session.add(
+            OwnTracksLocation(
+                tst=p.tst.in_timezone("UTC"),
+                lat=p.lat,
+                lon=p.lon,
+                acc=p.acc,
+                motion=p.motion,
+                username="u",
+                device="d",
+            )
+        )
+    db_session.commit()
+    return db_session
+
+
+def test_building_a_day_summarizes_it(db_day):
+    track, areas = processed_day(DAY, db_day)
+    row = db_day.exec(select(OwnTracksDaySummary)).one()
+    assert row.diary_date == date(2026, 7, 1)
+    assert row.timezone == TZ
+    assert row.distance_m == track.distance_m > 0
+    assert row.num_stays == len(track.stays) > 0
+    assert row.num_areas == (len(areas) or 1)
+    assert (row.min_lat, row.min_lon, row.max_lat, row.max_lon) == track.bounds()
+    # moving and stopped never add up to more than the day
+    assert 0 < row.moving_minutes
+    assert row.moving_minutes + row.stay_minutes <= 24 * 60
+
+
+def test_other_params_leave_the_summary_alone(db_day):
+    processed_day(DAY, db_day, TrackParams(stay_minutes=5))
+    assert db_day.exec(select(OwnTracksDaySummary)).all() == []
+
+
+def test_a_day_that_gained_fixes_is_listed_as_stale(db_day):
+    processed_day(DAY, db_day)
+    [week] = period_stats(db_day, by="week")
+    assert week["stale_days"] == []
+
+    db_day.add(
+        OwnTracksLocation(
+            tst=DAY.add(hours=23, minutes=50).in_timezone("UTC"),
+            lat=47.6,
+            lon=-122.3,
+            acc=10,
+            username="u",
+            device="d",
+        )
+    )
+    db_day.commit()
+    [week] = period_stats(db_day, by="week")
+    assert week["stale_days"] == [date(2026, 7, 1)]
+
+    processed_day(DAY, db_day)
+    [week] = period_stats(db_day, by="week")
+    assert week["stale_days"] == []
+
+
+def add_day(session, d, distance_m, num_stays=2, lat=47.6, lon=-122.3):
+    session.add(
+        OwnTracksDaySummary(
+            diary_date=d,
+            timezone=TZ,
+            version="1|0:0",
+            num_fixes=100,
+            distance_m=distance_m,
+            num_stays=num_stays,
+            stay_minutes=600.0,
+            moving_minutes=60.0,
+            num_areas=1,
+            min_lat=lat,
+            min_lon=lon,
+            max_lat=lat + 0.01,
+            max_lon=lon + 0.01,
+            updated_at=pendulum.now(tz="UTC"),
+        )
+    )
+
+
+def add_visit(session, place, d, minutes):
+    t = pendulum.datetime(d.year, d.month, d.day, 12)
+    session.add(
+        OwnTracksPlaceVisit(
+            place_id=place.id,
+            diary_date=d,
+            t_start=t,
+            t_end=t.add(minutes=minutes),
+            minutes=minutes,
+        )
+    )
+
+
+@pytest.fixture
+def summaries(db_session):
+    # Sunday 2026-06-28 ends one week; Monday 2026-06-29 to Wednesday
+    # 2026-07-01 spans the month boundary inside the next
+    for d, distance_m in [
+        (date(2026, 6, 28), 1000.0),
+        (date(2026, 6, 29), 2000.0),
+        (date(2026, 6, 30), 4000.0),
+        (date(2026, 7, 1), 8000.0),
+    ]:
+        add_day(db_session, d, distance_m)
+    add_day(db_session, date(2025, 12, 31), 500.0, lat=51.5, lon=-0.1)
+    db_session.commit()
+    return db_session
+
+
+def test_weeks_start_on_monday(summaries):
+    periods = period_stats(summaries, by="week", start=date(2026, 1, 1))
+    assert [p["start"] for p in periods] == [date(2026, 6, 22), date(2026, 6, 29)]
+    assert [p["num_days"] for p in periods] == [1, 3]
+    assert [p["distance_m"] for p in periods] == [1000.0, 14000.0]
+    assert periods[1]["max_day_distance_m"] == 8000.0
+    assert periods[1]["num_stays"] == 6
+    assert periods[1]["moving_minutes"] == 180.0
+
+
+def test_months_and_years(summaries):
+    months = period_stats(summaries, by="month")
+    assert [(p["start"], p["distance_m"]) for p in months] == [
+        (date(2025, 12, 1), 500.0),
+        (date(2026, 6, 1), 7000.0),
+        (date(2026, 7, 1), 8000.0),
+    ]
+    years = period_stats(summaries, by="year", end=date(2026, 6, 30))
+    assert [(p["start"], p["num_days"]) for p in years] == [
+        (date(2025, 1, 1), 1),
+        (date(2026, 1, 1), 3),
+    ]
+    assert years[0]["bounds"] == pytest.approx((51.5, -0.1, 51.51, -0.09))
+
+
+def test_each_period_lists_its_top_places(summaries):
+    home = OwnTracksPlace(name="Home", lat=47.6, lon=-122.3, created_at=pendulum.now())
+    gym = OwnTracksPlace(lat=47.62, lon=-122.31, created_at=pendulum.now())
+    summaries.add_all([home, gym])
+    summaries.commit()
+    add_visit(summaries, home, date(2026, 6, 29), 600.0)
+    add_visit(summaries, gym, date(2026, 6, 30), 90.0)
+    add_visit(summaries, gym, date(2026, 7, 1), 90.0)
+    add_visit(summaries, gym, date(2026, 6, 28), 45.0)
+    summaries.commit()
+
+    weeks = period_stats(summaries, by="week", start=date(2026, 6, 22))
+    assert weeks[0]["places"] == [{"place_id": gym.id, "name": None, "minutes": 45.0}]
+    assert [(p["name"], p["minutes"]) for p in weeks[1]["places"]] == [
+        ("Home", 600.0),
+        (None, 180.0),
+    ]
+    [week] = period_stats(summaries, by="week", start=date(2026, 6, 29), num_places=1)
+    assert [p["name"] for p in week["places"]] == ["Home"]
+
+
+def test_an_unknown_period_is_an_error(summaries):
+    with pytest.raises(ValueError):
+        period_stats(summaries, by="fortnight")
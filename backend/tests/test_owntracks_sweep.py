@@ -0,0 +1,74 @@
+from datetime import date
+
+import pytest
+
+from mydiary.owntracks_columns import TrackColumns, build_track
+from mydiary.owntracks_sweep import evaluate_day, param_grid, sweep
+from mydiary.owntracks_track import TrackParams, split_into_areas
+
+from .helpers import load_fixture, synthetic_day
+
+
+def test_the_grid_is_every_combination_over_the_defaults():
+    grid = param_grid(stay_radius_m=[100.0, 150.0], stay_minutes=[10.0, 20.0, 30.0])
+    assert len(grid) == len(set(grid)) == 6
+    assert {p.stay_radius_m for p in grid} == {100.0, 150.0}
+    assert all(p.max_acc == TrackParams().max_acc for p in grid)
+    assert param_grid() == [TrackParams()]
+    with pytest.raises(ValueError):
+        param_grid(stay_radius=[100.0])
+
+
+def test_a_day_comes_out_as_build_track_makes_it(rootdir):
+    cols = TrackColumns.from_points(load_fixture(rootdir, "owntracks_2026-06-27.json"))
+    params = [TrackParams(), TrackParams(stay_minutes=5)]
+    outcomes = evaluate_day(cols, params, hash_params=TrackParams())
+    for p, outcome in zip(params, outcomes):
+        track = build_track(cols, p)
+        assert outcome.num_stays == len(track.stays)
+        assert outcome.num_dropped == track.num_dropped
+        assert outcome.num_uncertain == sum(x.uncertain for x in track.links)
+        assert outcome.num_areas == len(split_into_areas(track))
+    assert outcomes[0].drawn_hash == build_track(cols, params[0]).content_hash(
+        TrackParams()
+    )
+
+
+def days():
+    for seed in range(6):
+        yield date(2026, 7, 1 + seed), TrackColumns.from_points(synthetic_day(seed))
+
+
+def test_a_process_pool_gives_the_in_process_answer():
+    grid = param_grid(stay_minutes=[10.0, 30.0], dwell_max_kmh=[0.5, 2.0])
+    inline = sweep(days(), grid, workers=1)
+    pooled = sweep(days(), grid, workers=2)
+    assert pooled.days == inline.days == [d for d, _ in days()]
+    assert pooled.outcomes == inline.outcomes
+    assert pooled.report() == inline.report()
+
+
+def test_the_report_lists_the_days_a_set_would_redraw():
+    result = sweep(days(), param_grid(stay_minutes=[20.0, 5.0]), workers=1)
+    # the default is already in the grid, so it is not added again
+    assert result.param_sets == [TrackParams(), TrackParams(stay_minutes=5.0)]
+    baseline, shorter = result.report()
+    assert baseline["baseline"] and not shorter["baseline"]
+    assert baseline["changed_days"] == []
+    assert shorter["changed_days"]
+    assert shorter["num_stays"]["mean"] >= baseline["num_stays"]["mean"]
+    assert baseline["num_days"] == 6
+    assert set(baseline["num_dropped"]) == {
+        "mean",
+        "min",
+        "p10",
+        "median",
+        "p90",
+        "max",
+    }
+
+
+def test_the_baseline_is_added_to_the_grid():
+    result = sweep(days(), [TrackParams(max_acc=50)], workers=1)
+    assert result.param_sets[0] == TrackParams()
+    assert result.report()[0]["baseline"]
@@ -1,4 +1,6 @@
 import json
+import math
+import random
 from pathlib import Path
 
 import pendulum
@@ -196,6 +198,32 @@ def test_build_track_summary(july1):
     assert summary_label(track) == "3.2 km · 3 stops"
 
 
+@pytest.mark.parametrize("tz", [TZ, "UTC", "Europe/Brussels"])
+def test_points_from_rows_matches_points_from_locations(tz):
+    # across the autumn change, so an hour of local times happens twice and
+    # only fold tells them apart
+    from datetime import datetime, timedelta
+    from types import SimpleNamespace
+
+    from mydiary.owntracks_track import points_from_locations, points_from_rows
+
+    start = datetime(2026, 10, 25, 0, 0)  # naive UTC, as sqlite returns it
+    rows = [
+        (start + timedelta(minutes=7 * i), 33.5 + i * 1e-4, -42.0, 10, None)
+        for i in range(2 * 24 * 60 // 7)
+    ]
+    rows[5] = (rows[5][0], rows[5][1], rows[5][2], None, "walking")
+    locations = [
+        SimpleNamespace(tst=t, lat=a, lon=o, acc=c, motion=m) for t, a, o, c, m in rows
+    ]
+    expected = points_from_locations(locations, timezone=tz)
+    points = points_from_rows(rows, timezone=tz)
+    assert points == expected
+    assert [str(p.tst) for p in points] == [str(p.tst) for p in expected]
+    assert [p.tst.fold for p in points] == [p.tst.fold for p in expected]
+    assert all(type(p.tst) is type(q.tst) for p, q in zip(points, expected))
+
+
 def test_build_track_empty_input():
     track = build_track([])
     assert track.is_empty()
@@ -254,6 +282,76 @@ def test_geojson_empty_day():
     assert gj["properties"]["num_stays"] == 0
 
 
+def _segment_distance_m(p, a, b):
+    """Distance from p to segment ab, all (lat, lon), in local metres."""
+    k = 111194.9
+    kx = k * math.cos(math.radians(a[0]))
+    px, py = (p[1] - a[1]) * kx, (p[0] - a[0]) * k
+    dx, dy = (b[1] - a[1]) * kx, (b[0] - a[0]) * k
+    seg2 = dx * dx + dy * dy
+    t = max(0.0, min(1.0, (px * dx + py * dy) / seg2)) if seg2 else 0.0
+    return math.hypot(px - t * dx, py - t * dy)
+
+
+def test_simplify_line_keeps_dropped_vertices_within_tolerance():
+    from mydiary.owntracks_track import simplify_line
+
+    rng = random.Random(0)
+    coords = [(47.6, -122.3)]
+    for _ in range(500):
+        lat, lon = coords[-1]
+        coords.append((lat + rng.gauss(0, 0.001), lon + rng.gauss(0.001, 0.001)))
+    for tolerance in (1.0, 20.0, 300.0):
+        simplified = simplify_line(coords, tolerance)
+        assert simplified[0] == coords[0] and simplified[-1] == coords[-1]
+        assert set(simplified) <= set(coords)
+        kept = [coords.index(c) for c in simplified]
+        for a, b in zip(kept, kept[1:]):
+            for i in range(a + 1, b):
+                d = _segment_distance_m(coords[i], coords[a], coords[b])
+                assert d <= tolerance * 1.001
+    assert len(simplify_line(coords, 300.0)) < len(simplify_line(coords, 1.0))
+    # an out-and-back is not a straight line to where it started
+    there_and_back = [(47.6, -122.3), (47.7, -122.3), (47.6, -122.3)]
+    assert simplify_line(there_and_back, 1.0) == there_and_back
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_zoomed_geojson_merges_links_that_draw_alike(seed):
+    from mydiary.owntracks_track import zoom_tolerance_m
+
+    from .helpers import synthetic_day
+
+    track = build_track(synthetic_day(seed), TrackParams())
+    full = track_to_geojson(track)
+    assert track_to_geojson(track, zoom=None) == full
+    full_links = [f for f in full["features"] if f["properties"]["kind"] == "link"]
+    full_stays = [f for f in full["features"] if f["properties"]["kind"] == "stay"]
+    vertices = {tuple(c) for f in full_links for c in f["geometry"]["coordinates"]}
+
+    sizes = []
+    for zoom in (6, 12, 18):
+        gj = track_to_geojson(track, zoom=zoom)
+        links = [f for f in gj["features"] if f["properties"]["kind"] == "link"]
+        assert [f for f in gj["features"] if f["properties"]["kind"] == "stay"] == (
+            full_stays
+        )
+        assert sum(f["properties"]["num_links"] for f in links) == len(full_links)
+        assert sum(f["properties"]["distance_m"] for f in links) == pytest.approx(
+            sum(f["properties"]["distance_m"] for f in full_links), abs=len(links)
+        )
+        first, last = links[0]["properties"], links[-1]["properties"]
+        assert first["t_start"] == full_links[0]["properties"]["t_start"]
+        assert last["t_end"] == full_links[-1]["properties"]["t_end"]
+        for f in links:
+            coords = [tuple(c) for c in f["geometry"]["coordinates"]]
+            assert set(coords) <= vertices
+        sizes.append(sum(len(f["geometry"]["coordinates"]) for f in links))
+    assert len(links) < len(full_links)
+    assert sizes == sorted(sizes)
+    assert zoom_tolerance_m(12, 0.0) == pytest.approx(38.2, abs=0.1)
+
+
 def test_merge_stays_folds_overlapping_stays_in_one_place():
     from mydiary.owntracks_track import Stay, merge_stays
 
@@ -451,6 +549,98 @@ def test_cluster_stays_links_through_an_intermediate_stay():
     assert len(cluster_stays(stays, threshold_m=5_000)) == 3
 
 
+def _quadratic_cluster_stays(stays, threshold_m):
+    """cluster_stays as it was before the grid: every stay against every member."""
+    clusters = []
+    for stay in stays:
+        joined = [
+            i
+            for i, cluster in enumerate(clusters)
+            if any(
+                haversine_m(stay.lat, stay.lon, other.lat, other.lon) <= threshold_m
+                for other in cluster
+            )
+        ]
+        if not joined:
+            clusters.append([stay])
+            continue
+        first = joined[0]
+        clusters[first].append(stay)
+        for i in reversed(joined[1:]):
+            clusters[first].extend(clusters.pop(i))
+    return clusters
+
+
+def _quadratic_nearest_cluster(lat, lon, clusters, threshold_m):
+    best_i, best_d = None, float("inf")
+    for i, cluster in enumerate(clusters):
+        d = min(haversine_m(lat, lon, s.lat, s.lon) for s in cluster)
+        if d < best_d:
+            best_i, best_d = i, d
+    return best_i if best_d <= threshold_m else None
+
+
+def _scattered_stays(seed, n, centres):
+    import random
+
+    rng = random.Random(seed)
+    base = pendulum.datetime(2026, 7, 1, tz=TZ)
+    stays = []
+    for i in range(n):
+        lat, lon = rng.choice(centres)
+        lat = max(-90.0, min(90.0, lat + rng.gauss(0, 0.3)))
+        lon = (lon + rng.gauss(0, 0.3) + 180.0) % 360.0 - 180.0
+        stays.append(_stay(lat, lon, base.add(minutes=i)))
+    return stays
+
+
+# a city, a scatter across the antimeridian, and one close to the pole
+CENTRES = [(HOME_LAT, HOME_LON), (-17.7, 179.9), (89.6, 10.0)]
+
+
+@pytest.mark.parametrize("threshold_m", [0, 5_000, 20_000, 60_000, 3e7])
+@pytest.mark.parametrize("seed", range(4))
+def test_cluster_stays_matches_the_quadratic_version(seed, threshold_m):
+    # same clusters, same member order, same cluster order: split_into_areas
+    # numbers the panels from this, and the panel hashes depend on it
+    from mydiary.owntracks_track import cluster_stays
+
+    stays = _scattered_stays(seed, 300, CENTRES)
+    stays += stays[:5]  # exact repeats sit at distance 0
+    assert cluster_stays(stays, threshold_m) == _quadratic_cluster_stays(
+        stays, threshold_m
+    )
+
+
+def test_cluster_stays_keeps_a_stay_exactly_at_the_threshold():
+    from mydiary.owntracks_track import cluster_stays
+
+    base = pendulum.datetime(2026, 7, 1, 9, tz=TZ)
+    a = _stay(HOME_LAT, HOME_LON, base)
+    b = _stay(HOME_LAT + 0.15, HOME_LON + 0.07, base.add(hours=3))
+    d = haversine_m(b.lat, b.lon, a.lat, a.lon)
+    assert len(cluster_stays([a, b], threshold_m=d)) == 1
+    assert len(cluster_stays([a, b], threshold_m=d * (1 - 1e-12))) == 2
+
+
+@pytest.mark.parametrize("threshold_m", [5_000, 20_000])
+def test_nearest_cluster_matches_the_quadratic_version(threshold_m):
+    import random
+
+    from mydiary.owntracks_track import _ClusterIndex, _nearest_cluster, cluster_stays
+
+    clusters = cluster_stays(_scattered_stays(11, 300, CENTRES), threshold_m)
+    index = _ClusterIndex(clusters, threshold_m)
+    rng = random.Random(3)
+    for _ in range(300):
+        lat, lon = rng.choice(CENTRES)
+        lat = max(-90.0, min(90.0, lat + rng.gauss(0, 0.5)))
+        lon = (lon + rng.gauss(0, 0.5) + 180.0) % 360.0 - 180.0
+        expected = _quadratic_nearest_cluster(lat, lon, clusters, threshold_m)
+        assert index.nearest(lat, lon) == expected
+        assert _nearest_cluster(lat, lon, clusters, threshold_m) == expected
+
+
 def test_a_long_haul_with_stays_at_only_one_end_still_gets_a_panel():
     # the shape of a real flight day: setting off, the airport and the flight
     # are all transit, so every stay is at the far end. Counting areas alone
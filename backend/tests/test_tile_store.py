@@ -0,0 +1,118 @@
+import sqlite3
+import time
+
+import pytest
+
+from mydiary import tile_store
+from mydiary.tile_store import TileStore, get_store, import_loose
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = TileStore(tmp_path / "tiles.mbtiles", max_bytes=1000)
+    yield s
+    s.close()
+
+
+def test_a_tile_round_trips_under_mbtiles_row_numbering(store, tmp_path):
+    store.put("basemap", 3, 1, 2, b"png")
+    assert store.get("basemap", 3, 1, 2) == b"png"
+    assert store.get("labels", 3, 1, 2) is None
+    assert store.has("basemap", 3, 1, 2) and not store.has("basemap", 3, 1, 3)
+    row = sqlite3.connect(tmp_path / "tiles.mbtiles").execute(
+        "SELECT zoom_level, tile_column, tile_row FROM tiles"
+    )
+    assert row.fetchall() == [(3, 1, 5)]  # 2**3 - 1 - 2
+
+
+def test_the_size_is_tracked_across_replacements_and_reopening(store, tmp_path):
+    store.put("basemap", 1, 0, 0, b"x" * 100)
+    store.put("basemap", 1, 0, 0, b"x" * 40)
+    store.put("basemap", 1, 1, 0, b"x" * 10)
+    assert store.num_bytes == 50
+    store.close()
+    again = TileStore(tmp_path / "tiles.mbtiles", max_bytes=1000)
+    assert again.num_bytes == 50
+    again.close()
+
+
+def test_eviction_drops_the_least_recently_read(store, monkeypatch):
+    clock = iter(range(1000, 2000))
+    monkeypatch.setattr(tile_store.time, "time", lambda: next(clock))
+    monkeypatch.setattr(store, "_evict_in_background", lambda: None)
+    for x in range(4):
+        store.put("basemap", 5, x, 0, b"x" * 200)
+    assert store.get("basemap", 5, 0, 0)  # the oldest write, but read since
+    evicted = store.evict(target_bytes=400)
+    assert evicted == 2
+    assert [store.has("basemap", 5, x, 0) for x in range(4)] == [
+        True,
+        False,
+        False,
+        True,
+    ]
+    assert store.num_bytes == 400
+
+
+def test_going_over_the_cap_evicts_in_the_background(store):
+    for x in range(8):
+        store.put("basemap", 5, x, 0, b"x" * 200)
+    for _ in range(100):
+        if store.num_bytes <= store.max_bytes:
+            break
+        time.sleep(0.01)
+    assert store.num_bytes <= 900  # LOW_WATER of the cap
+    assert store.stats()["num_tiles"] == store.num_bytes // 200
+
+
+def test_the_loose_cache_imports(tmp_path):
+    loose = tmp_path / "map_tiles"
+    tiles = [("carto-x", 4, 3, 5), ("carto-x", 4, 3, 6), ("other", 2, 1, 1)]
+    for slug, z, x, y in tiles:
+        path = loose / slug / str(z) / str(x)
+        path.mkdir(parents=True, exist_ok=True)
+        (path / f"{y}.png").write_bytes(f"{slug}{z}{x}{y}".encode())
+    (loose / "notes.txt").write_text("not a tile")
+    store = get_store(loose)
+    assert import_loose(store, loose, {"carto-x": "Carto X"}, delete=True) == 3
+    assert store.get("Carto X", 4, 3, 6) == b"carto-x436"
+    assert store.get("other", 2, 1, 1) == b"other211"
+    assert sorted(p.name for p in loose.iterdir()) == [
+        "notes.txt",
+        "tiles.mbtiles",
+        "tiles.mbtiles-shm",
+        "tiles.mbtiles-wal",
+    ]
+
+
+def test_processes_sharing_the_file_wait_for_each_other(tmp_path):
+    import threading
+
+    path = tmp_path / "tiles.mbtiles"
+    stores = [TileStore(path, max_bytes=10**9) for _ in range(2)]
+    errors = []
+
+    def write(store, provider):
+        try:
+            for x in range(200):
+                store.get(provider, 9, x, 0)
+                store.put(provider, 9, x, 0, b"x" * 10)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [
+        threading.Thread(target=write, args=(s, name))
+        for s, name in zip(stores, ["basemap", "labels"])
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    # each counted its own writes; eviction counts everyone's
+    assert [s.num_bytes for s in stores] == [2000, 2000]
+    stores[0].evict(target_bytes=3000)
+    assert stores[0].num_bytes == 3000
+    assert stores[1].stats()["num_tiles"] == 300
+    for s in stores:
+        s.close()
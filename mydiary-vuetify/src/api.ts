@@ -388,6 +388,7 @@ url: string;
 
 export type OwntracksLocationsForDayParams = {
 tz?: string;
+fmt?: string | null;
 };
 
 export type OwntracksTrackForDayParams = {
@@ -399,6 +400,8 @@ stay_minutes?: number;
 gap_minutes?: number;
 gap_metres?: number;
 dwell_max_kmh?: number;
+zoom?: number | null;
+fmt?: string | null;
 };
 
 export type OwntracksDayMapImageParams = {